@@ -0,0 +1,68 @@
+"""Requests of the read-only API, through the whole application."""
+import datetime
+
+from infolica.services.lineage import lineage
+
+# ids in every dataset scale (10 at scale 0.001)
+AFFAIRE_ID = 7
+NUMERO_ID = 3
+
+
+def test_affaires_first_page(benchmark, app):
+    response = benchmark(app.get, '/api/affaires?limit=100')
+    assert len(response.json['affaires']) == 100
+
+
+def test_affaires_deep_page(benchmark, app):
+    # the last page of the listing, reached by its keyset cursor
+    cursor = app.get('/api/affaires?limit=1&order=desc').json['next']
+    url = '/api/affaires?limit=100&cursor=%s' % cursor
+    benchmark(app.get, url)
+
+
+def test_affaires_filtered(benchmark, app):
+    response = benchmark(
+        app.get, '/api/affaires?limit=100&cadastre_id=1,2&cloture=false')
+    assert all(a['cadastre_id'] in (1, 2)
+               for a in response.json['affaires'])
+
+
+def test_affaire_full(benchmark, app):
+    response = benchmark(app.get, '/api/affaires/%d/full' % AFFAIRE_ID)
+    assert response.json['id'] == AFFAIRE_ID
+
+
+def test_affaires_bbox(benchmark, app):
+    # the spatial index is loaded by the first spatial request
+    app.get('/api/affaires/bbox?bbox=0,0,0,0')
+    benchmark(app.get,
+              '/api/affaires/bbox?bbox=2540000,1190000,2550000,1200000')
+
+
+def test_affaires_radius(benchmark, app):
+    app.get('/api/affaires/bbox?bbox=0,0,0,0')
+    benchmark(app.get, '/api/affaires/radius?e=2550000&n=1205000&r=2000')
+
+
+def test_clients_recherche(benchmark, app):
+    response = benchmark(app.get, '/api/clients/recherche?q=dub&limit=20')
+    assert response.status_int == 200
+
+
+def test_numero_lineage(benchmark, app, session_factory):
+    # without the lineage cache, the recursive query itself
+    session = session_factory()
+    try:
+        benchmark(lineage, session, NUMERO_ID, 'both', None)
+    finally:
+        session.close()
+
+
+def test_tarifs(benchmark, app):
+    response = benchmark(app.get, '/api/tarifs?date=%s' % (
+        datetime.date(2015, 6, 1).isoformat()))
+    assert response.json['mo'] is not None
+
+
+def test_affaires_statuts(benchmark, app):
+    benchmark(app.get, '/api/affaires/statuts?cadastre_id=3')
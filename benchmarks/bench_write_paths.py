@@ -0,0 +1,40 @@
+"""
+Writes of the services, each round in a transaction rolled back after
+it so every round starts from the generated dataset.
+
+"""
+import datetime
+
+from infolica import models
+from infolica.services.facturation import facturer_affaires_dues
+from infolica.services.numeros import reserve_numeros
+
+AFFAIRE_ID = 7
+ROUNDS = 50
+
+
+def test_reserve_numeros(benchmark, rolled_back):
+    setup, teardown = rolled_back
+    benchmark.pedantic(
+        lambda session: reserve_numeros(session, 1, 1, 50, 1),
+        setup=setup, teardown=teardown, rounds=ROUNDS)
+
+
+def test_facturer_affaires_dues(benchmark, rolled_back):
+    setup, teardown = rolled_back
+    count = benchmark.pedantic(
+        facturer_affaires_dues, setup=setup, teardown=teardown,
+        rounds=ROUNDS)
+    assert count > 0
+
+
+def test_ajouter_etape(benchmark, rolled_back):
+    # the ORM insert, maintaining the current status on flush
+    def ajouter_etape(session):
+        session.add(models.EtapeAffaire(
+            affaire_id=AFFAIRE_ID, statut_id=2, date=datetime.date.today()))
+        session.flush()
+
+    setup, teardown = rolled_back
+    benchmark.pedantic(ajouter_etape, setup=setup, teardown=teardown,
+                       rounds=ROUNDS)
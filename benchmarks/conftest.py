@@ -0,0 +1,88 @@
+import glob
+import os
+import warnings
+
+import pytest
+from pytest_benchmark.utils import get_machine_id
+
+from infolica import main, models
+from infolica.models.meta import Base
+from infolica.scripts.generate_data import generate
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--dataset-scale', type=float, default=1.0,
+        help='Scale of the generated dataset, see generate_infolica_data',
+    )
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    # baselines are per platform: without one there is nothing to fail on
+    storage = config.getoption('benchmark_storage')
+    if storage.startswith('file://'):
+        storage = storage[len('file://'):]
+    path = os.path.join(config.rootdir.strpath, storage, get_machine_id())
+    if config.getoption('benchmark_compare_fail') and \
+            not glob.glob(os.path.join(path, '*.json')):
+        warnings.warn('no baseline in %s, not comparing' % path)
+        config.option.benchmark_compare = False
+        config.option.benchmark_compare_fail = None
+
+
+@pytest.fixture(scope='session')
+def database_url(request, tmp_path_factory):
+    """A SQLite file filled by the dataset generator."""
+    directory = str(tmp_path_factory.mktemp('data'))
+    url = 'sqlite:///%s' % os.path.join(directory, 'infolica.sqlite')
+    engine = models.get_engine({'sqlalchemy.url': url})
+    Base.metadata.create_all(engine)
+    session = models.get_session_factory(engine)()
+    generate(session, scale=request.config.getoption('dataset_scale'),
+             report=lambda line: None)
+    session.commit()
+    session.close()
+    engine.dispose()
+    return url
+
+
+@pytest.fixture(scope='session')
+def app(database_url):
+    from webtest import TestApp
+
+    # the response cache would time the cache instead of the path
+    return TestApp(main({}, **{
+        'sqlalchemy.url': database_url,
+        'response_cache.enabled': 'false',
+    }))
+
+
+@pytest.fixture(scope='session')
+def session_factory(app):
+    return app.app.registry['dbsession_factory']
+
+
+@pytest.fixture
+def rolled_back(session_factory):
+    """
+    ``(setup, teardown)`` for ``benchmark.pedantic``: each round runs in
+    a new session whose changes are rolled back.
+
+    """
+    sessions = []
+
+    def setup():
+        sessions.append(session_factory())
+        return (sessions[-1],), {}
+
+    def teardown(session):
+        session.rollback()
+        session.close()
+
+    yield setup, teardown
+    # pytest-benchmark skips the teardown under --benchmark-disable, an
+    # open session would keep the database locked for the next test
+    for session in sessions:
+        session.rollback()
+        session.close()
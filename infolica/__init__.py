@@ -6,7 +6,23 @@ def main(global_config, **settings):
     """
     with Configurator(settings=settings) as config:
         config.include('.models')
+        config.include('.services.spatial')
+        config.include('.services.lineage')
+        config.include('.services.tarifs')
+        config.include('.services.search')
+        config.include('.services.detail')
+        config.include('.services.response_cache')
+        config.include('.services.instrumentation')
+        config.include('.services.slow_queries')
+        config.include('.services.jobs')
+        config.include('.services.documents')
+        config.include('.services.preavis')
         config.include('pyramid_mako')
         config.include('.routes')
         config.scan()
+
+        # load the in-memory caches before serving the first request
+        registry = config.registry
+        registry['lookup_cache'].warm(registry['dbsession_factory'])
+        registry['tarifs'].warm(registry['dbsession_factory'])
     return config.make_wsgi_app()
@@ -0,0 +1,65 @@
+"""invoicing amounts
+
+Revision ID: 1deebb619937
+Revises: 3ac1e2166b75
+Create Date: 2026-10-18 22:07:30.402518
+
+The affaire of existing invoices and fees is unknown, their affaire_id
+columns stay nullable in the database.  Amounts start at 0.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1deebb619937'
+down_revision = '3ac1e2166b75'
+branch_labels = None
+depends_on = None
+
+
+def _amount(name):
+    return sa.Column(name, sa.Float(), nullable=False, server_default='0')
+
+
+# table, columns, affaire_id index
+COLUMNS = [
+    ('facture', [sa.Column('affaire_id', sa.Integer()),
+                 _amount('montant_tva')], 'ix_facture_affaire_id'),
+    ('emoluments_mo', [sa.Column('affaire_id', sa.Integer()),
+                       _amount('montant'), _amount('montant_mat_diff')],
+     'ix_emoluments_mo_affaire_id'),
+    ('emoluments_rf', [_amount('montant')], None),
+]
+
+
+def _schema():
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else 'facture'
+
+
+def upgrade():
+    schema = _schema()
+    for table, columns, index in COLUMNS:
+        for column in columns:
+            op.add_column(table, column.copy(), schema=schema)
+        if index is None:
+            continue
+        # SQLite cannot add a constraint to an existing table
+        if schema is not None:
+            op.create_foreign_key(
+                'fk_%s_affaire_id_affaire' % table, table, 'affaire',
+                ['affaire_id'], ['id'], source_schema=schema,
+                referent_schema='affaire')
+        op.create_index(index, table, ['affaire_id'], schema=schema)
+
+
+def downgrade():
+    schema = _schema()
+    for table, columns, index in reversed(COLUMNS):
+        if index is not None:
+            op.drop_index(index, table, schema=schema)
+        with op.batch_alter_table(table, schema=schema) as batch:
+            for column in reversed(columns):
+                batch.drop_column(column.name)
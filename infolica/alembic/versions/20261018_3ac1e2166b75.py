@@ -0,0 +1,50 @@
+"""affaire hierarchy closure table
+
+Revision ID: 3ac1e2166b75
+Revises: e1735053725b
+Create Date: 2026-10-18 22:06:47.615832
+
+The closure table is filled by rebuild_infolica --only
+modification_affaire_hierarchie.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3ac1e2166b75'
+down_revision = 'e1735053725b'
+branch_labels = None
+depends_on = None
+
+
+def _schema(name):
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else name
+
+
+def _foreign_key(schema, column):
+    schema = _schema(schema)
+    return sa.ForeignKey(schema + '.' + column if schema else column)
+
+
+def upgrade():
+    schema = _schema('affaire')
+    op.create_table(
+        'modification_affaire_hierarchie',
+        sa.Column('affaire_id_ancetre', sa.Integer(), _foreign_key(
+            'affaire', 'affaire.id'), primary_key=True),
+        sa.Column('affaire_id_descendant', sa.Integer(), _foreign_key(
+            'affaire', 'affaire.id'), primary_key=True),
+        sa.Column('profondeur', sa.Integer(), nullable=False),
+        schema=schema,
+    )
+    op.create_index('ix_modification_affaire_hierarchie_affaire_id_descendant',
+                    'modification_affaire_hierarchie',
+                    ['affaire_id_descendant'], schema=schema)
+
+
+def downgrade():
+    schema = _schema('affaire')
+    op.drop_table('modification_affaire_hierarchie', schema=schema)
@@ -0,0 +1,36 @@
+"""import checkpoints
+
+Revision ID: 3b9e6c1d7a20
+Revises: fd84510c62a4
+Create Date: 2026-10-18 16:20:05.114873
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b9e6c1d7a20'
+down_revision = 'fd84510c62a4'
+branch_labels = None
+depends_on = None
+
+
+def _schema():
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else 'general'
+
+
+def upgrade():
+    schema = _schema()
+    op.create_table(
+        'import_checkpoint',
+        sa.Column('source', sa.Text(), primary_key=True),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('updated', sa.DateTime(), nullable=False),
+        schema=schema,
+    )
+
+
+def downgrade():
+    op.drop_table('import_checkpoint', schema=_schema())
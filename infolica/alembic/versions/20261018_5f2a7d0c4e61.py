@@ -0,0 +1,44 @@
+"""document store
+
+Revision ID: 5f2a7d0c4e61
+Revises: 8c41f2e5b9d3
+Create Date: 2026-10-18 18:12:09.114562
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f2a7d0c4e61'
+down_revision = '8c41f2e5b9d3'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ('nom', sa.Text()),
+    ('type_contenu', sa.Text()),
+    ('taille', sa.BigInteger()),
+    ('sha256', sa.Text()),
+]
+
+
+def _schema():
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else 'document'
+
+
+def upgrade():
+    schema = _schema()
+    for name, type_ in COLUMNS:
+        op.add_column('document', sa.Column(name, type_), schema=schema)
+    op.create_index('ix_document_sha256', 'document', ['sha256'],
+                    schema=schema)
+
+
+def downgrade():
+    schema = _schema()
+    op.drop_index('ix_document_sha256', 'document', schema=schema)
+    with op.batch_alter_table('document', schema=schema) as batch:
+        for name, type_ in reversed(COLUMNS):
+            batch.drop_column(name)
@@ -0,0 +1,52 @@
+"""current status of affaires
+
+Revision ID: 613eb1dae193
+Revises: e4b8a1f39c52
+Create Date: 2026-10-18 22:05:41.270314
+
+The projection is filled by rebuild_infolica --only statut_courant.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '613eb1dae193'
+down_revision = 'e4b8a1f39c52'
+branch_labels = None
+depends_on = None
+
+
+def _schema(name):
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else name
+
+
+def _foreign_key(schema, column):
+    schema = _schema(schema)
+    return sa.ForeignKey(schema + '.' + column if schema else column)
+
+
+def upgrade():
+    schema = _schema('affaire')
+    op.create_table(
+        'affaire_statut_courant',
+        sa.Column('affaire_id', sa.Integer(), _foreign_key(
+            'affaire', 'affaire.id'), primary_key=True),
+        sa.Column('etape_id', sa.Integer(), _foreign_key(
+            'affaire', 'etape_affaire.id'), nullable=False),
+        sa.Column('statut_id', sa.Integer(), _foreign_key(
+            'affaire', 'statut_affaire.id'), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        schema=schema,
+    )
+    op.create_index('ix_affaire_statut_courant_statut_id',
+                    'affaire_statut_courant', ['statut_id'], schema=schema)
+    op.create_index('ix_affaire_statut_courant_etape_id',
+                    'affaire_statut_courant', ['etape_id'], schema=schema)
+
+
+def downgrade():
+    schema = _schema('affaire')
+    op.drop_table('affaire_statut_courant', schema=schema)
@@ -0,0 +1,53 @@
+"""job queue
+
+Revision ID: 8c41f2e5b9d3
+Revises: 3b9e6c1d7a20
+Create Date: 2026-10-18 17:05:41.602318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c41f2e5b9d3'
+down_revision = '3b9e6c1d7a20'
+branch_labels = None
+depends_on = None
+
+
+def _schema():
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else 'general'
+
+
+def upgrade():
+    schema = _schema()
+    op.create_table(
+        'job',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('kind', sa.Text(), nullable=False),
+        sa.Column('params', sa.Text(), nullable=False),
+        sa.Column('state', sa.Text(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('progress', sa.Float(), nullable=False),
+        sa.Column('message', sa.Text()),
+        sa.Column('result', sa.Text()),
+        sa.Column('error', sa.Text()),
+        sa.Column('worker', sa.Text()),
+        sa.Column('created', sa.DateTime(), nullable=False),
+        sa.Column('run_after', sa.DateTime(), nullable=False),
+        sa.Column('started', sa.DateTime()),
+        sa.Column('heartbeat', sa.DateTime()),
+        sa.Column('finished', sa.DateTime()),
+        schema=schema,
+    )
+    op.create_index('ix_job_state_run_after', 'job', ['state', 'run_after'],
+                    schema=schema)
+    op.create_index('ix_job_kind_state', 'job', ['kind', 'state'],
+                    schema=schema)
+
+
+def downgrade():
+    op.drop_table('job', schema=_schema())
@@ -0,0 +1,43 @@
+"""document of an envoi
+
+Revision ID: a7e3c9b1f054
+Revises: 5f2a7d0c4e61
+Create Date: 2026-10-18 19:02:47.350211
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7e3c9b1f054'
+down_revision = '5f2a7d0c4e61'
+branch_labels = None
+depends_on = None
+
+
+def _schema():
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else 'document'
+
+
+def upgrade():
+    schema = _schema()
+    op.add_column('envoi_document', sa.Column('document_id', sa.Integer()),
+                  schema=schema)
+    # SQLite cannot add a constraint to an existing table
+    if schema is not None:
+        op.create_foreign_key(
+            'fk_envoi_document_document_id_document', 'envoi_document',
+            'document', ['document_id'], ['id'], source_schema=schema,
+            referent_schema=schema)
+    op.create_index('ix_envoi_document_document_id', 'envoi_document',
+                    ['document_id'], schema=schema)
+
+
+def downgrade():
+    schema = _schema()
+    op.drop_index('ix_envoi_document_document_id', 'envoi_document',
+                  schema=schema)
+    with op.batch_alter_table('envoi_document', schema=schema) as batch:
+        batch.drop_column('document_id')
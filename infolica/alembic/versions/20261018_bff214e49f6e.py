@@ -0,0 +1,46 @@
+"""affaire of remarks
+
+Revision ID: bff214e49f6e
+Revises: 1deebb619937
+Create Date: 2026-10-18 22:08:03.918664
+
+The affaire of existing remarks is unknown, the column stays nullable in
+the database.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'bff214e49f6e'
+down_revision = '1deebb619937'
+branch_labels = None
+depends_on = None
+
+
+def _schema():
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else 'affaire'
+
+
+def upgrade():
+    schema = _schema()
+    op.add_column('remarque_affaire', sa.Column('affaire_id', sa.Integer()),
+                  schema=schema)
+    # SQLite cannot add a constraint to an existing table
+    if schema is not None:
+        op.create_foreign_key(
+            'fk_remarque_affaire_affaire_id_affaire', 'remarque_affaire',
+            'affaire', ['affaire_id'], ['id'], source_schema=schema,
+            referent_schema=schema)
+    op.create_index('ix_remarque_affaire_affaire_id', 'remarque_affaire',
+                    ['affaire_id'], schema=schema)
+
+
+def downgrade():
+    schema = _schema()
+    op.drop_index('ix_remarque_affaire_affaire_id', 'remarque_affaire',
+                  schema=schema)
+    with op.batch_alter_table('remarque_affaire', schema=schema) as batch:
+        batch.drop_column('affaire_id')
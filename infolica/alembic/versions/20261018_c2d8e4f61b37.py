@@ -0,0 +1,38 @@
+"""preavis reminders
+
+Revision ID: c2d8e4f61b37
+Revises: a7e3c9b1f054
+Create Date: 2026-10-18 19:48:30.902145
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2d8e4f61b37'
+down_revision = 'a7e3c9b1f054'
+branch_labels = None
+depends_on = None
+
+
+def _schema():
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else 'preavis'
+
+
+def upgrade():
+    schema = _schema()
+    op.add_column('preavis', sa.Column('date_rappel', sa.Date()),
+                  schema=schema)
+    unanswered = sa.text('date_reponse IS NULL')
+    op.create_index('ix_preavis_date_demande_ouvert', 'preavis',
+                    ['date_demande'], schema=schema,
+                    postgresql_where=unanswered, sqlite_where=unanswered)
+
+
+def downgrade():
+    schema = _schema()
+    op.drop_index('ix_preavis_date_demande_ouvert', 'preavis', schema=schema)
+    with op.batch_alter_table('preavis', schema=schema) as batch:
+        batch.drop_column('date_rappel')
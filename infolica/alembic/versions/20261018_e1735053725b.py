@@ -0,0 +1,46 @@
+"""numero counters
+
+Revision ID: e1735053725b
+Revises: 613eb1dae193
+Create Date: 2026-10-18 22:06:12.849027
+
+The counters are filled by rebuild_infolica --only numero_compteur.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1735053725b'
+down_revision = '613eb1dae193'
+branch_labels = None
+depends_on = None
+
+
+def _schema(name):
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else name
+
+
+def _foreign_key(schema, column):
+    schema = _schema(schema)
+    return sa.ForeignKey(schema + '.' + column if schema else column)
+
+
+def upgrade():
+    schema = _schema('numero')
+    op.create_table(
+        'numero_compteur',
+        sa.Column('cadastre_id', sa.Integer(), _foreign_key(
+            'general', 'cadastre.id'), primary_key=True),
+        sa.Column('type_id', sa.Integer(), _foreign_key(
+            'numero', 'numero_type.id'), primary_key=True),
+        sa.Column('prochain', sa.Integer(), nullable=False),
+        schema=schema,
+    )
+
+
+def downgrade():
+    schema = _schema('numero')
+    op.drop_table('numero_compteur', schema=schema)
@@ -0,0 +1,59 @@
+"""operator workload rollups
+
+Revision ID: e4b8a1f39c52
+Revises: c2d8e4f61b37
+Create Date: 2026-10-18 21:14:07.553190
+
+The rollups are filled by rebuild_infolica --only statistiques.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b8a1f39c52'
+down_revision = 'c2d8e4f61b37'
+branch_labels = None
+depends_on = None
+
+
+def _schema(name):
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else name
+
+
+def _foreign_key(schema, column):
+    schema = _schema(schema)
+    return sa.ForeignKey(schema + '.' + column if schema else column)
+
+
+def upgrade():
+    schema = _schema('affaire')
+    op.create_table(
+        'statistique_operateur',
+        sa.Column('operateur_id', sa.Integer(), _foreign_key(
+            'general', 'operateur.id'), primary_key=True),
+        sa.Column('ouvertes_responsable', sa.Integer(), nullable=False),
+        sa.Column('ouvertes_technicien', sa.Integer(), nullable=False),
+        schema=schema,
+    )
+    op.create_table(
+        'statistique_mois',
+        sa.Column('operateur_id', sa.Integer(), _foreign_key(
+            'general', 'operateur.id'), primary_key=True),
+        sa.Column('mois', sa.Date(), primary_key=True),
+        sa.Column('type_id', sa.Integer(), _foreign_key(
+            'affaire', 'affaire_type.id'), primary_key=True),
+        sa.Column('cloturees', sa.Integer(), nullable=False),
+        sa.Column('jours', sa.Integer(), nullable=False),
+        schema=schema,
+    )
+    op.create_index('ix_statistique_mois_type_id_mois',
+                    'statistique_mois', ['type_id', 'mois'], schema=schema)
+
+
+def downgrade():
+    schema = _schema('affaire')
+    for table in ('statistique_mois', 'statistique_operateur'):
+        op.drop_table(table, schema=schema)
@@ -0,0 +1,77 @@
+"""foreign key and query indexes
+
+Revision ID: fd84510c62a4
+Revises: 23699963ba13
+Create Date: 2026-10-18 09:12:40.318204
+
+The application tables predate these migrations, which do not create
+them (initialize_infolica_db only adds the models table of the init
+revision).  This revision indexes them; the indexes of the tables and
+columns added by later revisions are created by those.
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'fd84510c62a4'
+down_revision = '23699963ba13'
+branch_labels = None
+depends_on = None
+
+# name, schema, table, columns
+INDEXES = [
+    ('ix_affaire_date_ouverture_id', 'affaire', 'affaire',
+     ['date_ouverture', 'id']),
+    ('ix_affaire_localisation', 'affaire', 'affaire',
+     ['localisation_E', 'localisation_N']),
+    ('ix_affaire_responsable_id', 'affaire', 'affaire', ['responsable_id']),
+    ('ix_affaire_technicien_id', 'affaire', 'affaire', ['technicien_id']),
+    ('ix_envoi_document_destinataire_id', 'document', 'envoi_document',
+     ['destinataire_id']),
+    ('ix_plan_cadastre_id_nom', 'general', 'plan', ['cadastre_id', 'nom']),
+    ('ix_numero_cadastre_id_type_id_numero_suffixe', 'numero', 'numero',
+     ['cadastre_id', 'type_id', 'numero', 'suffixe']),
+    ('ix_affaire_numero_affaire_id', 'affaire', 'affaire_numero',
+     ['affaire_id']),
+    ('ix_affaire_numero_numero_id_affaire_id', 'affaire', 'affaire_numero',
+     ['numero_id', 'affaire_id']),
+    ('ix_etape_affaire_affaire_id_date_id', 'affaire', 'etape_affaire',
+     ['affaire_id', 'date', 'id']),
+    ('ix_modification_affaire_affaire_id_fille', 'affaire',
+     'modification_affaire', ['affaire_id_fille']),
+    ('ix_modification_affaire_affaire_id_mere', 'affaire',
+     'modification_affaire', ['affaire_id_mere']),
+    ('ix_relation_affaire_client_affaire_id', 'client',
+     'relation_affaire_client', ['affaire_id']),
+    ('ix_relation_affaire_client_client_id_affaire_id', 'client',
+     'relation_affaire_client', ['client_id', 'affaire_id']),
+    ('ix_emoluments_rf_affaire_id', 'facture', 'emoluments_rf',
+     ['affaire_id']),
+    ('ix_facture_client_id', 'facture', 'facture', ['client_id']),
+    ('ix_numero_plan_numero_id_plan_id', 'numero', 'numero_plan',
+     ['numero_id', 'plan_id']),
+    ('ix_numero_plan_plan_id_numero_id', 'numero', 'numero_plan',
+     ['plan_id', 'numero_id']),
+    ('ix_numero_relation_numero_id_associe', 'numero', 'numero_relation',
+     ['numero_id_associe']),
+    ('ix_numero_relation_numero_id_base', 'numero', 'numero_relation',
+     ['numero_id_base']),
+    ('ix_preavis_affaire_id', 'preavis', 'preavis', ['affaire_id']),
+    ('ix_preavis_service_id', 'preavis', 'preavis', ['service_id']),
+]
+
+
+def _schema(name):
+    # SQLite databases keep all the schemas in the main one
+    return None if op.get_context().dialect.name == 'sqlite' else name
+
+
+def upgrade():
+    for name, schema, table, columns in INDEXES:
+        op.create_index(name, table, columns, schema=_schema(schema))
+
+
+def downgrade():
+    for name, schema, table, columns in reversed(INDEXES):
+        op.drop_index(name, table_name=table, schema=_schema(schema))
@@ -1,19 +1,123 @@
+import logging
+
 from sqlalchemy import engine_from_config
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.util import asbool
 from sqlalchemy.orm import configure_mappers
 import zope.sqlalchemy
 
 # import or define all models here to ensure they are attached to the
 # Base.metadata prior to any initialization routines
-from .mymodel import MyModel  # flake8: noqa
+from .meta import Base
+from .mymodel import (  # flake8: noqa
+    MyModel,
+    Operateur,
+    Cadastre,
+    Plan,
+    AffaireType,
+    Affaire,
+    StatutAffaire,
+    EtapeAffaire,
+    ModificationAffaireType,
+    ModificationAffaire,
+    Client,
+    ClientEntreprise,
+    ClientPersonne,
+    RelationClientAffaireType,
+    RelationAffaireClient,
+    Facture,
+    FacturePartielle,
+    EmolumentsMO,
+    EmolumentsMOParametres,
+    EmolumentsRF,
+    EmolumentsRFParametres,
+    RemarqueAffaire,
+    Document,
+    EnvoiDocument,
+    NumeroType,
+    NumeroEtat,
+    Numero,
+    RelationType,
+    NumeroRelation,
+    NumeroPlan,
+    AffaireNumero,
+    Services,
+    RemarquePreavis,
+    PreavisType,
+    PreavisDecision,
+    Preavis,
+)
+from .checkpoint import ImportCheckpoint  # flake8: noqa
+from .compteur import NumeroCompteur  # flake8: noqa
+from .hierarchie import ModificationAffaireHierarchie  # flake8: noqa
+from .job import Job  # flake8: noqa
+from .lookup import LOOKUP_MODELS, LookupCache, RequestLookups
+from .pool import (
+    MeteredQueuePool,
+    pool_status,
+    set_statement_timeout,
+    watch_sqlite_timeouts,
+    watch_statement_timeouts,
+)
+from .profiles import LOADING_PROFILES, with_profile
+from .statistiques import StatistiqueMois, StatistiqueOperateur  # flake8: noqa
+from .statut import AffaireStatutCourant  # flake8: noqa
 
 # run configure_mappers after defining all of the models to ensure
 # all relationships can be setup
 configure_mappers()
 
+log = logging.getLogger(__name__)
+
+POOL_SETTINGS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle',
+                 'pool_pre_ping', 'pool_use_lifo')
+
+# request methods answered from the read-only engine, when configured
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+# environ key making request.dbsession read from the primary
+READ_PRIMARY_KEY = 'infolica.read_primary'
+
 
 def get_engine(settings, prefix='sqlalchemy.'):
-    return engine_from_config(settings, prefix)
+    """
+    Create the engine configured by the ``prefix`` settings.
+
+    Server databases get a :class:`MeteredQueuePool` sized by the
+    ``pool_size``, ``max_overflow``, ``pool_timeout``, ``pool_recycle``,
+    ``pool_pre_ping`` and ``pool_use_lifo`` settings.  So does an SQLite
+    file when any of them is set, otherwise SQLite keeps its own pools.
+
+    """
+    url = make_url(settings[prefix + 'url'])
+    pooled = [k for k in POOL_SETTINGS if prefix + k in settings]
+    kwargs = {}
+    for key in ('pool_pre_ping', 'pool_use_lifo'):
+        if prefix + key in settings:
+            kwargs[key] = asbool(settings[prefix + key])
+    if url.get_backend_name() != 'sqlite':
+        kwargs['poolclass'] = MeteredQueuePool
+    elif url.database in (None, '', ':memory:'):
+        if pooled:
+            log.warning('ignoring %s for an in-memory SQLite database',
+                        ', '.join(prefix + k for k in pooled))
+            settings = {k: v for k, v in settings.items()
+                        if k[len(prefix):] not in POOL_SETTINGS}
+            kwargs = {}
+    elif pooled:
+        # connections are handed between threads, one at a time
+        connect_args = dict(settings.get(prefix + 'connect_args', {}))
+        connect_args['check_same_thread'] = False
+        kwargs.update(poolclass=MeteredQueuePool, connect_args=connect_args)
+    engine = engine_from_config(settings, prefix, **kwargs)
+    if engine.dialect.name == 'sqlite':
+        watch_sqlite_timeouts(engine)
+        # SQLite has no schemas, map them all onto the main database
+        schemas = {t.schema for t in Base.metadata.tables.values() if t.schema}
+        engine = engine.execution_options(
+            schema_translate_map=dict.fromkeys(schemas))
+    return engine
 
 
 def get_session_factory(engine):
@@ -22,6 +126,34 @@ def get_session_factory(engine):
     return factory
 
 
+def ensure_loaded(registry, cache):
+    """
+    Load ``cache`` (with an ``ensure_loaded(dbsession)`` method) from the
+    primary database.
+
+    The caches kept in sync from the commit events of the primary must
+    not load from the replica: a commit after the snapshot of a lagging
+    replica would be missing from them for good.
+
+    """
+    if getattr(cache, 'loaded', False):
+        return
+    dbsession = registry['dbsession_factory']()
+    try:
+        cache.ensure_loaded(dbsession)
+    finally:
+        dbsession.close()
+
+
+def read_primary(request):
+    """
+    Make ``request.dbsession`` read from the primary database, whatever
+    the request method.  Call it before the session is first used.
+
+    """
+    request.environ[READ_PRIMARY_KEY] = True
+
+
 def get_tm_session(session_factory, transaction_manager):
     """
     Get a ``sqlalchemy.orm.Session`` instance backed by a transaction.
@@ -68,10 +200,49 @@ def includeme(config):
     session_factory = get_session_factory(get_engine(settings))
     config.registry['dbsession_factory'] = session_factory
 
+    # GET and HEAD requests read from a replica when one is configured;
+    # it may lag behind, so a read right after a write may not see it
+    if 'sqlalchemy_ro.url' in settings:
+        session_factory_ro = get_session_factory(
+            get_engine(settings, 'sqlalchemy_ro.'))
+    else:
+        session_factory_ro = session_factory
+    config.registry['dbsession_factory_ro'] = session_factory_ro
+
+    # seconds a statement may run, raised per request with
+    # set_statement_timeout(request.dbsession, seconds)
+    timeout = settings.get('db.statement_timeout')
+    for factory in {session_factory, session_factory_ro}:
+        watch_statement_timeouts(factory, float(timeout) if timeout else None)
+
+    # id <-> nom maps of the reference tables, warmed by infolica.main
+    ttl = settings.get('lookup.ttl')
+    lookup_cache = LookupCache(ttl=float(ttl) if ttl else None)
+    lookup_cache.watch(session_factory)
+    config.registry['lookup_cache'] = lookup_cache
+
     # make request.dbsession available for use in Pyramid
+    def dbsession(r):
+        if session_factory_ro is not session_factory and \
+                r.method in READ_ONLY_METHODS and \
+                not r.environ.get(READ_PRIMARY_KEY):
+            # r.tm is the transaction manager used by pyramid_tm
+            return get_tm_session(session_factory_ro, r.tm)
+        return r.primary_dbsession
+
+    config.add_request_method(dbsession, 'dbsession', reify=True)
+
+    # the session of the primary whatever the method, for the reads
+    # filling caches synced from its commits and the reads after a write
     config.add_request_method(
-        # r.tm is the transaction manager used by pyramid_tm
         lambda r: get_tm_session(session_factory, r.tm),
-        'dbsession',
+        'primary_dbsession',
+        reify=True
+    )
+
+    # make request.lookups available to resolve reference labels
+    config.add_request_method(
+        lambda r: RequestLookups(lookup_cache, r.primary_dbsession),
+        'lookups',
         reify=True
     )
@@ -0,0 +1,39 @@
+import datetime
+
+from sqlalchemy import Column, DateTime, Integer, Text, select
+
+from .meta import Base
+
+
+class ImportCheckpoint(Base):
+    """
+    Rows of an input file already imported, by import source.
+
+    Written in the transaction of the rows it counts, so an interrupted
+    import resumes after the last committed batch, neither losing nor
+    repeating rows.
+
+    """
+    __tablename__ = 'import_checkpoint'
+    __table_args__ = {'schema': 'general'}
+    source = Column(Text, primary_key=True)
+    position = Column(Integer, nullable=False)
+    updated = Column(DateTime, default=datetime.datetime.utcnow,
+                     nullable=False)
+
+
+def get_checkpoint(connection, source):
+    """Rows of ``source`` already imported, 0 for a new source."""
+    table = ImportCheckpoint.__table__
+    position = connection.execute(select([table.c.position]).where(
+        table.c.source == source)).scalar()
+    return position or 0
+
+
+def set_checkpoint(connection, source, position):
+    table = ImportCheckpoint.__table__
+    values = {'position': position, 'updated': datetime.datetime.utcnow()}
+    result = connection.execute(
+        table.update().where(table.c.source == source).values(**values))
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(source=source, **values))
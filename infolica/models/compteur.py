@@ -0,0 +1,66 @@
+from sqlalchemy import (
+    Column,
+    Integer,
+    ForeignKey,
+    bindparam,
+    func,
+    select,
+)
+
+from .meta import Base
+from .mymodel import Cadastre, Numero, NumeroType
+
+
+class NumeroCompteur(Base):
+    """
+    Next free ``Numero.numero`` per cadastre and type.
+
+    Reserving numbers increments the counter row, which only locks that
+    row instead of scanning ``MAX(numero)`` under contention.
+
+    """
+    __tablename__ = 'numero_compteur'
+    __table_args__ = {'schema': 'numero'}
+    cadastre_id = Column(Integer, ForeignKey(Cadastre.id), primary_key=True)
+    type_id = Column(Integer, ForeignKey(NumeroType.id), primary_key=True)
+    prochain = Column(Integer, nullable=False)
+
+
+def rebuild_compteurs(dbsession):
+    """
+    Move every counter past the highest existing number.
+
+    Needed after numbers are written without going through the counters,
+    e.g. imports.  Counters are never moved backwards.  Returns the number
+    of inserted, updated and deleted rows.
+
+    """
+    table = NumeroCompteur.__table__
+    numero = Numero.__table__
+    expected = {
+        (row.cadastre_id, row.type_id): row.prochain
+        for row in dbsession.execute(
+            select([numero.c.cadastre_id, numero.c.type_id,
+                    (func.max(numero.c.numero) + 1).label('prochain')])
+            .group_by(numero.c.cadastre_id, numero.c.type_id))
+    }
+    current = {
+        (row.cadastre_id, row.type_id): row.prochain
+        for row in dbsession.execute(select([table]))
+    }
+
+    inserted = [k for k in expected if k not in current]
+    updated = [k for k in expected
+               if k in current and current[k] < expected[k]]
+    if inserted:
+        dbsession.execute(table.insert(), [
+            {'cadastre_id': c, 'type_id': t, 'prochain': expected[c, t]}
+            for c, t in inserted])
+    if updated:
+        dbsession.execute(
+            table.update().where(
+                (table.c.cadastre_id == bindparam('b_cadastre_id')) &
+                (table.c.type_id == bindparam('b_type_id'))),
+            [{'b_cadastre_id': c, 'b_type_id': t, 'prochain': expected[c, t]}
+             for c, t in updated])
+    return len(inserted), len(updated), 0
@@ -0,0 +1,5 @@
+# VAT rate applied to the official surveying (MO) fees
+tva = 0.077
+
+# invoice amounts are rounded to 5 centimes
+arrondi = 0.05
@@ -0,0 +1,230 @@
+from collections import defaultdict, deque
+
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    ForeignKey,
+    bindparam,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.orm.attributes import get_history
+
+from .meta import Base
+from .mymodel import Affaire, ModificationAffaire
+
+
+class ModificationAffaireHierarchie(Base):
+    """
+    Closure table of the mother/daughter ``ModificationAffaire`` links.
+
+    One row per (ancestor, descendant) pair with the length of the
+    shortest path between them, so a whole affaire family is read with
+    one indexed lookup whatever its depth.  Maintained from the
+    ``ModificationAffaire`` mapper events below; the links are expected
+    to be acyclic.
+
+    """
+    __tablename__ = 'modification_affaire_hierarchie'
+    __table_args__ = {'schema': 'affaire'}
+    affaire_id_ancetre = Column(
+        Integer, ForeignKey(Affaire.id), primary_key=True)
+    affaire_id_descendant = Column(
+        Integer, ForeignKey(Affaire.id), primary_key=True)
+    profondeur = Column(Integer, nullable=False)
+
+
+Index('ix_modification_affaire_hierarchie_affaire_id_descendant',
+      ModificationAffaireHierarchie.affaire_id_descendant)
+
+
+def _ancestors(connection, affaire_id):
+    """``{ancestor: distance}`` of an affaire, itself included."""
+    table = ModificationAffaireHierarchie.__table__
+    result = {affaire_id: 0}
+    result.update(connection.execute(
+        select([table.c.affaire_id_ancetre, table.c.profondeur])
+        .where(table.c.affaire_id_descendant == affaire_id)).fetchall())
+    return result
+
+
+def _descendants(connection, affaire_id):
+    """``{descendant: distance}`` of an affaire, itself included."""
+    table = ModificationAffaireHierarchie.__table__
+    result = {affaire_id: 0}
+    result.update(connection.execute(
+        select([table.c.affaire_id_descendant, table.c.profondeur])
+        .where(table.c.affaire_id_ancetre == affaire_id)).fetchall())
+    return result
+
+
+def _link(connection, mere, fille, descendants=None):
+    """Add the pairs going through the ``mere`` -> ``fille`` link."""
+    table = ModificationAffaireHierarchie.__table__
+    ancestors = _ancestors(connection, mere)
+    if descendants is None:
+        descendants = _descendants(connection, fille)
+    pairs = {
+        (a, d): da + 1 + dd
+        for a, da in ancestors.items()
+        for d, dd in descendants.items()
+    }
+    existing = dict(
+        ((a, d), depth) for a, d, depth in connection.execute(
+            select([table.c.affaire_id_ancetre,
+                    table.c.affaire_id_descendant, table.c.profondeur])
+            .where(table.c.affaire_id_ancetre.in_(list(ancestors)))
+            .where(table.c.affaire_id_descendant.in_(list(descendants)))))
+    inserted = [
+        {'affaire_id_ancetre': a, 'affaire_id_descendant': d,
+         'profondeur': depth}
+        for (a, d), depth in pairs.items() if (a, d) not in existing]
+    shorter = [
+        {'b_ancetre': a, 'b_descendant': d, 'profondeur': depth}
+        for (a, d), depth in pairs.items()
+        if (a, d) in existing and depth < existing[a, d]]
+    if inserted:
+        connection.execute(table.insert(), inserted)
+    if shorter:
+        connection.execute(table.update().where(
+            (table.c.affaire_id_ancetre == bindparam('b_ancetre')) &
+            (table.c.affaire_id_descendant == bindparam('b_descendant'))),
+            shorter)
+
+
+def _unlink(connection, fille):
+    """
+    Drop the pairs entering the subtree of ``fille`` after a removed link.
+
+    The pairs are added back through the links still pointing into the
+    subtree, if any.
+
+    """
+    table = ModificationAffaireHierarchie.__table__
+    links = ModificationAffaire.__table__
+    # the subtree is selected by the database instead of sent as a list;
+    # the pairs from ``fille`` it reads are never deleted below
+    sous_arbre = table.alias('sous_arbre')
+    descendants = select([sous_arbre.c.affaire_id_descendant]).where(
+        sous_arbre.c.affaire_id_ancetre == fille)
+
+    def in_subtree(column):
+        return (column == fille) | column.in_(descendants)
+
+    connection.execute(table.delete().where(
+        in_subtree(table.c.affaire_id_descendant) &
+        ~in_subtree(table.c.affaire_id_ancetre)))
+    remaining = connection.execute(
+        select([links.c.affaire_id_mere, links.c.affaire_id_fille])
+        .where(in_subtree(links.c.affaire_id_fille))
+        .where(~in_subtree(links.c.affaire_id_mere))).fetchall()
+    for mere, other in remaining:
+        _link(connection, mere, other)
+
+
+@event.listens_for(ModificationAffaire, 'after_insert')
+def _modification_inserted(mapper, connection, target):
+    _link(connection, target.affaire_id_mere, target.affaire_id_fille)
+
+
+@event.listens_for(ModificationAffaire, 'after_delete')
+def _modification_deleted(mapper, connection, target):
+    _unlink(connection, target.affaire_id_fille)
+
+
+@event.listens_for(ModificationAffaire, 'after_update')
+def _modification_updated(mapper, connection, target):
+    mere = get_history(target, 'affaire_id_mere')
+    fille = get_history(target, 'affaire_id_fille')
+    if not (mere.has_changes() or fille.has_changes()):
+        return
+    old_fille = (fille.deleted or [target.affaire_id_fille])[0]
+    _unlink(connection, old_fille)
+    _link(connection, target.affaire_id_mere, target.affaire_id_fille)
+
+
+def subtree(dbsession, affaire_id, max_depth=None):
+    """``[(descendant_id, depth)]`` of an affaire, nearest first."""
+    H = ModificationAffaireHierarchie
+    query = dbsession.query(H.affaire_id_descendant, H.profondeur).filter(
+        H.affaire_id_ancetre == affaire_id)
+    if max_depth is not None:
+        query = query.filter(H.profondeur <= max_depth)
+    return query.order_by(H.profondeur, H.affaire_id_descendant).all()
+
+
+def path_to_root(dbsession, affaire_id):
+    """``[(ancestor_id, depth)]`` of an affaire, farthest (root) first."""
+    H = ModificationAffaireHierarchie
+    return dbsession.query(H.affaire_id_ancetre, H.profondeur).filter(
+        H.affaire_id_descendant == affaire_id).order_by(
+            H.profondeur.desc(), H.affaire_id_ancetre).all()
+
+
+def subtree_counts(dbsession, affaire_ids):
+    """``{affaire_id: number of descendants}`` for many affaires at once."""
+    H = ModificationAffaireHierarchie
+    counts = dict.fromkeys(affaire_ids, 0)
+    counts.update(dbsession.query(H.affaire_id_ancetre, func.count()).filter(
+        H.affaire_id_ancetre.in_(list(affaire_ids))).group_by(
+            H.affaire_id_ancetre))
+    return counts
+
+
+def rebuild_hierarchie(dbsession):
+    """
+    Recompute the closure table from the ``ModificationAffaire`` links.
+
+    Only differing rows are written.  Returns the number of inserted,
+    updated and deleted rows.
+
+    """
+    table = ModificationAffaireHierarchie.__table__
+    links = ModificationAffaire.__table__
+    children = defaultdict(set)
+    for mere, fille in dbsession.execute(
+            select([links.c.affaire_id_mere, links.c.affaire_id_fille])):
+        children[mere].add(fille)
+
+    expected = {}
+    for ancestor in list(children):
+        depths = {ancestor: 0}
+        queue = deque([ancestor])
+        while queue:
+            current = queue.popleft()
+            for child in children.get(current, ()):
+                if child not in depths:
+                    depths[child] = depths[current] + 1
+                    queue.append(child)
+        del depths[ancestor]
+        for descendant, depth in depths.items():
+            expected[ancestor, descendant] = depth
+
+    current = {
+        (a, d): depth for a, d, depth in dbsession.execute(select([
+            table.c.affaire_id_ancetre, table.c.affaire_id_descendant,
+            table.c.profondeur]))
+    }
+    inserted = [k for k in expected if k not in current]
+    updated = [k for k in expected
+               if k in current and current[k] != expected[k]]
+    deleted = [k for k in current if k not in expected]
+
+    if inserted:
+        dbsession.execute(table.insert(), [
+            {'affaire_id_ancetre': a, 'affaire_id_descendant': d,
+             'profondeur': expected[a, d]} for a, d in inserted])
+    if updated:
+        dbsession.execute(table.update().where(
+            (table.c.affaire_id_ancetre == bindparam('b_ancetre')) &
+            (table.c.affaire_id_descendant == bindparam('b_descendant'))),
+            [{'b_ancetre': a, 'b_descendant': d, 'profondeur': expected[a, d]}
+             for a, d in updated])
+    if deleted:
+        dbsession.execute(table.delete().where(
+            (table.c.affaire_id_ancetre == bindparam('b_ancetre')) &
+            (table.c.affaire_id_descendant == bindparam('b_descendant'))),
+            [{'b_ancetre': a, 'b_descendant': d} for a, d in deleted])
+    return len(inserted), len(updated), len(deleted)
@@ -0,0 +1,49 @@
+import datetime
+
+from sqlalchemy import Column, DateTime, Float, Index, Integer, Text
+
+from .meta import Base
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+STATES = (PENDING, RUNNING, DONE, FAILED)
+
+
+class Job(Base):
+    """
+    Work queued for the background workers (see ``services.jobs``).
+
+    ``params`` and ``result`` are JSON.  A job is ``pending`` until a
+    worker claims it, ``running`` until it ends ``done`` or ``failed``,
+    and back to ``pending`` after ``run_after`` when a retryable error
+    leaves attempts.  ``heartbeat`` is set when claimed and on each
+    commit of the job.
+
+    """
+    __tablename__ = 'job'
+    __table_args__ = {'schema': 'general'}
+    id = Column(Integer, primary_key=True)
+    kind = Column(Text, nullable=False)
+    params = Column(Text, nullable=False, default='{}')
+    state = Column(Text, nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    progress = Column(Float, nullable=False, default=0.0)
+    message = Column(Text)
+    result = Column(Text)
+    error = Column(Text)
+    worker = Column(Text)
+    created = Column(DateTime, default=datetime.datetime.utcnow,
+                     nullable=False)
+    run_after = Column(DateTime, default=datetime.datetime.utcnow,
+                       nullable=False)
+    started = Column(DateTime)
+    heartbeat = Column(DateTime)
+    finished = Column(DateTime)
+
+
+# claiming reads the pending jobs due, and counts the running ones by kind
+Index('ix_job_state_run_after', Job.state, Job.run_after)
+Index('ix_job_kind_state', Job.kind, Job.state)
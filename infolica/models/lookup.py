@@ -0,0 +1,144 @@
+import logging
+import time
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import DBAPIError
+
+from .mymodel import (
+    AffaireType,
+    Cadastre,
+    ModificationAffaireType,
+    NumeroEtat,
+    NumeroType,
+    PreavisDecision,
+    PreavisType,
+    RelationClientAffaireType,
+    RelationType,
+    StatutAffaire,
+)
+
+log = logging.getLogger(__name__)
+
+# small (id, nom) tables that rarely change
+LOOKUP_MODELS = (
+    AffaireType,
+    Cadastre,
+    ModificationAffaireType,
+    NumeroEtat,
+    NumeroType,
+    PreavisDecision,
+    PreavisType,
+    RelationClientAffaireType,
+    RelationType,
+    StatutAffaire,
+)
+
+PENDING_KEY = 'lookup_pending'
+
+
+class LookupCache(object):
+    """
+    ``id`` <-> ``nom`` maps of the reference tables, held in memory.
+
+    A table is (re)loaded on first access, after a committed change to it
+    from a watched session, and when its copy is older than ``ttl``
+    seconds, which bounds staleness for changes made by other processes.
+
+    """
+
+    def __init__(self, models=LOOKUP_MODELS, ttl=None):
+        self.models = tuple(models)
+        self.ttl = ttl
+        # model -> (loaded_at, {id: nom}, {nom: id}), replaced as a whole
+        self._tables = {}
+        self._generations = dict.fromkeys(self.models, 0)
+
+    def _fresh(self, model):
+        entry = self._tables.get(model)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.monotonic() - entry[0] >= self.ttl:
+            return None
+        return entry
+
+    def load(self, dbsession, models=None):
+        for model in models or self.models:
+            generation = self._generations[model]
+            table = model.__table__
+            noms = dict(dbsession.execute(
+                select([table.c.id, table.c.nom])).fetchall())
+            entry = (time.monotonic(), noms,
+                     {nom: id_ for id_, nom in noms.items()})
+            # an invalidation during the load may not be reflected
+            if generation == self._generations[model]:
+                self._tables[model] = entry
+
+    def warm(self, session_factory):
+        """Load every table, tolerating a database not initialized yet."""
+        dbsession = session_factory()
+        try:
+            self.load(dbsession)
+        except DBAPIError:
+            log.warning('could not load the lookup tables at startup',
+                        exc_info=True)
+        finally:
+            dbsession.close()
+
+    def _entry(self, dbsession, model):
+        entry = self._fresh(model)
+        if entry is None:
+            self.load(dbsession, [model])
+            entry = self._tables[model]
+        return entry
+
+    def invalidate(self, model=None):
+        for m in [model] if model is not None else self.models:
+            self._generations[m] += 1
+            self._tables.pop(m, None)
+
+    def noms(self, dbsession, model):
+        """``{id: nom}`` of a reference table (do not modify)."""
+        return self._entry(dbsession, model)[1]
+
+    def nom(self, dbsession, model, id_):
+        """Label of an id, None for an unknown or null id."""
+        return self._entry(dbsession, model)[1].get(id_)
+
+    def id(self, dbsession, model, nom):
+        """Id of a label, None if unknown."""
+        return self._entry(dbsession, model)[2].get(nom)
+
+    def watch(self, session_factory):
+        """Invalidate on changes committed by ``session_factory`` sessions."""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        for obj in session.new | session.dirty | session.deleted:
+            if type(obj) in self._generations:
+                session.info.setdefault(PENDING_KEY, set()).add(type(obj))
+
+    def _after_commit(self, session):
+        for model in session.info.pop(PENDING_KEY, ()):
+            self.invalidate(model)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+class RequestLookups(object):
+    """The lookup cache bound to the session of a request."""
+
+    def __init__(self, cache, dbsession):
+        self.cache = cache
+        self.dbsession = dbsession
+
+    def noms(self, model):
+        return self.cache.noms(self.dbsession, model)
+
+    def nom(self, model, id_):
+        return self.cache.nom(self.dbsession, model, id_)
+
+    def id(self, model, nom):
+        return self.cache.id(self.dbsession, model, nom)
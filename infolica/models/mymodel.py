@@ -1,4 +1,5 @@
 from sqlalchemy import (
+    BigInteger,
     Column,
     Index,
     Integer,
@@ -7,14 +8,25 @@ from sqlalchemy import (
     Date,
     Boolean,
     ForeignKey,
-    UniqueConstraint,
 )
+from sqlalchemy.orm import relationship
 
 import datetime
 
+from . import constant
 from .meta import Base
 
 
+class MyModel(Base):
+    __tablename__ = 'models'
+    id = Column(Integer, primary_key=True)
+    name = Column(Text)
+    value = Column(Integer)
+
+
+Index('my_index', MyModel.name, unique=True, mysql_length=255)
+
+
 class Operateur(Base):
     __tablename__ = 'operateur'
     __table_args__ = {'schema': 'general'}
@@ -39,6 +51,11 @@ class Plan(Base):
     cadastre_id = Column(Integer, ForeignKey(Cadastre.id), nullable=False)
     nom = Column(Text, nullable=False)
 
+    cadastre = relationship(Cadastre)
+
+
+Index('ix_plan_cadastre_id_nom', Plan.cadastre_id, Plan.nom)
+
 
 class AffaireType(Base):
     __tablename__ = 'affaire_type'
@@ -63,6 +80,24 @@ class Affaire(Base):
     localisation_E = Column(Integer, nullable=False)
     localisation_N = Column(Integer, nullable=False)
 
+    responsable = relationship(Operateur, foreign_keys=[responsable_id])
+    technicien = relationship(Operateur, foreign_keys=[technicien_id])
+    type = relationship(AffaireType)
+    cadastre = relationship(Cadastre)
+    etapes = relationship(
+        'EtapeAffaire', back_populates='affaire',
+        order_by='[EtapeAffaire.date, EtapeAffaire.id]')
+    clients = relationship('RelationAffaireClient', back_populates='affaire')
+    numeros = relationship('AffaireNumero', back_populates='affaire')
+    preavis = relationship('Preavis', back_populates='affaire')
+
+
+Index('ix_affaire_localisation',
+      Affaire.localisation_E, Affaire.localisation_N)
+Index('ix_affaire_date_ouverture_id', Affaire.date_ouverture, Affaire.id)
+Index('ix_affaire_responsable_id', Affaire.responsable_id)
+Index('ix_affaire_technicien_id', Affaire.technicien_id)
+
 
 class StatutAffaire(Base):
     __tablename__ = 'statut_affaire'
@@ -79,6 +114,9 @@ class EtapeAffaire(Base):
     statut_id = Column(Integer, ForeignKey(StatutAffaire.id), nullable=False)
     date = Column(Date, default=datetime.datetime.utcnow, nullable=False)
 
+    affaire = relationship(Affaire, back_populates='etapes')
+    statut = relationship(StatutAffaire)
+
 
 class ModificationAffaireType(Base):
     __tablename__ = 'modification_affaire_type'
@@ -96,6 +134,16 @@ class ModificationAffaire(Base):
     type_id = Column(Integer, ForeignKey(
         ModificationAffaireType.id), nullable=False)
 
+    mere = relationship(Affaire, foreign_keys=[affaire_id_mere])
+    fille = relationship(Affaire, foreign_keys=[affaire_id_fille])
+    type = relationship(ModificationAffaireType)
+
+
+Index('ix_modification_affaire_affaire_id_mere',
+      ModificationAffaire.affaire_id_mere)
+Index('ix_modification_affaire_affaire_id_fille',
+      ModificationAffaire.affaire_id_fille)
+
 
 class Client(Base):
     __tablename__ = 'client'
@@ -119,20 +167,28 @@ class Client(Base):
 class ClientEntreprise(Client):
     __tablename__ = 'client_entreprise'
     __table_args__ = {'schema': 'client'}
+    id = Column(Integer, ForeignKey(Client.id), primary_key=True)
     nom = Column(Text, nullable=False)
 
-    __mapper_args__ = {'polymorphic_identity': 'client_entreprise'}
+    __mapper_args__ = {
+        'polymorphic_identity': 'client_entreprise',
+        'polymorphic_load': 'selectin',
+    }
 
 
 class ClientPersonne(Client):
     __tablename__ = 'client_personne'
     __table_args__ = {'schema': 'client'}
+    id = Column(Integer, ForeignKey(Client.id), primary_key=True)
     titre = Column(Text)
     nom = Column(Text, nullable=False)
     prenom = Column(Text, nullable=False)
     tel_portable = Column(Text, nullable=False)
 
-    __mapper_args__ = {'polymorphic_identity': 'client_personne'}
+    __mapper_args__ = {
+        'polymorphic_identity': 'client_personne',
+        'polymorphic_load': 'selectin',
+    }
 
 
 class RelationClientAffaireType(Base):
@@ -147,44 +203,75 @@ class RelationAffaireClient(Base):
     __table_args__ = {'schema': 'client'}
     id = Column(Integer, primary_key=True)
     client_id = Column(Integer, ForeignKey(Client.id), nullable=False)
-    affaire_id = Column(Integer, ForeignKey(affaire.id), nullable=False)
+    affaire_id = Column(Integer, ForeignKey(Affaire.id), nullable=False)
     relation_type_id = Column(Integer, ForeignKey(
         RelationClientAffaireType.id), nullable=False)
 
+    client = relationship(Client)
+    affaire = relationship(Affaire, back_populates='clients')
+    relation_type = relationship(RelationClientAffaireType)
+
+
+Index('ix_relation_affaire_client_affaire_id',
+      RelationAffaireClient.affaire_id)
+# the affaires of a client, without reading the table
+Index('ix_relation_affaire_client_client_id_affaire_id',
+      RelationAffaireClient.client_id, RelationAffaireClient.affaire_id)
+
+
+def arrondir(montant, pas=constant.arrondi):
+    """Round an amount to the nearest ``pas`` (5 centimes)."""
+    return round(round(montant / pas) * pas, 2)
+
 
 class Facture(Base):
     __tablename__ = 'facture'
     __table_args__ = {'schema': 'facture'}
     sap = Column(Text, primary_key=True)
-    client_id = Column(Integer, ForeignKey(client.id))
+    affaire_id = Column(Integer, ForeignKey(Affaire.id))
+    client_id = Column(Integer, ForeignKey(Client.id))
     montant_mo = Column(Float, default=0.0, nullable=False)
     montant_rf = Column(Float, default=0.0, nullable=False)
     montant_mat_diff = Column(Float, default=0.0, nullable=False)
+    montant_tva = Column(Float, default=0.0, nullable=False)
     total = Column(Float, default=0.0, nullable=False)
     date = Column(Date, default=datetime.datetime.utcnow, nullable=False)
     type = Column(Text)
 
+    affaire = relationship(Affaire)
+    client = relationship(Client)
+
     __mapper_args__ = {
         'polymorphic_identity': 'facture',
         'polymorphic_on': type
     }
 
-    def __init__(self, montant_mo, montant_rf, montant_mat_diff):
+    def __init__(self, montant_mo=0.0, montant_rf=0.0, montant_mat_diff=0.0,
+                 **kwargs):
+        super(Facture, self).__init__(**kwargs)
         self.montant_mo = montant_mo
         self.montant_rf = montant_rf
-        self.montant_matdiff = montant_mat_diff
+        self.montant_mat_diff = montant_mat_diff
+
+    def calculer_tva(self, taux=constant.tva):
+        self.montant_tva = arrondir(
+            taux * (self.montant_mo + self.montant_mat_diff))  # TVA MO
+        return self.montant_tva
 
-    def tva(self):
-        self.tva = constant.tva * \
-            (self.montant_mo + self.montant_matdiff)  # TVA MO
+    def calculer_total(self):
+        self.total = arrondir(self.montant_mo + self.montant_rf +
+                              self.montant_mat_diff + self.montant_tva)
+        return self.total
 
-    def total(self):
-        self.total = self.montant_mo + self.montant_rf + self.montant_matdiff
+
+Index('ix_facture_affaire_id', Facture.affaire_id)
+Index('ix_facture_client_id', Facture.client_id)
 
 
 class FacturePartielle(Facture):
     __tablename__ = 'facture_partielle'
     __table_args__ = {'schema': 'facture'}
+    sap = Column(Text, ForeignKey(Facture.sap), primary_key=True)
     immeuble = Column(Text, default='Tous', nullable=False)
 
     __mapper_args__ = {'polymorphic_identity': 'facture_partielle'}
@@ -194,9 +281,15 @@ class EmolumentsMO(Base):
     __tablename__ = 'emoluments_mo'
     __table_args__ = {'schema': 'facture'}
     id = Column(Integer, primary_key=True)
+    affaire_id = Column(Integer, ForeignKey(Affaire.id), nullable=False)
+    montant = Column(Float, default=0.0, nullable=False)
+    montant_mat_diff = Column(Float, default=0.0, nullable=False)
     ...
 
 
+Index('ix_emoluments_mo_affaire_id', EmolumentsMO.affaire_id)
+
+
 class EmolumentsMOParametres(Base):
     __tablename__ = 'emoluments_mo_parametres'
     __table_args__ = {'schema': 'facture'}
@@ -210,9 +303,13 @@ class EmolumentsRF(Base):
     __table_args__ = {'schema': 'facture'}
     id = Column(Integer, primary_key=True)
     affaire_id = Column(Integer, ForeignKey(Affaire.id), nullable=False)
+    montant = Column(Float, default=0.0, nullable=False)
     ...
 
 
+Index('ix_emoluments_rf_affaire_id', EmolumentsRF.affaire_id)
+
+
 class EmolumentsRFParametres(Base):
     __tablename__ = 'emoluments_rf_parametres'
     __table_args__ = {'schema': 'facture'}
@@ -226,24 +323,48 @@ class RemarqueAffaire(Base):
     __tablename__ = 'remarque_affaire'
     __table_args__ = {'schema': 'affaire'}
     id = Column(Integer, primary_key=True)
-    remarque = Column(text, nullable=False)
+    affaire_id = Column(Integer, ForeignKey(Affaire.id), nullable=False)
+    remarque = Column(Text, nullable=False)
     operateur_id = Column(Integer, ForeignKey(Operateur.id), nullable=False)
     date = Column(Date, default=datetime.datetime.utcnow, nullable=False)
 
+    operateur = relationship(Operateur)
+
+
+Index('ix_remarque_affaire_affaire_id', RemarqueAffaire.affaire_id)
+
 
 class Document(Base):
     __tablename__ = 'document'
     __table_args__ = {'schema': 'document'}
     id = Column(Integer, primary_key=True)
-    chemin = Column(text, nullable=False)
+    chemin = Column(Text, nullable=False)
+    # documents uploaded to the store (services.documents), whose chemin
+    # is relative to documents.root
+    nom = Column(Text)
+    type_contenu = Column(Text)
+    taille = Column(BigInteger)
+    sha256 = Column(Text)
+
+
+Index('ix_document_sha256', Document.sha256)
 
 
 class EnvoiDocument(Base):
     __tablename__ = 'envoi_document'
     __table_args__ = {'schema': 'document'}
     id = Column(Integer, primary_key=True)
-    destinataire_id = Column(Integer, ForeignKey(Client.id) nullable=False)
+    destinataire_id = Column(Integer, ForeignKey(Client.id), nullable=False)
     date = Column(Date, default=datetime.datetime.utcnow, nullable=False)
+    # the document sent (services.envoi), unknown for older envois
+    document_id = Column(Integer, ForeignKey(Document.id))
+
+    destinataire = relationship(Client)
+    document = relationship(Document)
+
+
+Index('ix_envoi_document_destinataire_id', EnvoiDocument.destinataire_id)
+Index('ix_envoi_document_document_id', EnvoiDocument.document_id)
 
 
 # class SuiviMandat(Base):
@@ -294,6 +415,15 @@ class Numero(Base):
     suffixe = Column(Text)
     etat_id = Column(Integer, ForeignKey(NumeroEtat.id), nullable=False)
 
+    cadastre = relationship(Cadastre)
+    type = relationship(NumeroType)
+    etat = relationship(NumeroEtat)
+
+
+# numeros are known by cadastre, type, number and suffix
+Index('ix_numero_cadastre_id_type_id_numero_suffixe',
+      Numero.cadastre_id, Numero.type_id, Numero.numero, Numero.suffixe)
+
 
 class RelationType(Base):
     __tablename__ = 'relation_type'
@@ -311,6 +441,14 @@ class NumeroRelation(Base):
     relation_type_id = Column(Integer, ForeignKey(
         RelationType.id), nullable=False)
 
+    base = relationship(Numero, foreign_keys=[numero_id_base])
+    associe = relationship(Numero, foreign_keys=[numero_id_associe])
+    relation_type = relationship(RelationType)
+
+
+Index('ix_numero_relation_numero_id_base', NumeroRelation.numero_id_base)
+Index('ix_numero_relation_numero_id_associe', NumeroRelation.numero_id_associe)
+
 
 class NumeroPlan(Base):
     __tablename__ = 'numero_plan'
@@ -319,6 +457,16 @@ class NumeroPlan(Base):
     numero_id = Column(Integer, ForeignKey(Numero.id), nullable=False)
     plan_id = Column(Integer, ForeignKey(Plan.id), nullable=False)
 
+    numero = relationship(Numero)
+    plan = relationship(Plan)
+
+
+# both directions of the link, without reading the table
+Index('ix_numero_plan_numero_id_plan_id',
+      NumeroPlan.numero_id, NumeroPlan.plan_id)
+Index('ix_numero_plan_plan_id_numero_id',
+      NumeroPlan.plan_id, NumeroPlan.numero_id)
+
 
 class AffaireNumero(Base):
     __tablename__ = 'affaire_numero'
@@ -326,7 +474,16 @@ class AffaireNumero(Base):
     id = Column(Integer, primary_key=True)
     affaire_id = Column(Integer, ForeignKey(Affaire.id), nullable=False)
     numero_id = Column(Integer, ForeignKey(Numero.id), nullable=False)
-    modifie = Column(Boolean, default=False, nullable=False)
+    modifie = Column(Boolean(name='modifie'), default=False, nullable=False)
+
+    affaire = relationship(Affaire, back_populates='numeros')
+    numero = relationship(Numero)
+
+
+Index('ix_affaire_numero_affaire_id', AffaireNumero.affaire_id)
+# the affaires of a numero, without reading the table
+Index('ix_affaire_numero_numero_id_affaire_id',
+      AffaireNumero.numero_id, AffaireNumero.affaire_id)
 
 
 class Services(Base):
@@ -370,9 +527,24 @@ class Preavis(Base):
     __table_args__ = {'schema': 'preavis'}
     id = Column(Integer, primary_key=True)
     affaire_id = Column(Integer, ForeignKey(Affaire.id), nullable=False)
-    service_id = Column(Integer, ForeignKey(Service.id), nullable=False)
-    preavis_id = Column(Text, ForeignKey(Preavis_type.id) nullable=False)
-    decision = Column(Text, ForeignKey(PreavisDecision.id), nullable=False)
+    service_id = Column(Integer, ForeignKey(Services.id), nullable=False)
+    preavis_id = Column(Integer, ForeignKey(PreavisType.id), nullable=False)
+    decision = Column(Integer, ForeignKey(PreavisDecision.id), nullable=False)
     date_demande = Column(
         Date, default=datetime.datetime.utcnow, nullable=False)
     date_reponse = Column(Date)
+    # last reminder sent to the service (services.preavis)
+    date_rappel = Column(Date)
+
+    affaire = relationship(Affaire, back_populates='preavis')
+    service = relationship(Services)
+    preavis_type = relationship(PreavisType)
+    preavis_decision = relationship(PreavisDecision)
+
+
+Index('ix_preavis_affaire_id', Preavis.affaire_id)
+Index('ix_preavis_service_id', Preavis.service_id)
+# the unanswered preavis, a small part of the table
+Index('ix_preavis_date_demande_ouvert', Preavis.date_demande,
+      postgresql_where=Preavis.date_reponse.is_(None),
+      sqlite_where=Preavis.date_reponse.is_(None))
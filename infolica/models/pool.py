@@ -0,0 +1,165 @@
+import threading
+import time
+
+from sqlalchemy import event, exc, text
+from sqlalchemy.pool import QueuePool
+
+STATEMENT_TIMEOUT_KEY = 'statement_timeout'
+
+
+class PoolMetrics(object):
+    """Counters of the connection checkouts of a pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.max_checked_out = 0
+
+    def record(self, checked_out, waited=None, timeout=False):
+        with self._lock:
+            if timeout:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.max_checked_out = max(self.max_checked_out, checked_out)
+            if waited is not None:
+                self.waits += 1
+                self.wait_time += waited
+
+    def as_dict(self):
+        return {
+            'checkouts': self.checkouts,
+            'waits': self.waits,
+            'wait_time': self.wait_time,
+            'timeouts': self.timeouts,
+            'max_checked_out': self.max_checked_out,
+        }
+
+
+class MeteredQueuePool(QueuePool):
+    """
+    ``QueuePool`` counting checkouts and the time spent waiting.
+
+    A checkout waits when no connection is idle and the overflow is
+    used up, so it blocks until another thread checks one in or
+    ``pool_timeout`` passes.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        exhausted = self._pool.empty() and -1 < self._max_overflow <= \
+            self._overflow
+        start = time.perf_counter()
+        try:
+            connection = super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            self.metrics.record(
+                self.checkedout(), time.perf_counter() - start, timeout=True)
+            raise
+        self.metrics.record(
+            self.checkedout(),
+            time.perf_counter() - start if exhausted else None)
+        return connection
+
+    def recreate(self):
+        # keep counting across Engine.dispose()
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+def pool_status(engine):
+    """Size, use and checkout counters of the pool of ``engine``."""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {'class': type(pool).__name__}
+    status = {
+        'class': type(pool).__name__,
+        'size': pool.size(),
+        'max_overflow': pool._max_overflow,
+        'checked_out': pool.checkedout(),
+        'idle': pool.checkedin(),
+        'overflow': max(pool.overflow(), 0),
+    }
+    metrics = getattr(pool, 'metrics', None)
+    if metrics is not None:
+        status.update(metrics.as_dict())
+    return status
+
+
+def watch_sqlite_timeouts(engine):
+    """
+    Interrupt SQLite statements running longer than the statement
+    timeout of their session.
+
+    SQLite has no statement timeout, so a progress handler checks a
+    deadline set around each statement.
+
+    """
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, record):
+        deadline = record.info['statement_deadline'] = [None]
+        dbapi_connection.set_progress_handler(
+            lambda: deadline[0] is not None and time.monotonic() > deadline[0],
+            10000)
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, record):
+        record.info.pop(STATEMENT_TIMEOUT_KEY, None)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        timeout = conn.info.get(STATEMENT_TIMEOUT_KEY)
+        deadline = conn.info.get('statement_deadline')
+        if deadline is not None:
+            deadline[0] = time.monotonic() + timeout if timeout else None
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        deadline = conn.info.get('statement_deadline')
+        if deadline is not None:
+            deadline[0] = None
+
+
+def _apply_statement_timeout(connection, timeout):
+    connection.info[STATEMENT_TIMEOUT_KEY] = timeout
+    if connection.dialect.name == 'postgresql':
+        # only for the current transaction
+        connection.execute(text('SET LOCAL statement_timeout = %d' % (
+            int(timeout * 1000) if timeout else 0)))
+
+
+def watch_statement_timeouts(session_factory, default=None):
+    """
+    Apply the statement timeout of each session of ``session_factory``.
+
+    The timeout is ``default`` seconds unless changed for a session with
+    :func:`set_statement_timeout`; None or 0 means no timeout.
+
+    """
+    @event.listens_for(session_factory, 'after_begin')
+    def after_begin(session, transaction, connection):
+        timeout = session.info.get(STATEMENT_TIMEOUT_KEY, default)
+        if timeout or connection.dialect.name != 'postgresql':
+            _apply_statement_timeout(connection, timeout)
+
+
+def set_statement_timeout(dbsession, timeout):
+    """
+    Change the statement timeout of ``dbsession``, in seconds.
+
+    Views running long reports raise it for their request, e.g.
+    ``set_statement_timeout(request.dbsession, 300)``.
+
+    """
+    dbsession.info[STATEMENT_TIMEOUT_KEY] = timeout
+    _apply_statement_timeout(dbsession.connection(), timeout)
@@ -0,0 +1,52 @@
+from sqlalchemy.orm import joinedload, selectinload
+
+from .mymodel import (
+    Affaire,
+    AffaireNumero,
+    EtapeAffaire,
+    Numero,
+    Preavis,
+    RelationAffaireClient,
+)
+from .statut import AffaireStatutCourant
+
+# many-to-one references are joined into the main query, collections are
+# each read with one more "IN" query, so the number of queries of a
+# profile does not depend on the number of rows
+_AFFAIRE_REFERENCES = (
+    joinedload(Affaire.responsable),
+    joinedload(Affaire.technicien),
+    joinedload(Affaire.type),
+    joinedload(Affaire.cadastre),
+    joinedload(Affaire.statut_courant).joinedload(AffaireStatutCourant.statut),
+)
+
+LOADING_PROFILES = {
+    # affaires with their operators, type, cadastre and status: 1 query
+    'affaire_list': _AFFAIRE_REFERENCES,
+    # one affaire with everything shown on its page: 5 queries, plus one
+    # per client subclass present
+    'affaire_detail': _AFFAIRE_REFERENCES + (
+        selectinload(Affaire.etapes).joinedload(EtapeAffaire.statut),
+        selectinload(Affaire.clients).joinedload(
+            RelationAffaireClient.client),
+        selectinload(Affaire.clients).joinedload(
+            RelationAffaireClient.relation_type),
+        selectinload(Affaire.numeros).joinedload(
+            AffaireNumero.numero).joinedload(Numero.type),
+        selectinload(Affaire.numeros).joinedload(
+            AffaireNumero.numero).joinedload(Numero.etat),
+        selectinload(Affaire.preavis).joinedload(Preavis.service),
+        selectinload(Affaire.preavis).joinedload(Preavis.preavis_type),
+        selectinload(Affaire.preavis).joinedload(Preavis.preavis_decision),
+    ),
+}
+
+
+def with_profile(query, profile):
+    """Apply the loader options of a named loading profile to ``query``."""
+    try:
+        options = LOADING_PROFILES[profile]
+    except KeyError:
+        raise ValueError('Unknown loading profile: %s' % profile)
+    return query.options(*options)
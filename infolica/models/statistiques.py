@@ -0,0 +1,272 @@
+import datetime
+
+from sqlalchemy import (
+    Column,
+    Date,
+    ForeignKey,
+    Index,
+    Integer,
+    and_,
+    bindparam,
+    case,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.orm.attributes import PASSIVE_NO_INITIALIZE, get_history
+
+from .meta import Base
+from .mymodel import Affaire, AffaireType, Operateur
+
+
+class StatistiqueOperateur(Base):
+    """
+    Open affaires (without ``date_cloture``) of each operator, as
+    responsable and as technicien.
+
+    """
+    __tablename__ = 'statistique_operateur'
+    __table_args__ = {'schema': 'affaire'}
+    operateur_id = Column(Integer, ForeignKey(Operateur.id), primary_key=True)
+    ouvertes_responsable = Column(Integer, default=0, nullable=False)
+    ouvertes_technicien = Column(Integer, default=0, nullable=False)
+
+
+class StatistiqueMois(Base):
+    """
+    Affaires closed by responsable, month of ``date_cloture`` and type,
+    with their total days from ``date_ouverture`` to ``date_cloture``.
+
+    """
+    __tablename__ = 'statistique_mois'
+    __table_args__ = {'schema': 'affaire'}
+    operateur_id = Column(Integer, ForeignKey(Operateur.id), primary_key=True)
+    # first day of the month
+    mois = Column(Date, primary_key=True)
+    type_id = Column(Integer, ForeignKey(AffaireType.id), primary_key=True)
+    cloturees = Column(Integer, default=0, nullable=False)
+    jours = Column(Integer, default=0, nullable=False)
+
+
+Index('ix_statistique_mois_type_id_mois',
+      StatistiqueMois.type_id, StatistiqueMois.mois)
+
+# Both tables are maintained from the Affaire mapper events below, in the
+# transaction of the change, by adding its difference to the rows of the
+# buckets it moves: the dashboards read a row per operator, month and
+# type instead of aggregating the whole history.  Bulk query.update()
+# statements and imports bypass the events, rebuild_statistiques repairs
+# the tables afterwards.
+
+_COLUMNS = ('responsable_id', 'technicien_id', 'type_id', 'date_ouverture',
+            'date_cloture')
+
+
+def _month(date):
+    return date.replace(day=1)
+
+
+def _buckets(values):
+    """
+    ``{(model, key): {column: value}}`` an affaire with ``values`` (a
+    dict of ``_COLUMNS``) adds to the rollups.
+
+    """
+    buckets = {}
+
+    def add(model, key, column, value):
+        columns = buckets.setdefault((model, key), {})
+        columns[column] = columns.get(column, 0) + value
+
+    if values['date_cloture'] is None:
+        add(StatistiqueOperateur, (values['responsable_id'],),
+            'ouvertes_responsable', 1)
+        add(StatistiqueOperateur, (values['technicien_id'],),
+            'ouvertes_technicien', 1)
+    else:
+        key = (values['responsable_id'], _month(values['date_cloture']),
+               values['type_id'])
+        add(StatistiqueMois, key, 'cloturees', 1)
+        add(StatistiqueMois, key, 'jours', (
+            values['date_cloture'] - values['date_ouverture']).days)
+    return buckets
+
+
+def _difference(before, after):
+    """The deltas changing an affaire from ``before`` to ``after``."""
+    deltas = {}
+    for values, sign in ((before, -1), (after, 1)):
+        if values is None:
+            continue
+        for bucket, columns in _buckets(values).items():
+            delta = deltas.setdefault(bucket, {})
+            for column, value in columns.items():
+                delta[column] = delta.get(column, 0) + sign * value
+    return {bucket: {c: v for c, v in delta.items() if v}
+            for bucket, delta in deltas.items() if any(delta.values())}
+
+
+def apply_deltas(connection, deltas):
+    """Add ``{(table, key): {column: delta}}`` to the rollup rows."""
+    for (model, key), delta in sorted(
+            deltas.items(), key=lambda item: (item[0][0].__name__,
+                                              item[0][1])):
+        table = model.__table__
+        where = and_(*[c == v for c, v in zip(table.primary_key.columns, key)])
+        result = connection.execute(table.update().where(where).values(
+            {column: table.c[column] + value
+             for column, value in delta.items()}))
+        if result.rowcount == 0:
+            values = {c: 0 for c in table.c.keys()}
+            values.update(zip(table.primary_key.columns.keys(), key))
+            values.update(delta)
+            connection.execute(table.insert().values(values))
+
+
+def _date(value):
+    # the column default is utcnow, a datetime until loaded again
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+def _values(row):
+    return {name: _date(row[name]) for name in _COLUMNS}
+
+
+def _changes(connection, target):
+    """
+    Values of ``target`` in the database and as the flush writes it, the
+    former read again when one was changed without being loaded.
+
+    """
+    histories = {name: get_history(target, name, PASSIVE_NO_INITIALIZE)
+                 for name in _COLUMNS}
+    before = {}
+    for name, history in histories.items():
+        if history.deleted:
+            before[name] = history.deleted[0]
+        elif history.unchanged:
+            before[name] = history.unchanged[0]
+        else:
+            affaire = Affaire.__table__
+            row = connection.execute(select(
+                [affaire.c[c] for c in _COLUMNS]).where(
+                    affaire.c.id == target.id)).first()
+            before = dict(zip(_COLUMNS, row))
+            break
+    after = {name: history.added[0] if history.added else before[name]
+             for name, history in histories.items()}
+    return _values(before), _values(after)
+
+
+@event.listens_for(Affaire, 'after_insert')
+def _affaire_inserted(mapper, connection, target):
+    after = _values({name: getattr(target, name) for name in _COLUMNS})
+    apply_deltas(connection, _difference(None, after))
+
+
+@event.listens_for(Affaire, 'before_update')
+def _affaire_updated(mapper, connection, target):
+    before, after = _changes(connection, target)
+    apply_deltas(connection, _difference(before, after))
+
+
+@event.listens_for(Affaire, 'before_delete')
+def _affaire_deleted(mapper, connection, target):
+    before, _ = _changes(connection, target)
+    apply_deltas(connection, _difference(before, None))
+
+
+def expected_statistiques():
+    """
+    Select the rows of both rollups from the affaires: ``(operateur_id,
+    ouvertes_responsable, ouvertes_technicien)`` and ``(operateur_id,
+    mois, type_id, cloturees, jours)``, the month being computed in
+    Python as databases truncate dates differently.
+
+    """
+    affaire = Affaire.__table__
+    ouvertes = affaire.c.date_cloture.is_(None)
+    responsable = select([
+        affaire.c.responsable_id.label('operateur_id'),
+        func.count().label('ouvertes_responsable'),
+        func.sum(case([(affaire.c.responsable_id == affaire.c.technicien_id,
+                        1)], else_=0)).label('ouvertes_technicien'),
+    ]).where(ouvertes).group_by(affaire.c.responsable_id)
+    technicien = select([
+        affaire.c.technicien_id.label('operateur_id'),
+        func.count().label('ouvertes_technicien'),
+    ]).where(ouvertes).where(
+        affaire.c.responsable_id != affaire.c.technicien_id).group_by(
+            affaire.c.technicien_id)
+    cloturees = select([
+        affaire.c.responsable_id, affaire.c.type_id,
+        affaire.c.date_ouverture, affaire.c.date_cloture,
+    ]).where(affaire.c.date_cloture.isnot(None))
+    return responsable, technicien, cloturees
+
+
+def rebuild_statistiques(dbsession):
+    """
+    Repair drift between the rollups and the affaires.
+
+    Only differing rows are written, rows counting nothing are deleted.
+    Returns the number of inserted, updated and deleted rows.
+
+    """
+    responsable, technicien, cloturees = expected_statistiques()
+    expected = {}
+    for row in dbsession.execute(responsable):
+        expected[StatistiqueOperateur, (row.operateur_id,)] = {
+            'ouvertes_responsable': row.ouvertes_responsable,
+            'ouvertes_technicien': int(row.ouvertes_technicien or 0)}
+    for row in dbsession.execute(technicien):
+        expected.setdefault((StatistiqueOperateur, (row.operateur_id,)), {
+            'ouvertes_responsable': 0, 'ouvertes_technicien': 0,
+        })['ouvertes_technicien'] += row.ouvertes_technicien
+    rows = dbsession.execute(cloturees.execution_options(stream_results=True))
+    for row in rows:
+        values = expected.setdefault((StatistiqueMois, (
+            row.responsable_id, _month(_date(row.date_cloture)),
+            row.type_id)),
+            {'cloturees': 0, 'jours': 0})
+        values['cloturees'] += 1
+        values['jours'] += (_date(row.date_cloture) -
+                            _date(row.date_ouverture)).days
+
+    inserted = updated = deleted = 0
+    for model in (StatistiqueOperateur, StatistiqueMois):
+        table = model.__table__
+        keys = table.primary_key.columns.keys()
+        columns = [c for c in table.c.keys() if c not in keys]
+        current = {
+            (model, tuple(row[k] for k in keys)): {c: row[c] for c in columns}
+            for row in dbsession.execute(select([table]))
+        }
+        wanted = {k: v for k, v in expected.items() if k[0] is model}
+        to_insert = [k for k in wanted if k not in current]
+        to_update = [k for k in wanted
+                     if k in current and current[k] != wanted[k]]
+        to_delete = [k for k in current if k not in wanted]
+        if to_insert:
+            dbsession.execute(table.insert(), [
+                dict(zip(keys, k[1]), **wanted[k]) for k in to_insert])
+        if to_update:
+            # the keys are renamed, a bind named after a SET column is
+            # reserved
+            dbsession.execute(
+                table.update().where(and_(*[
+                    table.c[k] == bindparam('b_' + k) for k in keys])),
+                [dict({'b_' + n: v for n, v in zip(keys, k[1])}, **wanted[k])
+                 for k in to_update])
+        if to_delete:
+            dbsession.execute(
+                table.delete().where(and_(*[
+                    table.c[k] == bindparam('b_' + k) for k in keys])),
+                [{'b_' + n: v for n, v in zip(keys, k[1])}
+                 for k in to_delete])
+        inserted += len(to_insert)
+        updated += len(to_update)
+        deleted += len(to_delete)
+    return inserted, updated, deleted
@@ -0,0 +1,155 @@
+from sqlalchemy import (
+    Column,
+    Index,
+    Integer,
+    Date,
+    ForeignKey,
+    bindparam,
+    event,
+    func,
+    select,
+)
+from sqlalchemy.orm import relationship
+from sqlalchemy.orm.attributes import get_history
+
+from .meta import Base
+from .mymodel import Affaire, EtapeAffaire, StatutAffaire
+
+
+class AffaireStatutCourant(Base):
+    """
+    Latest ``EtapeAffaire`` of each affaire.
+
+    Maintained from the ``EtapeAffaire`` mapper events below, so the
+    current status of many affaires is one indexed join instead of a
+    groupwise maximum over the whole step history.  Steps are ordered by
+    ``(date, id)``.
+
+    """
+    __tablename__ = 'affaire_statut_courant'
+    __table_args__ = {'schema': 'affaire'}
+    affaire_id = Column(Integer, ForeignKey(Affaire.id), primary_key=True)
+    etape_id = Column(Integer, ForeignKey(EtapeAffaire.id), nullable=False)
+    statut_id = Column(Integer, ForeignKey(StatutAffaire.id), nullable=False)
+    date = Column(Date, nullable=False)
+
+    statut = relationship(StatutAffaire)
+
+
+# read only, the rows are written by the events below
+Affaire.statut_courant = relationship(
+    AffaireStatutCourant, uselist=False, viewonly=True)
+
+Index('ix_affaire_statut_courant_statut_id', AffaireStatutCourant.statut_id)
+Index('ix_affaire_statut_courant_etape_id', AffaireStatutCourant.etape_id)
+Index('ix_etape_affaire_affaire_id_date_id',
+      EtapeAffaire.affaire_id, EtapeAffaire.date, EtapeAffaire.id)
+
+
+def _latest_etape(connection, affaire_id):
+    etape = EtapeAffaire.__table__
+    return connection.execute(
+        select([etape.c.id, etape.c.statut_id, etape.c.date])
+        .where(etape.c.affaire_id == affaire_id)
+        .order_by(etape.c.date.desc(), etape.c.id.desc())
+        .limit(1)
+    ).first()
+
+
+def refresh_statut_courant(connection, affaire_id):
+    """Recompute the current status of one affaire."""
+    table = AffaireStatutCourant.__table__
+    latest = _latest_etape(connection, affaire_id)
+    if latest is None:
+        connection.execute(
+            table.delete().where(table.c.affaire_id == affaire_id))
+        return
+    values = {
+        'etape_id': latest.id,
+        'statut_id': latest.statut_id,
+        'date': latest.date,
+    }
+    result = connection.execute(
+        table.update().where(table.c.affaire_id == affaire_id).values(values))
+    if result.rowcount == 0:
+        connection.execute(
+            table.insert().values(affaire_id=affaire_id, **values))
+
+
+@event.listens_for(EtapeAffaire, 'after_insert')
+@event.listens_for(EtapeAffaire, 'after_delete')
+def _etape_changed(mapper, connection, target):
+    refresh_statut_courant(connection, target.affaire_id)
+
+
+@event.listens_for(EtapeAffaire, 'after_update')
+def _etape_updated(mapper, connection, target):
+    history = get_history(target, 'affaire_id')
+    for affaire_id in set(history.deleted or ()) | {target.affaire_id}:
+        refresh_statut_courant(connection, affaire_id)
+
+
+def expected_statut_courant():
+    """Select the current status of every affaire from the step history."""
+    etape = EtapeAffaire.__table__
+    rank = func.row_number().over(
+        partition_by=etape.c.affaire_id,
+        order_by=(etape.c.date.desc(), etape.c.id.desc()),
+    ).label('rank')
+    ranked = select([
+        etape.c.affaire_id,
+        etape.c.id.label('etape_id'),
+        etape.c.statut_id,
+        etape.c.date,
+        rank,
+    ]).alias('ranked')
+    return select([
+        ranked.c.affaire_id,
+        ranked.c.etape_id,
+        ranked.c.statut_id,
+        ranked.c.date,
+    ]).where(ranked.c.rank == 1)
+
+
+def rebuild_statut_courant(dbsession):
+    """
+    Repair drift between the projection and the step history.
+
+    Only differing rows are written.  Returns the number of inserted,
+    updated and deleted rows.
+
+    """
+    table = AffaireStatutCourant.__table__
+    expected = {
+        row.affaire_id: (row.etape_id, row.statut_id, row.date)
+        for row in dbsession.execute(expected_statut_courant())
+    }
+    current = {
+        row.affaire_id: (row.etape_id, row.statut_id, row.date)
+        for row in dbsession.execute(select([
+            table.c.affaire_id, table.c.etape_id,
+            table.c.statut_id, table.c.date]))
+    }
+
+    def values(affaire_id, key='affaire_id'):
+        etape_id, statut_id, date = expected[affaire_id]
+        return {key: affaire_id, 'etape_id': etape_id,
+                'statut_id': statut_id, 'date': date}
+
+    inserted = [k for k in expected if k not in current]
+    updated = [k for k in expected
+               if k in current and expected[k] != current[k]]
+    deleted = [k for k in current if k not in expected]
+
+    if inserted:
+        dbsession.execute(table.insert(), [values(k) for k in inserted])
+    if updated:
+        # the key is renamed, a bind named after a SET column is reserved
+        dbsession.execute(
+            table.update().where(
+                table.c.affaire_id == bindparam('b_affaire_id')),
+            [values(k, 'b_affaire_id') for k in updated])
+    for i in range(0, len(deleted), 500):
+        dbsession.execute(
+            table.delete().where(table.c.affaire_id.in_(deleted[i:i + 500])))
+    return len(inserted), len(updated), len(deleted)
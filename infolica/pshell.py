@@ -9,5 +9,7 @@ def setup(env):
 
     # inject some vars into the shell builtins
     env['tm'] = request.tm
-    env['dbsession'] = request.dbsession
+    # the primary database, request.dbsession of a GET may be the replica
+    env['dbsession'] = models.get_tm_session(
+        request.registry['dbsession_factory'], request.tm)
     env['models'] = models
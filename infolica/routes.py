@@ -1,3 +1,31 @@
 def includeme(config):
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/')
+    config.add_route('affaires', '/api/affaires')
+    config.add_route('affaires_statuts', '/api/affaires/statuts')
+    config.add_route('affaires_bbox', '/api/affaires/bbox')
+    config.add_route('affaires_radius', '/api/affaires/radius')
+    config.add_route('affaire', '/api/affaires/{id}')
+    config.add_route('affaire_famille', '/api/affaires/{id}/famille')
+    config.add_route('affaire_full', '/api/affaires/{id}/full')
+    config.add_route('numeros_reservations', '/api/numeros/reservations')
+    config.add_route('numero_lineage', '/api/numeros/{id}/lineage')
+    config.add_route('tarifs', '/api/tarifs')
+    config.add_route('clients_recherche', '/api/clients/recherche')
+    config.add_route('export_affaires', '/api/export/affaires')
+    config.add_route('export_factures', '/api/export/factures')
+    config.add_route('export_numeros', '/api/export/numeros')
+    config.add_route('documents', '/api/documents')
+    config.add_route('document_info', '/api/documents/{id}/info')
+    config.add_route('document', '/api/documents/{id}')
+    config.add_route('preavis_retard', '/api/preavis/retard')
+    config.add_route('preavis_statistiques', '/api/preavis/statistiques')
+    config.add_route('statistiques_operateurs',
+                     '/api/statistiques/operateurs')
+    config.add_route('statistiques_types', '/api/statistiques/types')
+    config.add_route('jobs', '/api/jobs')
+    config.add_route('job', '/api/jobs/{id}')
+    config.add_route('response_cache_stats', '/api/cache/stats')
+    config.add_route('pool_stats', '/api/pool/stats')
+    config.add_route('slow_queries', '/api/slow-queries')
+    config.add_route('metrics', '/metrics')
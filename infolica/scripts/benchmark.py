@@ -0,0 +1,424 @@
+import argparse
+import datetime
+import random
+import sys
+import time
+
+import transaction
+
+from .. import models
+from ..models.meta import Base
+from ..services.spatial import AffaireSpatialIndex
+
+# Swiss LV95 extent of the canton
+E_RANGE = (2520000, 2580000)
+N_RANGE = (1180000, 1230000)
+
+NOMS = [
+    'Aubert', 'Béguin', 'Bonjour', 'Chappuis', 'Châtelain', 'Cuche',
+    'Dubois', 'Ducommun', 'Favre', 'Gaillard', 'Girard', 'Huguenin',
+    'Jacot', 'Jeanneret', 'L\'Eplattenier', 'Matthey', 'Monnier', 'Müller',
+    'Perrenoud', 'Perret', 'Robert', 'Rossel', 'Sandoz', 'Vuilleumier',
+]
+PRENOMS = [
+    'André', 'Anne', 'Benoît', 'Céline', 'Chloé', 'François', 'Hélène',
+    'Jérôme', 'Léa', 'Loïc', 'Marc', 'Noémie', 'Pierre', 'Sébastien',
+]
+LOCALITES = [
+    ('2000', 'Neuchâtel'), ('2300', 'La Chaux-de-Fonds'),
+    ('2400', 'Le Locle'), ('2017', 'Boudry'), ('2108', 'Couvet'),
+    ('2525', 'Le Landeron'), ('2053', 'Cernier'), ('2088', 'Cressier'),
+    ('2114', 'Fleurier'),
+]
+SYLLABES = ['ber', 'bo', 'chat', 'du', 'fer', 'gui', 'lard', 'ler', 'mé',
+            'mon', 'net', 'quin', 'rot', 'tel', 'val', 'zin']
+RUES = ['Rue de la Gare', 'Avenue Léopold-Robert', 'Chemin des Prés',
+        'Rue du Château', 'Faubourg de l\'Hôpital', 'Grand-Rue']
+
+
+def create_reference_data(dbsession, cadastres=10, operateurs=20, types=5):
+    """Add the general rows affaires point to."""
+    dbsession.add_all(
+        [models.Cadastre(id=i, nom='Cadastre %d' % i)
+         for i in range(1, cadastres + 1)] +
+        [models.Operateur(id=i, nom='Nom %d' % i, prenom='Prenom %d' % i)
+         for i in range(1, operateurs + 1)] +
+        [models.AffaireType(id=i, nom='Type %d' % i)
+         for i in range(1, types + 1)]
+    )
+    dbsession.flush()
+
+
+def generate_affaires(dbsession, size, seed=0, chunk_size=10000):
+    """Bulk insert ``size`` random affaires (reference data must exist)."""
+    rnd = random.Random(seed)
+    start = datetime.date(2000, 1, 1)
+    table = models.Affaire.__table__
+    for offset in range(0, size, chunk_size):
+        rows = []
+        for i in range(offset + 1, min(offset + chunk_size, size) + 1):
+            ouverture = start + datetime.timedelta(days=rnd.randrange(7000))
+            closed = rnd.random() < 0.7
+            rows.append({
+                'id': i,
+                'responsable_id': rnd.randint(1, 20),
+                'technicien_id': rnd.randint(1, 20),
+                'type_id': rnd.randint(1, 5),
+                'cadastre_id': rnd.randint(1, 10),
+                'date_ouverture': ouverture,
+                'date_cloture': (
+                    ouverture + datetime.timedelta(days=rnd.randrange(400))
+                    if closed else None),
+                'localisation_E': rnd.randint(*E_RANGE),
+                'localisation_N': rnd.randint(*N_RANGE),
+            })
+        dbsession.execute(table.insert(), rows)
+
+
+def generate_clients(dbsession, size, seed=0, chunk_size=10000):
+    """Bulk insert ``size`` random clients, one in five a company."""
+    rnd = random.Random(seed)
+    client = models.Client.__table__
+    personne = models.ClientPersonne.__table__
+    entreprise = models.ClientEntreprise.__table__
+    for offset in range(0, size, chunk_size):
+        clients, personnes, entreprises = [], [], []
+        for i in range(offset + 1, min(offset + chunk_size, size) + 1):
+            npa, localite = rnd.choice(LOCALITES)
+            # made up names give a realistic number of distinct names
+            if rnd.random() < 0.3:
+                nom = rnd.choice(NOMS)
+            else:
+                nom = ''.join(rnd.choice(SYLLABES) for _ in range(
+                    rnd.randint(2, 3))).capitalize()
+            is_entreprise = rnd.random() < 0.2
+            clients.append({
+                'id': i,
+                'adresse': '%s %d' % (rnd.choice(RUES), rnd.randint(1, 150)),
+                'npa': npa,
+                'localite': localite,
+                'entree': datetime.date(2000, 1, 1),
+                'type': ('client_entreprise' if is_entreprise
+                         else 'client_personne'),
+            })
+            if is_entreprise:
+                entreprises.append({'id': i, 'nom': '%s SA' % nom})
+            else:
+                personnes.append({'id': i, 'nom': nom, 'tel_portable': '',
+                                  'prenom': rnd.choice(PRENOMS)})
+        dbsession.execute(client.insert(), clients)
+        if personnes:
+            dbsession.execute(personne.insert(), personnes)
+        if entreprises:
+            dbsession.execute(entreprise.insert(), entreprises)
+
+
+def generate_numeros(dbsession, size, seed=0, chunk_size=10000,
+                     cadastres=10, types=3, etats=3):
+    """
+    Bulk insert ``size`` numeros, numbered per cadastre and type, one in
+    ten with a suffix (cadastres, types and etats must exist).
+
+    """
+    rnd = random.Random(seed)
+    table = models.Numero.__table__
+    next_numero = {}
+    for offset in range(0, size, chunk_size):
+        rows = []
+        for i in range(offset + 1, min(offset + chunk_size, size) + 1):
+            key = (rnd.randint(1, cadastres), rnd.randint(1, types))
+            next_numero[key] = numero = next_numero.get(key, 0) + 1
+            rows.append({
+                'id': i,
+                'cadastre_id': key[0],
+                'type_id': key[1],
+                'numero': numero,
+                'suffixe': str(rnd.randint(1, 9))
+                if rnd.random() < 0.1 else None,
+                'etat_id': rnd.randint(1, etats),
+            })
+        dbsession.execute(table.insert(), rows)
+
+
+def generate_links(dbsession, model, size, left, right, seed=0,
+                   chunk_size=10000):
+    """
+    Bulk insert ``size`` random rows of a link ``model`` between ids
+    ``1..left[1]`` of column ``left[0]`` and ``1..right[1]`` of column
+    ``right[0]``.
+
+    """
+    rnd = random.Random(seed)
+    table = model.__table__
+    for offset in range(0, size, chunk_size):
+        dbsession.execute(table.insert(), [
+            {left[0]: rnd.randint(1, left[1]),
+             right[0]: rnd.randint(1, right[1])}
+            for i in range(offset, min(offset + chunk_size, size))])
+
+
+def _timed(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - start) / repeat, result
+
+
+def bench_spatial(dbsession, args):
+    """Bounding box queries: table scan vs composite index vs grid."""
+    rnd = random.Random(args.seed)
+    boxes = []
+    for _ in range(args.queries):
+        e = rnd.randint(*E_RANGE)
+        n = rnd.randint(*N_RANGE)
+        boxes.append((e, n, e + 2000, n + 1500))
+
+    A = models.Affaire
+
+    def sql(box, e_col, n_col):
+        return dbsession.query(A.id).filter(
+            e_col.between(box[0], box[2]),
+            n_col.between(box[1], box[3])).all()
+
+    # "+ 0" keeps the planner from using the index
+    scan = [lambda b=b: sql(b, A.localisation_E + 0, A.localisation_N + 0)
+            for b in boxes]
+    indexed = [lambda b=b: sql(b, A.localisation_E, A.localisation_N)
+               for b in boxes]
+
+    load_start = time.perf_counter()
+    index = AffaireSpatialIndex(cell_size=args.cell_size)
+    index.load(dbsession)
+    load_time = time.perf_counter() - load_start
+    grid = [lambda b=b: index.bbox(*b) for b in boxes]
+
+    print('grid load: %.2f s for %d affaires' % (load_time, len(index)))
+    for name, funcs in (('scan', scan), ('index', indexed), ('grid', grid)):
+        total = sum(_timed(f, 1)[0] for f in funcs)
+        print('%-6s %8.3f ms/query' % (name, 1000 * total / len(funcs)))
+
+
+def bench_paging(dbsession, args):
+    """Pages of 100 affaires at increasing depth: OFFSET vs keyset."""
+    from ..services.listing import encode_cursor
+    from ..views.affaires import affaire_paginator, affaires_query
+
+    A = models.Affaire
+    ordered = affaires_query(dbsession).order_by(
+        A.date_ouverture, A.id)
+    for depth in (0, args.size // 10, args.size // 2, args.size - 100):
+        def offset():
+            return ordered.offset(depth).limit(100).all()
+
+        params = {'limit': '100'}
+        if depth:
+            key = ordered.offset(depth - 1).first()
+            params['cursor'] = encode_cursor([key.date_ouverture, key.id])
+
+        def keyset():
+            return affaire_paginator.page(affaires_query(dbsession), params)
+
+        print('depth %7d  offset %8.3f ms  keyset %8.3f ms' % (
+            depth,
+            1000 * _timed(offset, args.queries // 10 or 1)[0],
+            1000 * _timed(keyset, args.queries // 10 or 1)[0]))
+
+
+def bench_facturation(dbsession, args):
+    """Invoices of closed affaires: one ORM object at a time vs batch."""
+    from ..services.facturation import (
+        affaires_a_facturer,
+        facturer_affaires_dues,
+    )
+
+    rnd = random.Random(args.seed)
+    dbsession.execute(models.EmolumentsMO.__table__.insert(), [
+        {'affaire_id': i, 'montant': rnd.randint(500, 20000) / 4.0,
+         'montant_mat_diff': rnd.randint(0, 2000) / 4.0}
+        for i in range(1, args.size + 1)])
+    dbsession.execute(models.EmolumentsRF.__table__.insert(), [
+        {'affaire_id': i, 'montant': rnd.randint(50, 2000) / 4.0}
+        for i in range(1, args.size + 1)])
+    jusqu_au = datetime.date(2030, 1, 1)
+
+    # the per-object path is slow, time it on a sample and roll back
+    sample = dbsession.execute(
+        affaires_a_facturer(jusqu_au).limit(5000)).fetchall()
+    savepoint = dbsession.begin_nested()
+    start = time.perf_counter()
+    for ligne in sample:
+        facture = models.Facture(
+            ligne.montant_mo, ligne.montant_rf, ligne.montant_mat_diff,
+            sap=str(ligne.affaire_id), affaire_id=ligne.affaire_id,
+            date=jusqu_au)
+        facture.calculer_tva()
+        facture.calculer_total()
+        dbsession.add(facture)
+        dbsession.flush()
+    per_object = len(sample) / (time.perf_counter() - start)
+    savepoint.rollback()
+
+    start = time.perf_counter()
+    count = facturer_affaires_dues(dbsession, jusqu_au)
+    batch = count / (time.perf_counter() - start)
+    print('per object %10.0f rows/s (%d rows)' % (per_object, len(sample)))
+    print('batch      %10.0f rows/s (%d rows)' % (batch, count))
+
+
+def bench_tarifs(dbsession, args):
+    """Parameters valid at a date: SQL lookup vs in-memory bisect."""
+    from ..services.tarifs import TarifCache
+
+    P = models.EmolumentsMOParametres
+    start = datetime.date(1990, 1, 1)
+    dbsession.execute(P.__table__.insert(), [
+        {'indice': 1.0 + i / 100.0, 'date': start + datetime.timedelta(
+            days=90 * i)} for i in range(200)])
+    rnd = random.Random(args.seed)
+    dates = [start + datetime.timedelta(days=rnd.randrange(20000))
+             for _ in range(args.queries * 10)]
+
+    def sql():
+        for date in dates:
+            dbsession.query(P).filter(P.date <= date).order_by(
+                P.date.desc(), P.id.desc()).first()
+
+    cache = TarifCache(P)
+    cache.load(dbsession)
+
+    def cached():
+        for date in dates:
+            cache.valid_at(dbsession, date)
+
+    for name, func in (('sql', sql), ('cache', cached)):
+        elapsed = _timed(func, 1)[0]
+        print('%-6s %10.2f us/lookup' % (name, 1e6 * elapsed / len(dates)))
+
+
+def bench_clients(dbsession, args):
+    """Type-ahead client search: LIKE over the joined tables vs index."""
+    from ..services.search import ClientSearchIndex
+
+    generate_clients(dbsession, args.size, args.seed)
+    rnd = random.Random(args.seed)
+    queries = []
+    for _ in range(args.queries):
+        nom = rnd.choice(NOMS)
+        queries.append(nom[:rnd.randint(3, len(nom))] + ' ' +
+                       rnd.choice(LOCALITES)[1][:rnd.randint(2, 5)])
+
+    C = models.Client
+    P = models.ClientPersonne
+    E = models.ClientEntreprise
+
+    def like(query):
+        nom, localite = query.split(' ', 1)
+        return dbsession.query(C.id).outerjoin(P, P.id == C.id).outerjoin(
+            E, E.id == C.id).filter(
+                (P.nom.ilike('%' + nom + '%') | E.nom.ilike('%' + nom + '%')),
+                C.localite.ilike('%' + localite + '%')).limit(20).all()
+
+    load_start = time.perf_counter()
+    index = ClientSearchIndex()
+    index.load(dbsession)
+    load_time = time.perf_counter() - load_start
+
+    print('index load: %.2f s for %d clients' % (load_time, len(index)))
+    for name, func in (('like', like), ('index', index.search)):
+        times = sorted(_timed(lambda q=q: func(q), 1)[0] for q in queries)
+        print('%-6s %8.3f ms/query (p95 %.3f ms)' % (
+            name, 1000 * sum(times) / len(times),
+            1000 * times[int(len(times) * 0.95)]))
+
+
+def bench_indexes(dbsession, args):
+    """Numero, plan and link lookups without and with their indexes."""
+    N = models.Numero
+    AN = models.AffaireNumero
+    NP = models.NumeroPlan
+    dbsession.add_all(
+        [models.NumeroType(id=i, nom='Type %d' % i) for i in (1, 2, 3)] +
+        [models.NumeroEtat(id=i, nom='Etat %d' % i) for i in (1, 2, 3)] +
+        [models.Plan(id=i, cadastre_id=i % 10 + 1, nom='Plan %d' % i)
+         for i in range(1, 501)])
+    dbsession.flush()
+    generate_numeros(dbsession, args.size, args.seed)
+    generate_links(dbsession, AN, args.size, ('affaire_id', args.size),
+                   ('numero_id', args.size), args.seed)
+    generate_links(dbsession, NP, args.size, ('numero_id', args.size),
+                   ('plan_id', 500), args.seed)
+    rnd = random.Random(args.seed)
+    keys = dbsession.query(N.cadastre_id, N.type_id, N.numero).filter(
+        N.suffixe.is_(None)).order_by(N.id).limit(args.queries).all()
+    ids = [rnd.randint(1, args.size) for _ in range(args.queries)]
+    plans = [rnd.randint(1, 500) for _ in range(args.queries)]
+
+    lookups = (
+        ('numero by cadastre, type, numero', N, lambda: [
+            dbsession.query(N.id).filter(
+                N.cadastre_id == c, N.type_id == t, N.numero == n,
+                N.suffixe.is_(None)).all() for c, t, n in keys]),
+        ('affaires of a numero', AN, lambda: [
+            dbsession.query(AN.affaire_id).filter(AN.numero_id == i).all()
+            for i in ids]),
+        ('numeros of a plan', NP, lambda: [
+            dbsession.query(NP.numero_id).filter(NP.plan_id == i).all()
+            for i in plans]),
+    )
+    connection = dbsession.connection()
+    for name, model, func in lookups:
+        indexes = model.__table__.indexes
+        for index in indexes:
+            index.drop(connection)
+        before = _timed(func, 1)[0]
+        for index in indexes:
+            index.create(connection)
+        after = _timed(func, 1)[0]
+        print('%-34s without %9.3f ms  with %7.3f ms  (%d queries)' % (
+            name, 1000 * before / args.queries, 1000 * after / args.queries,
+            args.queries))
+
+
+BENCHMARKS = {
+    'clients': bench_clients,
+    'facturation': bench_facturation,
+    'indexes': bench_indexes,
+    'paging': bench_paging,
+    'spatial': bench_spatial,
+    'tarifs': bench_tarifs,
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument(
+        '--url', default='sqlite://',
+        help='Database URL, defaults to an in-memory SQLite database',
+    )
+    parser.add_argument('--size', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cell-size', type=int, default=500)
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    engine = models.get_engine({'sqlalchemy.url': args.url})
+    Base.metadata.create_all(engine)
+    session_factory = models.get_session_factory(engine)
+
+    # everything runs in one transaction that is rolled back at the end
+    tm = transaction.TransactionManager(explicit=True)
+    tm.begin()
+    try:
+        dbsession = models.get_tm_session(session_factory, tm)
+        start = time.perf_counter()
+        create_reference_data(dbsession)
+        generate_affaires(dbsession, args.size, seed=args.seed)
+        print('generated %d affaires in %.2f s' % (
+            args.size, time.perf_counter() - start))
+        BENCHMARKS[args.benchmark](dbsession, args)
+    finally:
+        tm.abort()
@@ -0,0 +1,354 @@
+import argparse
+import datetime
+import random
+import sys
+import time
+from collections import OrderedDict
+
+from pyramid.paster import bootstrap, setup_logging
+
+from .. import models
+from ..models import get_tm_session, set_statement_timeout
+from ..models.meta import Base
+from ..services.facturation import calculer_montants
+from .benchmark import (
+    LOCALITES,
+    create_reference_data,
+    generate_affaires,
+    generate_clients,
+    generate_links,
+    generate_numeros,
+)
+from .rebuild import REBUILDERS
+
+# rows at scale 1, the other tables follow from the affaires
+AFFAIRES = 10000
+CLIENTS = 5000
+NUMEROS = 20000
+CADASTRES = 10
+PLANS_PAR_CADASTRE = 50
+
+STATUTS = ['Ouverte', 'Terrain', 'Calculs', 'Contrôle', 'Signature',
+           'Clôturée']
+MODIFICATION_TYPES = ['Division', 'Réunion', 'Correction']
+RELATION_CLIENT_TYPES = ['Mandant', 'Facturation', 'Propriétaire']
+NUMERO_TYPES = ['Bien-fonds', 'Droit distinct et permanent', 'PPE']
+NUMERO_ETATS = ['Projet', 'Vigueur', 'Abandonné']
+RELATION_TYPES = ['Division', 'Réunion']
+SERVICES = ['Service des ponts et chaussées', 'Service de l\'énergie',
+            'Service de la faune', 'Service de l\'aménagement',
+            'Service de l\'agriculture', 'Commune']
+PREAVIS_TYPES = ['Préavis', 'Consultation']
+PREAVIS_DECISIONS = ['En attente', 'Favorable', 'Favorable avec réserves',
+                     'Défavorable']
+REMARQUES = ['Bornage à prévoir', 'Client absent', 'Plan envoyé',
+             'Attente du registre foncier', 'Points repérés sur le terrain']
+
+
+def _lookup(model, noms):
+    return [model(id=i, nom=nom) for i, nom in enumerate(noms, 1)]
+
+
+def create_all_reference_data(dbsession):
+    """Add the reference rows of every schema, returns their number."""
+    create_reference_data(dbsession, cadastres=CADASTRES)
+    start = datetime.date(1990, 1, 1)
+    rows = (
+        _lookup(models.StatutAffaire, STATUTS) +
+        _lookup(models.ModificationAffaireType, MODIFICATION_TYPES) +
+        _lookup(models.RelationClientAffaireType, RELATION_CLIENT_TYPES) +
+        _lookup(models.NumeroType, NUMERO_TYPES) +
+        _lookup(models.NumeroEtat, NUMERO_ETATS) +
+        _lookup(models.RelationType, RELATION_TYPES) +
+        _lookup(models.PreavisType, PREAVIS_TYPES) +
+        _lookup(models.PreavisDecision, PREAVIS_DECISIONS) +
+        [models.Services(id=i, service=nom, npa=npa, localite=localite)
+         for i, (nom, (npa, localite)) in enumerate(
+             zip(SERVICES, LOCALITES), 1)])
+    for i in range(40):
+        date = start + datetime.timedelta(days=365 * i)
+        rows.append(models.EmolumentsMOParametres(
+            indice=1.0 + i / 50.0, date=date))
+        rows.append(models.EmolumentsRFParametres(
+            tarif_servitude_principale=100.0 + i,
+            tarif_servitude_secondaire=50.0 + i, date=date))
+    dbsession.add_all(rows)
+    dbsession.flush()
+    # with the cadastres, operateurs and affaire types
+    return len(rows) + CADASTRES + 20 + 5
+
+
+def generate_plans(dbsession, per_cadastre=PLANS_PAR_CADASTRE):
+    dbsession.execute(models.Plan.__table__.insert(), [
+        {'id': (c - 1) * per_cadastre + p, 'cadastre_id': c,
+         'nom': 'Plan %d' % p}
+        for c in range(1, CADASTRES + 1) for p in range(1, per_cadastre + 1)])
+    return CADASTRES * per_cadastre
+
+
+def generate_numero_relations(dbsession, numeros, seed=0,
+                              chunk_size=10000):
+    """Link one numero in ten to a newer one, as after a division."""
+    rnd = random.Random(seed)
+    table = models.NumeroRelation.__table__
+    rows = []
+    count = 0
+    for base in range(1, numeros):
+        if rnd.random() < 0.1:
+            rows.append({
+                'numero_id_base': base,
+                'numero_id_associe': rnd.randint(base + 1, numeros),
+                'relation_type_id': rnd.randint(1, len(RELATION_TYPES)),
+            })
+        if len(rows) == chunk_size:
+            dbsession.execute(table.insert(), rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        dbsession.execute(table.insert(), rows)
+        count += len(rows)
+    return count
+
+
+class _Rows(object):
+    """Rows to insert per table, written every ``chunk_size`` rows."""
+
+    def __init__(self, dbsession, chunk_size):
+        self.dbsession = dbsession
+        self.chunk_size = chunk_size
+        self.rows = OrderedDict()
+        self.counts = OrderedDict()
+
+    def add(self, model, row):
+        rows = self.rows.setdefault(model, [])
+        rows.append(row)
+        if len(rows) >= self.chunk_size:
+            self.flush(model)
+
+    def flush(self, model=None):
+        for model in [model] if model is not None else list(self.rows):
+            rows = self.rows.pop(model, None)
+            if rows:
+                self.dbsession.execute(model.__table__.insert(), rows)
+                name = model.__table__.fullname
+                self.counts[name] = self.counts.get(name, 0) + len(rows)
+
+
+def generate_affaire_rows(dbsession, clients, numeros, seed=0,
+                          chunk_size=10000):
+    """
+    Add the rows hanging off each affaire: steps, remarks, clients,
+    numeros, preavis, fees, invoices, documents sent and modifications.
+
+    Dates follow the affaire: steps and preavis after its opening, the
+    last step and the invoice at its closing.  Returns the number of rows
+    per table.
+
+    """
+    rnd = random.Random(seed)
+    rows = _Rows(dbsession, chunk_size)
+    affaire = models.Affaire.__table__
+    today = datetime.date.today()
+    closed_id = len(STATUTS)
+    last_id = dbsession.execute(
+        affaire.select().with_only_columns(
+            [affaire.c.id]).order_by(affaire.c.id.desc()).limit(1)).scalar()
+    document_id = 0
+    for start in range(1, (last_id or 0) + 1, chunk_size):
+        for a in dbsession.execute(affaire.select().where(
+                affaire.c.id.between(start, start + chunk_size - 1))
+                .order_by(affaire.c.id)).fetchall():
+            fin = a.date_cloture or today
+            jours = max((fin - a.date_ouverture).days, 1)
+
+            def date_dans():
+                return a.date_ouverture + datetime.timedelta(
+                    days=rnd.randint(0, jours))
+
+            etapes = sorted(date_dans() for _ in range(rnd.randint(1, 4)))
+            etapes[0] = a.date_ouverture
+            for rang, date in enumerate(etapes):
+                rows.add(models.EtapeAffaire, {
+                    'affaire_id': a.id, 'date': date,
+                    'statut_id': min(rang + 1, closed_id - 1)})
+            if a.date_cloture is not None:
+                rows.add(models.EtapeAffaire, {
+                    'affaire_id': a.id, 'date': a.date_cloture,
+                    'statut_id': closed_id})
+
+            for _ in range(rnd.randint(0, 2)):
+                rows.add(models.RemarqueAffaire, {
+                    'affaire_id': a.id, 'remarque': rnd.choice(REMARQUES),
+                    'operateur_id': rnd.choice(
+                        (a.responsable_id, a.technicien_id)),
+                    'date': date_dans()})
+
+            client_id = rnd.randint(1, clients)
+            rows.add(models.RelationAffaireClient, {
+                'affaire_id': a.id, 'client_id': client_id,
+                'relation_type_id': 1})
+            if rnd.random() < 0.3:
+                rows.add(models.RelationAffaireClient, {
+                    'affaire_id': a.id, 'client_id': rnd.randint(1, clients),
+                    'relation_type_id': rnd.randint(2, 3)})
+
+            for _ in range(rnd.randint(1, 3)):
+                rows.add(models.AffaireNumero, {
+                    'affaire_id': a.id, 'numero_id': rnd.randint(1, numeros),
+                    'modifie': rnd.random() < 0.5})
+
+            for _ in range(rnd.randint(0, 2)):
+                demande = date_dans()
+                repondu = a.date_cloture is not None or rnd.random() < 0.7
+                rows.add(models.Preavis, {
+                    'affaire_id': a.id,
+                    'service_id': rnd.randint(1, len(SERVICES)),
+                    'preavis_id': rnd.randint(1, len(PREAVIS_TYPES)),
+                    'decision': rnd.randint(2, 4) if repondu else 1,
+                    'date_demande': demande,
+                    'date_reponse': demande + datetime.timedelta(
+                        days=rnd.randint(1, 60)) if repondu else None})
+
+            montant_mo = rnd.randint(500, 20000) / 4.0
+            montant_rf = rnd.randint(50, 2000) / 4.0
+            rows.add(models.EmolumentsMO, {
+                'affaire_id': a.id, 'montant': montant_mo,
+                'montant_mat_diff': rnd.randint(0, 2000) / 4.0})
+            rows.add(models.EmolumentsRF, {
+                'affaire_id': a.id, 'montant': montant_rf})
+
+            # most closed affaires are invoiced, the rest are due
+            if a.date_cloture is not None and rnd.random() < 0.8:
+                partielle = rnd.random() < 0.1
+                # numbered as facturer_affaires_dues does
+                sap = '%d-1' % a.id if partielle else str(a.id)
+                (tva,), (total,) = calculer_montants(
+                    [montant_mo], [montant_rf], [0.0])
+                rows.add(models.Facture, {
+                    'sap': sap, 'affaire_id': a.id, 'client_id': client_id,
+                    'montant_mo': montant_mo, 'montant_rf': montant_rf,
+                    'montant_mat_diff': 0.0, 'montant_tva': tva,
+                    'total': total, 'date': a.date_cloture,
+                    'type': 'facture_partielle' if partielle else 'facture'})
+                if partielle:
+                    rows.add(models.FacturePartielle, {
+                        'sap': sap, 'immeuble': 'Bien-fonds %d' % a.id})
+
+            if rnd.random() < 0.5:
+                document_id += 1
+                rows.add(models.Document, {
+                    'id': document_id,
+                    'chemin': 'affaires/%d/plan_%d.pdf' % (a.id, document_id)})
+                rows.add(models.EnvoiDocument, {
+                    'destinataire_id': client_id, 'date': date_dans()})
+
+            if a.id > 1 and rnd.random() < 0.05:
+                rows.add(models.ModificationAffaire, {
+                    'affaire_id_mere': rnd.randint(max(1, a.id - 1000),
+                                                   a.id - 1),
+                    'affaire_id_fille': a.id,
+                    'type_id': rnd.randint(1, len(MODIFICATION_TYPES))})
+        # parents before children for the foreign keys
+        rows.flush()
+
+    for _ in range(max(1, (last_id or 0) // 100)):
+        rows.add(models.RemarquePreavis, {
+            'remarque': rnd.choice(REMARQUES),
+            'date': today - datetime.timedelta(days=rnd.randint(0, 3650))})
+    rows.flush()
+    return rows.counts
+
+
+def generate(dbsession, scale=1.0, seed=0, chunk_size=10000, report=print):
+    """
+    Fill every schema with ``scale`` times the rows of a small office.
+
+    The rows are written with bulk inserts, derived tables are rebuilt
+    at the end.  ``report`` gets a line per step.  Returns the number of
+    rows per table.
+
+    """
+    affaires = max(int(AFFAIRES * scale), 1)
+    clients = max(int(CLIENTS * scale), 1)
+    numeros = max(int(NUMEROS * scale), 1)
+    counts = OrderedDict()
+
+    def step(name, func, *args):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        if not isinstance(result, dict):
+            result = {name: result}
+        counts.update(result)
+        rows = sum(result.values())
+        report('%-34s %9d rows %8.2f s %10.0f rows/s' % (
+            name, rows, elapsed, rows / elapsed if elapsed else 0))
+
+    def generated(func, size, *args, **kwargs):
+        # the benchmark generators return nothing
+        func(dbsession, size, *args, **kwargs)
+        return size
+
+    step('reference data', create_all_reference_data, dbsession)
+    step('client.client', generated, generate_clients, clients, seed,
+         chunk_size)
+    step('general.plan', generate_plans, dbsession)
+    step('numero.numero', lambda: generated(
+        generate_numeros, numeros, seed, chunk_size, cadastres=CADASTRES,
+        types=len(NUMERO_TYPES), etats=len(NUMERO_ETATS)))
+    step('numero.numero_relation', generate_numero_relations, dbsession,
+         numeros, seed, chunk_size)
+    step('numero.numero_plan', lambda: generate_links(
+        dbsession, models.NumeroPlan, numeros, ('numero_id', numeros),
+        ('plan_id', CADASTRES * PLANS_PAR_CADASTRE), seed,
+        chunk_size) or numeros)
+    step('affaire.affaire', generated, generate_affaires, affaires, seed,
+         chunk_size)
+    step('affaire rows', generate_affaire_rows, dbsession, clients, numeros,
+         seed, chunk_size)
+    for name in sorted(REBUILDERS):
+        step(name, lambda name=name: REBUILDERS[name](dbsession)[0])
+    return counts
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Fill the database with a generated, consistent dataset.',
+    )
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--scale', type=float, default=1.0,
+        help='Size of the dataset, 1 is %d affaires, %d clients and %d '
+             'numeros' % (AFFAIRES, CLIENTS, NUMEROS),
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument(
+        '--create-tables', action='store_true',
+        help='Create the missing tables first',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+    registry = env['registry']
+    if args.create_tables:
+        Base.metadata.create_all(registry['dbsession_factory'].kw['bind'])
+
+    start = time.perf_counter()
+    with env['request'].tm:
+        # the request of bootstrap is a GET, whose dbsession may be the
+        # read-only replica
+        dbsession = get_tm_session(registry['dbsession_factory'],
+                                   env['request'].tm)
+        # bulk statements may run longer than request statements
+        set_statement_timeout(dbsession, None)
+        counts = generate(dbsession, args.scale, args.seed, args.chunk_size)
+    print('%d rows in %.2f s' % (sum(counts.values()),
+                                 time.perf_counter() - start))
@@ -0,0 +1,305 @@
+import argparse
+import csv
+import itertools
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from pyramid.paster import bootstrap, setup_logging
+from sqlalchemy import select
+
+from .. import models
+from ..models import set_statement_timeout
+from ..models.checkpoint import get_checkpoint, set_checkpoint
+from ..models.compteur import rebuild_compteurs
+
+log = logging.getLogger(__name__)
+
+# columns of the input files, by kind
+COLUMNS = OrderedDict([
+    ('plans', ('cadastre', 'plan')),
+    ('numeros', ('cadastre', 'type', 'numero', 'suffixe', 'etat')),
+    ('numeros_plans', ('cadastre', 'type', 'numero', 'suffixe', 'plan')),
+])
+
+
+class RowError(ValueError):
+    """An input row that cannot be imported."""
+
+    def __init__(self, line, message):
+        super(RowError, self).__init__('line %d: %s' % (line, message))
+        self.line = line
+
+
+class TooManyErrors(Exception):
+    pass
+
+
+def read_rows(path, columns, delimiter=';', skip=0):
+    """
+    ``(line number, row)`` of a CSV file with a header, after the first
+    ``skip`` rows.
+
+    """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.DictReader(f, delimiter=delimiter)
+        missing = [c for c in columns if c not in (reader.fieldnames or ())]
+        if missing:
+            raise ValueError('%s: missing columns %s' % (
+                path, ', '.join(missing)))
+        for row in itertools.islice(reader, skip, None):
+            yield reader.line_num, row
+
+
+def load_ids(dbsession, model, *columns):
+    """``{value(s) of columns: id}`` of all the rows of ``model``."""
+    table = model.__table__
+    rows = dbsession.execute(select(
+        [table.c.id] + [table.c[c] for c in columns]))
+    if len(columns) == 1:
+        return {row[1]: row[0] for row in rows}
+    return {tuple(row[1:]): row[0] for row in rows}
+
+
+class NumeroIds(object):
+    """
+    Ids of the numeros by ``(type_id, numero, suffixe)``, loaded per
+    cadastre.
+
+    Only the maps of the last ``max_cadastres`` cadastres are kept, so
+    memory does not grow with the number of numeros; files grouped by
+    cadastre load each map once.
+
+    """
+
+    def __init__(self, max_cadastres=4):
+        self.max_cadastres = max_cadastres
+        self.loads = 0
+        self._maps = OrderedDict()
+
+    def cadastre(self, dbsession, cadastre_id):
+        ids = self._maps.pop(cadastre_id, None)
+        if ids is None:
+            numero = models.Numero.__table__
+            ids = {
+                (row.type_id, row.numero, row.suffixe): row.id
+                for row in dbsession.execute(select(
+                    [numero.c.id, numero.c.type_id, numero.c.numero,
+                     numero.c.suffixe]).where(
+                         numero.c.cadastre_id == cadastre_id))
+            }
+            self.loads += 1
+        self._maps[cadastre_id] = ids
+        while len(self._maps) > self.max_cadastres:
+            self._maps.popitem(last=False)
+        return ids
+
+    def clear(self):
+        self._maps.clear()
+
+
+class CadastreImport(object):
+    """
+    Import plans, numeros and their links from CSV files.
+
+    Names are resolved to ids through in-memory maps: cadastres, numero
+    types and states by ``nom``, plans by cadastre and ``nom``, numeros
+    by cadastre, type, number and suffix (see :class:`NumeroIds`).  Rows
+    are written with one multi-row insert per ``batch_size`` rows, each
+    batch in its own transaction with the checkpoint of its file.
+    Rows already in the database are skipped, invalid rows are logged
+    and skipped until there are more than ``max_errors``.
+
+    """
+
+    def __init__(self, session_factory, batch_size=10000, max_errors=100,
+                 delimiter=';', max_cadastres=4, report=print):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.delimiter = delimiter
+        self.report = report
+        self.numero_ids = NumeroIds(max_cadastres)
+
+    def run(self, kind, path, restart=False):
+        """
+        Import a ``kind`` file (see ``COLUMNS``), resuming after its
+        checkpoint unless ``restart``.  Returns the counts of rows read,
+        inserted, skipped and rejected.
+
+        """
+        source = '%s:%s' % (kind, os.path.basename(path))
+        prepare = getattr(self, '_prepare_' + kind)
+        table = {'plans': models.Plan, 'numeros': models.Numero,
+                 'numeros_plans': models.NumeroPlan}[kind].__table__
+        counts = OrderedDict.fromkeys(
+            ('read', 'inserted', 'skipped', 'rejected'), 0)
+        session = self.session_factory()
+        try:
+            # batches may run longer than request statements
+            set_statement_timeout(session, None)
+            position = 0 if restart else get_checkpoint(
+                session.connection(), source)
+            self._load_maps(session)
+            rows = read_rows(path, COLUMNS[kind], self.delimiter, position)
+            start = time.perf_counter()
+            while True:
+                batch = list(itertools.islice(rows, self.batch_size))
+                if not batch:
+                    break
+                values = []
+                for line, row in batch:
+                    try:
+                        value = prepare(session, line, row)
+                    except RowError as e:
+                        counts['rejected'] += 1
+                        log.warning('%s %s', path, e)
+                        if counts['rejected'] > self.max_errors:
+                            raise TooManyErrors(
+                                '%s: more than %d invalid rows' % (
+                                    path, self.max_errors))
+                        continue
+                    if value is None:
+                        counts['skipped'] += 1
+                    else:
+                        values.append(value)
+                if values:
+                    session.execute(table.insert(), values)
+                position += len(batch)
+                set_checkpoint(session.connection(), source, position)
+                session.commit()
+                counts['read'] += len(batch)
+                counts['inserted'] += len(values)
+                elapsed = time.perf_counter() - start
+                self.report('%s: %d rows read, %d inserted, %d skipped, '
+                            '%d rejected, %.0f rows/s' % (
+                                source, counts['read'], counts['inserted'],
+                                counts['skipped'], counts['rejected'],
+                                counts['read'] / elapsed if elapsed else 0))
+            if kind == 'numeros':
+                # numbers reserved later follow the imported ones
+                rebuild_compteurs(session)
+                session.commit()
+        finally:
+            session.close()
+        return counts
+
+    def _load_maps(self, session):
+        self.cadastres = load_ids(session, models.Cadastre, 'nom')
+        self.types = load_ids(session, models.NumeroType, 'nom')
+        self.etats = load_ids(session, models.NumeroEtat, 'nom')
+        self.plans = load_ids(session, models.Plan, 'cadastre_id', 'nom')
+        # the ids of the numeros inserted by previous runs
+        self.numero_ids.clear()
+
+    def _resolve(self, ids, line, row, column):
+        try:
+            return ids[row[column]]
+        except KeyError:
+            raise RowError(line, 'unknown %s %r' % (column, row[column]))
+
+    def _numero_key(self, line, row):
+        try:
+            numero = int(row['numero'])
+        except (TypeError, ValueError):
+            raise RowError(line, 'invalid numero %r' % row['numero'])
+        if numero <= 0:
+            raise RowError(line, 'invalid numero %r' % row['numero'])
+        return (self._resolve(self.types, line, row, 'type'), numero,
+                (row['suffixe'] or '').strip() or None)
+
+    def _prepare_plans(self, session, line, row):
+        cadastre_id = self._resolve(self.cadastres, line, row, 'cadastre')
+        nom = (row['plan'] or '').strip()
+        if not nom:
+            raise RowError(line, 'empty plan')
+        if (cadastre_id, nom) in self.plans:
+            return None
+        self.plans[cadastre_id, nom] = None
+        return {'cadastre_id': cadastre_id, 'nom': nom}
+
+    def _prepare_numeros(self, session, line, row):
+        cadastre_id = self._resolve(self.cadastres, line, row, 'cadastre')
+        key = self._numero_key(line, row)
+        etat_id = self._resolve(self.etats, line, row, 'etat')
+        ids = self.numero_ids.cadastre(session, cadastre_id)
+        if key in ids:
+            return None
+        ids[key] = None
+        type_id, numero, suffixe = key
+        return {'cadastre_id': cadastre_id, 'type_id': type_id,
+                'numero': numero, 'suffixe': suffixe, 'etat_id': etat_id}
+
+    def _prepare_numeros_plans(self, session, line, row):
+        cadastre_id = self._resolve(self.cadastres, line, row, 'cadastre')
+        key = self._numero_key(line, row)
+        numero_id = self.numero_ids.cadastre(session, cadastre_id).get(key)
+        if numero_id is None:
+            raise RowError(line, 'unknown numero %s %s%s' % (
+                row['type'], key[1], '.%s' % key[2] if key[2] else ''))
+        plan_id = self.plans.get((cadastre_id, (row['plan'] or '').strip()))
+        if plan_id is None:
+            raise RowError(line, 'unknown plan %r' % row['plan'])
+        return {'numero_id': numero_id, 'plan_id': plan_id}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Import plans, numeros and their links from CSV files '
+                    'with a header, in this order.',
+    )
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--plans', metavar='CSV',
+        help='Columns: %s' % ', '.join(COLUMNS['plans']),
+    )
+    parser.add_argument(
+        '--numeros', metavar='CSV',
+        help='Columns: %s' % ', '.join(COLUMNS['numeros']),
+    )
+    parser.add_argument(
+        '--numeros-plans', metavar='CSV',
+        help='Columns: %s' % ', '.join(COLUMNS['numeros_plans']),
+    )
+    parser.add_argument('--delimiter', default=';')
+    parser.add_argument(
+        '--batch-size', type=int, default=10000,
+        help='Rows per transaction',
+    )
+    parser.add_argument('--max-errors', type=int, default=100)
+    parser.add_argument(
+        '--max-cadastres', type=int, default=4,
+        help='Cadastres whose numero ids are kept in memory',
+    )
+    parser.add_argument(
+        '--restart', action='store_true',
+        help='Ignore the checkpoints of previous runs',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    importer = CadastreImport(
+        env['registry']['dbsession_factory'], batch_size=args.batch_size,
+        max_errors=args.max_errors, delimiter=args.delimiter,
+        max_cadastres=args.max_cadastres)
+    for kind in COLUMNS:
+        path = getattr(args, kind)
+        if path is None:
+            continue
+        try:
+            counts = importer.run(kind, path, restart=args.restart)
+        except (TooManyErrors, ValueError) as e:
+            print(e)
+            return 1
+        print('%s: %s' % (path, ', '.join(
+            '%d %s' % (v, k) for k, v in counts.items())))
@@ -0,0 +1,165 @@
+import argparse
+import re
+import sys
+from collections import OrderedDict, namedtuple
+
+from .. import models
+from ..models.meta import Base
+from ..services.slow_queries import read_records
+
+# rows referred to by many others but few, and hardly ever deleted: an
+# index on the referring column would not be used
+REFERENCE_MODELS = models.LOOKUP_MODELS + (models.Operateur,)
+
+Proposal = namedtuple('Proposal', 'table columns reason count duration')
+
+# "SCAN t" and "SCAN t USING INDEX i" read all the rows (or index
+# entries) of t, "SEARCH t USING INDEX i (c=?)" does not
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+POSTGRESQL_SCAN = re.compile(r'Seq Scan on (?:\w+\.)?(\w+)')
+
+# "table.column <op>" in a WHERE clause, tables aliased by the ORM as
+# table_1
+CONDITION = re.compile(
+    r'\b(\w+?)(?:_\d+)?\.(\w+)\s*(=|IN\b|IS\b|<=|>=|<|>|BETWEEN\b|LIKE\b)',
+    re.IGNORECASE)
+CLAUSE_END = re.compile(r'\b(?:GROUP BY|ORDER BY|LIMIT|HAVING)\b',
+                        re.IGNORECASE)
+
+
+def index_name(table, columns):
+    return 'ix_%s_%s' % (table.name, '_'.join(columns))
+
+
+def indexed_prefixes(table):
+    """Column names of the indexes, primary and unique keys of ``table``."""
+    keys = [tuple(c.name for c in index.columns) for index in table.indexes]
+    keys.append(tuple(c.name for c in table.primary_key.columns))
+    keys.extend(tuple(c.name for c in constraint.columns)
+                for constraint in table.constraints
+                if constraint.__class__.__name__ == 'UniqueConstraint')
+    return keys
+
+
+def is_covered(table, columns):
+    """Whether an index of ``table`` starts with ``columns``."""
+    columns = tuple(columns)
+    return any(key[:len(columns)] == columns
+               for key in indexed_prefixes(table))
+
+
+def unindexed_foreign_keys(metadata, reference_models=REFERENCE_MODELS):
+    """
+    Foreign keys no index starts with, so joins and deletes of the rows
+    they refer to read the whole table.
+
+    Keys to the tables of ``reference_models`` are left out.
+
+    """
+    reference_tables = {t for model in reference_models
+                        for t in model.__mapper__.tables}
+    proposals = []
+    for table in metadata.sorted_tables:
+        for fk in table.foreign_key_constraints:
+            columns = tuple(c.name for c in fk.columns)
+            if fk.referred_table in reference_tables or \
+                    is_covered(table, columns):
+                continue
+            proposals.append(Proposal(
+                table, columns, 'foreign key to %s' % fk.referred_table.name,
+                0, 0.0))
+    return proposals
+
+
+def scanned_tables(plan):
+    """Names of the tables read in full according to EXPLAIN rows."""
+    tables = []
+    for row in plan or ():
+        for pattern in (SQLITE_SCAN, POSTGRESQL_SCAN):
+            match = pattern.search(row)
+            if match:
+                tables.append(match.group(1))
+    return tables
+
+
+def filtered_columns(statement, table_name):
+    """
+    Columns of ``table_name`` in the WHERE clause of ``statement``,
+    equality conditions first as an index should list them.
+
+    """
+    where = re.split(r'\bWHERE\b', statement, maxsplit=1,
+                     flags=re.IGNORECASE)
+    if len(where) < 2:
+        return ()
+    where = CLAUSE_END.split(where[1], maxsplit=1)[0]
+    equal, other = OrderedDict(), OrderedDict()
+    for table, column, operator in CONDITION.findall(where):
+        if table == table_name:
+            operator = operator.upper()
+            (equal if operator in ('=', 'IN', 'IS') else other)[column] = None
+    # one range condition can use the index, the first one
+    return tuple(equal) + tuple(c for c in list(other)[:1] if c not in equal)
+
+
+def proposals_from_log(records, metadata):
+    """
+    Indexes for the columns filtered by logged statements that scanned
+    their table, most costly first.
+
+    """
+    tables = {t.name: t for t in metadata.tables.values()}
+    found = OrderedDict()
+    for record in records:
+        for name in scanned_tables(record.get('plan')):
+            table = tables.get(name)
+            if table is None:
+                continue
+            columns = filtered_columns(record['statement'], name)
+            if not columns or is_covered(table, columns):
+                continue
+            count, duration = found.get((table, columns), (0, 0.0))
+            found[table, columns] = (count + 1,
+                                     duration + record.get('duration', 0.0))
+    return sorted(
+        (Proposal(table, columns, 'scan in logged statements', count,
+                  duration)
+         for (table, columns), (count, duration) in found.items()),
+        key=lambda p: -p.duration)
+
+
+def format_proposal(proposal):
+    return 'CREATE INDEX %s ON %s (%s);  -- %s%s' % (
+        index_name(proposal.table, proposal.columns), proposal.table.fullname,
+        ', '.join(proposal.columns), proposal.reason,
+        ' (%d statements, %.3f s)' % (proposal.count, proposal.duration)
+        if proposal.count else '')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Propose indexes for unindexed foreign keys and for the '
+                    'columns of slow statements that scanned their table.',
+    )
+    parser.add_argument(
+        'slow_query_log', nargs='*',
+        help='JSON lines files written by the slow query log '
+             '(slow_queries.path)',
+    )
+    parser.add_argument(
+        '--all-foreign-keys', action='store_true',
+        help='Include the keys to the reference tables',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    proposals = unindexed_foreign_keys(
+        Base.metadata, () if args.all_foreign_keys else REFERENCE_MODELS)
+    records = [r for path in args.slow_query_log for r in read_records(path)]
+    proposals.extend(proposals_from_log(records, Base.metadata))
+    for proposal in proposals:
+        print(format_proposal(proposal))
+    if not proposals:
+        print('no index to propose')
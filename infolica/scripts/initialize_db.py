@@ -32,7 +32,10 @@ def main(argv=sys.argv):
 
     try:
         with env['request'].tm:
-            dbsession = env['request'].dbsession
+            # the request of bootstrap is a GET, whose dbsession may be
+            # the read-only replica
+            dbsession = models.get_tm_session(
+                env['registry']['dbsession_factory'], env['request'].tm)
             setup_models(dbsession)
     except OperationalError:
         print('''
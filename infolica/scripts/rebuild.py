@@ -0,0 +1,52 @@
+import argparse
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+
+from ..models import get_tm_session, set_statement_timeout
+from ..models.compteur import rebuild_compteurs
+from ..models.hierarchie import rebuild_hierarchie
+from ..models.statistiques import rebuild_statistiques
+from ..models.statut import rebuild_statut_courant
+
+# name -> function(dbsession) rebuilding a maintained table, returning
+# the number of inserted, updated and deleted rows
+REBUILDERS = {
+    'modification_affaire_hierarchie': rebuild_hierarchie,
+    'numero_compteur': rebuild_compteurs,
+    'statistiques': rebuild_statistiques,
+    'statut_courant': rebuild_statut_courant,
+}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Rebuild the tables derived from other tables.',
+    )
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--only', action='append', choices=sorted(REBUILDERS),
+        help='Rebuild only this table (may be repeated)',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+    env = bootstrap(args.config_uri)
+
+    with env['request'].tm:
+        # the request of bootstrap is a GET, whose dbsession may be the
+        # read-only replica
+        dbsession = get_tm_session(env['registry']['dbsession_factory'],
+                                   env['request'].tm)
+        # rebuilds may run longer than request statements
+        set_statement_timeout(dbsession, None)
+        for name in args.only or sorted(REBUILDERS):
+            inserted, updated, deleted = REBUILDERS[name](dbsession)
+            print('%s: %d inserted, %d updated, %d deleted' % (
+                name, inserted, updated, deleted))
@@ -0,0 +1,71 @@
+import argparse
+import logging
+import multiprocessing
+import signal
+import sys
+
+from pyramid.paster import bootstrap, setup_logging
+
+from ..services.jobs import KINDS, Worker
+
+log = logging.getLogger(__name__)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(
+        description='Run the queued background jobs.',
+    )
+    parser.add_argument(
+        'config_uri',
+        help='Configuration file, e.g., development.ini',
+    )
+    parser.add_argument(
+        '--processes', type=int, default=1,
+        help='Worker processes, each running one job at a time',
+    )
+    parser.add_argument(
+        '--kind', action='append', dest='kinds', choices=sorted(KINDS),
+        help='Run only the jobs of this kind (may be repeated)',
+    )
+    parser.add_argument(
+        '--once', action='store_true',
+        help='Stop when no job is due instead of polling',
+    )
+    return parser.parse_args(argv[1:])
+
+
+def run_worker(config_uri, kinds, once, stop):
+    # the parent handles the signals and sets stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(config_uri)
+    env = bootstrap(config_uri)
+    registry = env['registry']
+    options = dict(registry['job_worker_options'])
+    if kinds:
+        options['kinds'] = kinds
+    worker = Worker(registry['dbsession_factory'], **options)
+    log.info('worker %s started', worker.name)
+    worker.run(stop, once=once)
+    env['closer']()
+
+
+def main(argv=sys.argv):
+    args = parse_args(argv)
+    setup_logging(args.config_uri)
+
+    stop = multiprocessing.Event()
+    # the running jobs end before the workers stop
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+    processes = [
+        multiprocessing.Process(
+            target=run_worker, name='infolica-worker-%d' % i,
+            args=(args.config_uri, args.kinds, args.once, stop))
+        for i in range(max(args.processes, 1))
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    if any(p.exitcode for p in processes):
+        return 1
@@ -0,0 +1,7 @@
+"""
+In-process services shared by the views of the application.
+
+Modules holding state expose an ``includeme`` and are activated from
+``infolica.main`` with ``config.include``.
+
+"""
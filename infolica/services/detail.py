@@ -0,0 +1,324 @@
+import contextvars
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+from sqlalchemy.orm.attributes import get_history
+
+from ..models import (
+    LOOKUP_MODELS,
+    Affaire,
+    AffaireNumero,
+    Client,
+    EmolumentsRF,
+    EtapeAffaire,
+    Facture,
+    Numero,
+    Operateur,
+    Preavis,
+    RelationAffaireClient,
+    RemarqueAffaire,
+    Services,
+    with_profile,
+)
+
+PENDING_KEY = 'affaire_stamps_pending'
+
+# seconds a stamp is valid, bounds staleness for the changes of other
+# processes (job workers, scripts)
+STAMP_TTL = 60
+
+# rows belonging to one affaire, by the column pointing to it
+AFFAIRE_MODELS = {
+    Affaire: 'id',
+    AffaireNumero: 'affaire_id',
+    EmolumentsRF: 'affaire_id',
+    EtapeAffaire: 'affaire_id',
+    Facture: 'affaire_id',
+    Preavis: 'affaire_id',
+    RelationAffaireClient: 'affaire_id',
+    RemarqueAffaire: 'affaire_id',
+}
+
+# rows shown on the page of many affaires
+SHARED_MODELS = (Client, Numero, Operateur, Services) + LOOKUP_MODELS
+
+
+class AffaireStamps(object):
+    """
+    Last-change stamps of the affaire detail pages, held in memory.
+
+    The stamp of an affaire changes once a watched session commits a
+    change to one of its rows, and the stamp of every affaire changes on
+    a committed change to a row shared between affaires.  Stamps start
+    over with each process, so they never repeat across restarts.
+    Changes made by other processes, such as the job workers, are not
+    seen: every stamp also changes each ``ttl`` seconds, which bounds
+    how long such a change may be answered with 304 Not Modified.
+
+    """
+
+    def __init__(self, ttl=None, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._token = uuid.uuid4().hex[:12]
+        self._generation = 0
+        self._versions = {}
+
+    def stamp(self, affaire_id):
+        period = int(self.clock() // self.ttl) if self.ttl else 0
+        return '%d-%s-%d-%d-%d' % (affaire_id, self._token, self._generation,
+                                   self._versions.get(affaire_id, 0), period)
+
+    def touch(self, affaire_ids):
+        with self._lock:
+            for affaire_id in affaire_ids:
+                self._versions[affaire_id] = \
+                    self._versions.get(affaire_id, 0) + 1
+
+    def touch_all(self):
+        with self._lock:
+            self._generation += 1
+            self._versions.clear()
+
+    def watch(self, session_factory):
+        """Change the stamps on commits of ``session_factory`` sessions."""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.setdefault(PENDING_KEY, set())
+        for obj in session.new | session.dirty | session.deleted:
+            column = next((c for model, c in AFFAIRE_MODELS.items()
+                           if isinstance(obj, model)), None)
+            if column is not None:
+                # the old affaire too when a row moves to another one
+                history = get_history(obj, column)
+                pending.update(history.sum())
+            elif isinstance(obj, SHARED_MODELS):
+                pending.add(None)
+
+    def _after_commit(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if not pending:
+            return
+        if None in pending:
+            self.touch_all()
+        else:
+            self.touch(pending)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+def mark_changed(dbsession, affaire_ids):
+    """
+    Change the stamps of affaires written without the ORM, on commit.
+
+    Bulk statements bypass the flush events the stamps are kept with.
+
+    """
+    dbsession.info.setdefault(PENDING_KEY, set()).update(affaire_ids)
+
+
+def _date(value):
+    return value.isoformat() if value is not None else None
+
+
+def _read_affaire(dbsession, affaire_id):
+    affaire = with_profile(dbsession.query(Affaire), 'affaire_list').filter(
+        Affaire.id == affaire_id).one_or_none()
+    if affaire is None:
+        return None
+    statut = affaire.statut_courant
+    return {
+        'id': affaire.id,
+        'type': affaire.type.nom,
+        'cadastre': affaire.cadastre.nom,
+        'responsable': {'id': affaire.responsable.id,
+                        'nom': affaire.responsable.nom,
+                        'prenom': affaire.responsable.prenom},
+        'technicien': {'id': affaire.technicien.id,
+                       'nom': affaire.technicien.nom,
+                       'prenom': affaire.technicien.prenom},
+        'information': affaire.information,
+        'date_ouverture': _date(affaire.date_ouverture),
+        'date_cloture': _date(affaire.date_cloture),
+        'localisation_E': affaire.localisation_E,
+        'localisation_N': affaire.localisation_N,
+        'statut': statut.statut.nom if statut is not None else None,
+    }
+
+
+def _read_etapes(dbsession, affaire_id):
+    return [{'statut': e.statut.nom, 'date': _date(e.date)}
+            for e in dbsession.query(EtapeAffaire).options(
+                joinedload(EtapeAffaire.statut)).filter(
+                    EtapeAffaire.affaire_id == affaire_id).order_by(
+                        EtapeAffaire.date, EtapeAffaire.id)]
+
+
+def _read_remarques(dbsession, affaire_id):
+    return [{
+        'remarque': r.remarque,
+        'date': _date(r.date),
+        'operateur': '%s %s' % (r.operateur.prenom, r.operateur.nom),
+    } for r in dbsession.query(RemarqueAffaire).options(
+        joinedload(RemarqueAffaire.operateur)).filter(
+            RemarqueAffaire.affaire_id == affaire_id).order_by(
+                RemarqueAffaire.date, RemarqueAffaire.id)]
+
+
+def _read_numeros(dbsession, affaire_id):
+    return [{
+        'id': n.numero.id,
+        'numero': n.numero.numero,
+        'suffixe': n.numero.suffixe,
+        'type': n.numero.type.nom,
+        'etat': n.numero.etat.nom,
+        'modifie': n.modifie,
+    } for n in dbsession.query(AffaireNumero).options(
+        joinedload(AffaireNumero.numero).joinedload(Numero.type),
+        joinedload(AffaireNumero.numero).joinedload(Numero.etat)).filter(
+            AffaireNumero.affaire_id == affaire_id).order_by(AffaireNumero.id)]
+
+
+def _read_clients(dbsession, affaire_id):
+    return [{
+        'id': r.client.id,
+        'type': r.client.type,
+        'nom': getattr(r.client, 'nom', None),
+        'prenom': getattr(r.client, 'prenom', None),
+        'adresse': r.client.adresse,
+        'npa': r.client.npa,
+        'localite': r.client.localite,
+        'relation': r.relation_type.nom,
+    } for r in dbsession.query(RelationAffaireClient).options(
+        joinedload(RelationAffaireClient.client),
+        joinedload(RelationAffaireClient.relation_type)).filter(
+            RelationAffaireClient.affaire_id == affaire_id).order_by(
+                RelationAffaireClient.id)]
+
+
+def _read_preavis(dbsession, affaire_id):
+    return [{
+        'service': p.service.service,
+        'type': p.preavis_type.nom,
+        'decision': p.preavis_decision.nom,
+        'date_demande': _date(p.date_demande),
+        'date_reponse': _date(p.date_reponse),
+    } for p in dbsession.query(Preavis).options(
+        joinedload(Preavis.service),
+        joinedload(Preavis.preavis_type),
+        joinedload(Preavis.preavis_decision)).filter(
+            Preavis.affaire_id == affaire_id).order_by(Preavis.id)]
+
+
+def _read_factures(dbsession, affaire_id):
+    return [{
+        'sap': f.sap,
+        'type': f.type,
+        'client_id': f.client_id,
+        'montant_mo': f.montant_mo,
+        'montant_rf': f.montant_rf,
+        'montant_mat_diff': f.montant_mat_diff,
+        'montant_tva': f.montant_tva,
+        'total': f.total,
+        'date': _date(f.date),
+    } for f in dbsession.query(Facture).filter(
+        Facture.affaire_id == affaire_id).order_by(Facture.date, Facture.sap)]
+
+
+def _read_emoluments_rf(dbsession, affaire_id):
+    return [{'id': e.id, 'montant': e.montant}
+            for e in dbsession.query(EmolumentsRF).filter(
+                EmolumentsRF.affaire_id == affaire_id).order_by(
+                    EmolumentsRF.id)]
+
+
+# the independent reads making up an affaire detail page
+AFFAIRE_PARTS = OrderedDict([
+    ('affaire', _read_affaire),
+    ('etapes', _read_etapes),
+    ('remarques', _read_remarques),
+    ('numeros', _read_numeros),
+    ('clients', _read_clients),
+    ('preavis', _read_preavis),
+    ('factures', _read_factures),
+    ('emoluments_rf', _read_emoluments_rf),
+])
+
+
+def _read_part(session_factory, reader, affaire_id):
+    dbsession = session_factory()
+    try:
+        return reader(dbsession, affaire_id)
+    finally:
+        dbsession.close()
+
+
+def read_affaire_full(dbsession, affaire_id, executor=None,
+                      session_factory=None):
+    """
+    All the data of an affaire detail page, None for an unknown affaire.
+
+    With an ``executor``, the parts are read concurrently, each in its
+    own ``session_factory`` session and pooled connection, so the time
+    taken is about that of the slowest part; the parts then do not share
+    a transaction.  Otherwise they are read one after the other in
+    ``dbsession``.
+
+    """
+    if executor is None:
+        parts = {name: reader(dbsession, affaire_id)
+                 for name, reader in AFFAIRE_PARTS.items()}
+    else:
+        # each in a copy of the request context, for its instrumentation
+        futures = {
+            name: executor.submit(
+                contextvars.copy_context().run,
+                _read_part, session_factory, reader, affaire_id)
+            for name, reader in AFFAIRE_PARTS.items()
+        }
+        parts = {name: future.result() for name, future in futures.items()}
+    if parts['affaire'] is None:
+        return None
+    result = parts.pop('affaire')
+    result.update(parts)
+    return result
+
+
+def includeme(config):
+    """
+    Register the affaire detail stamps and reader pool on the registry.
+
+    ``affaires.detail_threads`` sets the number of threads reading the
+    parts of detail pages, shared by all requests; 0 reads them in the
+    request session.  Every thread holds a pooled connection while it
+    reads.  ``affaires.stamp_ttl`` sets the seconds an ETag of these
+    pages is valid, 0 for ever.
+
+    Activate this setup using ``config.include('infolica.services.detail')``.
+
+    """
+    settings = config.get_settings()
+    session_factory = config.registry['dbsession_factory']
+    stamps = AffaireStamps(ttl=float(
+        settings.get('affaires.stamp_ttl', STAMP_TTL)) or None)
+    stamps.watch(session_factory)
+    config.registry['affaire_stamps'] = stamps
+    threads = int(settings.get('affaires.detail_threads', 0))
+    engine = session_factory.kw['bind']
+    if engine.dialect.name == 'sqlite' and \
+            engine.url.database in (None, '', ':memory:'):
+        # every thread would get its own empty in-memory database
+        threads = 0
+    config.registry['affaire_detail_executor'] = (
+        ThreadPoolExecutor(threads, thread_name_prefix='affaire-detail')
+        if threads > 0 else None)
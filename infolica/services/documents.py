@@ -0,0 +1,171 @@
+import hashlib
+import os
+import tempfile
+
+# bytes read or written at once
+BLOCK_SIZE = 1024 * 1024
+
+
+class DocumentTooLarge(Exception):
+    pass
+
+
+class DocumentStore(object):
+    """
+    Files stored under ``root`` by the SHA-256 of their content.
+
+    ``ab/cd/abcd...`` holds the content whose digest is ``abcd...``, so
+    the same content uploaded twice is stored once.  Uploads are written
+    block by block to a temporary file of ``root/tmp`` while hashed, then
+    renamed to their path, which is atomic on one filesystem: a stored
+    file is always complete.
+
+    """
+
+    def __init__(self, root, block_size=BLOCK_SIZE):
+        self.root = root
+        self.block_size = block_size
+        self.tmp = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+
+    @staticmethod
+    def relative_path(digest):
+        return os.path.join(digest[:2], digest[2:4], digest)
+
+    def path(self, digest):
+        return os.path.join(self.root, self.relative_path(digest))
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def write(self, stream, max_size=None):
+        """
+        Store what ``stream`` (a file-like object) reads until its end.
+
+        Returns ``(digest, size, stored)``, ``stored`` being false when
+        the content already was in the store.  Raises ``DocumentTooLarge``
+        beyond ``max_size`` bytes.
+
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    block = stream.read(self.block_size)
+                    if not block:
+                        break
+                    size += len(block)
+                    if max_size is not None and size > max_size:
+                        raise DocumentTooLarge(
+                            'documents are limited to %d bytes' % max_size)
+                    sha256.update(block)
+                    f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = sha256.hexdigest()
+            path = self.path(digest)
+            if os.path.exists(path):
+                return digest, size, False
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.chmod(temp_path, 0o444)
+            os.replace(temp_path, path)
+            return digest, size, True
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def open(self, digest):
+        return open(self.path(digest), 'rb')
+
+
+class FileRange(object):
+    """
+    Read-only file-like object over ``[start, stop)`` of ``f``.
+
+    A server's ``wsgi.file_wrapper`` may send a file to its end whatever
+    the Content-Length; given this one, it sends the range only.
+
+    """
+
+    def __init__(self, f, start, stop):
+        self.f = f
+        self.remaining = stop - start
+        f.seek(start)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+class FileIter(object):
+    """Blocks of a file-like object, for servers without a file wrapper."""
+
+    def __init__(self, f, block_size=BLOCK_SIZE):
+        self.f = f
+        self.block_size = block_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        data = self.f.read(self.block_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def file_app_iter(environ, f, block_size=BLOCK_SIZE):
+    """
+    The body of a response sending ``f``: through the server's
+    ``wsgi.file_wrapper`` when it has one (e.g. sendfile), in blocks
+    otherwise.  Memory does not depend on the size of the file.
+
+    """
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None:
+        return file_wrapper(f, block_size)
+    return FileIter(f, block_size)
+
+
+def retry_attempts(request):
+    """
+    pyramid_retry activate hook: a request whose body is larger than
+    ``BLOCK_SIZE`` is attempted once, rather than copied to be read
+    again by the next attempts.  Uploads are streamed to the store and
+    the same content is stored once, so they can simply be sent again.
+
+    """
+    if (request.content_length or 0) > BLOCK_SIZE:
+        return 1
+    return None
+
+
+def includeme(config):
+    """
+    Add the document store when ``documents.root`` is set.
+
+    Settings: ``documents.root`` (directory) and ``documents.max_size``
+    (bytes of an upload).
+
+    """
+    settings = config.get_settings()
+    # read by pyramid_retry once the configuration is committed
+    settings.setdefault('retry.activate_hook',
+                        'infolica.services.documents.retry_attempts')
+    root = settings.get('documents.root')
+    if not root:
+        return
+    config.registry['document_store'] = DocumentStore(root)
+    max_size = settings.get('documents.max_size')
+    config.registry['document_max_size'] = int(max_size) if max_size else None
@@ -0,0 +1,303 @@
+import datetime
+import functools
+import logging
+import os
+import smtplib
+import time
+from collections import OrderedDict
+from email.message import EmailMessage
+
+from pyramid.settings import asbool
+from sqlalchemy import select
+
+from .. import models
+from ..models import set_statement_timeout
+
+log = logging.getLogger(__name__)
+
+# recipients whose messages are sent between two writes of their envois
+BATCH_SIZE = 100
+# messages sent over one connection before it is opened again
+MAX_PER_CONNECTION = 100
+# attempts of a message refused for a transient reason
+MAX_ATTEMPTS = 3
+# seconds before the second attempt, doubled on each further attempt
+BACKOFF = 1.0
+# bytes of documents attached to one message, the others are linked
+MAX_ATTACHMENTS_SIZE = 10 * 2 ** 20
+
+SUBJECT = 'Documents de vos affaires'
+GREETING = 'Madame, Monsieur,'
+SIGNATURE = 'Meilleures salutations'
+
+
+def smtp_connect(host='localhost', port=25, timeout=30, starttls=False,
+                 username=None, password=None):
+    """Open an SMTP connection, as ``Dispatcher(connect=...)`` expects."""
+    connection = smtplib.SMTP(host, port, timeout=timeout)
+    if starttls:
+        connection.starttls()
+    if username:
+        connection.login(username, password)
+    return connection
+
+
+def _connection_lost(exc):
+    # SMTPException is an OSError too
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(exc, OSError) and not isinstance(
+        exc, smtplib.SMTPException)
+
+
+def _transient(exc):
+    """Whether sending again may succeed (4xx replies, lost connection)."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500
+                   for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return 400 <= exc.smtp_code < 500
+    return _connection_lost(exc)
+
+
+def destinataires(dbsession, envois, relation_type_id=None):
+    """
+    ``(client_id, document_id)`` pairs of the ``(affaire_id,
+    document_id)`` pairs: every client of the affaire (of relation
+    ``relation_type_id`` only, when given) receives the document.
+
+    """
+    documents = {}
+    for affaire_id, document_id in envois:
+        documents.setdefault(affaire_id, []).append(document_id)
+    relation = models.RelationAffaireClient.__table__
+    query = select([relation.c.affaire_id, relation.c.client_id]).where(
+        relation.c.affaire_id.in_(list(documents)))
+    if relation_type_id is not None:
+        query = query.where(relation.c.relation_type_id == relation_type_id)
+    query = query.order_by(relation.c.client_id, relation.c.affaire_id)
+    for affaire_id, client_id in dbsession.execute(query):
+        for document_id in documents[affaire_id]:
+            yield client_id, document_id
+
+
+class Dispatcher(object):
+    """
+    Send documents to clients by mail and record the ``EnvoiDocument``.
+
+    The documents of a recipient are sent in one message, attached up
+    to ``max_attachments_size`` bytes and listed with their link after
+    ``documents_url`` otherwise.  Messages go over one connection of
+    ``connect()``, opened again after ``max_per_connection`` messages or
+    when the server drops it, at most ``rate`` per second.  A message
+    refused for a transient reason is sent again, ``max_attempts``
+    times, ``backoff`` seconds later, doubled on each further attempt.
+    The envois of each ``batch_size`` recipients are written with one
+    multi-row insert and committed.  Documents already sent to a client
+    are not sent again unless ``resend``: after a crash, running the
+    same envois again sends at most the messages of one batch twice.
+
+    """
+
+    def __init__(self, session_factory, connect, sender, store=None,
+                 documents_url=None, subject=SUBJECT, rate=None,
+                 batch_size=BATCH_SIZE,
+                 max_per_connection=MAX_PER_CONNECTION,
+                 max_attempts=MAX_ATTEMPTS, backoff=BACKOFF,
+                 max_attachments_size=MAX_ATTACHMENTS_SIZE,
+                 resend=False, sleep=time.sleep, report=print):
+        self.session_factory = session_factory
+        self.connect = connect
+        self.sender = sender
+        self.store = store
+        self.documents_url = documents_url
+        self.subject = subject
+        self.rate = rate
+        self.batch_size = batch_size
+        self.max_per_connection = max_per_connection
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_attachments_size = max_attachments_size
+        self.resend = resend
+        self.sleep = sleep
+        self.report = report
+        self._connection = None
+        self._sent_on_connection = 0
+
+    def run(self, envois):
+        """
+        Send the ``(client_id, document_id)`` pairs of ``envois``.
+
+        Returns the counts of messages sent, recipients without address
+        or with nothing left to send, messages rejected and envois
+        written, and the messages per second.
+
+        """
+        by_client = OrderedDict()
+        for client_id, document_id in envois:
+            documents = by_client.setdefault(client_id, [])
+            if document_id not in documents:
+                documents.append(document_id)
+        counts = OrderedDict.fromkeys(
+            ('envoyes', 'sans_adresse', 'deja_envoyes', 'rejetes', 'envois'),
+            0)
+        session = self.session_factory()
+        start = time.perf_counter()
+        try:
+            set_statement_timeout(session, None)
+            client_ids = list(by_client)
+            for i in range(0, len(client_ids), self.batch_size):
+                batch = client_ids[i:i + self.batch_size]
+                self._send_batch(session, batch, by_client, counts, start)
+                elapsed = time.perf_counter() - start
+                self.report('%d/%d recipients: %d sent, %d without address, '
+                            '%d rejected, %.1f messages/s' % (
+                                i + len(batch), len(client_ids),
+                                counts['envoyes'], counts['sans_adresse'],
+                                counts['rejetes'], counts['envoyes'] /
+                                elapsed if elapsed else 0))
+        finally:
+            self._disconnect()
+            session.close()
+        elapsed = time.perf_counter() - start
+        counts['messages_par_seconde'] = round(
+            counts['envoyes'] / elapsed if elapsed else 0, 1)
+        return counts
+
+    def _send_batch(self, session, client_ids, by_client, counts, start):
+        client = models.Client.__table__
+        mails = {row.id: row.mail for row in session.execute(
+            select([client.c.id, client.c.mail]).where(
+                client.c.id.in_(client_ids)))}
+        document = models.Document.__table__
+        document_ids = {d for c in client_ids for d in by_client[c]}
+        documents = {row.id: row for row in session.execute(
+            select([document]).where(document.c.id.in_(document_ids)))}
+        already = set()
+        if not self.resend:
+            envoi = models.EnvoiDocument.__table__
+            already = {tuple(row) for row in session.execute(select(
+                [envoi.c.destinataire_id, envoi.c.document_id]).where(
+                    envoi.c.destinataire_id.in_(client_ids)).where(
+                        envoi.c.document_id.in_(document_ids)))}
+        today = datetime.date.today()
+        rows = []
+        for client_id in client_ids:
+            mail = (mails.get(client_id) or '').strip()
+            if not mail:
+                counts['sans_adresse'] += 1
+                continue
+            sent = [documents[d] for d in by_client[client_id]
+                    if d in documents and (client_id, d) not in already]
+            if not sent:
+                counts['deja_envoyes'] += 1
+                continue
+            self._throttle(counts['envoyes'] + counts['rejetes'], start)
+            if not self._send(self.message(mail, sent)):
+                counts['rejetes'] += 1
+                continue
+            counts['envoyes'] += 1
+            rows.extend({'destinataire_id': client_id, 'document_id': d.id,
+                         'date': today} for d in sent)
+        if rows:
+            session.execute(models.EnvoiDocument.__table__.insert(), rows)
+            counts['envois'] += len(rows)
+        session.commit()
+
+    def message(self, mail, documents):
+        """The message sending ``documents`` (rows of document) to ``mail``."""
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = mail
+        message['Subject'] = self.subject
+        attached, linked = [], []
+        size = 0
+        for document in documents:
+            if (self.store is not None and document.sha256 is not None and
+                    size + document.taille <= self.max_attachments_size):
+                attached.append(document)
+                size += document.taille
+            else:
+                linked.append(document)
+        lines = [GREETING, '']
+        if attached:
+            lines.append('Veuillez trouver ci-joint les documents suivants :')
+            lines.extend('- %s' % self._name(d) for d in attached)
+            lines.append('')
+        if linked:
+            lines.append('Les documents suivants sont disponibles :')
+            lines.extend('- %s%s' % (self._name(d), ' : %s%d' % (
+                self.documents_url, d.id) if self.documents_url else '')
+                for d in linked)
+            lines.append('')
+        lines.append(SIGNATURE)
+        message.set_content('\n'.join(lines))
+        for document in attached:
+            maintype, _, subtype = (
+                document.type_contenu or 'application/octet-stream'
+            ).partition('/')
+            with self.store.open(document.sha256) as f:
+                message.add_attachment(
+                    f.read(), maintype=maintype, subtype=subtype,
+                    filename=self._name(document))
+        return message
+
+    @staticmethod
+    def _name(document):
+        return document.nom or os.path.basename(document.chemin)
+
+    def _throttle(self, count, start):
+        if self.rate:
+            delay = start + count / self.rate - time.perf_counter()
+            if delay > 0:
+                self.sleep(delay)
+
+    def _send(self, message):
+        """Send ``message``, returns whether it was accepted."""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if self._connection is None or (
+                        self._sent_on_connection >= self.max_per_connection):
+                    self._disconnect()
+                    self._connection = self.connect()
+                self._connection.send_message(message)
+                self._sent_on_connection += 1
+                return True
+            except OSError as e:
+                if _connection_lost(e):
+                    self._disconnect()
+                if not _transient(e) or attempt == self.max_attempts:
+                    log.warning('message to %s rejected: %s',
+                                message['To'], e)
+                    return False
+                log.info('message to %s deferred: %s', message['To'], e)
+                self.sleep(self.backoff * 2 ** (attempt - 1))
+        return False
+
+    def _disconnect(self):
+        connection, self._connection = self._connection, None
+        self._sent_on_connection = 0
+        if connection is not None:
+            try:
+                connection.quit()
+            except OSError:
+                connection.close()
+
+
+def dispatcher_options(settings):
+    """``Dispatcher`` keyword arguments from the ``mail.*`` settings."""
+    rate = settings.get('mail.rate')
+    return {
+        'connect': functools.partial(
+            smtp_connect,
+            host=settings.get('mail.host', 'localhost'),
+            port=int(settings.get('mail.port', 25)),
+            starttls=asbool(settings.get('mail.starttls', False)),
+            username=settings.get('mail.username') or None,
+            password=settings.get('mail.password') or None),
+        'sender': settings.get('mail.sender', 'infolica@localhost'),
+        'documents_url': settings.get('mail.documents_url') or None,
+        'rate': float(rate) if rate else None,
+        'max_per_connection': int(settings.get(
+            'mail.max_per_connection', MAX_PER_CONNECTION)),
+    }
@@ -0,0 +1,237 @@
+import csv
+import datetime
+import io
+import numbers
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from ..models import set_statement_timeout
+
+# rows fetched from the cursor at once
+FETCH_SIZE = 1000
+# rows serialized between two chunks of the response body
+CHUNK_ROWS = 500
+
+XLSX_CONTENT_TYPE = (
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+# characters XML 1.0 does not allow, even escaped
+_XML_INVALID = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_EXCEL_EPOCH = datetime.date(1899, 12, 30)
+
+
+def iter_rows(session_factory, statement, fetch_size=FETCH_SIZE):
+    """
+    Result rows of a Core ``statement``, fetched ``fetch_size`` at a time.
+
+    The rows are read in their own session, as a streamed response is
+    sent after the request transaction ended, through a server-side
+    cursor where the driver has one (``stream_results``).  The session is
+    closed when the rows are exhausted or the generator is closed.
+
+    """
+    session = session_factory()
+    try:
+        # an export takes as long as the client reads it
+        set_statement_timeout(session, None)
+        result = session.execute(
+            statement.execution_options(stream_results=True))
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        session.close()
+
+
+def _csv_value(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value
+
+
+def iter_csv(header, rows, chunk_rows=CHUNK_ROWS):
+    """
+    A CSV file in chunks of ``chunk_rows`` rows, UTF-8 with a BOM and
+    ``;`` separated as spreadsheets of the region expect.
+
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=';', lineterminator='\r\n')
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    count = 0
+    for row in rows:
+        writer.writerow([_csv_value(v) for v in row])
+        count += 1
+        if count % chunk_rows == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+class _Sink(object):
+    """Unseekable file collecting what a ``ZipFile`` writes."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _number_cell(value):
+    return '<c><v>%r</v></c>' % value
+
+
+def _text_cell(value):
+    return '<c t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % (
+        escape(_XML_INVALID.sub('', value)))
+
+
+def _date_cell(value):
+    return '<c s="1"><v>%d</v></c>' % (value - _EXCEL_EPOCH).days
+
+
+def _datetime_cell(value):
+    delta = value - datetime.datetime.combine(_EXCEL_EPOCH, datetime.time())
+    return '<c s="2"><v>%r</v></c>' % (delta.total_seconds() / 86400)
+
+
+def _other_cell(value):
+    if isinstance(value, numbers.Number):
+        return _number_cell(float(value))
+    return _text_cell(str(value))
+
+
+# cell writers by value type, cells without reference follow each other
+_CELLS = {
+    type(None): lambda value: '<c/>',
+    bool: lambda value: '<c t="b"><v>%d</v></c>' % value,
+    int: _number_cell,
+    float: _number_cell,
+    str: _text_cell,
+    datetime.date: _date_cell,
+    datetime.datetime: _datetime_cell,
+}
+
+
+def _xlsx_row(values):
+    return '<row>%s</row>' % ''.join(
+        [_CELLS.get(type(v), _other_cell)(v) for v in values])
+
+
+XLSX_PARTS = [
+    ('[Content_Types].xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Types xmlns="http://schemas.openxmlformats.org/package/2006/'
+     'content-types">'
+     '<Default Extension="rels" ContentType="application/'
+     'vnd.openxmlformats-package.relationships+xml"/>'
+     '<Default Extension="xml" ContentType="application/xml"/>'
+     '<Override PartName="/xl/workbook.xml" ContentType="application/'
+     'vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+     '<Override PartName="/xl/worksheets/sheet1.xml" ContentType='
+     '"application/vnd.openxmlformats-officedocument.spreadsheetml.'
+     'worksheet+xml"/>'
+     '<Override PartName="/xl/styles.xml" ContentType="application/'
+     'vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+     '</Types>'),
+    ('_rels/.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+     '2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/officeDocument" '
+     'Target="xl/workbook.xml"/>'
+     '</Relationships>'),
+    ('xl/_rels/workbook.xml.rels',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<Relationships xmlns="http://schemas.openxmlformats.org/package/'
+     '2006/relationships">'
+     '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/worksheet" '
+     'Target="worksheets/sheet1.xml"/>'
+     '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/'
+     'officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+     '</Relationships>'),
+    # cell styles 1 and 2 are dates and date-times
+    ('xl/styles.xml',
+     '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+     '<styleSheet xmlns="http://schemas.openxmlformats.org/'
+     'spreadsheetml/2006/main">'
+     '<numFmts count="1"><numFmt numFmtId="164" '
+     'formatCode="yyyy-mm-dd hh:mm:ss"/></numFmts>'
+     '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font>'
+     '</fonts>'
+     '<fills count="1"><fill><patternFill patternType="none"/></fill>'
+     '</fills>'
+     '<borders count="1"><border/></borders>'
+     '<cellStyleXfs count="1"><xf/></cellStyleXfs>'
+     '<cellXfs count="3"><xf/>'
+     '<xf numFmtId="14" applyNumberFormat="1"/>'
+     '<xf numFmtId="164" applyNumberFormat="1"/></cellXfs>'
+     '<cellStyles count="1"><cellStyle name="Normal" xfId="0" '
+     'builtinId="0"/></cellStyles>'
+     '</styleSheet>'),
+]
+
+
+def iter_xlsx(header, rows, sheet_name='Export', chunk_rows=CHUNK_ROWS):
+    """
+    A one-sheet XLSX workbook in chunks of ``chunk_rows`` rows.
+
+    The sheet is written as it is zipped, strings inline, so memory
+    does not grow with the number of rows.
+
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as package:
+        for name, content in XLSX_PARTS:
+            package.writestr(name, content)
+        package.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/'
+            'spreadsheetml/2006/main" xmlns:r="http://schemas.'
+            'openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="%s" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>') % escape(sheet_name, {'"': '&quot;'}))
+        yield sink.drain()
+
+        with package.open('xl/worksheets/sheet1.xml', 'w',
+                          force_zip64=True) as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/'
+                'spreadsheetml/2006/main"><sheetData>' +
+                _xlsx_row(header)).encode('utf-8'))
+            chunk = []
+            for row in rows:
+                chunk.append(_xlsx_row(row))
+                if len(chunk) >= chunk_rows:
+                    sheet.write(''.join(chunk).encode('utf-8'))
+                    chunk = []
+                    yield sink.drain()
+            sheet.write((''.join(chunk) + '</sheetData></worksheet>').encode(
+                'utf-8'))
+    yield sink.drain()
+
+
+# format parameter -> (writer, content type)
+FORMATS = {
+    'csv': (iter_csv, 'text/csv'),
+    'xlsx': (iter_xlsx, XLSX_CONTENT_TYPE),
+}
@@ -0,0 +1,154 @@
+import datetime
+
+from sqlalchemy import and_, exists, func, null, select
+
+from ..models import (
+    Affaire,
+    EmolumentsMO,
+    EmolumentsRF,
+    Facture,
+    FacturePartielle,
+    RelationAffaireClient,
+)
+from ..models import constant
+from ..models.mymodel import arrondir
+from .detail import mark_changed
+
+
+def affaires_a_facturer(jusqu_au, relation_type_id=None, apres=None):
+    """
+    Select the closed affaires without invoice, with their summed fees.
+
+    Columns: ``affaire_id``, ``client_id``, ``montant_mo``, ``montant_rf``
+    and ``montant_mat_diff``.  The invoiced client is the client linked
+    with ``relation_type_id``, if any.  ``apres`` starts after an affaire
+    id, to walk the selection in chunks.
+
+    """
+    affaire = Affaire.__table__
+    facture = Facture.__table__
+    mo = EmolumentsMO.__table__
+    rf = EmolumentsRF.__table__
+    relation = RelationAffaireClient.__table__
+
+    def somme(column, table):
+        # correlated per affaire, so each chunk only reads its own fees
+        return func.coalesce(select([func.sum(column)]).where(
+            table.c.affaire_id == affaire.c.id).as_scalar(), 0.0)
+
+    columns = [
+        affaire.c.id.label('affaire_id'),
+        somme(mo.c.montant, mo).label('montant_mo'),
+        somme(rf.c.montant, rf).label('montant_rf'),
+        somme(mo.c.montant_mat_diff, mo).label('montant_mat_diff'),
+    ]
+    if relation_type_id is not None:
+        columns.insert(1, select([func.min(relation.c.client_id)]).where(and_(
+            relation.c.affaire_id == affaire.c.id,
+            relation.c.relation_type_id == relation_type_id,
+        )).as_scalar().label('client_id'))
+    else:
+        columns.insert(1, null().label('client_id'))
+
+    query = select(columns).where(and_(
+        affaire.c.date_cloture <= jusqu_au,
+        ~exists().where(facture.c.affaire_id == affaire.c.id),
+    ))
+    if apres is not None:
+        query = query.where(affaire.c.id > apres)
+    return query.order_by(affaire.c.id)
+
+
+def calculer_montants(montant_mo, montant_rf, montant_mat_diff,
+                      taux_tva=constant.tva):
+    """
+    VAT and totals of many invoices at once, from amount columns.
+
+    Same rules as ``Facture.calculer_tva`` and ``Facture.calculer_total``.
+    Returns the ``montant_tva`` and ``total`` columns.
+
+    """
+    tva = [arrondir(taux_tva * (mo + md))
+           for mo, md in zip(montant_mo, montant_mat_diff)]
+    total = [arrondir(mo + rf + md + t) for mo, rf, md, t in zip(
+        montant_mo, montant_rf, montant_mat_diff, tva)]
+    return tva, total
+
+
+def ecrire_factures(dbsession, lignes, date, prefixe='',
+                    taux_tva=constant.tva):
+    """
+    Bulk insert the invoices of a chunk of billing lines.
+
+    ``lignes`` are ``(affaire_id, client_id, montant_mo, montant_rf,
+    montant_mat_diff)`` tuples, optionally followed by an ``immeuble``
+    making it a ``FacturePartielle``.  The SAP number is ``prefixe``
+    followed by the affaire id, and for partial invoices by their rank
+    within the affaire, so all partial lines of an affaire must come in
+    the same chunk.
+
+    """
+    if not lignes:
+        return 0
+    columns = list(zip(*lignes))
+    affaire_id, client_id, montant_mo, montant_rf, montant_mat_diff = \
+        columns[:5]
+    immeubles = columns[5] if len(columns) > 5 else [None] * len(lignes)
+    tva, total = calculer_montants(
+        montant_mo, montant_rf, montant_mat_diff, taux_tva)
+
+    factures = []
+    partielles = []
+    rangs = {}
+    for i, immeuble in enumerate(immeubles):
+        if immeuble is None:
+            sap = '%s%d' % (prefixe, affaire_id[i])
+        else:
+            rangs[affaire_id[i]] = rang = rangs.get(affaire_id[i], 0) + 1
+            sap = '%s%d-%d' % (prefixe, affaire_id[i], rang)
+            partielles.append({'sap': sap, 'immeuble': immeuble})
+        factures.append({
+            'sap': sap,
+            'affaire_id': affaire_id[i],
+            'client_id': client_id[i],
+            'montant_mo': montant_mo[i],
+            'montant_rf': montant_rf[i],
+            'montant_mat_diff': montant_mat_diff[i],
+            'montant_tva': tva[i],
+            'total': total[i],
+            'date': date,
+            'type': 'facture' if immeuble is None else 'facture_partielle',
+        })
+    dbsession.execute(Facture.__table__.insert(), factures)
+    mark_changed(dbsession, set(affaire_id))
+    if partielles:
+        dbsession.execute(FacturePartielle.__table__.insert(), partielles)
+    return len(factures)
+
+
+def facturer_affaires_dues(dbsession, jusqu_au=None, relation_type_id=None,
+                           prefixe='', taux_tva=constant.tva, chunk_size=1000,
+                           report=None):
+    """
+    Invoice every closed affaire not invoiced yet.
+
+    The affaires are read and written in chunks of ``chunk_size``, so
+    memory use does not depend on the number of affaires.  ``report`` is
+    called with the number of invoices written so far after each chunk.
+    Returns the number of invoices written.
+
+    """
+    jusqu_au = jusqu_au or datetime.date.today()
+    count = 0
+    apres = None
+    while True:
+        lignes = dbsession.execute(affaires_a_facturer(
+            jusqu_au, relation_type_id, apres).limit(chunk_size)).fetchall()
+        if not lignes:
+            return count
+        count += ecrire_factures(
+            dbsession, [tuple(ligne) for ligne in lignes], jusqu_au, prefixe,
+            taux_tva)
+        apres = lignes[-1].affaire_id
+        if report is not None:
+            report(count)
@@ -0,0 +1,275 @@
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+from pyramid.settings import asbool
+from pyramid.tweens import EXCVIEW, INGRESS
+from pyramid.viewderivers import VIEW
+from sqlalchemy import event
+
+# upper bounds of the buckets, in seconds and in statements
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                    10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# histograms kept per route, by RequestTimings attribute
+SERIES = (
+    ('duration', DURATION_BUCKETS),
+    ('sql_count', STATEMENT_BUCKETS),
+    ('sql_time', DURATION_BUCKETS),
+    ('view_time', DURATION_BUCKETS),
+    ('render_time', DURATION_BUCKETS),
+    ('commit_time', DURATION_BUCKETS),
+)
+
+_current = contextvars.ContextVar('request_timings', default=None)
+
+
+def current_timings():
+    """The timings of the request being handled, None outside requests."""
+    return _current.get()
+
+
+class RequestTimings(object):
+    """
+    Where the time of one request went.
+
+    SQL statements are counted from the thread of the request and from
+    the threads running a copy of its context (see
+    ``contextvars.copy_context``), hence the lock.
+
+    """
+
+    def __init__(self, request=None):
+        self._lock = threading.Lock()
+        self.request = request
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.view_time = 0.0
+        self.render_time = 0.0
+        self.commit_time = 0.0
+        # end of the view and rendering, before pyramid_tm commits
+        self.handled = None
+
+    @property
+    def route_name(self):
+        route = getattr(self.request, 'matched_route', None)
+        return route.name if route is not None else None
+
+    def add_statement(self, elapsed):
+        with self._lock:
+            self.sql_count += 1
+            self.sql_time += elapsed
+
+    def server_timing(self):
+        """Value of a ``Server-Timing`` header, durations in ms."""
+        return ', '.join((
+            'sql;desc="%d statements";dur=%.1f' % (
+                self.sql_count, self.sql_time * 1000),
+            'view;dur=%.1f' % (self.view_time * 1000),
+            'render;dur=%.1f' % (self.render_time * 1000),
+            'commit;dur=%.1f' % (self.commit_time * 1000),
+            'total;dur=%.1f' % (self.duration * 1000),
+        ))
+
+
+class RollingHistogram(object):
+    """
+    Observations of the last ``window`` seconds, counted in ``buckets``.
+
+    The window moves by ``window / slots`` steps: observations are
+    counted in the slot of their time, and a slot is cleared when it
+    comes round again.
+
+    """
+
+    def __init__(self, buckets, window=300, slots=10, clock=time.monotonic):
+        self.buckets = buckets
+        self.window = window
+        self.clock = clock
+        self._step = float(window) / slots
+        # [slot number, counts per bucket (and above the last), sum]
+        self._slots = [[None, [0] * (len(buckets) + 1), 0.0]
+                       for i in range(slots)]
+
+    def _slot(self, number):
+        slot = self._slots[number % len(self._slots)]
+        if slot[0] != number:
+            slot[0] = number
+            slot[1] = [0] * (len(self.buckets) + 1)
+            slot[2] = 0.0
+        return slot
+
+    def observe(self, value):
+        slot = self._slot(int(self.clock() // self._step))
+        index = next((i for i, bound in enumerate(self.buckets)
+                      if value <= bound), len(self.buckets))
+        slot[1][index] += 1
+        slot[2] += value
+
+    def snapshot(self):
+        """Cumulative counts per bucket bound, sum and count."""
+        current = int(self.clock() // self._step)
+        counts = [0] * (len(self.buckets) + 1)
+        total = 0.0
+        for number, slot_counts, slot_sum in self._slots:
+            if number is not None and current - number < len(self._slots):
+                counts = [a + b for a, b in zip(counts, slot_counts)]
+                total += slot_sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            running += count
+            cumulative.append((bound, running))
+        return {'buckets': cumulative, 'sum': total, 'count': running}
+
+
+class RequestMetrics(object):
+    """Rolling histograms of the request timings, per route."""
+
+    def __init__(self, window=300):
+        self.window = window
+        self._lock = threading.Lock()
+        self._routes = defaultdict(lambda: {
+            name: RollingHistogram(buckets, window) for name, buckets in SERIES
+        })
+
+    def observe(self, route_name, timings):
+        with self._lock:
+            for name, histogram in self._routes[route_name].items():
+                histogram.observe(getattr(timings, name))
+
+    def snapshot(self):
+        """``{route name: {series: histogram snapshot}}``."""
+        with self._lock:
+            return {
+                route_name: {name: h.snapshot() for name, h in series.items()}
+                for route_name, series in self._routes.items()
+            }
+
+
+def watch_engine(engine):
+    """Add the statements run on ``engine`` to the current request."""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None and _current.get() is not None:
+        context.instrumentation_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    timings = _current.get()
+    start = getattr(context, 'instrumentation_start', None)
+    if timings is not None and start is not None:
+        timings.add_statement(time.perf_counter() - start)
+
+
+def instrumentation_tween_factory(handler, registry):
+    """Time each request, and add its ``Server-Timing`` header."""
+    metrics = registry['request_metrics']
+    server_timing = asbool(registry.settings.get(
+        'instrumentation.server_timing', True))
+
+    def instrumentation_tween(request):
+        timings = RequestTimings(request)
+        token = _current.set(timings)
+        try:
+            response = handler(request)
+        finally:
+            _current.reset(token)
+        end = time.perf_counter()
+        timings.duration = end - timings.start
+        if timings.handled is not None:
+            timings.commit_time = end - timings.handled
+        metrics.observe(timings.route_name, timings)
+        if server_timing:
+            response.headers['Server-Timing'] = timings.server_timing()
+        return response
+
+    return instrumentation_tween
+
+
+def handled_tween_factory(handler, registry):
+    """Note when the view is done, under pyramid_tm which then commits."""
+
+    def handled_tween(request):
+        response = handler(request)
+        timings = _current.get()
+        if timings is not None:
+            timings.handled = time.perf_counter()
+        return response
+
+    return handled_tween
+
+
+def timed_view(view, info):
+    """View deriver adding the view and its rendering to the timings."""
+
+    def wrapper(context, request):
+        timings = _current.get()
+        if timings is None:
+            return view(context, request)
+        start = time.perf_counter()
+        view_time = timings.view_time
+        response = view(context, request)
+        # whatever the inner deriver did not count as the view
+        timings.render_time += time.perf_counter() - start - (
+            timings.view_time - view_time)
+        return response
+
+    return wrapper
+
+
+def timed_view_callable(view, info):
+    """View deriver adding the view callable alone to the timings."""
+
+    def wrapper(context, request):
+        timings = _current.get()
+        if timings is None:
+            return view(context, request)
+        start = time.perf_counter()
+        try:
+            return view(context, request)
+        finally:
+            timings.view_time += time.perf_counter() - start
+
+    return wrapper
+
+
+def includeme(config):
+    """
+    Time the SQL statements, view, rendering and commit of each request.
+
+    The timings are sent in a ``Server-Timing`` header unless
+    ``instrumentation.server_timing`` is false, and kept per route for
+    ``instrumentation.window`` seconds in the ``request_metrics``
+    histograms shown on ``/metrics``.
+
+    Activate this setup using
+    ``config.include('infolica.services.instrumentation')``.
+
+    """
+    settings = config.get_settings()
+    registry = config.registry
+    registry['request_metrics'] = RequestMetrics(
+        window=float(settings.get('instrumentation.window', 300)))
+    engines = {registry[k].kw['bind']
+               for k in ('dbsession_factory', 'dbsession_factory_ro')}
+    for engine in engines:
+        watch_engine(engine)
+    config.add_view_deriver(timed_view)
+    config.add_view_deriver(
+        timed_view_callable, under='rendered_view', over=VIEW)
+    config.add_tween(
+        'infolica.services.instrumentation.instrumentation_tween_factory',
+        under=INGRESS)
+    config.add_tween(
+        'infolica.services.instrumentation.handled_tween_factory',
+        under='pyramid_tm.tm_tween_factory', over=EXCVIEW)
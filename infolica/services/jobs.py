@@ -0,0 +1,459 @@
+import datetime
+import json
+import logging
+import os
+import socket
+from collections import namedtuple
+
+import transaction
+from pyramid.settings import aslist
+from pyramid_retry import IRetryableError, RetryableException
+from sqlalchemy import and_, func, select, text
+from zope.interface import alsoProvides
+from zope.sqlalchemy import mark_changed
+
+from ..models import get_tm_session, set_statement_timeout
+from ..models.job import DONE, FAILED, PENDING, RUNNING, Job
+
+log = logging.getLogger(__name__)
+
+# attempts of a job when neither its kind nor retry.attempts tell
+MAX_ATTEMPTS = 3
+# seconds between two polls of an idle worker
+POLL_INTERVAL = 2.0
+# seconds before the first retry, doubled on each further attempt
+BACKOFF = 10.0
+# seconds without a commit after which a running job is deemed lost
+TIMEOUT = 1800.0
+# pending jobs a worker looks at when claiming one
+CLAIM_CANDIDATES = 20
+
+JobKind = namedtuple('JobKind', 'name function limit max_attempts')
+
+# name -> JobKind, see job_kind
+KINDS = {}
+
+
+def job_kind(name, limit=None, max_attempts=None):
+    """
+    Register the decorated ``function(context)`` as the jobs of ``kind``.
+
+    At most ``limit`` jobs of the kind run at once over all the workers
+    (``jobs.limit.<name>`` overrides it).  ``max_attempts`` overrides the
+    ``retry.attempts`` setting for the kind.  The function returns the
+    JSON result of the job.
+
+    """
+    def register(function):
+        KINDS[name] = JobKind(name, function, limit, max_attempts)
+        return function
+    return register
+
+
+def _utcnow():
+    return datetime.datetime.utcnow()
+
+
+class JobLost(Exception):
+    """The job was requeued by another worker while it ran."""
+
+
+def enqueue(dbsession, kind, params=None, max_attempts=None, run_after=None,
+            default_max_attempts=None):
+    """
+    Queue a job of ``kind`` in the transaction of ``dbsession``; workers
+    see it once that transaction is committed.
+
+    The job is attempted ``max_attempts`` times, else as many times as
+    its kind sets, else ``default_max_attempts`` times.
+
+    """
+    if kind not in KINDS:
+        raise ValueError('Unknown job kind: %s' % kind)
+    job = Job(
+        kind=kind,
+        params=json.dumps(params or {}, sort_keys=True),
+        state=PENDING,
+        attempts=0,
+        max_attempts=(max_attempts or KINDS[kind].max_attempts or
+                      default_max_attempts or MAX_ATTEMPTS),
+        progress=0.0,
+        created=_utcnow(),
+        run_after=run_after or _utcnow(),
+    )
+    dbsession.add(job)
+    dbsession.flush()
+    return job
+
+
+def job_status(job):
+    """JSON of a ``Job``."""
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'params': json.loads(job.params),
+        'state': job.state,
+        'attempts': job.attempts,
+        'max_attempts': job.max_attempts,
+        'progress': job.progress,
+        'message': job.message,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'created': job.created.isoformat(),
+        'run_after': job.run_after.isoformat(),
+        'started': job.started.isoformat() if job.started else None,
+        'finished': job.finished.isoformat() if job.finished else None,
+    }
+
+
+def is_retryable(transaction_manager, exc):
+    """
+    Whether ``exc`` is retried as pyramid_retry would retry a request.
+
+    As pyramid_tm does, the current transaction is asked first so that
+    the errors its data managers know as transient (e.g. serialization
+    failures) are tagged retryable; call it before aborting.
+
+    """
+    txn = transaction_manager.get()
+    if txn.isRetryableError(exc):
+        alsoProvides(exc, IRetryableError)
+    return isinstance(exc, RetryableException) or IRetryableError.providedBy(
+        exc)
+
+
+class JobContext(object):
+    """
+    What a job function works with.
+
+    ``dbsession`` is joined to the job's transaction, committed when the
+    function returns with the final state of the job.  Long jobs call
+    :meth:`commit` between steps: their work so far, the progress and
+    the heartbeat are committed together, and a new transaction begins.
+
+    """
+
+    def __init__(self, worker, job, dbsession, transaction_manager):
+        self.worker = worker
+        self.id = job.id
+        self.kind = job.kind
+        self.attempt = job.attempts
+        self.params = json.loads(job.params)
+        self.dbsession = dbsession
+        self.transaction_manager = transaction_manager
+        self.session_factory = worker.session_factory
+        self.settings = worker.settings
+        self._progress = {}
+
+    def progress(self, fraction=None, message=None):
+        """Record the progress, written on the next commit."""
+        if fraction is not None:
+            self._progress['progress'] = min(max(float(fraction), 0.0), 1.0)
+        if message is not None:
+            self._progress['message'] = message
+
+    def update(self, **values):
+        """Write ``values`` to the job row, unless another worker owns it."""
+        job = Job.__table__
+        values = dict(self._progress, heartbeat=_utcnow(), **values)
+        result = self.dbsession.execute(job.update().where(and_(
+            job.c.id == self.id, job.c.state == RUNNING,
+            job.c.worker == self.worker.name)).values(**values))
+        if result.rowcount != 1:
+            raise JobLost('job %d was requeued' % self.id)
+        # statements outside the ORM do not tell the session it changed,
+        # the transaction would be rolled back
+        mark_changed(self.dbsession, self.transaction_manager)
+
+    def commit(self):
+        self.update()
+        self.transaction_manager.commit()
+        self.transaction_manager.begin()
+
+
+class Worker(object):
+    """
+    Claim the due jobs and run them, one at a time.
+
+    A job is claimed with a conditional update, so two workers never run
+    the same job and no more than the limit of its kind run at once.
+    A failed job is retried after ``backoff * 2 ** (attempt - 1)``
+    seconds when its error is retryable and it has attempts left.
+    Running jobs whose heartbeat is older than ``timeout`` seconds are
+    requeued (their worker died) when polling.
+
+    """
+
+    def __init__(self, session_factory, name=None, kinds=None, limits=None,
+                 backoff=BACKOFF, timeout=TIMEOUT,
+                 poll_interval=POLL_INTERVAL, settings=None):
+        self.session_factory = session_factory
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.kinds = KINDS if kinds is None else {
+            k: KINDS[k] for k in kinds}
+        self.limits = {k: v.limit for k, v in self.kinds.items()}
+        self.limits.update(limits or {})
+        self.backoff = backoff
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.settings = settings or {}
+
+    def requeue_stale(self, session, now):
+        job = Job.__table__
+        stale = and_(job.c.state == RUNNING,
+                     job.c.heartbeat < now - datetime.timedelta(
+                         seconds=self.timeout))
+        session.execute(job.update().where(
+            and_(stale, job.c.attempts < job.c.max_attempts)).values(
+                state=PENDING, run_after=now, worker=None,
+                error='worker lost'))
+        count = session.execute(job.update().where(stale).values(
+            state=FAILED, finished=now, error='worker lost')).rowcount
+        if count:
+            log.warning('%d lost jobs failed', count)
+
+    def claim(self):
+        """Claim the next due job and return its row, or ``None``."""
+        job = Job.__table__
+        now = _utcnow()
+        session = self.session_factory()
+        try:
+            self.requeue_stale(session, now)
+            session.commit()
+            candidates = session.execute(
+                select([job.c.id, job.c.kind]).where(and_(
+                    job.c.state == PENDING, job.c.run_after <= now,
+                    job.c.kind.in_(list(self.kinds))
+                )).order_by(job.c.run_after, job.c.id).limit(
+                    CLAIM_CANDIDATES)).fetchall()
+            for job_id, kind in candidates:
+                condition = and_(job.c.id == job_id, job.c.state == PENDING)
+                limit = self.limits.get(kind)
+                if limit is not None:
+                    if session.bind.dialect.name == 'postgresql':
+                        # claims of a kind count the running jobs in turn
+                        session.execute(
+                            text('SELECT pg_advisory_xact_lock(hashtext(:k))'),
+                            {'k': kind})
+                    running = select([func.count()]).where(and_(
+                        job.c.kind == kind, job.c.state == RUNNING))
+                    condition = and_(condition, running.as_scalar() < limit)
+                claimed = session.execute(job.update().where(condition).values(
+                    state=RUNNING, attempts=job.c.attempts + 1, started=now,
+                    heartbeat=now, worker=self.name)).rowcount
+                if claimed:
+                    row = session.execute(select([job]).where(
+                        job.c.id == job_id)).first()
+                    session.commit()
+                    return row
+                session.rollback()
+            return None
+        finally:
+            session.close()
+
+    def execute(self, job):
+        """Run a claimed ``job`` and record how it ended."""
+        manager = transaction.TransactionManager(explicit=True)
+        manager.begin()
+        dbsession = get_tm_session(self.session_factory, manager)
+        # jobs are not bound by the timeout of request statements
+        set_statement_timeout(dbsession, None)
+        context = JobContext(self, job, dbsession, manager)
+        try:
+            result = self.kinds[job.kind].function(context)
+            context.update(state=DONE, progress=1.0, finished=_utcnow(),
+                           result=json.dumps(result), error=None)
+            manager.commit()
+        except JobLost as exc:
+            manager.abort()
+            log.warning('%s', exc)
+            return None
+        except Exception as exc:
+            retryable = is_retryable(manager, exc)
+            manager.abort()
+            log.exception('job %d (%s) failed', job.id, job.kind)
+            return self._failed(job, exc, retryable)
+        finally:
+            dbsession.close()
+        return DONE
+
+    def _failed(self, job, exc, retryable):
+        table = Job.__table__
+        now = _utcnow()
+        values = {'error': '%s: %s' % (type(exc).__name__, exc),
+                  'heartbeat': now}
+        if retryable and job.attempts < job.max_attempts:
+            values.update(state=PENDING, worker=None, run_after=now +
+                          datetime.timedelta(seconds=self.backoff * 2 ** (
+                              job.attempts - 1)))
+        else:
+            values.update(state=FAILED, finished=now)
+        session = self.session_factory()
+        try:
+            session.execute(table.update().where(and_(
+                table.c.id == job.id, table.c.state == RUNNING,
+                table.c.worker == self.name)).values(**values))
+            session.commit()
+        finally:
+            session.close()
+        return values['state']
+
+    def run(self, stop, once=False):
+        """
+        Run the due jobs until ``stop`` (an ``Event``) is set, or until
+        none is left when ``once``.
+
+        """
+        while not stop.is_set():
+            job = self.claim()
+            if job is None:
+                if once:
+                    return
+                stop.wait(self.poll_interval)
+                continue
+            self.execute(job)
+
+
+@job_kind('facturation', limit=1)
+def facturation_job(context):
+    """
+    Invoice the closed affaires (``jusqu_au``: ISO date, ``prefixe``).
+    Each chunk of invoices is committed with the heartbeat, a retry only
+    invoices the affaires left.
+
+    """
+    from .facturation import facturer_affaires_dues
+
+    jusqu_au = context.params.get('jusqu_au')
+    if jusqu_au is not None:
+        jusqu_au = datetime.datetime.strptime(jusqu_au, '%Y-%m-%d').date()
+
+    def report(count):
+        context.progress(message='%d factures' % count)
+        context.commit()
+
+    count = facturer_affaires_dues(context.dbsession, jusqu_au,
+                                   prefixe=context.params.get('prefixe', ''),
+                                   report=report)
+    return {'factures': count}
+
+
+@job_kind('rebuild', limit=1)
+def rebuild_job(context):
+    """Rebuild the derived tables (``only``: their names), one by one."""
+    from ..scripts.rebuild import REBUILDERS
+
+    names = context.params.get('only') or sorted(REBUILDERS)
+    unknown = [n for n in names if n not in REBUILDERS]
+    if unknown:
+        raise ValueError('Unknown tables: %s' % ', '.join(unknown))
+    result = {}
+    for i, name in enumerate(names):
+        result[name] = dict(zip(('inserted', 'updated', 'deleted'),
+                                REBUILDERS[name](context.dbsession)))
+        context.progress((i + 1) / len(names), name)
+        context.commit()
+    return result
+
+
+@job_kind('import_cadastre', limit=1)
+def import_cadastre_job(context):
+    """
+    Import CSV files of the ``jobs.import_dir`` directory (``plans``,
+    ``numeros``, ``numeros_plans``: file names).  Batches are committed
+    with their checkpoint, so a retry resumes where the failed attempt
+    stopped.
+
+    """
+    from ..scripts.import_cadastre import COLUMNS, CadastreImport
+
+    directory = context.settings.get('jobs.import_dir')
+    if not directory:
+        raise ValueError('jobs.import_dir is not set')
+    files = [(k, context.params[k]) for k in COLUMNS if context.params.get(k)]
+
+    def report(line):
+        context.progress(message=line)
+        context.commit()
+
+    importer = CadastreImport(context.session_factory, report=report)
+    result = {}
+    for i, (kind, name) in enumerate(files):
+        if os.path.basename(name) != name:
+            raise ValueError('Invalid file name: %s' % name)
+        result[kind] = importer.run(kind, os.path.join(directory, name))
+        context.progress((i + 1) / len(files))
+    return result
+
+
+@job_kind('envoi_documents', limit=1)
+def envoi_documents_job(context):
+    """
+    Mail documents to the clients of affaires (``envois``: ``[affaire_id,
+    document_id]`` pairs, ``relation_type_id``, ``sujet``).  A retry
+    does not send again the documents already sent.
+
+    """
+    from .documents import DocumentStore
+    from .envoi import SUBJECT, Dispatcher, destinataires, dispatcher_options
+
+    envois = [tuple(e) for e in context.params.get('envois', ())]
+    pairs = list(destinataires(context.dbsession, envois,
+                               context.params.get('relation_type_id')))
+
+    def report(line):
+        context.progress(message=line)
+        context.commit()
+
+    root = context.settings.get('documents.root')
+    dispatcher = Dispatcher(
+        context.session_factory, subject=context.params.get('sujet', SUBJECT),
+        store=DocumentStore(root) if root else None, report=report,
+        **dispatcher_options(context.settings))
+    return dispatcher.run(pairs)
+
+
+@job_kind('rappels_preavis', limit=1)
+def rappels_preavis_job(context):
+    """
+    Remind the services of their overdue preavis, at most once every
+    ``preavis.rappel_intervalle`` days; meant to be queued daily.
+
+    """
+    from .envoi import dispatcher_options
+    from .preavis import (
+        RAPPEL_INTERVALLE, PreavisScheduler, envoyer_rappels,
+        scheduler_options)
+
+    settings = context.settings
+    options = dispatcher_options(settings)
+    return envoyer_rappels(
+        context.session_factory,
+        PreavisScheduler(**scheduler_options(settings)),
+        options['connect'], options['sender'],
+        intervalle=int(settings.get('preavis.rappel_intervalle',
+                                    RAPPEL_INTERVALLE)))
+
+
+def worker_options(settings):
+    """``Worker`` keyword arguments from the ``jobs.*`` settings."""
+    prefix = 'jobs.limit.'
+    return {
+        'poll_interval': float(settings.get('jobs.poll_interval',
+                                            POLL_INTERVAL)),
+        'backoff': float(settings.get('jobs.backoff', BACKOFF)),
+        'timeout': float(settings.get('jobs.timeout', TIMEOUT)),
+        'limits': {k[len(prefix):]: int(v) for k, v in settings.items()
+                   if k.startswith(prefix)},
+        'kinds': aslist(settings['jobs.kinds'])
+        if settings.get('jobs.kinds') else None,
+        'settings': settings,
+    }
+
+
+def includeme(config):
+    settings = config.get_settings()
+    # a job is attempted as many times as a request
+    config.registry['job_max_attempts'] = int(
+        settings.get('retry.attempts', MAX_ATTEMPTS))
+    config.registry['job_worker_options'] = worker_options(settings)
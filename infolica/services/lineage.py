@@ -0,0 +1,291 @@
+import threading
+from collections import defaultdict, deque
+
+from pyramid.settings import asbool
+from sqlalchemy import case, event, literal, or_, select
+from sqlalchemy.orm.attributes import get_history
+
+from ..models import Numero, NumeroRelation
+
+DIRECTIONS = ('descendants', 'ancestors', 'both')
+
+PENDING_KEY = 'lineage_pending'
+
+
+class Lineage(object):
+    """
+    Numeros reached from ``numero_id`` and the relations followed.
+
+    ``nodes`` maps each reached numero id to its distance from the start,
+    ``edges`` holds ``(numero_id_base, numero_id_associe,
+    relation_type_id)`` tuples.
+
+    """
+
+    def __init__(self, numero_id, nodes, edges):
+        self.numero_id = numero_id
+        self.nodes = nodes
+        self.edges = edges
+
+    def as_dict(self):
+        return {
+            'numero_id': self.numero_id,
+            'nodes': [{'id': k, 'depth': v}
+                      for k, v in sorted(self.nodes.items())],
+            'edges': [list(e) for e in sorted(self.edges)],
+        }
+
+
+def _lineage_cte(numero_id, direction, max_depth=None):
+    """
+    Recursive select of the numeros whose relations are followed from
+    ``numero_id``: those less than ``max_depth`` relations away.
+
+    UNION drops a numero reached again (at the same depth when
+    ``max_depth`` is given), so each one is expanded once (once per
+    depth) and the recursion stops when no numero is new, even through
+    cycles or both ways.
+
+    """
+    rel = NumeroRelation.__table__
+    seed = [literal(numero_id).label('node')]
+    if max_depth is not None:
+        seed.append(literal(0).label('depth'))
+    cte = select(seed).cte('lineage', recursive=True)
+
+    if direction == 'descendants':
+        match = rel.c.numero_id_base == cte.c.node
+        node = rel.c.numero_id_associe
+    elif direction == 'ancestors':
+        match = rel.c.numero_id_associe == cte.c.node
+        node = rel.c.numero_id_base
+    else:
+        match = or_(rel.c.numero_id_base == cte.c.node,
+                    rel.c.numero_id_associe == cte.c.node)
+        node = case([(rel.c.numero_id_base == cte.c.node,
+                      rel.c.numero_id_associe)],
+                    else_=rel.c.numero_id_base)
+    recursive = select([node.label('node')]).where(match)
+    if max_depth is not None:
+        recursive = recursive.column((cte.c.depth + 1).label('depth')).where(
+            cte.c.depth < max_depth - 1)
+    return cte.union(recursive)
+
+
+def _depths(numero_id, direction, edges, max_depth=None):
+    """Distance of each numero reached through ``edges`` from the start."""
+    neighbours = defaultdict(list)
+    for base, associe, _ in edges:
+        if direction != 'ancestors':
+            neighbours[base].append(associe)
+        if direction != 'descendants':
+            neighbours[associe].append(base)
+    nodes = {numero_id: 0}
+    queue = deque([numero_id])
+    while queue:
+        current = queue.popleft()
+        if max_depth is not None and nodes[current] >= max_depth:
+            continue
+        for node in neighbours.get(current, ()):
+            if node not in nodes:
+                nodes[node] = nodes[current] + 1
+                queue.append(node)
+    return nodes
+
+
+def lineage(dbsession, numero_id, direction='descendants', max_depth=None):
+    """
+    Traverse the relations of a numero with one recursive query.
+
+    ``direction`` follows relations from base to associe (descendants),
+    backwards (ancestors) or both ways, up to ``max_depth`` relations
+    away when given.  The query returns the relations of the numeros
+    expanded, their distances are computed from these.
+
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError('direction must be one of %s' % ', '.join(DIRECTIONS))
+    cte = _lineage_cte(numero_id, direction, max_depth)
+    rel = NumeroRelation.__table__
+    expanded = select([cte.c.node])
+    if direction == 'descendants':
+        match = rel.c.numero_id_base.in_(expanded)
+    elif direction == 'ancestors':
+        match = rel.c.numero_id_associe.in_(expanded)
+    else:
+        match = or_(rel.c.numero_id_base.in_(expanded),
+                    rel.c.numero_id_associe.in_(expanded))
+    edges = {tuple(row) for row in dbsession.execute(select([
+        rel.c.numero_id_base, rel.c.numero_id_associe,
+        rel.c.relation_type_id]).where(match))}
+    return Lineage(numero_id, _depths(numero_id, direction, edges, max_depth),
+                   edges)
+
+
+class LineageCache(object):
+    """
+    In-memory adjacency lists of the numero relations, per cadastre.
+
+    A cadastre is loaded with one query the first time a traversal
+    reaches one of its numeros, and dropped when a committed change
+    touches a relation of one of its numeros.  Loads run outside the
+    lock, a load overlapping an invalidation is used by its traversal
+    only.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # cadastre_id -> (children, parents) adjacency dicts, replaced as
+        # a whole
+        self._cadastres = {}
+        self._node_cadastre = {}
+        # incremented by every invalidation
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._cadastres)
+
+    def _load(self, dbsession, cadastre_id):
+        rel = NumeroRelation.__table__
+        base = Numero.__table__.alias('base')
+        associe = Numero.__table__.alias('associe')
+        children = defaultdict(list)
+        parents = defaultdict(list)
+        node_cadastre = {}
+        query = select([
+            rel.c.numero_id_base, rel.c.numero_id_associe,
+            rel.c.relation_type_id, base.c.cadastre_id, associe.c.cadastre_id,
+        ]).select_from(
+            rel.join(base, base.c.id == rel.c.numero_id_base)
+            .join(associe, associe.c.id == rel.c.numero_id_associe)
+        ).where(or_(base.c.cadastre_id == cadastre_id,
+                    associe.c.cadastre_id == cadastre_id))
+        for b, a, type_id, b_cadastre, a_cadastre in dbsession.execute(query):
+            edge = (b, a, type_id)
+            if b_cadastre == cadastre_id:
+                children[b].append(edge)
+            if a_cadastre == cadastre_id:
+                parents[a].append(edge)
+            node_cadastre[b] = b_cadastre
+            node_cadastre[a] = a_cadastre
+        return (children, parents), node_cadastre
+
+    def _adjacency(self, dbsession, numero_id, loaded):
+        """
+        Adjacency dicts of the cadastre of ``numero_id``; ``loaded`` keeps
+        those of the current traversal.
+
+        """
+        with self._lock:
+            cadastre_id = self._node_cadastre.get(numero_id)
+        if cadastre_id is None:
+            cadastre_id = dbsession.query(Numero.cadastre_id).filter(
+                Numero.id == numero_id).scalar()
+            if cadastre_id is None:
+                return {}, {}
+            with self._lock:
+                self._node_cadastre[numero_id] = cadastre_id
+        if cadastre_id in loaded:
+            return loaded[cadastre_id]
+        with self._lock:
+            adjacency = self._cadastres.get(cadastre_id)
+            generation = self._generation
+        if adjacency is None:
+            adjacency, node_cadastre = self._load(dbsession, cadastre_id)
+            with self._lock:
+                if self._generation == generation:
+                    self._cadastres[cadastre_id] = adjacency
+                    self._node_cadastre.update(node_cadastre)
+        loaded[cadastre_id] = adjacency
+        return adjacency
+
+    def lineage(self, dbsession, numero_id, direction='descendants',
+                max_depth=None):
+        """Same result as :func:`lineage`, from the adjacency lists."""
+        if direction not in DIRECTIONS:
+            raise ValueError(
+                'direction must be one of %s' % ', '.join(DIRECTIONS))
+        nodes = {numero_id: 0}
+        edges = set()
+        queue = deque([numero_id])
+        loaded = {}
+        while queue:
+            current = queue.popleft()
+            depth = nodes[current]
+            if max_depth is not None and depth >= max_depth:
+                continue
+            children, parents = self._adjacency(dbsession, current, loaded)
+            found = []
+            if direction != 'ancestors':
+                found.extend((e, e[1]) for e in children.get(current, ()))
+            if direction != 'descendants':
+                found.extend((e, e[0]) for e in parents.get(current, ()))
+            for edge, node in found:
+                edges.add(edge)
+                if node not in nodes:
+                    nodes[node] = depth + 1
+                    queue.append(node)
+        return Lineage(numero_id, nodes, edges)
+
+    def invalidate(self, cadastre_ids):
+        with self._lock:
+            self._generation += 1
+            for cadastre_id in cadastre_ids:
+                self._cadastres.pop(cadastre_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cadastres.clear()
+            self._node_cadastre.clear()
+
+    def watch(self, session_factory):
+        """Invalidate on changes committed by ``session_factory`` sessions."""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        numero_ids = set()
+        for obj in session.new | session.dirty | session.deleted:
+            if isinstance(obj, NumeroRelation):
+                for key in ('numero_id_base', 'numero_id_associe'):
+                    numero_ids.update(get_history(obj, key).sum())
+        numero_ids.discard(None)
+        if not numero_ids:
+            return
+        pending = session.info.setdefault(PENDING_KEY, set())
+        # the cadastres of numeros deleted by this flush are known only
+        # when they were loaded
+        with self._lock:
+            pending.update(self._node_cadastre[i] for i in numero_ids
+                           if i in self._node_cadastre)
+        numero = Numero.__table__
+        ids = sorted(numero_ids)
+        for i in range(0, len(ids), 500):
+            pending.update(cadastre_id for cadastre_id, in session.execute(
+                select([numero.c.cadastre_id]).where(
+                    numero.c.id.in_(ids[i:i + 500]))))
+
+    def _after_commit(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if pending:
+            self.invalidate(pending)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+def includeme(config):
+    """
+    Register the numero lineage cache when ``lineage.cache`` is enabled.
+
+    Activate this setup using ``config.include('infolica.services.lineage')``.
+
+    """
+    settings = config.get_settings()
+    if asbool(settings.get('lineage.cache', False)):
+        cache = LineageCache()
+        cache.watch(config.registry['dbsession_factory'])
+        config.registry['numero_lineage_cache'] = cache
@@ -0,0 +1,156 @@
+import base64
+import datetime
+import json
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.settings import asbool
+from sqlalchemy import tuple_
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def in_filter(column, convert=_int_list):
+    """Filter on ``column`` being one of a comma separated list of values."""
+    def criterion(value):
+        values = convert(value)
+        if len(values) == 1:
+            return column == values[0]
+        return column.in_(values)
+    return criterion
+
+
+def null_filter(column):
+    """Filter on ``column`` being set (true) or null (false)."""
+    def criterion(value):
+        if asbool(value):
+            return column.isnot(None)
+        return column.is_(None)
+    return criterion
+
+
+class FilterSet(object):
+    """
+    Translate request parameters into SQL criteria.
+
+    ``filters`` maps a parameter name to a callable returning the criterion
+    for the parameter value.  Unknown parameters are ignored so that paging
+    parameters can live in the same query string.
+
+    """
+
+    def __init__(self, **filters):
+        self.filters = filters
+
+    def criteria(self, params):
+        result = []
+        for name, build in sorted(self.filters.items()):
+            value = params.get(name)
+            if value is None or value == '':
+                continue
+            try:
+                result.append(build(value))
+            except ValueError:
+                raise HTTPBadRequest('Invalid parameter: %s' % name)
+        return result
+
+    def apply(self, query, params):
+        for criterion in self.criteria(params):
+            query = query.filter(criterion)
+        return query
+
+
+def _default(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(repr(value))
+
+
+def encode_cursor(values):
+    """Opaque cursor for the sort key of the last row of a page."""
+    data = json.dumps(values, default=_default).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor, converters):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if len(values) != len(converters):
+            raise ValueError
+        return [convert(v) for convert, v in zip(converters, values)]
+    except (TypeError, ValueError):
+        raise HTTPBadRequest('Invalid parameter: cursor')
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+
+
+class KeysetPaginator(object):
+    """
+    Keyset (a.k.a. seek) pagination over an ordered, unique sort key.
+
+    Instead of ``OFFSET`` the next page starts after the sort key of the
+    last row seen, so with an index on the key every page costs the same
+    whatever its depth.
+
+    """
+
+    def __init__(self, columns, converters, default_limit=100, max_limit=1000):
+        self.columns = columns
+        self.converters = converters
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+
+    def limit(self, params):
+        try:
+            limit = int(params.get('limit', self.default_limit))
+        except ValueError:
+            raise HTTPBadRequest('Invalid parameter: limit')
+        return max(1, min(limit, self.max_limit))
+
+    def page(self, query, params):
+        """
+        Return ``(rows, next_cursor)``, the cursor being None on the last page.
+
+        The sort key columns must be selected by ``query``.
+
+        """
+        descending = params.get('order', 'asc') == 'desc'
+        key = tuple_(*self.columns)
+        cursor = params.get('cursor')
+        if cursor:
+            after = tuple_(*decode_cursor(cursor, self.converters))
+            query = query.filter(key < after if descending else key > after)
+        order = [c.desc() if descending else c.asc() for c in self.columns]
+        limit = self.limit(params)
+        rows = query.order_by(*order).limit(limit + 1).all()
+        if len(rows) <= limit:
+            return rows, None
+        rows = rows[:limit]
+        last = rows[-1]
+        return rows, encode_cursor(
+            [getattr(last, c.key) for c in self.columns])
+
+
+def iter_json_page(name, rows, next_cursor, serialize=None, chunk_size=200):
+    """
+    Serialize a page as ``{name: [...], "next": cursor}`` in chunks.
+
+    ``serialize`` turns a row into a dict, by default ``row._asdict()``
+    (query result rows).
+
+    """
+    serialize = serialize or (lambda row: row._asdict())
+    encoder = json.JSONEncoder(default=_default)
+    yield ('{"%s": [' % name).encode('utf-8')
+    chunk = []
+    for i, row in enumerate(rows):
+        chunk.append((',' if i else '') + encoder.encode(serialize(row)))
+        if len(chunk) >= chunk_size:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+    yield ('], "next": %s}' % encoder.encode(next_cursor)).encode('utf-8')
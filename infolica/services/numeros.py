@@ -0,0 +1,65 @@
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from ..models import Numero
+from ..models.compteur import NumeroCompteur
+
+MAX_RESERVATION = 1000
+
+
+def _take(connection, cadastre_id, type_id, nombre):
+    """Advance the counter, return the first number taken or None."""
+    table = NumeroCompteur.__table__
+    where = (table.c.cadastre_id == cadastre_id) & (table.c.type_id == type_id)
+    result = connection.execute(
+        table.update().where(where).values(prochain=table.c.prochain + nombre))
+    if result.rowcount == 0:
+        return None
+    # the row stays locked by the update until the transaction ends
+    prochain = connection.execute(
+        select([table.c.prochain]).where(where)).scalar()
+    return prochain - nombre
+
+
+def _create_counter(dbsession, cadastre_id, type_id):
+    numero = Numero.__table__
+    highest = dbsession.execute(
+        select([func.max(numero.c.numero)]).where(
+            (numero.c.cadastre_id == cadastre_id) &
+            (numero.c.type_id == type_id))).scalar()
+    savepoint = dbsession.begin_nested()
+    try:
+        dbsession.execute(NumeroCompteur.__table__.insert().values(
+            cadastre_id=cadastre_id, type_id=type_id,
+            prochain=(highest or 0) + 1))
+        savepoint.commit()
+    except IntegrityError:
+        # another transaction created it first
+        savepoint.rollback()
+
+
+def reserve_numeros(dbsession, cadastre_id, type_id, nombre, etat_id):
+    """
+    Reserve ``nombre`` consecutive numbers of a cadastre and type.
+
+    Returns the created ``Numero`` rows.  Concurrent reservations for the
+    same cadastre and type queue on the counter row until the reserving
+    transaction ends; other counters are not affected.
+
+    """
+    if not 0 < nombre <= MAX_RESERVATION:
+        raise ValueError('nombre must be between 1 and %d' % MAX_RESERVATION)
+    connection = dbsession.connection()
+    first = _take(connection, cadastre_id, type_id, nombre)
+    if first is None:
+        _create_counter(dbsession, cadastre_id, type_id)
+        first = _take(connection, cadastre_id, type_id, nombre)
+
+    numeros = [
+        Numero(cadastre_id=cadastre_id, type_id=type_id,
+               numero=first + i, etat_id=etat_id)
+        for i in range(nombre)
+    ]
+    dbsession.add_all(numeros)
+    dbsession.flush()
+    return numeros
@@ -0,0 +1,384 @@
+import datetime
+import heapq
+import logging
+import smtplib
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from email.message import EmailMessage
+
+from sqlalchemy import event, inspect, select
+
+from ..models import Preavis, Services
+from .envoi import GREETING, SIGNATURE
+
+log = logging.getLogger(__name__)
+
+PENDING_KEY = 'preavis_scheduler_pending'
+
+# days a service has to answer
+DELAI = 30
+# days between two reminders of an unanswered preavis
+RAPPEL_INTERVALLE = 7
+
+SUBJECT = 'Préavis en attente de réponse'
+
+# columns of a preavis the scheduler keeps
+Etat = namedtuple('Etat', 'affaire_id service_id date_demande date_reponse')
+Ouvert = namedtuple('Ouvert', 'affaire_id service_id date_demande echeance')
+
+_COLUMNS = Etat._fields
+
+
+def _etat(obj, before):
+    """
+    ``Etat`` of a flushed preavis, as it is or as it was ``before`` the
+    flush; ``None`` when a previous value was not loaded.
+
+    """
+    state = inspect(obj)
+    values = []
+    for name in _COLUMNS:
+        history = state.attrs[name].history
+        if not before:
+            values.append(getattr(obj, name))
+        elif history.deleted:
+            values.append(history.deleted[0])
+        elif history.unchanged:
+            values.append(history.unchanged[0])
+        elif history.added:
+            # changed without its previous value being loaded
+            return None
+        else:
+            values.append(None)
+    return Etat(*values)
+
+
+class PreavisScheduler(object):
+    """
+    Due dates of the unanswered preavis and response times by service.
+
+    A preavis is due ``delai`` days after its request (``delais`` by
+    service id).  The unanswered ones are kept in a heap by due date;
+    moving the day forward pops those gone overdue, so the overdue list
+    and the counts by service are maintained rather than computed from
+    all the preavis.  Answered preavis only add to the count and total
+    response days of their service.
+
+    Like the spatial index, it is loaded on first use (the unanswered
+    preavis through their partial index) and then kept up to date from
+    the sessions it watches.  Bulk ``query.update()`` statements bypass
+    the ORM and require a :meth:`reset`.
+
+    """
+
+    def __init__(self, delai=DELAI, delais=None):
+        self.delai = delai
+        self.delais = delais or {}
+        self.loaded = False
+        self._lock = threading.RLock()
+        self._clear()
+
+    def _clear(self):
+        # id -> Ouvert of the unanswered preavis
+        self._open = {}
+        # (echeance, id) of the unanswered preavis not overdue on _today,
+        # and of some answered since (dropped when popped)
+        self._heap = []
+        # id -> echeance of the overdue preavis
+        self._overdue = {}
+        self._today = None
+        self._ouverts = defaultdict(int)
+        self._en_retard = defaultdict(int)
+        # service id -> [answered preavis, total response days]
+        self._repondus = defaultdict(lambda: [0, 0])
+
+    def echeance(self, service_id, date_demande):
+        days = self.delais.get(service_id, self.delai)
+        return date_demande + datetime.timedelta(days=days)
+
+    def load(self, dbsession):
+        preavis = Preavis.__table__
+        with self._lock:
+            self._clear()
+            rows = dbsession.execute(select(
+                [preavis.c.id] + [preavis.c[c] for c in _COLUMNS]).where(
+                    preavis.c.date_reponse.is_(None)))
+            for row in rows:
+                self._add(row.id, Etat(*row[1:]))
+            rows = dbsession.execute(select(
+                [preavis.c.service_id, preavis.c.date_demande,
+                 preavis.c.date_reponse]).where(
+                    preavis.c.date_reponse.isnot(None)).execution_options(
+                        stream_results=True))
+            for service_id, date_demande, date_reponse in rows:
+                repondus = self._repondus[service_id]
+                repondus[0] += 1
+                repondus[1] += (date_reponse - date_demande).days
+            self.loaded = True
+        log.debug('preavis scheduler loaded with %d unanswered preavis',
+                  len(self._open))
+
+    def ensure_loaded(self, dbsession):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.load(dbsession)
+
+    def reset(self):
+        with self._lock:
+            self._clear()
+            self.loaded = False
+
+    def _add(self, id_, etat):
+        if etat.date_reponse is not None:
+            repondus = self._repondus[etat.service_id]
+            repondus[0] += 1
+            repondus[1] += (etat.date_reponse - etat.date_demande).days
+            return
+        echeance = self.echeance(etat.service_id, etat.date_demande)
+        self._open[id_] = Ouvert(etat.affaire_id, etat.service_id,
+                                 etat.date_demande, echeance)
+        self._ouverts[etat.service_id] += 1
+        if self._today is not None and echeance < self._today:
+            self._overdue[id_] = echeance
+            self._en_retard[etat.service_id] += 1
+        else:
+            heapq.heappush(self._heap, (echeance, id_))
+
+    def _remove(self, id_, etat):
+        if etat.date_reponse is not None:
+            repondus = self._repondus[etat.service_id]
+            repondus[0] -= 1
+            repondus[1] -= (etat.date_reponse - etat.date_demande).days
+            return
+        ouvert = self._open.pop(id_, None)
+        if ouvert is None:
+            return
+        self._ouverts[ouvert.service_id] -= 1
+        if self._overdue.pop(id_, None) is not None:
+            self._en_retard[ouvert.service_id] -= 1
+        # its heap entry is dropped when popped, or when they pile up
+        if len(self._heap) > 2 * len(self._open) + 64:
+            self._heap = [(o.echeance, i) for i, o in self._open.items()
+                          if i not in self._overdue]
+            heapq.heapify(self._heap)
+
+    def _advance(self, today):
+        """Move the preavis due before ``today`` to the overdue ones."""
+        if self._today is not None and today < self._today:
+            # back in time: the overdue preavis may not be yet
+            for id_, echeance in self._overdue.items():
+                heapq.heappush(self._heap, (echeance, id_))
+            self._overdue.clear()
+            self._en_retard.clear()
+        self._today = today
+        heap = self._heap
+        while heap and heap[0][0] < today:
+            echeance, id_ = heapq.heappop(heap)
+            ouvert = self._open.get(id_)
+            if ouvert is None or ouvert.echeance != echeance:
+                continue
+            if id_ not in self._overdue:
+                self._overdue[id_] = echeance
+                self._en_retard[ouvert.service_id] += 1
+
+    def overdue(self, today=None):
+        """
+        The unanswered preavis due before ``today``, the most late first:
+        ``(id, Ouvert)`` pairs.
+
+        """
+        with self._lock:
+            self._advance(today or datetime.date.today())
+            return sorted(((id_, self._open[id_]) for id_ in self._overdue),
+                          key=lambda item: (item[1].echeance, item[0]))
+
+    def stats(self, today=None):
+        """
+        ``{service_id: {ouverts, en_retard, repondus, delai_moyen}}``,
+        ``delai_moyen`` being the mean days to answer.
+
+        """
+        with self._lock:
+            self._advance(today or datetime.date.today())
+            services = set(self._repondus) | {
+                s for s, n in self._ouverts.items() if n}
+            result = {}
+            for service_id in services:
+                repondus, jours = self._repondus.get(service_id, (0, 0))
+                result[service_id] = {
+                    'ouverts': self._ouverts.get(service_id, 0),
+                    'en_retard': self._en_retard.get(service_id, 0),
+                    'repondus': repondus,
+                    'delai_moyen': round(jours / repondus, 1)
+                    if repondus else None,
+                }
+            return result
+
+    def watch(self, session_factory):
+        """Keep the scheduler in sync with sessions of ``session_factory``."""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.setdefault(PENDING_KEY, [])
+        for obj in session.new:
+            if isinstance(obj, Preavis):
+                pending.append((obj.id, None, _etat(obj, False)))
+        for obj in session.dirty:
+            if isinstance(obj, Preavis) and session.is_modified(obj):
+                before = _etat(obj, True)
+                if before is None:
+                    pending.append(None)
+                else:
+                    pending.append((obj.id, before, _etat(obj, False)))
+        for obj in session.deleted:
+            if isinstance(obj, Preavis):
+                before = _etat(obj, True)
+                pending.append(None if before is None else (
+                    obj.id, before, None))
+
+    def _after_commit(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if not pending or not self.loaded:
+            return
+        with self._lock:
+            if None in pending:
+                log.debug('preavis changed without their previous values, '
+                          'reloading the scheduler')
+                self.reset()
+                return
+            for id_, before, after in pending:
+                if before is not None:
+                    self._remove(id_, before)
+                if after is not None:
+                    self._add(id_, after)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+def rappels(dbsession, scheduler, today, intervalle=RAPPEL_INTERVALLE):
+    """
+    ``{service_id: [(preavis id, Ouvert)]}`` of the overdue preavis whose
+    service was not reminded of them for ``intervalle`` days.
+
+    Reads the unanswered preavis only, through their partial index.
+
+    """
+    preavis = Preavis.__table__
+    last = today - datetime.timedelta(days=intervalle)
+    query = select([preavis.c.id, preavis.c.affaire_id, preavis.c.service_id,
+                    preavis.c.date_demande]).where(
+        preavis.c.date_reponse.is_(None)).where(
+            (preavis.c.date_rappel.is_(None)) |
+            (preavis.c.date_rappel <= last)).order_by(
+                preavis.c.service_id, preavis.c.date_demande, preavis.c.id)
+    result = {}
+    for id_, affaire_id, service_id, date_demande in dbsession.execute(query):
+        echeance = scheduler.echeance(service_id, date_demande)
+        if echeance < today:
+            result.setdefault(service_id, []).append((id_, Ouvert(
+                affaire_id, service_id, date_demande, echeance)))
+    return result
+
+
+def message_rappel(sender, mail, ouverts, today):
+    """The message reminding ``mail`` of the ``(id, Ouvert)`` pairs."""
+    message = EmailMessage()
+    message['From'] = sender
+    message['To'] = mail
+    message['Subject'] = SUBJECT
+    lines = [GREETING, '',
+             'Les préavis suivants attendent votre réponse :']
+    lines.extend('- affaire %d, demandé le %s, échu depuis %d jours' % (
+        o.affaire_id, o.date_demande.strftime('%d.%m.%Y'),
+        (today - o.echeance).days) for _, o in ouverts)
+    lines.extend(['', SIGNATURE])
+    message.set_content('\n'.join(lines))
+    return message
+
+
+def envoyer_rappels(session_factory, scheduler, connect, sender, today=None,
+                    intervalle=RAPPEL_INTERVALLE):
+    """
+    Remind each service of its overdue preavis in one message, all of
+    them sent over one connection of ``connect()``, and record the day
+    of the reminder on the preavis of the services reminded.
+
+    Returns the counts of services reminded, without address or whose
+    message was rejected, and of preavis reminded.
+
+    """
+    today = today or datetime.date.today()
+    counts = OrderedDict.fromkeys(
+        ('services', 'sans_adresse', 'rejetes', 'preavis'), 0)
+    session = session_factory()
+    connection = None
+    try:
+        due = rappels(session, scheduler, today, intervalle)
+        service = Services.__table__
+        mails = {row.id: (row.mail or '').strip() for row in session.execute(
+            select([service.c.id, service.c.mail]).where(
+                service.c.id.in_(list(due))))} if due else {}
+        reminded = []
+        for service_id, ouverts in due.items():
+            mail = mails.get(service_id)
+            if not mail:
+                counts['sans_adresse'] += 1
+                continue
+            try:
+                if connection is None:
+                    connection = connect()
+                connection.send_message(
+                    message_rappel(sender, mail, ouverts, today))
+            except OSError as e:
+                log.warning('reminder to %s rejected: %s', mail, e)
+                counts['rejetes'] += 1
+                if connection is not None and not isinstance(
+                        e, smtplib.SMTPResponseException):
+                    connection.close()
+                    connection = None
+                continue
+            counts['services'] += 1
+            reminded.extend(id_ for id_, _ in ouverts)
+        if reminded:
+            preavis = Preavis.__table__
+            session.execute(preavis.update().where(
+                preavis.c.id.in_(reminded)).values(date_rappel=today))
+            counts['preavis'] = len(reminded)
+        session.commit()
+    finally:
+        if connection is not None:
+            try:
+                connection.quit()
+            except OSError:
+                connection.close()
+        session.close()
+    return counts
+
+
+def scheduler_options(settings):
+    """``PreavisScheduler`` keyword arguments from the settings."""
+    prefix = 'preavis.delai.'
+    return {
+        'delai': int(settings.get('preavis.delai', DELAI)),
+        'delais': {int(k[len(prefix):]): int(v)
+                   for k, v in settings.items() if k.startswith(prefix)},
+    }
+
+
+def includeme(config):
+    """
+    Register the preavis scheduler on the registry.
+
+    Settings: ``preavis.delai`` (days a service has to answer),
+    ``preavis.delai.<service id>`` for the services answering in
+    another delay and ``preavis.rappel_intervalle`` (days between two
+    reminders).
+
+    """
+    scheduler = PreavisScheduler(**scheduler_options(config.get_settings()))
+    scheduler.watch(config.registry['dbsession_factory'])
+    config.registry['preavis_scheduler'] = scheduler
@@ -0,0 +1,363 @@
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from pyramid.interfaces import IRoutesMapper
+from pyramid.response import Response
+from pyramid.settings import asbool
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+from ..models import read_primary
+
+log = logging.getLogger(__name__)
+
+PENDING_KEY = 'response_cache_pending'
+
+Entry = namedtuple('Entry', 'status headerlist body tables created')
+
+
+def table_names(dependencies):
+    """Full names of the tables of models or tables, subclass tables too."""
+    names = set()
+    for dependency in dependencies:
+        mapper = getattr(dependency, '__mapper__', None)
+        tables = mapper.tables if mapper is not None else [dependency]
+        names.update(t.fullname for t in tables)
+    return frozenset(names)
+
+
+class ResponseCache(object):
+    """
+    Bounded LRU of rendered GET responses, by route and query string.
+
+    Each entry depends on the tables read to build it.  Committing a
+    change to one of these tables from a watched session drops it, as
+    does reaching ``ttl`` seconds of age, which bounds staleness for
+    changes made by other processes.  Entries pushed out of memory are
+    written to ``spill_dir`` when set, up to ``spill_max_size`` bytes.
+    Responses larger than ``max_entry_size`` (an eighth of ``max_size``
+    by default) are not kept.
+
+    """
+
+    def __init__(self, max_size, ttl=None, spill_dir=None, spill_max_size=0,
+                 max_entry_size=None):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size or max_size // 8
+        self.ttl = ttl
+        self.spill_dir = spill_dir
+        self.spill_max_size = spill_max_size
+        # route name -> names of the tables its responses depend on
+        self.routes = {}
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # key -> (path, size, tables) of the entries spilled to disk
+        self._spilled = OrderedDict()
+        self._spilled_size = 0
+        # table -> number of invalidations, to drop responses built
+        # while their tables were changing
+        self._generations = {}
+        self.stats = dict.fromkeys((
+            'hits', 'misses', 'stores', 'evictions', 'invalidations',
+            'spills', 'spill_hits'), 0)
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    @property
+    def memory_size(self):
+        return self._memory_size
+
+    @property
+    def spilled_size(self):
+        return self._spilled_size
+
+    def _path(self, key):
+        return os.path.join(
+            self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def _expired(self, entry):
+        return self.ttl is not None and time.time() - entry.created >= self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+            elif key in self._spilled:
+                entry = self._unspill(key)
+            if entry is not None and self._expired(entry):
+                self._drop(key)
+                entry = None
+            self.stats['hits' if entry is not None else 'misses'] += 1
+            return entry
+
+    def generations(self, tables):
+        return tuple(self._generations.get(t, 0) for t in sorted(tables))
+
+    def put(self, key, entry, generations):
+        """Store ``entry`` unless its tables changed since ``generations``."""
+        size = len(entry.body)
+        if size > self.max_entry_size:
+            return False
+        with self._lock:
+            if generations != self.generations(entry.tables):
+                return False
+            self._drop(key)
+            self._memory[key] = entry
+            self._memory_size += size
+            self.stats['stores'] += 1
+            self._evict()
+            return True
+
+    def _evict(self):
+        while self._memory_size > self.max_size:
+            key, entry = self._memory.popitem(last=False)
+            self._memory_size -= len(entry.body)
+            self.stats['evictions'] += 1
+            if self.spill_dir:
+                self._spill(key, entry)
+
+    def _spill(self, key, entry):
+        path = self._path(key)
+        try:
+            with open(path, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            log.warning('could not spill a cached response', exc_info=True)
+            return
+        size = len(entry.body)
+        self._spilled[key] = (path, size, entry.tables)
+        self._spilled_size += size
+        self.stats['spills'] += 1
+        while self._spilled_size > self.spill_max_size:
+            old_key = next(iter(self._spilled))
+            self._unlink(old_key)
+
+    def _unspill(self, key):
+        path = self._spilled[key][0]
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            log.warning('could not read a spilled response', exc_info=True)
+            entry = None
+        self._unlink(key)
+        if entry is not None:
+            self.stats['spill_hits'] += 1
+            self._memory[key] = entry
+            self._memory_size += len(entry.body)
+            self._evict()
+        return entry
+
+    def _unlink(self, key):
+        path, size, tables = self._spilled.pop(key)
+        self._spilled_size -= size
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _drop(self, key):
+        entry = self._memory.pop(key, None)
+        if entry is not None:
+            self._memory_size -= len(entry.body)
+        if key in self._spilled:
+            self._unlink(key)
+
+    def invalidate(self, tables):
+        """Drop the entries depending on any of ``tables``."""
+        tables = set(tables)
+        with self._lock:
+            for table in tables:
+                self._generations[table] = self._generations.get(table, 0) + 1
+            stale = [k for k, e in self._memory.items() if e.tables & tables]
+            stale.extend(k for k, (path, size, entry_tables)
+                         in self._spilled.items() if entry_tables & tables)
+            for key in stale:
+                self._drop(key)
+            self.stats['invalidations'] += len(stale)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._memory) + list(self._spilled):
+                self._drop(key)
+
+    def watch(self, session_factory):
+        """
+        Invalidate on changes committed by ``session_factory`` sessions.
+
+        The changed tables are those of the INSERT, UPDATE and DELETE
+        statements run on the connections of a session, so bulk
+        statements are seen as well as flushes.  Textual SQL is not.
+
+        """
+        engine = session_factory.kw['bind']
+        event.listen(engine, 'after_execute', self._after_execute)
+        event.listen(session_factory, 'after_begin', self._after_begin)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_begin(self, session, transaction, connection):
+        # shared by the DBAPI connection of the session until the next
+        # session using it, unlike the Connection objects
+        connection.info[PENDING_KEY] = session.info.setdefault(
+            PENDING_KEY, set())
+
+    def _after_execute(self, conn, clauseelement, multiparams, params,
+                       result):
+        if isinstance(clauseelement, UpdateBase):
+            pending = conn.info.get(PENDING_KEY)
+            if pending is not None:
+                pending.add(clauseelement.table.fullname)
+
+    def _after_commit(self, session):
+        tables = session.info.pop(PENDING_KEY, None)
+        if tables:
+            self.invalidate(tables)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+class _StoringIter(object):
+    """Stream an app_iter while keeping a copy to store once complete."""
+
+    def __init__(self, app_iter, store, max_size):
+        self.app_iter = app_iter
+        self.store = store
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            if self.chunks is not None:
+                self.size += len(chunk)
+                if self.size > self.max_size:
+                    self.chunks = None
+                else:
+                    self.chunks.append(chunk)
+            yield chunk
+        if self.chunks is not None:
+            self.store(b''.join(self.chunks))
+
+    def close(self):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+
+
+def response_cache_tween_factory(handler, registry):
+    """
+    Answer GET requests of cached routes from the response cache.
+
+    The entries are invalidated by the commits of the primary, so the
+    responses to store are read from it: read from a lagging replica,
+    they would be kept with rows from before the commit.
+
+    """
+    cache = registry['response_cache']
+    mapper = registry.queryUtility(IRoutesMapper)
+
+    def response_cache_tween(request):
+        if request.method != 'GET':
+            return handler(request)
+        route = mapper(request)['route']
+        tables = cache.routes.get(route.name) if route is not None else None
+        if tables is None:
+            return handler(request)
+
+        key = (route.name, request.path, tuple(sorted(request.GET.items())))
+        entry = cache.get(key)
+        if entry is not None:
+            response = Response(
+                status=entry.status, headerlist=list(entry.headerlist),
+                body=entry.body)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        generations = cache.generations(tables)
+        read_primary(request)
+        response = handler(request)
+        if response.status_int != 200 or 'Set-Cookie' in response.headers:
+            return response
+        headerlist = [(k, v) for k, v in response.headerlist
+                      if k.lower() not in ('content-length', 'x-cache')]
+
+        def store(body):
+            cache.put(key, Entry(response.status, headerlist, body, tables,
+                                 time.time()), generations)
+
+        response.headers['X-Cache'] = 'MISS'
+        if response.app_iter is not None and \
+                not isinstance(response.app_iter, (list, tuple)):
+            response.app_iter = _StoringIter(
+                response.app_iter, store, cache.max_entry_size)
+        else:
+            store(response.body)
+        return response
+
+    return response_cache_tween
+
+
+def cache_depends(view, info):
+    """
+    View deriver registering ``cache_depends`` tables for the view route.
+
+    ``@view_config(route_name=..., cache_depends=(Model, ...))`` makes
+    the GET responses of the route cacheable, depending on the tables of
+    these models.
+
+    """
+    dependencies = info.options.get('cache_depends')
+    route_name = info.options.get('route_name')
+    if dependencies and route_name:
+        routes = info.registry.setdefault('response_cache_routes', {})
+        routes[route_name] = table_names(dependencies)
+    return view
+
+
+cache_depends.options = ('cache_depends',)
+
+
+def includeme(config):
+    """
+    Add the ``cache_depends`` view option and, when
+    ``response_cache.enabled``, the response cache tween.
+
+    Settings: ``response_cache.max_size`` (bytes in memory),
+    ``response_cache.ttl`` (seconds), ``response_cache.spill_dir`` and
+    ``response_cache.spill_max_size`` (bytes on disk).
+
+    Activate this setup using
+    ``config.include('infolica.services.response_cache')``.
+
+    """
+    config.add_view_deriver(cache_depends)
+    settings = config.get_settings()
+    if not asbool(settings.get('response_cache.enabled', False)):
+        return
+    ttl = settings.get('response_cache.ttl')
+    cache = ResponseCache(
+        max_size=int(settings.get('response_cache.max_size', 64 * 2 ** 20)),
+        ttl=float(ttl) if ttl else None,
+        spill_dir=settings.get('response_cache.spill_dir') or None,
+        spill_max_size=int(settings.get(
+            'response_cache.spill_max_size', 512 * 2 ** 20)),
+    )
+    # filled by the view deriver as views are added
+    cache.routes = config.registry.setdefault('response_cache_routes', {})
+    cache.watch(config.registry['dbsession_factory'])
+    config.registry['response_cache'] = cache
+    config.add_tween(
+        'infolica.services.response_cache.response_cache_tween_factory',
+        over='pyramid_tm.tm_tween_factory')
@@ -0,0 +1,319 @@
+import bisect
+import functools
+import heapq
+import logging
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+from sqlalchemy import event, func, select
+
+from ..models import Client, ClientEntreprise, ClientPersonne
+
+log = logging.getLogger(__name__)
+
+PENDING_KEY = 'client_search_pending'
+
+# weight of a token by the field it comes from
+FIELD_WEIGHTS = {
+    'nom': 3,
+    'prenom': 2,
+    'localite': 2,
+    'npa': 2,
+    'adresse': 1,
+    'mail': 1,
+}
+
+# weight of a token by how it matches a query term
+EXACT, PREFIX, FUZZY = 3, 2, 1
+
+_split = re.compile(r'[^0-9a-z]+').split
+
+
+def fold(text):
+    """Lowercase ``text`` and strip its accents (Müller -> muller)."""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+@functools.lru_cache(maxsize=65536)
+def _tokenize(text):
+    return tuple(t for t in _split(fold(text)) if t)
+
+
+def tokenize(text):
+    """Folded words of ``text``, cached as field values repeat a lot."""
+    return _tokenize(text) if text else ()
+
+
+def trigrams(token):
+    padded = ' %s ' % token
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def within_distance(a, b, limit):
+    """
+    Whether ``a`` and ``b`` differ by at most ``limit`` typos.
+
+    A typo is an inserted, deleted or replaced letter or two swapped
+    letters (optimal string alignment distance).
+
+    """
+    if abs(len(a) - len(b)) > limit:
+        return False
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1,
+                       previous[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit and min(previous) > limit:
+            return False
+        before, previous = previous, current
+    return previous[-1] <= limit
+
+
+def field_weights(fields):
+    """``{token: weight}`` of a client from ``{field: text}``."""
+    weights = {}
+    for field, text in fields.items():
+        weight = FIELD_WEIGHTS.get(field)
+        if weight is None:
+            continue
+        for token in tokenize(text):
+            if weights.get(token, 0) < weight:
+                weights[token] = weight
+    return weights
+
+
+class ClientSearchIndex(object):
+    """
+    Accent-insensitive, typo tolerant search over client names and places.
+
+    Client fields are split in folded tokens.  A query term matches the
+    tokens equal to it, starting with it (type-ahead) or, from four
+    letters on, within one typo (two from eight letters on), found through
+    a trigram index of the vocabulary.  Every term must match; clients
+    are ranked by the sum of their best match per term, weighted by the
+    field matched.
+
+    The index is loaded on first use and kept up to date from the
+    sessions it watches, once their changes are committed.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        # token -> {client_id: field weight}
+        self._postings = {}
+        # client_id -> {token: field weight}
+        self._documents = {}
+        self._vocabulary = []
+        self._vocabulary_trigrams = defaultdict(set)
+
+    def __len__(self):
+        return len(self._documents)
+
+    def _add_token(self, token):
+        bisect.insort(self._vocabulary, token)
+        for trigram in trigrams(token):
+            self._vocabulary_trigrams[trigram].add(token)
+
+    def _drop_token(self, token):
+        i = bisect.bisect_left(self._vocabulary, token)
+        del self._vocabulary[i]
+        for trigram in trigrams(token):
+            tokens = self._vocabulary_trigrams[trigram]
+            tokens.discard(token)
+            if not tokens:
+                del self._vocabulary_trigrams[trigram]
+
+    def index(self, client_id, fields):
+        """(Re)index a client from ``{field: text}``."""
+        weights = field_weights(fields)
+        with self._lock:
+            self._remove(client_id)
+            self._documents[client_id] = weights
+            for token, weight in weights.items():
+                posting = self._postings.get(token)
+                if posting is None:
+                    posting = self._postings[token] = {}
+                    self._add_token(token)
+                posting[client_id] = weight
+
+    def remove(self, client_id):
+        with self._lock:
+            self._remove(client_id)
+
+    def _remove(self, client_id):
+        weights = self._documents.pop(client_id, None)
+        if not weights:
+            return
+        for token in weights:
+            posting = self._postings[token]
+            del posting[client_id]
+            if not posting:
+                del self._postings[token]
+                self._drop_token(token)
+
+    def _matches(self, term):
+        """``{token: match weight}`` of the vocabulary for a query term."""
+        matches = {}
+        vocabulary = self._vocabulary
+        i = bisect.bisect_left(vocabulary, term)
+        while i < len(vocabulary) and vocabulary[i].startswith(term):
+            matches[vocabulary[i]] = PREFIX
+            i += 1
+        if term in matches:
+            matches[term] = EXACT
+        if len(term) >= 4:
+            limit = 2 if len(term) >= 8 else 1
+            counts = defaultdict(int)
+            for trigram in trigrams(term):
+                for token in self._vocabulary_trigrams.get(trigram, ()):
+                    counts[token] += 1
+            # a typo changes at most 3 trigrams
+            needed = len(term) - 1 - 3 * limit
+            for token, count in counts.items():
+                if token not in matches and count >= needed and \
+                        within_distance(term, token, limit):
+                    matches[token] = FUZZY
+        return matches
+
+    def search(self, query, limit=20):
+        """Return ``(client_id, score)`` pairs, best first."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            term_matches = [self._matches(t) for t in terms]
+            if not all(term_matches):
+                return []
+            postings = [[(self._postings[t], quality)
+                         for t, quality in matches.items()]
+                        for matches in term_matches]
+            postings.sort(key=lambda p: sum(len(posting) for posting, _ in p))
+            # the clients matching the most selective term, then every term;
+            # a dict view intersection iterates the smaller side only
+            candidates = set().union(*(posting for posting, _ in postings[0]))
+            for term_postings in postings[1:]:
+                kept = set()
+                for posting, _ in term_postings:
+                    kept |= posting.keys() & candidates
+                candidates = kept
+            scores = dict.fromkeys(candidates, 0)
+            for term_postings in postings:
+                best = {}
+                for posting, quality in term_postings:
+                    for client_id in posting.keys() & candidates:
+                        score = quality * posting[client_id]
+                        if best.get(client_id, 0) < score:
+                            best[client_id] = score
+                for client_id, score in best.items():
+                    scores[client_id] += score
+        return heapq.nsmallest(
+            limit, scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def load(self, dbsession):
+        documents = {}
+        postings = defaultdict(dict)
+        for row in dbsession.execute(client_search_query()):
+            row = dict(row)
+            client_id = row.pop('id')
+            documents[client_id] = weights = field_weights(row)
+            for token, weight in weights.items():
+                postings[token][client_id] = weight
+        vocabulary_trigrams = defaultdict(set)
+        for token in postings:
+            for trigram in trigrams(token):
+                vocabulary_trigrams[trigram].add(token)
+        with self._lock:
+            self._documents = documents
+            self._postings = dict(postings)
+            self._vocabulary = sorted(postings)
+            self._vocabulary_trigrams = vocabulary_trigrams
+            self.loaded = True
+        log.debug('client search index loaded with %d clients', len(self))
+
+    def ensure_loaded(self, dbsession):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.load(dbsession)
+
+    def watch(self, session_factory):
+        """Keep the index in sync with sessions made by ``session_factory``."""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.setdefault(PENDING_KEY, [])
+        for obj in session.new | session.dirty:
+            if isinstance(obj, Client):
+                pending.append((obj.id, client_fields(obj)))
+        for obj in session.deleted:
+            if isinstance(obj, Client):
+                pending.append((obj.id, None))
+
+    def _after_commit(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if not pending or not self.loaded:
+            return
+        with self._lock:
+            for client_id, fields in pending:
+                if fields is None:
+                    self.remove(client_id)
+                else:
+                    self.index(client_id, fields)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+def client_fields(client):
+    """Searchable fields of a ``Client`` instance."""
+    return {
+        'nom': getattr(client, 'nom', None),
+        'prenom': getattr(client, 'prenom', None),
+        'adresse': client.adresse,
+        'npa': client.npa,
+        'localite': client.localite,
+        'mail': client.mail,
+    }
+
+
+def client_search_query():
+    """Searchable fields of all clients, across the client subclasses."""
+    client = Client.__table__
+    personne = ClientPersonne.__table__
+    entreprise = ClientEntreprise.__table__
+    return select([
+        client.c.id,
+        client.c.adresse,
+        client.c.npa,
+        client.c.localite,
+        client.c.mail,
+        personne.c.prenom,
+        func.coalesce(personne.c.nom, entreprise.c.nom).label('nom'),
+    ]).select_from(
+        client.outerjoin(personne, personne.c.id == client.c.id)
+        .outerjoin(entreprise, entreprise.c.id == client.c.id))
+
+
+def includeme(config):
+    """
+    Register the client search index on the registry.
+
+    Activate this setup using ``config.include('infolica.services.search')``.
+
+    """
+    index = ClientSearchIndex()
+    index.watch(config.registry['dbsession_factory'])
+    config.registry['client_search_index'] = index
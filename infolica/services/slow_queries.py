@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from pyramid.settings import asbool
+from sqlalchemy import event
+
+from .instrumentation import current_timings
+
+log = logging.getLogger(__name__)
+
+THIS_FILE = os.path.abspath(__file__)
+PACKAGE_DIR = os.path.dirname(os.path.dirname(THIS_FILE))
+
+# longest parameter list and value kept in a record
+MAX_PARAMETERS = 20
+MAX_VALUE_LENGTH = 200
+# infolica frames kept of the stack running a statement
+MAX_FRAMES = 5
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ',
+    'mysql': 'EXPLAIN ',
+}
+SAVEPOINT = 'slow_query_explain'
+
+
+def _short(value):
+    if isinstance(value, (int, float, bool)) or value is None:
+        return value
+    text = value if isinstance(value, str) else repr(value)
+    if len(text) > MAX_VALUE_LENGTH:
+        text = text[:MAX_VALUE_LENGTH] + '...'
+    return text
+
+
+def _parameters(parameters, executemany):
+    if executemany:
+        return {'rows': len(parameters),
+                'first': _parameters(parameters[0], False)
+                if parameters else None}
+    if isinstance(parameters, dict):
+        return {k: _short(v) for k, v in
+                list(parameters.items())[:MAX_PARAMETERS]}
+    return [_short(v) for v in list(parameters or ())[:MAX_PARAMETERS]]
+
+
+def stack_sites(limit=MAX_FRAMES):
+    """``file:line in function`` of the infolica callers, innermost first."""
+    sites = []
+    frame = sys._getframe(1)
+    while frame is not None and len(sites) < limit:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(PACKAGE_DIR) and filename != THIS_FILE:
+            sites.append('%s:%d in %s' % (
+                os.path.relpath(filename, os.path.dirname(PACKAGE_DIR)),
+                frame.f_lineno, frame.f_code.co_name))
+        frame = frame.f_back
+    return sites
+
+
+def explain(cursor, dialect_name, statement, parameters):
+    """
+    Plan rows of a SELECT, run on the DBAPI connection of ``cursor``.
+
+    The ``EXPLAIN`` runs in a savepoint: its failure would otherwise
+    abort the transaction of the request on PostgreSQL.
+
+    """
+    prefix = EXPLAIN.get(dialect_name)
+    words = statement.split(None, 1)
+    if prefix is None or not words or \
+            words[0].upper() not in ('SELECT', 'WITH'):
+        return None
+    # a plain DBAPI cursor, out of sight of the engine events
+    explain_cursor = cursor.connection.cursor()
+    try:
+        explain_cursor.execute('SAVEPOINT %s' % SAVEPOINT)
+        try:
+            explain_cursor.execute(prefix + statement, parameters)
+            plan = [' '.join(str(c) for c in row)
+                    if dialect_name != 'sqlite' else row[-1]
+                    for row in explain_cursor.fetchall()]
+        except Exception:
+            explain_cursor.execute('ROLLBACK TO SAVEPOINT %s' % SAVEPOINT)
+            raise
+        finally:
+            explain_cursor.execute('RELEASE SAVEPOINT %s' % SAVEPOINT)
+        return plan
+    finally:
+        explain_cursor.close()
+
+
+class SlowQueryLog(object):
+    """
+    Statements slower than ``threshold`` seconds, with their plan.
+
+    The last ``max_records`` are kept in memory, and all are appended as
+    JSON lines to ``path`` when set.  Each record tells the statement,
+    its parameters, its duration, the route of the request, the
+    infolica code that ran it (``site``) and its callers, and the
+    ``EXPLAIN`` output of SELECT statements (``EXPLAIN QUERY PLAN`` on
+    SQLite) when ``explain`` is set.
+
+    """
+
+    def __init__(self, threshold, max_records=200, path=None, explain=True):
+        self.threshold = threshold
+        self.path = path
+        self.explain = explain
+        self.records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+        self.count = 0
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def watch(self, engine):
+        """Time the statements run on ``engine``."""
+        event.listen(engine, 'before_cursor_execute',
+                     self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute',
+                     self._after_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        if context is not None:
+            context.slow_query_start = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        start = getattr(context, 'slow_query_start', None)
+        if start is None:
+            return
+        duration = time.perf_counter() - start
+        if duration < self.threshold:
+            return
+        plan = None
+        if self.explain and not executemany:
+            try:
+                plan = explain(cursor, conn.dialect.name, statement,
+                               parameters)
+            except Exception as e:
+                plan = ['EXPLAIN failed: %s' % e]
+        timings = current_timings()
+        sites = stack_sites()
+        self.add({
+            'time': time.time(),
+            'duration': duration,
+            'statement': statement,
+            'parameters': _parameters(parameters, executemany),
+            'route': timings.route_name if timings is not None else None,
+            'site': sites[0] if sites else None,
+            'stack': sites,
+            'plan': plan,
+        })
+
+    def add(self, record):
+        with self._lock:
+            self.count += 1
+            self.records.append(record)
+            if self.path:
+                try:
+                    with open(self.path, 'a', encoding='utf-8') as f:
+                        f.write(json.dumps(record, default=str) + '\n')
+                except OSError:
+                    log.warning('could not write the slow query log',
+                                exc_info=True)
+        log.info('slow query (%.3fs) at %s: %s', record['duration'],
+                 record['site'], record['statement'])
+
+    def recent(self, limit=None):
+        """The last records, most recent first."""
+        with self._lock:
+            records = list(self.records)
+        records.reverse()
+        return records[:limit] if limit is not None else records
+
+
+def read_records(path):
+    """The records of a JSON lines slow query log."""
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def includeme(config):
+    """
+    Record the slow statements when ``slow_queries.enabled``.
+
+    Settings: ``slow_queries.threshold`` (seconds),
+    ``slow_queries.max_records`` kept in memory, ``slow_queries.path``
+    of a JSON lines file and ``slow_queries.explain``.
+
+    Activate this setup using
+    ``config.include('infolica.services.slow_queries')``.
+
+    """
+    settings = config.get_settings()
+    if not asbool(settings.get('slow_queries.enabled', False)):
+        return
+    registry = config.registry
+    slow_queries = SlowQueryLog(
+        threshold=float(settings.get('slow_queries.threshold', 0.2)),
+        max_records=int(settings.get('slow_queries.max_records', 200)),
+        path=settings.get('slow_queries.path') or None,
+        explain=asbool(settings.get('slow_queries.explain', True)),
+    )
+    engines = {registry[k].kw['bind']
+               for k in ('dbsession_factory', 'dbsession_factory_ro')}
+    for engine in engines:
+        slow_queries.watch(engine)
+    registry['slow_queries'] = slow_queries
@@ -0,0 +1,192 @@
+import logging
+import math
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event
+
+from ..models import Affaire
+
+log = logging.getLogger(__name__)
+
+PENDING_KEY = 'affaire_spatial_pending'
+
+
+class GridIndex(object):
+    """
+    Uniform grid over (E, N) points, keyed by an identifier.
+
+    Points are bucketed in square cells of ``cell_size`` metres so that a
+    bounding box or radius query only visits the cells it overlaps.
+
+    """
+
+    def __init__(self, cell_size=500):
+        self.cell_size = cell_size
+        self._cells = defaultdict(dict)
+        self._points = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def _cell(self, e, n):
+        return (int(e // self.cell_size), int(n // self.cell_size))
+
+    def insert(self, key, e, n):
+        """Add a point, or move it if ``key`` is already indexed."""
+        with self._lock:
+            self._discard(key)
+            self._points[key] = (e, n)
+            self._cells[self._cell(e, n)][key] = (e, n)
+
+    def remove(self, key):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        point = self._points.pop(key, None)
+        if point is None:
+            return
+        cell = self._cell(*point)
+        bucket = self._cells[cell]
+        bucket.pop(key, None)
+        if not bucket:
+            del self._cells[cell]
+
+    def clear(self):
+        with self._lock:
+            self._cells.clear()
+            self._points.clear()
+
+    def _candidate_cells(self, min_e, min_n, max_e, max_n):
+        min_cx, min_cy = self._cell(min_e, min_n)
+        max_cx, max_cy = self._cell(max_e, max_n)
+        span = (max_cx - min_cx + 1) * (max_cy - min_cy + 1)
+        if span > len(self._cells):
+            # zoomed out: walking the occupied cells is cheaper
+            for (cx, cy), bucket in self._cells.items():
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy:
+                    yield bucket
+            return
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                bucket = self._cells.get((cx, cy))
+                if bucket:
+                    yield bucket
+
+    def bbox(self, min_e, min_n, max_e, max_n):
+        """Return the sorted keys of the points inside the box (inclusive)."""
+        result = []
+        with self._lock:
+            for bucket in self._candidate_cells(min_e, min_n, max_e, max_n):
+                for key, (e, n) in bucket.items():
+                    if min_e <= e <= max_e and min_n <= n <= max_n:
+                        result.append(key)
+        result.sort()
+        return result
+
+    def radius(self, e, n, r):
+        """Return ``(key, distance)`` pairs within ``r``, nearest first."""
+        result = []
+        r2 = r * r
+        with self._lock:
+            cells = self._candidate_cells(e - r, n - r, e + r, n + r)
+            for bucket in cells:
+                for key, (pe, pn) in bucket.items():
+                    d2 = (pe - e) ** 2 + (pn - n) ** 2
+                    if d2 <= r2:
+                        result.append((key, math.sqrt(d2)))
+        result.sort(key=lambda item: (item[1], item[0]))
+        return result
+
+    def point(self, key):
+        return self._points.get(key)
+
+
+class AffaireSpatialIndex(GridIndex):
+    """
+    Grid index over the ``localisation_E`` / ``localisation_N`` of affaires.
+
+    The index is loaded lazily from the database on first use and then kept
+    up to date from the sessions it watches: inserted, moved and deleted
+    affaires are applied once their transaction commits.  Changes made with
+    bulk ``query.update()`` bypass the ORM and require a :meth:`reset`.
+
+    """
+
+    def __init__(self, cell_size=500):
+        super(AffaireSpatialIndex, self).__init__(cell_size)
+        self.loaded = False
+
+    def load(self, dbsession):
+        query = dbsession.query(
+            Affaire.id, Affaire.localisation_E, Affaire.localisation_N)
+        with self._lock:
+            self.clear()
+            for id_, e, n in query.yield_per(10000):
+                self.insert(id_, e, n)
+            self.loaded = True
+        log.debug('spatial index loaded with %d affaires', len(self))
+
+    def ensure_loaded(self, dbsession):
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:
+                    self.load(dbsession)
+
+    def reset(self):
+        with self._lock:
+            self.clear()
+            self.loaded = False
+
+    def watch(self, session_factory):
+        """Keep the index in sync with sessions made by ``session_factory``."""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        pending = session.info.setdefault(PENDING_KEY, [])
+        for obj in session.new:
+            if isinstance(obj, Affaire):
+                pending.append(
+                    (obj.id, obj.localisation_E, obj.localisation_N))
+        for obj in session.dirty:
+            if isinstance(obj, Affaire):
+                pending.append(
+                    (obj.id, obj.localisation_E, obj.localisation_N))
+        for obj in session.deleted:
+            if isinstance(obj, Affaire):
+                pending.append((obj.id, None, None))
+
+    def _after_commit(self, session):
+        pending = session.info.pop(PENDING_KEY, None)
+        if not pending or not self.loaded:
+            return
+        with self._lock:
+            for id_, e, n in pending:
+                if e is None or n is None:
+                    self.remove(id_)
+                else:
+                    self.insert(id_, e, n)
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+def includeme(config):
+    """
+    Register the affaire spatial index on the registry.
+
+    Activate this setup using ``config.include('infolica.services.spatial')``.
+
+    """
+    settings = config.get_settings()
+    index = AffaireSpatialIndex(
+        cell_size=int(settings.get('spatial.cell_size', 500)))
+    index.watch(config.registry['dbsession_factory'])
+    config.registry['affaire_spatial_index'] = index
@@ -0,0 +1,125 @@
+import bisect
+import logging
+import time
+from collections import namedtuple
+
+from sqlalchemy import event, select
+from sqlalchemy.exc import DBAPIError
+
+from ..models import EmolumentsMOParametres, EmolumentsRFParametres
+
+log = logging.getLogger(__name__)
+
+PENDING_KEY = 'tarifs_pending'
+
+
+class TarifCache(object):
+    """
+    In-memory copy of a parameter table versioned by ``date``.
+
+    Each row is valid from its ``date`` until the next row's, so the
+    parameters valid at a date are found by bisecting the sorted dates.
+    The table is reloaded on the first lookup after :meth:`invalidate`,
+    or after ``max_age`` seconds when set.
+
+    """
+
+    def __init__(self, model, max_age=None):
+        self.model = model
+        self.max_age = max_age
+        table = model.__table__
+        self._columns = [c for c in table.c]
+        self.row_class = namedtuple(
+            model.__name__, [c.name for c in self._columns])
+        # (dates, rows) replaced as a whole on reload
+        self._snapshot = ([], [])
+        self._loaded_at = None
+        self._generation = 0
+
+    @property
+    def loaded(self):
+        if self._loaded_at is None:
+            return False
+        if self.max_age is not None:
+            return time.monotonic() - self._loaded_at < self.max_age
+        return True
+
+    def load(self, dbsession):
+        generation = self._generation
+        table = self.model.__table__
+        rows = [self.row_class(*row) for row in dbsession.execute(
+            select(self._columns).order_by(table.c.date, table.c.id))]
+        self._snapshot = ([row.date for row in rows], rows)
+        # an invalidation during the load may not be reflected in the rows
+        if generation == self._generation:
+            self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self._generation += 1
+        self._loaded_at = None
+
+    def valid_at(self, dbsession, date):
+        """Parameters valid at ``date``, or None before the first row."""
+        if not self.loaded:
+            self.load(dbsession)
+        dates, rows = self._snapshot
+        i = bisect.bisect_right(dates, date)
+        return rows[i - 1] if i else None
+
+
+class Tarifs(object):
+    """The fee parameter caches shared by all fee computations."""
+
+    def __init__(self, max_age=None):
+        self.mo = TarifCache(EmolumentsMOParametres, max_age)
+        self.rf = TarifCache(EmolumentsRFParametres, max_age)
+        self._by_model = {c.model: c for c in (self.mo, self.rf)}
+
+    def load(self, dbsession):
+        for cache in self._by_model.values():
+            cache.load(dbsession)
+
+    def warm(self, session_factory):
+        """Load the caches, tolerating a database not initialized yet."""
+        dbsession = session_factory()
+        try:
+            self.load(dbsession)
+        except DBAPIError:
+            log.warning('could not load the fee parameters at startup',
+                        exc_info=True)
+        finally:
+            dbsession.close()
+
+    def watch(self, session_factory):
+        """Invalidate on parameter changes committed by these sessions."""
+        event.listen(session_factory, 'after_flush', self._after_flush)
+        event.listen(session_factory, 'after_commit', self._after_commit)
+        event.listen(session_factory, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        for obj in session.new | session.dirty | session.deleted:
+            cache = self._by_model.get(type(obj))
+            if cache is not None:
+                session.info.setdefault(PENDING_KEY, set()).add(cache)
+
+    def _after_commit(self, session):
+        for cache in session.info.pop(PENDING_KEY, ()):
+            cache.invalidate()
+
+    def _after_rollback(self, session):
+        session.info.pop(PENDING_KEY, None)
+
+
+def includeme(config):
+    """
+    Register the fee parameter caches, warmed by ``infolica.main``.
+
+    Activate this setup using ``config.include('infolica.services.tarifs')``.
+
+    """
+    settings = config.get_settings()
+    max_age = settings.get('tarifs.max_age')
+    tarifs = Tarifs(max_age=float(max_age) if max_age else None)
+    session_factory = config.registry['dbsession_factory']
+    tarifs.watch(session_factory)
+    config.registry['tarifs'] = tarifs
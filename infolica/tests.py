@@ -1,3 +1,5 @@
+import contextlib
+import os
 import unittest
 
 from pyramid import testing
@@ -6,7 +8,13 @@ import transaction
 
 
 def dummy_request(dbsession):
-    return testing.DummyRequest(dbsession=dbsession)
+    from .models import LookupCache, RequestLookups
+
+    return testing.DummyRequest(
+        dbsession=dbsession,
+        primary_dbsession=dbsession,
+        lookups=RequestLookups(LookupCache(), dbsession),
+    )
 
 
 class BaseTest(unittest.TestCase):
@@ -24,14 +32,32 @@ class BaseTest(unittest.TestCase):
             )
 
         self.engine = get_engine(settings)
-        session_factory = get_session_factory(self.engine)
+        self.session_factory = get_session_factory(self.engine)
 
-        self.session = get_tm_session(session_factory, transaction.manager)
+        self.session = get_tm_session(
+            self.session_factory, transaction.manager)
 
     def init_database(self):
         from .models.meta import Base
         Base.metadata.create_all(self.engine)
 
+    @contextlib.contextmanager
+    def assertQueryCount(self, expected):
+        """Fail unless the block runs exactly ``expected`` SQL statements."""
+        from sqlalchemy import event
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute', count)
+        try:
+            yield statements
+        finally:
+            event.remove(self.engine, 'before_cursor_execute', count)
+        self.assertEqual(len(statements), expected, '\n\n'.join(statements))
+
     def tearDown(self):
         from .models.meta import Base
 
@@ -64,3 +90,3261 @@ class TestMyViewFailureCondition(BaseTest):
         from .views.default import my_view
         info = my_view(dummy_request(self.session))
         self.assertEqual(info.status_int, 500)
+
+
+class TestGridIndex(unittest.TestCase):
+
+    def setUp(self):
+        import random
+        from .services.spatial import GridIndex
+
+        rnd = random.Random(42)
+        self.points = {
+            i: (rnd.randint(0, 10000), rnd.randint(0, 10000))
+            for i in range(2000)
+        }
+        self.index = GridIndex(cell_size=250)
+        for key, (e, n) in self.points.items():
+            self.index.insert(key, e, n)
+
+    def test_bbox_matches_brute_force(self):
+        for box in [(0, 0, 10000, 10000), (1200, 3400, 2600, 3900),
+                    (5000, 5000, 5000, 5000), (-500, -500, -1, -1)]:
+            expected = sorted(
+                k for k, (e, n) in self.points.items()
+                if box[0] <= e <= box[2] and box[1] <= n <= box[3])
+            self.assertEqual(self.index.bbox(*box), expected)
+
+    def test_radius_matches_brute_force(self):
+        found = self.index.radius(4000, 6000, 800)
+        expected = sorted(
+            k for k, (e, n) in self.points.items()
+            if (e - 4000) ** 2 + (n - 6000) ** 2 <= 800 ** 2)
+        self.assertEqual(sorted(k for k, _ in found), expected)
+        distances = [d for _, d in found]
+        self.assertEqual(distances, sorted(distances))
+
+    def test_move_and_remove(self):
+        self.index.insert(0, 20000, 20000)
+        self.assertEqual(self.index.bbox(19999, 19999, 20001, 20001), [0])
+        self.assertNotIn(0, self.index.bbox(*self.points[0] * 2))
+        self.index.remove(0)
+        self.assertEqual(self.index.bbox(19999, 19999, 20001, 20001), [])
+        self.assertEqual(len(self.index), 1999)
+
+
+class TestAffaireSpatialIndex(BaseTest):
+
+    def setUp(self):
+        super(TestAffaireSpatialIndex, self).setUp()
+        self.init_database()
+        self.config.include('.services.spatial')
+
+        from .scripts.benchmark import create_reference_data
+
+        create_reference_data(self.session)
+        self.config.registry['dbsession_factory'] = self.session_factory
+        self.index = self.config.registry['affaire_spatial_index']
+        self.index.watch(self.session_factory)
+
+    def _affaire(self, id_, e, n):
+        from .models import Affaire
+
+        return Affaire(id=id_, responsable_id=1, technicien_id=1, type_id=1,
+                       cadastre_id=1, localisation_E=e, localisation_N=n)
+
+    def test_index_follows_committed_changes(self):
+        self.session.add(self._affaire(1, 2550000, 1200000))
+        self.index.ensure_loaded(self.session)
+        self.assertEqual(len(self.index), 1)
+
+        affaire = self._affaire(2, 2551000, 1201000)
+        self.session.add(affaire)
+        self.session.flush()
+        self.assertNotIn(2, self.index)
+        transaction.commit()
+        self.assertEqual(self.index.point(2), (2551000, 1201000))
+
+        affaire = self.session.query(type(affaire)).get(2)
+        affaire.localisation_E = 2560000
+        transaction.commit()
+        self.assertEqual(self.index.point(2), (2560000, 1201000))
+
+        self.session.delete(self.session.query(type(affaire)).get(1))
+        self.session.flush()
+        transaction.abort()
+        self.assertIn(1, self.index)
+
+    def test_bbox_and_radius_views(self):
+        from .views.affaires import affaires_bbox_view, affaires_radius_view
+
+        self.session.add_all([
+            self._affaire(1, 2550000, 1200000),
+            self._affaire(2, 2550300, 1200400),
+            self._affaire(3, 2570000, 1220000),
+        ])
+        self.session.flush()
+        request = dummy_request(self.session)
+        request.params = {'bbox': '2549000,1199000,2551000,1201000'}
+        info = affaires_bbox_view(request)
+        self.assertEqual(info['count'], 2)
+        self.assertEqual([a['id'] for a in info['affaires']], [1, 2])
+
+        request.params = {'e': '2550000', 'n': '1200000', 'r': '500'}
+        info = affaires_radius_view(request)
+        self.assertEqual([a['id'] for a in info['affaires']], [1, 2])
+        self.assertEqual(info['affaires'][1]['distance'], 500.0)
+
+    def test_loaded_from_primary(self):
+        from sqlalchemy.orm import sessionmaker
+        from .models import get_engine
+        from .models.meta import Base
+        from .views.affaires import _spatial_index
+
+        self.session.add(self._affaire(1, 2550000, 1200000))
+        transaction.commit()
+        # GET requests may read from a replica lagging behind
+        replica = get_engine({'sqlalchemy.url': 'sqlite://'})
+        Base.metadata.create_all(replica)
+        request = dummy_request(sessionmaker(bind=replica)())
+        self.assertEqual(len(_spatial_index(request)), 1)
+
+    def test_invalid_bbox(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .views.affaires import affaires_bbox_view
+
+        request = dummy_request(self.session)
+        request.params = {'bbox': '1,2,3'}
+        self.assertRaises(HTTPBadRequest, affaires_bbox_view, request)
+        request.params = {'bbox': '1,2,inf,4'}
+        self.assertRaises(HTTPBadRequest, affaires_bbox_view, request)
+
+    def test_invalid_radius(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .views.affaires import affaires_radius_view
+
+        request = dummy_request(self.session)
+        for params in ({'e': 'nan', 'n': '1', 'r': '1'},
+                       {'e': '1', 'n': '1', 'r': 'inf'},
+                       {'e': '1', 'n': '1', 'r': '-1'}):
+            request.params = params
+            self.assertRaises(HTTPBadRequest, affaires_radius_view, request)
+
+    def test_removed_during_search(self):
+        from .views.affaires import (
+            _spatial_index,
+            affaires_bbox_view,
+            affaires_radius_view,
+        )
+
+        self.session.add_all([
+            self._affaire(1, 2550000, 1200000),
+            self._affaire(2, 2550300, 1200400),
+        ])
+        self.session.flush()
+        request = dummy_request(self.session)
+        index = _spatial_index(request)
+        point = index.point
+        # affaire 2 is removed between the search and reading its point
+        index.point = lambda key: None if key == 2 else point(key)
+
+        request.params = {'bbox': '2549000,1199000,2551000,1201000'}
+        info = affaires_bbox_view(request)
+        self.assertEqual([a['id'] for a in info['affaires']], [1])
+        request.params = {'e': '2550000', 'n': '1200000', 'r': '500'}
+        info = affaires_radius_view(request)
+        self.assertEqual([a['id'] for a in info['affaires']], [1])
+
+
+class TestAffairesListing(BaseTest):
+
+    def setUp(self):
+        super(TestAffairesListing, self).setUp()
+        self.init_database()
+
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        create_reference_data(self.session)
+        generate_affaires(self.session, 1000, seed=3)
+
+    def _get(self, **params):
+        import json
+        from .views.affaires import affaires_view
+
+        request = dummy_request(self.session)
+        request.params = params
+        response = affaires_view(request)
+        return json.loads(b''.join(response.app_iter).decode('utf-8'))
+
+    def _walk(self, **params):
+        ids = []
+        cursor = None
+        while True:
+            if cursor:
+                params['cursor'] = cursor
+            page = self._get(**params)
+            ids.extend(a['id'] for a in page['affaires'])
+            cursor = page['next']
+            if cursor is None:
+                return ids
+
+    def _expected(self, *criteria, **kwargs):
+        from .models import Affaire
+
+        query = self.session.query(Affaire.id).filter(*criteria)
+        if kwargs.get('desc'):
+            query = query.order_by(
+                Affaire.date_ouverture.desc(), Affaire.id.desc())
+        else:
+            query = query.order_by(Affaire.date_ouverture, Affaire.id)
+        return [id_ for id_, in query]
+
+    def test_walk_all_pages(self):
+        self.assertEqual(self._walk(limit='37'), self._expected())
+        self.assertEqual(
+            self._walk(limit='50', order='desc'), self._expected(desc=True))
+
+    def test_filters(self):
+        from .models import Affaire
+
+        self.assertEqual(
+            self._walk(limit='40', type_id='2,3', cloture='false'),
+            self._expected(Affaire.type_id.in_([2, 3]),
+                           Affaire.date_cloture.is_(None)))
+        self.assertEqual(
+            self._walk(cadastre_id='4', responsable_id='7', cloture='true'),
+            self._expected(Affaire.cadastre_id == 4,
+                           Affaire.responsable_id == 7,
+                           Affaire.date_cloture.isnot(None)))
+
+    def test_invalid_parameters(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        self.assertRaises(HTTPBadRequest, self._get, cursor='garbage')
+        self.assertRaises(HTTPBadRequest, self._get, type_id='a')
+        self.assertRaises(HTTPBadRequest, self._get, order='sideways')
+
+
+class TestAffairesListingDepth(unittest.TestCase):
+    """Deep pages on a 500k affaires dataset cost as much as the first."""
+
+    size = 500000
+
+    @classmethod
+    def setUpClass(cls):
+        from .models import get_engine, get_session_factory
+        from .models.meta import Base
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        cls.engine = get_engine({'sqlalchemy.url': 'sqlite://'})
+        Base.metadata.create_all(cls.engine)
+        cls.session = get_session_factory(cls.engine)()
+        create_reference_data(cls.session)
+        generate_affaires(cls.session, cls.size, seed=5)
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+        cls.engine.dispose()
+
+    def _page_time(self, cursor):
+        import time
+        from .views.affaires import affaires_view
+
+        request = dummy_request(self.session)
+        request.params = {'limit': '100'}
+        if cursor:
+            request.params['cursor'] = cursor
+        best = None
+        for _ in range(5):
+            start = time.perf_counter()
+            affaires_view(request)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def test_deep_page_uses_index(self):
+        from .models import Affaire
+        from .services.listing import encode_cursor
+
+        last = self.session.query(Affaire.date_ouverture, Affaire.id).order_by(
+            Affaire.date_ouverture.desc(), Affaire.id.desc()).offset(
+                150).first()
+        deep = encode_cursor(list(last))
+        first_time = self._page_time(None)
+        deep_time = self._page_time(deep)
+        # OFFSET paging at this depth is over 20 times slower on SQLite
+        self.assertLess(deep_time, first_time * 10 + 0.005)
+
+
+class TestAffaireStatutCourant(BaseTest):
+
+    def setUp(self):
+        super(TestAffaireStatutCourant, self).setUp()
+        self.init_database()
+
+        from .models import StatutAffaire
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        create_reference_data(self.session)
+        generate_affaires(self.session, 3)
+        self.session.add_all(
+            [StatutAffaire(id=i, nom='Statut %d' % i) for i in (1, 2, 3)])
+
+    def _etape(self, affaire_id, statut_id, day):
+        import datetime
+        from .models import EtapeAffaire
+
+        etape = EtapeAffaire(affaire_id=affaire_id, statut_id=statut_id,
+                             date=datetime.date(2019, 11, day))
+        self.session.add(etape)
+        self.session.flush()
+        return etape
+
+    def _current(self):
+        from .models import AffaireStatutCourant
+
+        return {
+            s.affaire_id: s.statut_id
+            for s in self.session.query(AffaireStatutCourant)}
+
+    def test_projection_follows_steps(self):
+        self._etape(1, 1, 1)
+        second = self._etape(1, 2, 5)
+        self._etape(1, 3, 3)  # backdated step does not win
+        self._etape(2, 1, 1)
+        self.assertEqual(self._current(), {1: 2, 2: 1})
+
+        second.statut_id = 3
+        self.session.flush()
+        self.assertEqual(self._current(), {1: 3, 2: 1})
+
+        second.affaire_id = 3
+        self.session.flush()
+        self.assertEqual(self._current(), {1: 3, 2: 1, 3: 3})
+
+        self.session.delete(second)
+        self.session.flush()
+        self.assertEqual(self._current(), {1: 3, 2: 1})
+
+    def test_rebuild_repairs_drift(self):
+        import datetime
+        from .models import AffaireStatutCourant
+        from .models.statut import rebuild_statut_courant
+
+        self._etape(1, 1, 1)
+        self._etape(2, 2, 1)
+        table = AffaireStatutCourant.__table__
+        self.session.execute(table.update().where(
+            table.c.affaire_id == 1).values(statut_id=3))
+        self.session.execute(table.delete().where(table.c.affaire_id == 2))
+        self.session.execute(table.insert().values(
+            affaire_id=3, etape_id=99, statut_id=1,
+            date=datetime.date(2019, 1, 1)))
+
+        self.assertEqual(rebuild_statut_courant(self.session), (1, 1, 1))
+        self.assertEqual(self._current(), {1: 1, 2: 2})
+        self.assertEqual(rebuild_statut_courant(self.session), (0, 0, 0))
+
+    def test_statut_views(self):
+        import json
+        from .views.affaires import affaires_statuts_view, affaires_view
+
+        self._etape(1, 1, 1)
+        self._etape(2, 2, 1)
+        self._etape(3, 2, 1)
+        request = dummy_request(self.session)
+        self.assertEqual(affaires_statuts_view(request)['statuts'], [
+            {'statut_id': 1, 'statut': 'Statut 1', 'count': 1},
+            {'statut_id': 2, 'statut': 'Statut 2', 'count': 2}])
+
+        request.params = {'statut_id': '2'}
+        page = json.loads(b''.join(affaires_view(request).app_iter))
+        self.assertEqual(
+            sorted(a['id'] for a in page['affaires']), [2, 3])
+        self.assertEqual({a['statut_id'] for a in page['affaires']}, {2})
+        self.assertEqual({a['statut'] for a in page['affaires']}, {'Statut 2'})
+        for a in page['affaires']:
+            self.assertEqual(a['type'], 'Type %d' % a['type_id'])
+
+
+class TestNumeroReservation(BaseTest):
+
+    def setUp(self):
+        super(TestNumeroReservation, self).setUp()
+        self.init_database()
+
+        from .models import Numero
+
+        self.session.add_all([
+            Numero(cadastre_id=1, type_id=1, numero=41, etat_id=1),
+            Numero(cadastre_id=1, type_id=2, numero=7, etat_id=1),
+        ])
+        self.session.flush()
+
+    def test_reserve_consecutive_numbers(self):
+        from .services.numeros import reserve_numeros
+
+        first = reserve_numeros(self.session, 1, 1, 3, etat_id=2)
+        self.assertEqual([n.numero for n in first], [42, 43, 44])
+        second = reserve_numeros(self.session, 1, 1, 2, etat_id=2)
+        self.assertEqual([n.numero for n in second], [45, 46])
+        other = reserve_numeros(self.session, 2, 1, 1, etat_id=2)
+        self.assertEqual([n.numero for n in other], [1])
+        self.assertRaises(
+            ValueError, reserve_numeros, self.session, 1, 1, 0, 2)
+
+    def test_rebuild_moves_counters_forward(self):
+        from .models import Numero
+        from .models.compteur import NumeroCompteur, rebuild_compteurs
+        from .services.numeros import reserve_numeros
+
+        reserve_numeros(self.session, 1, 1, 1, etat_id=2)
+        self.session.add(
+            Numero(cadastre_id=1, type_id=1, numero=100, etat_id=1))
+        self.session.flush()
+        self.assertEqual(rebuild_compteurs(self.session), (1, 1, 0))
+        counters = {
+            (c.cadastre_id, c.type_id): c.prochain
+            for c in self.session.query(NumeroCompteur)}
+        self.assertEqual(counters, {(1, 1): 101, (1, 2): 8})
+
+    def test_view(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .views.numeros import numeros_reservation_view
+
+        request = dummy_request(self.session)
+        request.json_body = {'cadastre_id': 1, 'type_id': 2, 'nombre': 2,
+                             'etat_id': 3}
+        info = numeros_reservation_view(request)
+        self.assertEqual(request.response.status_int, 201)
+        self.assertEqual([n['numero'] for n in info['numeros']], [8, 9])
+
+        request.json_body = {'cadastre_id': 1, 'type_id': 2, 'nombre': 'x'}
+        self.assertRaises(HTTPBadRequest, numeros_reservation_view, request)
+
+
+class TestNumeroReservationConcurrency(unittest.TestCase):
+    """Parallel workers reserving from a file backed SQLite database."""
+
+    workers = 8
+    reservations = 25
+
+    def setUp(self):
+        import tempfile
+        from .models import get_engine, get_session_factory
+        from .models.meta import Base
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = get_engine({
+            'sqlalchemy.url': 'sqlite:///%s/numeros.sqlite' % self.tmpdir.name,
+            'sqlalchemy.connect_args': {'timeout': 30},
+        })
+        Base.metadata.create_all(self.engine)
+        self.session_factory = get_session_factory(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def _worker(self, cadastre_id):
+        from .services.numeros import reserve_numeros
+
+        taken = []
+        for _ in range(self.reservations):
+            session = self.session_factory()
+            try:
+                numeros = reserve_numeros(
+                    session, cadastre_id, 1, 3, etat_id=1)
+                taken.append([n.numero for n in numeros])
+                session.commit()
+            finally:
+                session.close()
+        return taken
+
+    def test_no_duplicates(self):
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+        from .models import Numero
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = list(pool.map(
+                self._worker, [1 + i % 2 for i in range(self.workers)]))
+        elapsed = time.perf_counter() - start
+
+        for blocks in results:
+            for block in blocks:
+                self.assertEqual(block, list(range(block[0], block[0] + 3)))
+        session = self.session_factory()
+        rows = session.query(Numero.cadastre_id, Numero.numero).all()
+        session.close()
+        total = self.workers * self.reservations * 3
+        self.assertEqual(len(rows), total)
+        self.assertEqual(len(set(rows)), total)
+        for cadastre_id in (1, 2):
+            self.assertEqual(
+                sorted(n for c, n in rows if c == cadastre_id),
+                list(range(1, total // 2 + 1)))
+        # 200 reservations complete without lock timeouts or retries
+        self.assertLess(elapsed, 20)
+
+
+class TestNumeroLineage(BaseTest):
+
+    chain = 3000
+    fan_out = 3000
+
+    def setUp(self):
+        super(TestNumeroLineage, self).setUp()
+        self.init_database()
+
+        from .models import Numero, NumeroRelation
+
+        # 1..chain: a deep chain in cadastre 1
+        # chain+1: root of a wide fan-out in cadastre 2
+        # last chain numero also descends into the fan-out root
+        root = self.chain + 1
+        numeros = [
+            {'id': i, 'cadastre_id': 1 if i <= self.chain else 2,
+             'type_id': 1, 'numero': i, 'etat_id': 1}
+            for i in range(1, root + self.fan_out + 1)]
+        relations = [
+            {'numero_id_base': i, 'numero_id_associe': i + 1,
+             'relation_type_id': 1} for i in range(1, self.chain)]
+        relations.append({'numero_id_base': self.chain,
+                          'numero_id_associe': root, 'relation_type_id': 2})
+        relations.extend(
+            {'numero_id_base': root, 'numero_id_associe': root + i,
+             'relation_type_id': 1} for i in range(1, self.fan_out + 1))
+        self.session.execute(Numero.__table__.insert(), numeros)
+        self.session.execute(NumeroRelation.__table__.insert(), relations)
+        self.root = root
+
+    def _both_ways(self, *args):
+        import time
+        from .services.lineage import LineageCache, lineage
+
+        start = time.perf_counter()
+        result = lineage(self.session, *args)
+        self.assertLess(time.perf_counter() - start, 1)
+        cached = LineageCache().lineage(self.session, *args)
+        self.assertEqual(cached.nodes, result.nodes)
+        self.assertEqual(cached.edges, result.edges)
+        return result
+
+    def test_deep_chain_and_fan_out(self):
+        result = self._both_ways(1)
+        self.assertEqual(len(result.nodes), self.chain + 1 + self.fan_out)
+        self.assertEqual(result.nodes[self.root], self.chain)
+        self.assertEqual(result.nodes[self.root + 1], self.chain + 1)
+
+        result = self._both_ways(self.root + 5, 'ancestors')
+        self.assertEqual(len(result.nodes), self.chain + 2)
+        self.assertEqual(result.nodes[1], self.chain + 1)
+
+    def test_depth_limited_neighbourhood(self):
+        result = self._both_ways(self.root, 'both', 2)
+        self.assertEqual(
+            sorted(result.nodes),
+            [self.chain - 1, self.chain] + list(
+                range(self.root, self.root + self.fan_out + 1)))
+        self.assertEqual(len(result.edges), self.fan_out + 2)
+
+    def test_cycles_terminate(self):
+        from .models import NumeroRelation
+
+        self.session.add(NumeroRelation(
+            numero_id_base=self.root + 1, numero_id_associe=self.chain - 10,
+            relation_type_id=3))
+        self.session.flush()
+        result = self._both_ways(self.chain - 5, 'descendants', 50)
+        self.assertEqual(result.nodes[self.chain - 10], 8)
+        self.assertEqual(result.nodes[self.chain - 9], 9)
+
+    def test_both_ways_unlimited(self):
+        from .models import NumeroRelation
+
+        # every numero and relation, each reached once
+        result = self._both_ways(self.chain // 2, 'both')
+        self.assertEqual(len(result.nodes), self.chain + 1 + self.fan_out)
+        self.assertEqual(len(result.edges), self.chain + self.fan_out)
+        self.assertEqual(result.nodes[1], self.chain // 2 - 1)
+        self.assertEqual(result.nodes[self.root + 1],
+                         self.chain - self.chain // 2 + 2)
+
+        # closing the chain into a cycle shortens the way to its start
+        self.session.add(NumeroRelation(
+            numero_id_base=self.chain, numero_id_associe=1,
+            relation_type_id=3))
+        self.session.flush()
+        result = self._both_ways(self.chain - 5, 'both')
+        self.assertEqual(len(result.edges), self.chain + self.fan_out + 1)
+        self.assertEqual(result.nodes[1], 6)
+        result = self._both_ways(self.chain - 5)
+        self.assertEqual(result.nodes[self.chain - 6], self.chain - 1)
+
+    def test_cache_invalidation_and_view(self):
+        from .models import NumeroRelation
+        from .services.lineage import LineageCache
+        from .views.numeros import numero_lineage_view
+
+        cache = LineageCache()
+        cache.watch(self.session_factory)
+        self.config.registry['numero_lineage_cache'] = cache
+        request = dummy_request(self.session)
+        request.matchdict = {'id': str(self.chain - 1)}
+        request.params = {'depth': '2'}
+        info = numero_lineage_view(request)
+        self.assertEqual([n['id'] for n in info['nodes']],
+                         [self.chain - 1, self.chain, self.root])
+        self.assertEqual(len(cache), 1)
+
+        self.session.add(NumeroRelation(
+            numero_id_base=self.chain, numero_id_associe=1,
+            relation_type_id=3))
+        transaction.commit()
+        self.assertEqual(len(cache), 0)
+        info = numero_lineage_view(request)
+        self.assertEqual([n['id'] for n in info['nodes']],
+                         [1, self.chain - 1, self.chain, self.root])
+
+        # a relation between numeros not seen yet, of a loaded cadastre
+        from .models import Numero
+        self.session.add_all([
+            Numero(id=9001, cadastre_id=1, type_id=1, numero=9001,
+                   etat_id=1),
+            Numero(id=9002, cadastre_id=1, type_id=1, numero=9002,
+                   etat_id=1)])
+        request.matchdict = {'id': '9001'}
+        self.assertEqual([n['id'] for n in numero_lineage_view(
+            request)['nodes']], [9001])
+        self.assertEqual(len(cache), 1)
+        self.session.add(NumeroRelation(
+            numero_id_base=9001, numero_id_associe=9002, relation_type_id=1))
+        transaction.commit()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual([n['id'] for n in numero_lineage_view(
+            request)['nodes']], [9001, 9002])
+
+
+class TestModificationAffaireHierarchie(BaseTest):
+
+    def setUp(self):
+        super(TestModificationAffaireHierarchie, self).setUp()
+        self.init_database()
+
+    def _link(self, mere, fille):
+        from .models import ModificationAffaire
+
+        link = ModificationAffaire(
+            affaire_id_mere=mere, affaire_id_fille=fille, type_id=1)
+        self.session.add(link)
+        self.session.flush()
+        return link
+
+    def _pairs(self):
+        from .models import ModificationAffaireHierarchie as H
+
+        return {(h.affaire_id_ancetre, h.affaire_id_descendant): h.profondeur
+                for h in self.session.query(H)}
+
+    def _assert_rebuild_agrees(self):
+        from .models.hierarchie import rebuild_hierarchie
+
+        self.assertEqual(rebuild_hierarchie(self.session), (0, 0, 0))
+
+    def test_tree_maintenance(self):
+        from .models.hierarchie import path_to_root, subtree, subtree_counts
+
+        # 1 -> 2 -> 3 -> 4 and 2 -> 5, grafted bottom-up
+        self._link(3, 4)
+        self._link(2, 3)
+        self._link(2, 5)
+        link = self._link(1, 2)
+        self.assertEqual(subtree(self.session, 1),
+                         [(2, 1), (3, 2), (5, 2), (4, 3)])
+        self.assertEqual(subtree(self.session, 1, 2), [(2, 1), (3, 2), (5, 2)])
+        self.assertEqual(path_to_root(self.session, 4),
+                         [(1, 3), (2, 2), (3, 1)])
+        self.assertEqual(subtree_counts(self.session, [1, 3, 4]),
+                         {1: 4, 3: 1, 4: 0})
+        self._assert_rebuild_agrees()
+
+        link.affaire_id_mere = 6
+        self.session.flush()
+        self.assertEqual(path_to_root(self.session, 4),
+                         [(6, 3), (2, 2), (3, 1)])
+        self.assertEqual(subtree(self.session, 1), [])
+        self._assert_rebuild_agrees()
+
+        self.session.delete(link)
+        self.session.flush()
+        self.assertEqual(path_to_root(self.session, 4), [(2, 2), (3, 1)])
+        self._assert_rebuild_agrees()
+
+    def test_shared_daughter(self):
+        # 1 -> 2 -> 4, 1 -> 3 -> 4, 3 -> 5 -> 4: 4 has several mothers
+        self._link(1, 2)
+        self._link(2, 4)
+        self._link(1, 3)
+        self._link(3, 5)
+        link = self._link(5, 4)
+        self.assertEqual(self._pairs()[1, 4], 2)
+        self._assert_rebuild_agrees()
+
+        self.session.delete(self.session.query(type(link)).filter_by(
+            affaire_id_mere=2).one())
+        self.session.flush()
+        self.assertEqual(self._pairs()[1, 4], 3)
+        self.assertNotIn((2, 4), self._pairs())
+        self._assert_rebuild_agrees()
+
+    def test_unlink_large_subtree(self):
+        from .models import ModificationAffaire
+        from .models.hierarchie import subtree
+
+        # more descendants than bind parameters SQLite accepts in a list
+        link = self._link(1, 2)
+        self.session.add_all([
+            ModificationAffaire(affaire_id_mere=2, affaire_id_fille=i,
+                                type_id=1) for i in range(3, 1103)])
+        self._link(1100, 1103)
+        self.assertEqual(len(subtree(self.session, 1)), 1102)
+
+        self.session.delete(link)
+        self.session.flush()
+        self.assertEqual(subtree(self.session, 1), [])
+        self.assertEqual(len(subtree(self.session, 2)), 1101)
+        self._assert_rebuild_agrees()
+
+    def test_rebuild_and_view(self):
+        from .models import ModificationAffaireHierarchie as H
+        from .models.hierarchie import rebuild_hierarchie
+        from .views.affaires import affaire_famille_view
+
+        self._link(1, 2)
+        self._link(2, 3)
+        self.session.query(H).delete()
+        self.assertEqual(rebuild_hierarchie(self.session), (3, 0, 0))
+
+        request = dummy_request(self.session)
+        request.matchdict = {'id': '2'}
+        info = affaire_famille_view(request)
+        self.assertEqual(info['ancetres'], [{'id': 1, 'profondeur': 1}])
+        self.assertEqual(info['descendants'], [{'id': 3, 'profondeur': 1}])
+
+
+class TestFacturation(BaseTest):
+
+    def setUp(self):
+        super(TestFacturation, self).setUp()
+        self.init_database()
+
+        import datetime
+        from .models import (
+            Affaire,
+            EmolumentsMO,
+            EmolumentsRF,
+            RelationAffaireClient,
+        )
+
+        for id_, cloture in ((1, datetime.date(2019, 10, 1)),
+                             (2, datetime.date(2019, 11, 5)),
+                             (3, None),
+                             (4, datetime.date(2019, 12, 20))):
+            self.session.add(Affaire(
+                id=id_, responsable_id=1, technicien_id=1, type_id=1,
+                cadastre_id=1, date_cloture=cloture,
+                localisation_E=2550000, localisation_N=1200000))
+        self.session.add_all([
+            EmolumentsMO(affaire_id=1, montant=1000.0, montant_mat_diff=0.0),
+            EmolumentsMO(affaire_id=1, montant=234.5, montant_mat_diff=80.0),
+            EmolumentsRF(affaire_id=1, montant=120.0),
+            EmolumentsMO(affaire_id=3, montant=50.0, montant_mat_diff=0.0),
+            RelationAffaireClient(affaire_id=1, client_id=7,
+                                  relation_type_id=2),
+            RelationAffaireClient(affaire_id=1, client_id=8,
+                                  relation_type_id=1),
+        ])
+        self.session.flush()
+
+    def test_facture_methods(self):
+        from .models import Facture
+
+        facture = Facture(1314.5, 120.0, 80.0)
+        self.assertEqual(facture.calculer_tva(), 107.4)
+        self.assertEqual(facture.calculer_total(), 1621.9)
+
+    def test_vectorized_amounts_match_objects(self):
+        import random
+        from .models import Facture
+        from .services.facturation import calculer_montants
+
+        rnd = random.Random(1)
+        lignes = [(rnd.randint(0, 10 ** 6) / 100.0,
+                   rnd.randint(0, 10 ** 5) / 100.0,
+                   rnd.randint(0, 10 ** 5) / 100.0) for _ in range(500)]
+        tva, total = calculer_montants(*zip(*lignes))
+        for i, ligne in enumerate(lignes):
+            facture = Facture(*ligne)
+            self.assertEqual(facture.calculer_tva(), tva[i])
+            self.assertEqual(facture.calculer_total(), total[i])
+
+    def test_facturer_affaires_dues(self):
+        import datetime
+        from .models import Facture
+        from .services.facturation import facturer_affaires_dues
+
+        jusqu_au = datetime.date(2019, 11, 30)
+        reports = []
+        count = facturer_affaires_dues(
+            self.session, jusqu_au, relation_type_id=2, prefixe='F',
+            chunk_size=1, report=reports.append)
+        self.assertEqual(count, 2)
+        self.assertEqual(reports, [1, 2])
+        factures = {f.sap: f for f in self.session.query(Facture)}
+        self.assertEqual(sorted(factures), ['F1', 'F2'])
+        self.assertEqual(factures['F1'].client_id, 7)
+        self.assertEqual(factures['F1'].montant_mo, 1234.5)
+        self.assertEqual(factures['F1'].montant_tva, 101.2)
+        self.assertEqual(factures['F1'].total, 1535.7)
+        self.assertEqual(factures['F2'].total, 0.0)
+        self.assertIsNone(factures['F2'].client_id)
+        self.assertEqual(facturer_affaires_dues(self.session, jusqu_au), 0)
+
+    def test_factures_partielles(self):
+        import datetime
+        from .models import Facture, FacturePartielle
+        from .services.facturation import ecrire_factures
+
+        ecrire_factures(self.session, [
+            (4, 7, 100.0, 0.0, 0.0, 'DP 12'),
+            (4, 8, 300.0, 20.0, 0.0, 'DP 13'),
+        ], datetime.date(2019, 12, 31))
+        partielles = self.session.query(FacturePartielle).order_by(
+            FacturePartielle.sap).all()
+        self.assertEqual([(f.sap, f.immeuble, f.total) for f in partielles],
+                         [('4-1', 'DP 12', 107.7), ('4-2', 'DP 13', 343.1)])
+        self.assertEqual(self.session.query(Facture).count(), 2)
+
+
+class TestTarifs(BaseTest):
+
+    def setUp(self):
+        super(TestTarifs, self).setUp()
+        self.init_database()
+
+        import datetime
+        from .models import EmolumentsMOParametres, EmolumentsRFParametres
+
+        self.session.add_all([
+            EmolumentsMOParametres(indice=1.0, date=datetime.date(2010, 1, 1)),
+            EmolumentsMOParametres(indice=1.2, date=datetime.date(2015, 7, 1)),
+            EmolumentsMOParametres(indice=1.5, date=datetime.date(2019, 1, 1)),
+            EmolumentsRFParametres(
+                tarif_servitude_principale=50.0,
+                tarif_servitude_secondaire=20.0,
+                date=datetime.date(2012, 1, 1)),
+        ])
+        transaction.commit()
+
+        from .services.tarifs import Tarifs
+
+        self.tarifs = Tarifs()
+        self.tarifs.watch(self.session_factory)
+
+    def test_valid_at(self):
+        import datetime
+
+        def indice(*date):
+            row = self.tarifs.mo.valid_at(self.session, datetime.date(*date))
+            return row.indice if row is not None else None
+
+        self.assertIsNone(indice(2009, 12, 31))
+        self.assertEqual(indice(2010, 1, 1), 1.0)
+        self.assertEqual(indice(2015, 6, 30), 1.0)
+        self.assertEqual(indice(2015, 7, 1), 1.2)
+        self.assertEqual(indice(2030, 1, 1), 1.5)
+
+    def test_lookups_do_not_query(self):
+        import datetime
+
+        self.tarifs.load(self.session)
+        with self.assertQueryCount(0):
+            for year in range(2000, 2030):
+                self.tarifs.rf.valid_at(
+                    self.session, datetime.date(year, 1, 1))
+
+    def test_invalidated_on_commit(self):
+        import datetime
+        from .models import EmolumentsMOParametres
+
+        date = datetime.date(2020, 1, 1)
+        self.tarifs.load(self.session)
+        self.assertEqual(
+            self.tarifs.mo.valid_at(self.session, date).indice, 1.5)
+        self.session.add(EmolumentsMOParametres(
+            indice=1.7, date=datetime.date(2019, 12, 1)))
+        self.session.flush()
+        self.assertEqual(
+            self.tarifs.mo.valid_at(self.session, date).indice, 1.5)
+        transaction.commit()
+        self.assertFalse(self.tarifs.mo.loaded)
+        self.assertTrue(self.tarifs.rf.loaded)
+        self.assertEqual(
+            self.tarifs.mo.valid_at(self.session, date).indice, 1.7)
+
+    def test_max_age(self):
+        import datetime
+        from .services.tarifs import TarifCache
+        from .models import EmolumentsMOParametres
+
+        cache = TarifCache(EmolumentsMOParametres, max_age=0)
+        cache.valid_at(self.session, datetime.date(2020, 1, 1))
+        self.assertFalse(cache.loaded)
+
+    def test_view(self):
+        from .views.tarifs import tarifs_view
+
+        self.config.registry['tarifs'] = self.tarifs
+        request = dummy_request(self.session)
+        request.params = {'date': '2016-03-01'}
+        info = tarifs_view(request)
+        self.assertEqual(info['mo']['indice'], 1.2)
+        self.assertEqual(info['rf']['tarif_servitude_principale'], 50.0)
+        # rendered as JSON
+        self.assertEqual(info['mo']['date'], '2015-07-01')
+        request.params = {'date': '2011-01-01'}
+        self.assertIsNone(tarifs_view(request)['rf'])
+
+
+class TestLookupCache(BaseTest):
+
+    def setUp(self):
+        super(TestLookupCache, self).setUp()
+        self.init_database()
+
+        from .models import AffaireType, NumeroEtat
+
+        self.session.add_all([
+            AffaireType(id=1, nom='Mutation'),
+            AffaireType(id=2, nom='Cadastration'),
+            NumeroEtat(id=1, nom='Projet'),
+        ])
+        transaction.commit()
+
+        from .models import LookupCache
+
+        self.cache = LookupCache()
+        self.cache.watch(self.session_factory)
+
+    def test_maps(self):
+        from .models import AffaireType, NumeroEtat
+
+        self.assertEqual(self.cache.nom(self.session, AffaireType, 2),
+                         'Cadastration')
+        self.assertEqual(self.cache.id(self.session, AffaireType, 'Mutation'),
+                         1)
+        self.assertIsNone(self.cache.nom(self.session, AffaireType, None))
+        self.assertEqual(self.cache.noms(self.session, NumeroEtat),
+                         {1: 'Projet'})
+
+    def test_warm_then_no_queries(self):
+        from .models import LOOKUP_MODELS
+
+        self.cache.warm(self.session_factory)
+        with self.assertQueryCount(0):
+            for model in LOOKUP_MODELS:
+                self.cache.noms(self.session, model)
+                self.cache.nom(self.session, model, 1)
+
+    def test_refresh(self):
+        from .models import AffaireType, LookupCache
+
+        self.cache.warm(self.session_factory)
+        self.session.query(AffaireType).get(1).nom = 'Mutation parcellaire'
+        self.session.flush()
+        self.assertEqual(self.cache.nom(self.session, AffaireType, 1),
+                         'Mutation')
+        transaction.commit()
+        self.assertEqual(self.cache.nom(self.session, AffaireType, 1),
+                         'Mutation parcellaire')
+
+        expired = LookupCache(ttl=0)
+        expired.warm(self.session_factory)
+        with self.assertQueryCount(1):
+            expired.nom(self.session, AffaireType, 1)
+
+
+class TestClientSearch(BaseTest):
+
+    def setUp(self):
+        super(TestClientSearch, self).setUp()
+        self.init_database()
+
+        from .models import ClientEntreprise, ClientPersonne
+
+        self.session.add_all([
+            ClientPersonne(id=1, nom='Müller', prenom='Hélène',
+                           tel_portable='', npa='2000',
+                           localite='Neuchâtel', adresse='Rue du Château 4'),
+            ClientPersonne(id=2, nom='Muller', prenom='Jérôme',
+                           tel_portable='', npa='2300',
+                           localite='La Chaux-de-Fonds'),
+            ClientEntreprise(id=3, nom='Géomètres Dubois SA', npa='2000',
+                             localite='Neuchâtel'),
+            ClientPersonne(id=4, nom='Perrenoud', prenom='André',
+                           tel_portable='', localite='Le Locle',
+                           adresse='Rue Müller 12'),
+        ])
+        transaction.commit()
+
+        from .services.search import ClientSearchIndex
+
+        self.index = ClientSearchIndex()
+        self.index.watch(self.session_factory)
+        self.index.load(self.session)
+
+    def _ids(self, query):
+        return [id_ for id_, score in self.index.search(query)]
+
+    def test_accents_and_ranking(self):
+        # names rank before addresses, then by id
+        self.assertEqual(self._ids('muller'), [1, 2, 4])
+        self.assertEqual(self._ids('MÜLLER'), [1, 2, 4])
+        self.assertEqual(self._ids('geometres'), [3])
+
+    def test_every_term_must_match(self):
+        self.assertEqual(self._ids('muller neuchatel'), [1])
+        self.assertEqual(self._ids('muller chaux'), [2])
+        self.assertEqual(self._ids('muller boudry'), [])
+
+    def test_prefix(self):
+        self.assertEqual(self._ids('perr'), [4])
+        self.assertEqual(self._ids('dub neu'), [3])
+        # exact matches rank before completions
+        self.assertEqual(self._ids('la'), [2])
+
+    def test_typos(self):
+        self.assertEqual(self._ids('perenoud'), [4])
+        self.assertEqual(self._ids('dubios'), [3])
+        self.assertEqual(self._ids('neuchatle'), [1, 3])
+        self.assertEqual(self._ids('dbx'), [])
+
+    def test_flush_events(self):
+        from .models import Client, ClientEntreprise
+
+        self.session.add(ClientEntreprise(id=5, nom='Bureau Chappuis'))
+        self.session.query(Client).get(4).localite = 'Boudry'
+        self.session.flush()
+        # not committed yet
+        self.assertEqual(self._ids('chappuis'), [])
+        transaction.commit()
+        self.assertEqual(self._ids('chappuis'), [5])
+        self.assertEqual(self._ids('perrenoud boudry'), [4])
+        self.assertEqual(self._ids('locle'), [])
+
+        self.session.delete(self.session.query(Client).get(5))
+        self.session.flush()
+        transaction.abort()
+        self.assertEqual(self._ids('chappuis'), [5])
+        self.session.delete(self.session.query(Client).get(5))
+        transaction.commit()
+        self.assertEqual(self._ids('chappuis'), [])
+        self.assertEqual(self.index._vocabulary.count('chappuis'), 0)
+
+    def test_view(self):
+        from .views.clients import clients_recherche_view
+
+        request = dummy_request(self.session)
+        request.registry['client_search_index'] = self.index
+        request.params['q'] = 'Hélène Muller'
+        clients = clients_recherche_view(request)['clients']
+        self.assertEqual([c['id'] for c in clients], [1])
+        self.assertEqual(clients[0]['localite'], 'Neuchâtel')
+        self.assertEqual(clients[0]['type'], 'client_personne')
+
+
+class TestLoadingProfiles(BaseTest):
+
+    def setUp(self):
+        super(TestLoadingProfiles, self).setUp()
+        self.init_database()
+
+        import datetime
+        from .models import (
+            AffaireNumero,
+            ClientEntreprise,
+            ClientPersonne,
+            EtapeAffaire,
+            Numero,
+            NumeroEtat,
+            NumeroType,
+            Preavis,
+            PreavisDecision,
+            PreavisType,
+            RelationAffaireClient,
+            RelationClientAffaireType,
+            Services,
+            StatutAffaire,
+        )
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        create_reference_data(self.session)
+        generate_affaires(self.session, 20)
+        day = datetime.date(2020, 1, 1)
+        self.session.add_all([
+            StatutAffaire(id=1, nom='Ouverte'),
+            StatutAffaire(id=2, nom='En cours'),
+            RelationClientAffaireType(id=1, nom='Mandataire'),
+            NumeroType(id=1, nom='Bien-fonds'),
+            NumeroEtat(id=1, nom='Vigueur'),
+            Services(id=1, service='Aménagement'),
+            PreavisType(id=1, nom='Ordinaire'),
+            PreavisDecision(id=1, nom='Favorable'),
+            ClientPersonne(id=1, nom='Favre', prenom='Anne',
+                           tel_portable=''),
+            ClientEntreprise(id=2, nom='Sandoz SA'),
+        ])
+        self.session.flush()
+        for affaire_id in range(1, 21):
+            self.session.add_all([
+                EtapeAffaire(affaire_id=affaire_id, statut_id=1, date=day),
+                EtapeAffaire(affaire_id=affaire_id, statut_id=2, date=day),
+                RelationAffaireClient(affaire_id=affaire_id, client_id=1,
+                                      relation_type_id=1),
+                RelationAffaireClient(affaire_id=affaire_id, client_id=2,
+                                      relation_type_id=1),
+                Numero(id=affaire_id, cadastre_id=1, type_id=1,
+                       numero=affaire_id, etat_id=1),
+                Preavis(affaire_id=affaire_id, service_id=1, preavis_id=1,
+                        decision=1, date_demande=day),
+            ])
+            self.session.flush()
+            self.session.add(AffaireNumero(affaire_id=affaire_id,
+                                           numero_id=affaire_id))
+        transaction.commit()
+
+    def _touch(self, affaires):
+        for affaire in affaires:
+            affaire.responsable.nom
+            affaire.technicien.nom
+            affaire.type.nom
+            affaire.cadastre.nom
+            affaire.statut_courant.statut.nom
+
+    def test_affaire_list(self):
+        from .models import Affaire, with_profile
+
+        with self.assertQueryCount(1):
+            affaires = with_profile(
+                self.session.query(Affaire), 'affaire_list').all()
+            self._touch(affaires)
+        self.assertEqual(len(affaires), 20)
+
+    def test_affaire_detail(self):
+        from .models import Affaire, with_profile
+        from .views.affaires import affaire_detail
+
+        for ids, expected in ((range(1, 2), 7), (range(1, 21), 7)):
+            self.session.expunge_all()
+            # clients come with one query per subclass
+            with self.assertQueryCount(expected):
+                affaires = with_profile(
+                    self.session.query(Affaire), 'affaire_detail').filter(
+                        Affaire.id.in_(list(ids))).all()
+                data = [affaire_detail(a) for a in affaires]
+        self.assertEqual(data[0]['statut'], 'En cours')
+        self.assertEqual([c['nom'] for c in data[0]['clients']],
+                         ['Favre', 'Sandoz SA'])
+        self.assertEqual(data[0]['preavis'][0]['decision'], 'Favorable')
+
+    def test_unknown_profile(self):
+        from .models import Affaire, with_profile
+
+        with self.assertRaises(ValueError):
+            with_profile(self.session.query(Affaire), 'nope')
+
+    def test_view(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from .views.affaires import affaire_view
+
+        request = dummy_request(self.session)
+        request.matchdict['id'] = '3'
+        data = affaire_view(request)
+        self.assertEqual(data['id'], 3)
+        self.assertEqual(data['numeros'][0]['numero'], 3)
+        self.assertEqual([e['statut'] for e in data['etapes']],
+                         ['Ouverte', 'En cours'])
+        request.matchdict['id'] = '999'
+        with self.assertRaises(HTTPNotFound):
+            affaire_view(request)
+
+
+class TestAffaireFull(unittest.TestCase):
+    """Detail pages read from a file backed SQLite database."""
+
+    def setUp(self):
+        import datetime
+        import tempfile
+        from .models import (
+            EmolumentsRF,
+            EtapeAffaire,
+            RemarqueAffaire,
+            StatutAffaire,
+            get_engine,
+            get_session_factory,
+        )
+        from .models.meta import Base
+        from .scripts.benchmark import create_reference_data, generate_affaires
+        from .services.detail import AffaireStamps
+
+        self.config = testing.setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = get_engine({
+            'sqlalchemy.url': 'sqlite:///%s/detail.sqlite' % self.tmpdir.name,
+        })
+        Base.metadata.create_all(self.engine)
+        self.session_factory = get_session_factory(self.engine)
+        self.stamps = AffaireStamps()
+        self.stamps.watch(self.session_factory)
+
+        session = self.session_factory()
+        create_reference_data(session)
+        generate_affaires(session, 3)
+        session.add_all([
+            StatutAffaire(id=1, nom='Ouverte'),
+            EtapeAffaire(affaire_id=1, statut_id=1,
+                         date=datetime.date(2020, 1, 1)),
+            RemarqueAffaire(affaire_id=1, operateur_id=1, remarque='Bornage',
+                            date=datetime.date(2020, 1, 2)),
+            EmolumentsRF(affaire_id=1, montant=120.0),
+        ])
+        session.commit()
+        session.close()
+        self.session = self.session_factory()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmpdir.cleanup()
+        testing.tearDown()
+
+    def _request(self, affaire_id, etag=None):
+        from pyramid.request import Request
+
+        registry = self.config.registry
+        registry['affaire_stamps'] = self.stamps
+        registry['affaire_detail_executor'] = None
+        registry['dbsession_factory'] = self.session_factory
+        registry['dbsession_factory_ro'] = self.session_factory
+        headers = {'If-None-Match': '"%s"' % etag} if etag else {}
+        request = Request.blank(
+            '/api/affaires/%d/full' % affaire_id, headers=headers)
+        request.registry = registry
+        request.dbsession = self.session
+        request.matchdict = {'id': str(affaire_id)}
+        return request
+
+    def test_parallel_same_as_serial(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from .services.detail import read_affaire_full
+
+        serial = read_affaire_full(self.session, 1)
+        with ThreadPoolExecutor(4) as executor:
+            parallel = read_affaire_full(
+                self.session, 1, executor, self.session_factory)
+            self.assertIsNone(read_affaire_full(
+                self.session, 99, executor, self.session_factory))
+        self.assertEqual(serial, parallel)
+        self.assertEqual(serial['statut'], 'Ouverte')
+        self.assertEqual(serial['remarques'][0]['remarque'], 'Bornage')
+        self.assertEqual(serial['emoluments_rf'][0]['montant'], 120.0)
+        self.assertEqual(serial['factures'], [])
+
+    def test_etag(self):
+        from pyramid.httpexceptions import HTTPNotFound, HTTPNotModified
+        from sqlalchemy import event
+        from .views.affaires import affaire_full_view
+
+        request = self._request(1)
+        affaire_full_view(request)
+        etag = request.response.etag
+
+        statements = []
+        event.listen(self.engine, 'before_cursor_execute',
+                     lambda *args: statements.append(args[2]))
+        request = self._request(1, etag)
+        self.assertIsInstance(affaire_full_view(request), HTTPNotModified)
+        self.assertEqual(statements, [])
+
+        request = self._request(2, etag)
+        self.assertEqual(affaire_full_view(request)['id'], 2)
+
+        request = self._request(99)
+        with self.assertRaises(HTTPNotFound):
+            affaire_full_view(request)
+
+    def test_stamps(self):
+        import datetime
+        from .models import Client, EtapeAffaire
+        from .services.facturation import ecrire_factures
+
+        one, two = self.stamps.stamp(1), self.stamps.stamp(2)
+        self.session.add(EtapeAffaire(affaire_id=1, statut_id=1,
+                                      date=datetime.date(2020, 2, 1)))
+        self.session.flush()
+        self.assertEqual(self.stamps.stamp(1), one)
+        self.session.rollback()
+        self.assertEqual(self.stamps.stamp(1), one)
+
+        self.session.add(EtapeAffaire(affaire_id=1, statut_id=1,
+                                      date=datetime.date(2020, 2, 1)))
+        self.session.commit()
+        self.assertNotEqual(self.stamps.stamp(1), one)
+        self.assertEqual(self.stamps.stamp(2), two)
+
+        # bulk writes
+        ecrire_factures(self.session, [(2, None, 10.0, 0.0, 0.0)],
+                        datetime.date(2020, 3, 1))
+        self.session.commit()
+        self.assertNotEqual(self.stamps.stamp(2), two)
+
+        # rows shown on every page
+        three = self.stamps.stamp(3)
+        self.session.add(Client(adresse='Rue 1'))
+        self.session.commit()
+        self.assertNotEqual(self.stamps.stamp(3), three)
+
+    def test_stamps_expire(self):
+        from .services.detail import AffaireStamps
+
+        # changes of other processes are not seen, stamps expire instead
+        now = [0.0]
+        stamps = AffaireStamps(ttl=60, clock=lambda: now[0])
+        one = stamps.stamp(1)
+        now[0] = 59
+        self.assertEqual(stamps.stamp(1), one)
+        now[0] = 60
+        self.assertNotEqual(stamps.stamp(1), one)
+
+
+class TestResponseCache(BaseTest):
+
+    def setUp(self):
+        super(TestResponseCache, self).setUp()
+        self.init_database()
+
+        from .services.response_cache import ResponseCache
+
+        self.cache = ResponseCache(max_size=1000, max_entry_size=300)
+        self.cache.watch(self.session_factory)
+
+    def _entry(self, body, *models):
+        import time
+        from .services.response_cache import Entry, table_names
+
+        return Entry('200 OK', [], body, table_names(models), time.time())
+
+    def _put(self, key, body, *models):
+        entry = self._entry(body, *models)
+        return self.cache.put(key, entry, self.cache.generations(entry.tables))
+
+    def test_lru(self):
+        from .models import Affaire
+
+        for key in 'abcd':
+            self.assertTrue(self._put(key, b'x' * 300, Affaire))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b').body, b'x' * 300)
+        self.assertTrue(self._put('e', b'x' * 200, Affaire))
+        self.assertIsNone(self.cache.get('c'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertFalse(self._put('f', b'x' * 301, Affaire))
+        self.assertEqual(self.cache.stats['hits'], 2)
+        self.assertEqual(self.cache.stats['misses'], 2)
+
+    def test_spill(self):
+        import os
+        import tempfile
+        from .models import Affaire, Cadastre
+        from .services.response_cache import ResponseCache
+
+        with tempfile.TemporaryDirectory() as spill_dir:
+            self.cache = ResponseCache(
+                max_size=1000, max_entry_size=300, spill_dir=spill_dir,
+                spill_max_size=700)
+            for key in 'abcd':
+                self._put(key, key.encode() * 300, Affaire)
+            self._put('e', b'e' * 200, Cadastre)
+            self.assertEqual(len(os.listdir(spill_dir)), 2)
+            self.assertEqual(self.cache.get('b').body, b'b' * 300)
+            self.assertEqual(self.cache.stats['spill_hits'], 1)
+            self.cache.invalidate({Affaire.__table__.fullname})
+            self.assertEqual(len(self.cache), 1)
+            self.assertEqual(os.listdir(spill_dir), [])
+
+    def test_invalidated_on_commit(self):
+        from .models import AffaireType, Cadastre
+        from .scripts.benchmark import create_reference_data
+
+        self._put('types', b'[]', AffaireType)
+        self._put('cadastres', b'[]', Cadastre)
+        create_reference_data(self.session, types=0)
+        self.session.flush()
+        self.assertIsNotNone(self.cache.get('cadastres'))
+        transaction.abort()
+        self.assertIsNotNone(self.cache.get('cadastres'))
+
+        # bulk statements too
+        import zope.sqlalchemy
+        self.session.execute(Cadastre.__table__.insert(), [
+            {'id': 1, 'nom': 'Neuchâtel'}])
+        zope.sqlalchemy.mark_changed(self.session)
+        transaction.commit()
+        self.assertIsNone(self.cache.get('cadastres'))
+        self.assertIsNotNone(self.cache.get('types'))
+
+    def test_not_stored_after_concurrent_change(self):
+        from .models import Cadastre
+
+        entry = self._entry(b'[]', Cadastre)
+        generations = self.cache.generations(entry.tables)
+        self.cache.invalidate({Cadastre.__table__.fullname})
+        self.assertFalse(self.cache.put('cadastres', entry, generations))
+
+    def test_ttl(self):
+        from .models import Cadastre
+        from .services.response_cache import ResponseCache
+
+        self.cache = ResponseCache(max_size=1000, ttl=0)
+        self._put('cadastres', b'[]', Cadastre)
+        self.assertIsNone(self.cache.get('cadastres'))
+
+
+class TestResponseCacheTween(unittest.TestCase):
+
+    def setUp(self):
+        from webtest import TestApp
+        from . import main
+        from .models.meta import Base
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        app = main({}, **{
+            'sqlalchemy.url': 'sqlite://',
+            'response_cache.enabled': 'true',
+        })
+        self.registry = app.registry
+        self.session_factory = self.registry['dbsession_factory']
+        Base.metadata.create_all(self.session_factory.kw['bind'])
+        session = self.session_factory()
+        create_reference_data(session)
+        generate_affaires(session, 20)
+        session.commit()
+        session.close()
+        self.app = TestApp(app)
+
+    def test_hit_and_invalidation(self):
+        from .models import Affaire
+
+        url = '/api/affaires?limit=5&type_id=1,2'
+        first = self.app.get(url)
+        self.assertEqual(first.headers['X-Cache'], 'MISS')
+        second = self.app.get(url)
+        self.assertEqual(second.headers['X-Cache'], 'HIT')
+        self.assertEqual(second.json, first.json)
+        self.assertEqual(second.content_type, 'application/json')
+        # other parameters, other entry
+        self.assertEqual(
+            self.app.get(url + '&order=desc').headers['X-Cache'], 'MISS')
+
+        session = self.session_factory()
+        session.query(Affaire).get(first.json['affaires'][0]['id']) \
+            .information = 'Bornage'
+        session.commit()
+        session.close()
+        third = self.app.get(url)
+        self.assertEqual(third.headers['X-Cache'], 'MISS')
+        self.assertEqual(third.json['affaires'][0]['information'], 'Bornage')
+
+        stats = self.app.get('/api/cache/stats').json
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['invalidations'], 2)
+
+    def test_misses_read_the_primary(self):
+        from webtest import TestApp
+        from . import main
+        from .models.meta import Base
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        # an empty replica: a response built from it would be stored under
+        # the generations of the primary
+        app = main({}, **{
+            'sqlalchemy.url': 'sqlite://',
+            'sqlalchemy_ro.url': 'sqlite://',
+            'response_cache.enabled': 'true',
+        })
+        session_factory = app.registry['dbsession_factory']
+        Base.metadata.create_all(session_factory.kw['bind'])
+        Base.metadata.create_all(
+            app.registry['dbsession_factory_ro'].kw['bind'])
+        session = session_factory()
+        create_reference_data(session)
+        generate_affaires(session, 5)
+        session.commit()
+        session.close()
+        response = TestApp(app).get('/api/affaires')
+        self.assertEqual(response.headers['X-Cache'], 'MISS')
+        self.assertEqual(len(response.json['affaires']), 5)
+
+    def test_errors_not_cached(self):
+        self.app.get('/api/affaires?order=up', status=400)
+        self.app.get('/api/affaires?order=up', status=400)
+        self.assertEqual(self.registry['response_cache'].stats['stores'], 0)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.url = 'sqlite:///%s/pool.sqlite' % self.tmpdir.name
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.dispose()
+        self.tmpdir.cleanup()
+
+    def _engine(self, url=None, prefix='sqlalchemy.', **settings):
+        from .models import get_engine
+
+        settings = {prefix + k: v for k, v in settings.items()}
+        settings[prefix + 'url'] = url or self.url
+        engine = get_engine(settings, prefix)
+        self.engines.append(engine)
+        return engine
+
+    def test_pool_settings(self):
+        from .models import MeteredQueuePool, pool_status
+
+        engine = self._engine(pool_size='3', max_overflow='1',
+                              pool_timeout='5', pool_pre_ping='false')
+        self.assertIsInstance(engine.pool, MeteredQueuePool)
+        self.assertFalse(engine.pool._pre_ping)
+        status = pool_status(engine)
+        self.assertEqual(status['size'], 3)
+        self.assertEqual(status['max_overflow'], 1)
+        self.assertEqual(status['checked_out'], 0)
+        # SQLite defaults without pool settings
+        self.assertNotIsInstance(self._engine().pool, MeteredQueuePool)
+        with self.assertLogs('infolica.models', 'WARNING'):
+            engine = self._engine('sqlite://', pool_size='3')
+        self.assertNotIsInstance(engine.pool, MeteredQueuePool)
+
+    def test_metrics(self):
+        from sqlalchemy.exc import TimeoutError
+        from .models import pool_status
+
+        engine = self._engine(pool_size='1', max_overflow='0',
+                              pool_timeout='1')
+        with engine.connect():
+            with self.assertRaises(TimeoutError):
+                engine.connect()
+            self.assertEqual(pool_status(engine)['checked_out'], 1)
+        with engine.connect():
+            pass
+        engine.dispose()
+        status = pool_status(engine)
+        self.assertEqual(status['checkouts'], 2)
+        self.assertEqual(status['timeouts'], 1)
+        self.assertEqual(status['waits'], 1)
+        self.assertGreaterEqual(status['wait_time'], 1)
+        self.assertEqual(status['max_checked_out'], 1)
+
+    def test_statement_timeout(self):
+        from sqlalchemy.exc import OperationalError
+        from .models import (
+            get_session_factory,
+            set_statement_timeout,
+            watch_statement_timeouts,
+        )
+
+        slow = ('WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL '
+                'SELECT i + 1 FROM n WHERE i < 100000000) SELECT count(*) '
+                'FROM n')
+        session_factory = get_session_factory(self._engine())
+        watch_statement_timeouts(session_factory, 0.05)
+        session = session_factory()
+        with self.assertRaises(OperationalError):
+            session.execute(slow)
+        session.close()
+
+        session = session_factory()
+        self.assertEqual(session.execute('SELECT 1').scalar(), 1)
+        set_statement_timeout(session, None)
+        self.assertEqual(session.execute(
+            slow.replace('100000000', '100000')).scalar(), 100000)
+        session.close()
+
+    def test_read_only_routing(self):
+        from pyramid.request import Request, apply_request_extensions
+        from . import main
+        from .models import read_primary
+
+        app = main({}, **{
+            'sqlalchemy.url': self.url,
+            'sqlalchemy_ro.url': 'sqlite:///%s/replica.sqlite' %
+                                 self.tmpdir.name,
+        })
+        registry = app.registry
+        self.assertIsNot(registry['dbsession_factory_ro'],
+                         registry['dbsession_factory'])
+        for method, factory in (('GET', 'dbsession_factory_ro'),
+                                ('HEAD', 'dbsession_factory_ro'),
+                                ('POST', 'dbsession_factory')):
+            request = Request.blank('/', method=method)
+            request.registry = registry
+            request.tm = transaction.TransactionManager(explicit=True)
+            apply_request_extensions(request)
+            self.assertIs(request.dbsession.bind,
+                          registry[factory].kw['bind'])
+            # the caches synced from the primary load from it
+            self.assertIs(request.primary_dbsession.bind,
+                          registry['dbsession_factory'].kw['bind'])
+            self.assertIs(request.lookups.dbsession,
+                          request.primary_dbsession)
+
+        request = Request.blank('/', method='GET')
+        request.registry = registry
+        request.tm = transaction.TransactionManager(explicit=True)
+        apply_request_extensions(request)
+        read_primary(request)
+        self.assertIs(request.dbsession, request.primary_dbsession)
+
+    def test_load_under_waitress(self):
+        """
+        No pool timeout with as many connections as waitress threads
+        plus detail threads, whatever the number of clients.
+
+        """
+        import json
+        import threading
+        import urllib.request
+        from concurrent.futures import ThreadPoolExecutor
+        from waitress.server import create_server
+        from . import main
+        from .models.meta import Base
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        threads, detail_threads = 4, 4
+        app = main({}, **{
+            'sqlalchemy.url': self.url,
+            'sqlalchemy.pool_size': str(threads + detail_threads),
+            'sqlalchemy.max_overflow': '0',
+            'sqlalchemy.pool_timeout': '10',
+            'affaires.detail_threads': str(detail_threads),
+        })
+        session_factory = app.registry['dbsession_factory']
+        engine = session_factory.kw['bind']
+        self.engines.append(engine)
+        Base.metadata.create_all(engine)
+        session = session_factory()
+        create_reference_data(session)
+        generate_affaires(session, 200)
+        session.commit()
+        session.close()
+
+        server = create_server(app, host='127.0.0.1', port=0, threads=threads)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        base = 'http://127.0.0.1:%s' % server.effective_port
+
+        def get(i):
+            path = ('/api/affaires/%d/full' % (i % 200 + 1) if i % 2
+                    else '/api/affaires?limit=50&offset=%d' % (i % 150))
+            with urllib.request.urlopen(base + path, timeout=30) as response:
+                response.read()
+                return response.status
+
+        try:
+            with ThreadPoolExecutor(16) as clients:
+                statuses = list(clients.map(get, range(320)))
+            with urllib.request.urlopen(base + '/api/pool/stats') as response:
+                stats = json.loads(response.read())['primary']
+        finally:
+            server.close()
+            server.task_dispatcher.shutdown()
+        self.assertEqual(set(statuses), {200})
+        self.assertEqual(stats['timeouts'], 0)
+        self.assertLessEqual(stats['max_checked_out'],
+                             threads + detail_threads)
+        self.assertGreaterEqual(stats['checkouts'], 320)
+
+
+class TestRollingHistogram(unittest.TestCase):
+
+    def test_window(self):
+        from .services.instrumentation import RollingHistogram
+
+        now = [0.0]
+        histogram = RollingHistogram((1, 10), window=60, slots=6,
+                                     clock=lambda: now[0])
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        now[0] = 30
+        histogram.observe(2)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['buckets'],
+                         [(1, 2), (10, 4), (float('inf'), 5)])
+        self.assertEqual(snapshot['count'], 5)
+        self.assertEqual(snapshot['sum'], 58.5)
+        # the first observations leave the window, the last stays
+        now[0] = 65
+        self.assertEqual(histogram.snapshot()['count'], 1)
+        now[0] = 95
+        self.assertEqual(histogram.snapshot()['count'], 0)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        from webtest import TestApp
+        from . import main
+        from .models.meta import Base
+        from .scripts.benchmark import create_reference_data, generate_affaires
+
+        app = main({}, **{'sqlalchemy.url': 'sqlite://'})
+        self.registry = app.registry
+        session_factory = self.registry['dbsession_factory']
+        Base.metadata.create_all(session_factory.kw['bind'])
+        session = session_factory()
+        create_reference_data(session)
+        generate_affaires(session, 20)
+        session.commit()
+        session.close()
+        self.app = TestApp(app)
+
+    def test_server_timing(self):
+        import re
+
+        response = self.app.get('/api/affaires?limit=5')
+        timing = dict(
+            (m.group(1), m.group(0)) for m in re.finditer(
+                r'(\w+);(?:desc="[^"]*";)?dur=[\d.]+',
+                response.headers['Server-Timing']))
+        self.assertEqual(
+            set(timing), {'sql', 'view', 'render', 'commit', 'total'})
+        self.assertRegex(timing['sql'], r'desc="[1-9]\d* statements"')
+
+    def test_metrics(self):
+        for i in range(3):
+            self.app.get('/api/affaires?limit=5')
+        self.app.get('/api/affaires?order=up', status=400)
+        snapshot = self.registry['request_metrics'].snapshot()
+        self.assertEqual(snapshot['affaires']['duration']['count'], 4)
+        self.assertGreater(snapshot['affaires']['sql_count']['sum'], 0)
+
+        body = self.app.get('/metrics').text
+        self.assertIn(
+            'infolica_request_duration_seconds_count{route="affaires"} 4',
+            body)
+        self.assertIn(
+            'infolica_request_sql_statements_bucket{route="affaires",'
+            'le="+Inf"} 4', body)
+
+
+class TestSlowQueryLog(BaseTest):
+
+    def setUp(self):
+        import tempfile
+
+        super(TestSlowQueryLog, self).setUp()
+        self.init_database()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = '%s/var/slow.jsonl' % self.tmpdir.name
+
+    def tearDown(self):
+        transaction.abort()
+        testing.tearDown()
+        self.tmpdir.cleanup()
+
+    def test_record(self):
+        from .models import EtapeAffaire
+        from .services.slow_queries import SlowQueryLog, read_records
+
+        slow_queries = SlowQueryLog(0, max_records=2, path=self.path)
+        slow_queries.watch(self.engine)
+        for affaire_id in (1, 2, 3):
+            self.session.query(EtapeAffaire).filter(
+                EtapeAffaire.affaire_id == affaire_id).all()
+
+        self.assertEqual(slow_queries.count, 3)
+        records = slow_queries.recent()
+        self.assertEqual(len(records), 2)
+        record = records[0]
+        self.assertIn('FROM etape_affaire', record['statement'])
+        self.assertEqual(record['parameters'], [3])
+        self.assertRegex(record['site'],
+                         r'^infolica/tests\.py:\d+ in test_record$')
+        self.assertIsNone(record['route'])
+        self.assertRegex(record['plan'][0],
+                         r'^SEARCH etape_affaire USING INDEX ')
+        self.assertEqual([r['parameters'] for r in read_records(self.path)],
+                         [[1], [2], [3]])
+
+    def test_threshold(self):
+        from .models import EtapeAffaire
+        from .services.slow_queries import SlowQueryLog
+
+        slow_queries = SlowQueryLog(60)
+        slow_queries.watch(self.engine)
+        self.session.query(EtapeAffaire).all()
+        self.assertEqual(slow_queries.recent(), [])
+
+    def test_explain_failure(self):
+        from .models import Operateur
+        from .services.slow_queries import explain
+
+        self.session.add(Operateur(id=99, nom='Lent', prenom='Luc'))
+        self.session.flush()
+        connection = self.session.connection().connection
+        statements = []
+
+        class Cursor(object):
+            # the cursor of the statement, recording the ones of explain()
+            def __init__(self):
+                self.cursor = connection.cursor()
+
+            def execute(self, statement, parameters=()):
+                statements.append(statement.split(' ', 1)[0])
+                return self.cursor.execute(statement, parameters)
+
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+        class Connection(object):
+            def cursor(self):
+                return Cursor()
+
+        cursor = Cursor()
+        cursor.connection = Connection()
+        with self.assertRaises(Exception):
+            explain(cursor, 'sqlite', 'SELECT * FROM missing', ())
+        # PostgreSQL would otherwise abort the transaction of the request
+        self.assertEqual(statements,
+                         ['SAVEPOINT', 'EXPLAIN', 'ROLLBACK', 'RELEASE'])
+        self.assertEqual(self.session.query(Operateur.nom).filter(
+            Operateur.id == 99).scalar(), 'Lent')
+
+    def test_route(self):
+        from webtest import TestApp
+        from . import main
+        from .models.meta import Base
+
+        app = main({}, **{
+            'sqlalchemy.url': 'sqlite://',
+            'slow_queries.enabled': 'true',
+            'slow_queries.threshold': '0',
+        })
+        Base.metadata.create_all(app.registry['dbsession_factory'].kw['bind'])
+        app = TestApp(app)
+        app.get('/api/affaires')
+        records = app.get('/api/slow-queries').json['records']
+        stacks = [r['stack'] for r in records if r['route'] == 'affaires']
+        self.assertTrue(any(site.startswith('infolica/views/affaires.py:')
+                            for stack in stacks for site in stack), stacks)
+
+
+class TestIndexAudit(unittest.TestCase):
+
+    def test_foreign_keys_indexed(self):
+        from .models import Numero
+        from .models.meta import Base
+        from .scripts.index_audit import unindexed_foreign_keys
+
+        self.assertEqual(unindexed_foreign_keys(Base.metadata), [])
+        proposals = unindexed_foreign_keys(Base.metadata, ())
+        self.assertIn((Numero.__table__, ('etat_id',)),
+                      [(p.table, p.columns) for p in proposals])
+
+    def test_log_proposals(self):
+        from .models import Facture
+        from .models.meta import Base
+        from .scripts.index_audit import (
+            filtered_columns,
+            format_proposal,
+            proposals_from_log,
+        )
+
+        self.assertEqual(filtered_columns(
+            'SELECT facture.sap FROM facture JOIN affaire AS affaire_1 ON '
+            'affaire_1.id = facture.affaire_id WHERE facture.date >= ? AND '
+            'facture.type = ? AND affaire_1.cadastre_id = ? ORDER BY '
+            'facture.sap', 'facture'), ('type', 'date'))
+        records = [{
+            'statement': 'SELECT facture.sap FROM facture '
+                         'WHERE facture.type = ? AND facture.date >= ?',
+            'plan': ['SCAN facture'],
+            'duration': 0.5,
+        }, {
+            'statement': 'SELECT facture.sap FROM facture '
+                         'WHERE facture.affaire_id = ?',
+            # covered by ix_facture_affaire_id
+            'plan': ['SCAN facture'],
+            'duration': 2.0,
+        }, {
+            'statement': 'SELECT facture.sap FROM facture '
+                         'WHERE facture.client_id = ?',
+            'plan': ['SEARCH facture USING INDEX ix_facture_client_id '
+                     '(client_id=?)'],
+            'duration': 2.0,
+        }]
+        proposals = proposals_from_log(records * 2, Base.metadata)
+        self.assertEqual([(p.table, p.columns, p.count) for p in proposals],
+                         [(Facture.__table__, ('type', 'date'), 2)])
+        self.assertEqual(
+            format_proposal(proposals[0]),
+            'CREATE INDEX ix_facture_type_date ON facture.facture (type, '
+            'date);  -- scan in logged statements (2 statements, 1.000 s)')
+
+    def test_migration(self):
+        import importlib.util
+        import os
+        from alembic.migration import MigrationContext
+        from alembic.operations import Operations
+        from sqlalchemy import create_engine, inspect
+        from .models.meta import Base
+
+        path = os.path.join(os.path.dirname(__file__), 'alembic', 'versions',
+                            '20261018_fd84510c62a4.py')
+        spec = importlib.util.spec_from_file_location('migration', path)
+        migration = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(migration)
+
+        # created by later revisions
+        later = {'ix_job_state_run_after', 'ix_job_kind_state',
+                 'ix_document_sha256', 'ix_envoi_document_document_id',
+                 'ix_preavis_date_demande_ouvert',
+                 'ix_statistique_mois_type_id_mois',
+                 'ix_affaire_statut_courant_etape_id',
+                 'ix_affaire_statut_courant_statut_id',
+                 'ix_modification_affaire_hierarchie_affaire_id_descendant',
+                 'ix_facture_affaire_id', 'ix_emoluments_mo_affaire_id',
+                 'ix_remarque_affaire_affaire_id'}
+        declared = {i.name for t in Base.metadata.tables.values()
+                    for i in t.indexes} - {'my_index'} - later
+        self.assertEqual({i[0] for i in migration.INDEXES}, declared)
+
+        engine = create_engine('sqlite://')
+        with engine.connect() as connection:
+            connection = connection.execution_options(
+                schema_translate_map=dict.fromkeys(
+                    {t.schema for t in Base.metadata.tables.values()}))
+            Base.metadata.create_all(connection)
+            # as created before the indexes were declared
+            for name in declared:
+                connection.execute('DROP INDEX %s' % name)
+
+            def indexes():
+                inspector = inspect(connection)
+                return {i['name'] for t in inspector.get_table_names()
+                        for i in inspector.get_indexes(t)}
+
+            with Operations.context(MigrationContext.configure(connection)):
+                migration.upgrade()
+                self.assertEqual(indexes() & declared, declared)
+                migration.downgrade()
+                self.assertEqual(indexes() & declared, set())
+
+    def test_offline_migrations(self):
+        import io
+        import os
+        import tempfile
+        from alembic import command
+        from alembic.config import Config
+
+        # ``alembic upgrade --sql`` has no database to inspect
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'offline.ini')
+            with open(path, 'w') as f:
+                f.write('[app:main]\nuse = call:infolica:main\n'
+                        'sqlalchemy.url = postgresql://\n')
+            output = io.StringIO()
+            config = Config(path, output_buffer=output)
+            config.set_main_option('script_location', os.path.join(
+                os.path.dirname(__file__), 'alembic'))
+            command.upgrade(config, 'head', sql=True)
+            sql = output.getvalue()
+            self.assertIn('CREATE INDEX ix_affaire_responsable_id ON '
+                          'affaire.affaire (responsable_id)', sql)
+            self.assertIn('CREATE TABLE affaire.affaire_statut_courant', sql)
+            self.assertIn('ALTER TABLE facture.facture ADD COLUMN '
+                          'montant_tva', sql)
+            command.downgrade(config, 'head:base', sql=True)
+            self.assertIn('DROP TABLE general.job', output.getvalue())
+
+
+class TestGenerateData(BaseTest):
+
+    def setUp(self):
+        super(TestGenerateData, self).setUp()
+        self.init_database()
+
+    def test_generate(self):
+        from sqlalchemy import func
+        from . import models
+        from .models.meta import Base
+        from .scripts.generate_data import generate
+
+        counts = generate(self.session, scale=0.01, report=lambda line: None)
+        self.assertEqual(counts['affaire.affaire'], 100)
+        self.assertEqual(counts['client.client'], 50)
+
+        # every schema gets rows
+        schemas = {t.schema for t in Base.metadata.tables.values()
+                   if t.schema is not None}
+        filled = {t.schema for t in Base.metadata.tables.values()
+                  if self.session.query(func.count()).select_from(t).scalar()}
+        self.assertEqual(schemas - filled, set())
+
+        # closed affaires end with their last step, invoices on that day
+        closed = self.session.query(models.Affaire).filter(
+            models.Affaire.date_cloture.isnot(None)).all()
+        self.assertTrue(closed)
+        for affaire in closed:
+            self.assertEqual(affaire.statut_courant.date, affaire.date_cloture)
+            for facture in self.session.query(models.Facture).filter_by(
+                    affaire_id=affaire.id):
+                self.assertEqual(facture.date, affaire.date_cloture)
+        open_preavis = self.session.query(models.Preavis).filter(
+            models.Preavis.date_reponse.is_(None)).all()
+        self.assertTrue(all(p.affaire.date_cloture is None
+                            for p in open_preavis))
+
+    def test_seeded(self):
+        from .models import Affaire
+        from .scripts.generate_data import generate
+
+        generate(self.session, scale=0.005, seed=3, report=lambda line: None)
+        first = [(a.date_ouverture, a.cadastre_id)
+                 for a in self.session.query(Affaire).order_by(Affaire.id)]
+        transaction.abort()
+        generate(self.session, scale=0.005, seed=3, report=lambda line: None)
+        self.assertEqual(first, [
+            (a.date_ouverture, a.cadastre_id)
+            for a in self.session.query(Affaire).order_by(Affaire.id)])
+
+
+class TestCadastreImport(BaseTest):
+
+    def setUp(self):
+        super(TestCadastreImport, self).setUp()
+        self.init_database()
+
+        import tempfile
+        from .models import Cadastre, NumeroEtat, NumeroType
+
+        self.session.add_all([
+            Cadastre(id=1, nom='Neuchâtel'), Cadastre(id=2, nom='Boudry'),
+            NumeroType(id=1, nom='Bien-fonds'), NumeroType(id=2, nom='DDP'),
+            NumeroEtat(id=1, nom='Vigueur'),
+        ])
+        transaction.commit()
+        self.directory = tempfile.TemporaryDirectory()
+        self.reports = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+        super(TestCadastreImport, self).tearDown()
+
+    def _csv(self, name, lines):
+        import os
+
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def _importer(self, **kwargs):
+        from .scripts.import_cadastre import CadastreImport
+
+        kwargs.setdefault('report', self.reports.append)
+        return CadastreImport(self.session_factory, **kwargs)
+
+    def test_import(self):
+        from .models import Numero, NumeroCompteur, NumeroPlan, Plan
+
+        plans = self._csv('plans.csv', [
+            'cadastre;plan', 'Neuchâtel;1', 'Neuchâtel;2', 'Boudry;1',
+            'Boudry;1', 'Inconnu;3'])
+        numeros = self._csv('numeros.csv', [
+            'cadastre;type;numero;suffixe;etat',
+            'Neuchâtel;Bien-fonds;10;;Vigueur',
+            'Neuchâtel;Bien-fonds;10;1;Vigueur',
+            'Neuchâtel;DDP;4;;Vigueur',
+            'Boudry;Bien-fonds;7;;Vigueur',
+            'Boudry;Bien-fonds;x;;Vigueur'])
+        links = self._csv('numeros_plans.csv', [
+            'cadastre;type;numero;suffixe;plan',
+            'Neuchâtel;Bien-fonds;10;;1',
+            'Neuchâtel;Bien-fonds;10;1;2',
+            'Boudry;Bien-fonds;7;;1',
+            'Boudry;Bien-fonds;8;;1'])
+        importer = self._importer(batch_size=2, max_cadastres=1)
+
+        counts = importer.run('plans', plans)
+        self.assertEqual(dict(counts), {
+            'read': 5, 'inserted': 3, 'skipped': 1, 'rejected': 1})
+        counts = importer.run('numeros', numeros)
+        self.assertEqual(dict(counts), {
+            'read': 5, 'inserted': 4, 'skipped': 0, 'rejected': 1})
+        counts = importer.run('numeros_plans', links)
+        self.assertEqual(dict(counts), {
+            'read': 4, 'inserted': 3, 'skipped': 0, 'rejected': 1})
+        self.assertEqual(len(self.reports), 3 + 3 + 2)
+
+        self.assertEqual(self.session.query(Plan).count(), 3)
+        linked = sorted(
+            (n.cadastre_id, n.numero, n.suffixe or '', p.nom)
+            for n, p in self.session.query(Numero, Plan).join(
+                NumeroPlan, NumeroPlan.numero_id == Numero.id).join(
+                    Plan, Plan.id == NumeroPlan.plan_id))
+        self.assertEqual(linked, [
+            (1, 10, '', '1'), (1, 10, '1', '2'), (2, 7, '', '1')])
+        # new reservations follow the imported numbers
+        self.assertEqual(self.session.query(NumeroCompteur).get(
+            (1, 1)).prochain, 11)
+
+        # already imported: every row is skipped
+        counts = importer.run('numeros', numeros, restart=True)
+        self.assertEqual(counts['inserted'], 0)
+        self.assertEqual(counts['skipped'], 4)
+
+    def test_resume(self):
+        from .models import ImportCheckpoint, Numero
+
+        path = self._csv('numeros.csv', [
+            'cadastre;type;numero;suffixe;etat'] + [
+                'Neuchâtel;Bien-fonds;%d;;Vigueur' % i for i in range(1, 8)])
+
+        def interrupt(line):
+            raise KeyboardInterrupt
+
+        # stopped after the first batch is committed
+        with self.assertRaises(KeyboardInterrupt):
+            self._importer(batch_size=3, report=interrupt).run(
+                'numeros', path)
+        self.assertEqual(self.session.query(Numero).count(), 3)
+        self.assertEqual(self.session.query(ImportCheckpoint).get(
+            'numeros:numeros.csv').position, 3)
+        transaction.abort()
+
+        counts = self._importer(batch_size=3).run('numeros', path)
+        self.assertEqual(counts['read'], 4)
+        self.assertEqual(counts['inserted'], 4)
+        self.assertEqual(sorted(n for n, in self.session.query(
+            Numero.numero)), list(range(1, 8)))
+
+    def test_too_many_errors(self):
+        from .models import Numero
+        from .scripts.import_cadastre import TooManyErrors
+
+        path = self._csv('numeros.csv', [
+            'cadastre;type;numero;suffixe;etat',
+            'Neuchâtel;Bien-fonds;1;;Vigueur',
+            'Neuchâtel;Bien-fonds;2;;Aboli',
+            'Neuchâtel;Bien-fonds;-3;;Vigueur'])
+        with self.assertRaises(TooManyErrors):
+            self._importer(max_errors=1).run('numeros', path)
+        # the batch is rolled back
+        self.assertEqual(self.session.query(Numero).count(), 0)
+
+        with self.assertRaises(ValueError):
+            self._importer().run('plans', path)
+
+
+class TestExports(unittest.TestCase):
+
+    def setUp(self):
+        from webtest import TestApp
+        from . import main
+        from .models.meta import Base
+
+        self.wsgi_app = main({}, **{'sqlalchemy.url': 'sqlite://'})
+        self.session_factory = self.wsgi_app.registry['dbsession_factory']
+        Base.metadata.create_all(self.session_factory.kw['bind'])
+        self.app = TestApp(self.wsgi_app)
+
+    def _generate(self):
+        from .scripts.generate_data import generate
+
+        session = self.session_factory()
+        generate(session, scale=0.02, report=lambda line: None)
+        session.commit()
+        session.close()
+
+    def test_csv(self):
+        import csv
+        import io
+
+        self._generate()
+        response = self.app.get('/api/export/factures?annee=2010')
+        self.assertEqual(response.content_type, 'text/csv')
+        self.assertIn('factures_2010.csv',
+                      response.headers['Content-Disposition'])
+        rows = list(csv.DictReader(
+            io.StringIO(response.body.decode('utf-8-sig')), delimiter=';'))
+        self.assertTrue(rows)
+        self.assertTrue(all(r['date'].startswith('2010-') for r in rows))
+        self.assertEqual([r['date'] for r in rows],
+                         sorted(r['date'] for r in rows))
+
+        response = self.app.get('/api/export/affaires?cloture=false')
+        rows = list(csv.DictReader(
+            io.StringIO(response.body.decode('utf-8-sig')), delimiter=';'))
+        self.assertTrue(rows)
+        self.assertTrue(all(r['date_cloture'] == '' for r in rows))
+        self.assertTrue(all(r['statut'] for r in rows))
+
+    def test_xlsx(self):
+        import io
+        import zipfile
+        from xml.etree import ElementTree
+        from .models import Numero
+
+        self._generate()
+        response = self.app.get(
+            '/api/export/numeros?cadastre_id=2&format=xlsx')
+        self.assertEqual(response.content_type,
+                         'application/vnd.openxmlformats-officedocument.'
+                         'spreadsheetml.sheet')
+        package = zipfile.ZipFile(io.BytesIO(response.body))
+        self.assertIsNone(package.testzip())
+        sheet = ElementTree.fromstring(
+            package.read('xl/worksheets/sheet1.xml'))
+        ns = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+        rows = sheet.findall('%ssheetData/%srow' % (ns, ns))
+        header = [t.text for t in rows[0].iter(ns + 't')]
+        self.assertEqual(header, ['id', 'numero', 'suffixe', 'type', 'etat'])
+        session = self.session_factory()
+        self.assertEqual(len(rows) - 1, session.query(Numero).filter_by(
+            cadastre_id=2).count())
+        session.close()
+
+    def test_invalid(self):
+        self.app.get('/api/export/numeros', status=400)
+        self.app.get('/api/export/numeros?cadastre_id=x', status=400)
+        self.app.get('/api/export/factures?annee=2010&format=pdf', status=400)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'),
+                         'needs /proc to read the resident memory')
+    def test_million_rows_flat_memory(self):
+        from webob import Request
+        from .models import Cadastre, NumeroEtat, NumeroType
+
+        def resident():
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+        session = self.session_factory()
+        session.add_all([Cadastre(id=1, nom='Neuchâtel'),
+                         NumeroType(id=1, nom='Bien-fonds'),
+                         NumeroEtat(id=1, nom='Vigueur')])
+        session.flush()
+        session.execute(
+            'WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n '
+            'WHERE i < 1000000) INSERT INTO numero '
+            '(id, cadastre_id, type_id, numero, etat_id) '
+            'SELECT i, 1, 1, i, 1 FROM n')
+        session.commit()
+        session.close()
+
+        start = resident()
+        growth = 0
+        size = lines = 0
+        status, headers, app_iter = Request.blank(
+            '/api/export/numeros?cadastre_id=1').call_application(
+                self.wsgi_app)
+        try:
+            for chunk in app_iter:
+                size += len(chunk)
+                lines += chunk.count(b'\n')
+                growth = max(growth, resident() - start)
+        finally:
+            app_iter.close()
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(lines, 1000001)
+        # the body alone is about 20 MB
+        self.assertGreater(size, 16 * 2 ** 20)
+        self.assertLess(growth, 16 * 2 ** 20)
+
+
+class TestJobs(BaseTest):
+
+    def setUp(self):
+        super(TestJobs, self).setUp()
+        self.init_database()
+
+        from transaction.interfaces import TransientError
+        from .services.jobs import KINDS, job_kind
+
+        self.calls = []
+        self.kinds = set(KINDS)
+
+        @job_kind('test_flaky')
+        def flaky(context):
+            self.calls.append(context.attempt)
+            if context.attempt < context.params.get('succeed_at', 99):
+                raise TransientError('conflict')
+            return {'attempt': context.attempt}
+
+        @job_kind('test_broken')
+        def broken(context):
+            context.progress(0.5, 'half way')
+            context.commit()
+            raise ValueError('broken')
+
+        @job_kind('test_limited', limit=1, max_attempts=4)
+        def limited(context):
+            return None
+
+    def tearDown(self):
+        from .services.jobs import KINDS
+
+        for kind in set(KINDS) - self.kinds:
+            del KINDS[kind]
+        super(TestJobs, self).tearDown()
+
+    def _enqueue(self, kind, params=None, **kwargs):
+        from .services.jobs import enqueue
+
+        job_id = enqueue(self.session, kind, params, **kwargs).id
+        transaction.commit()
+        return job_id
+
+    def _job(self, job_id):
+        from .models import Job
+
+        session = self.session_factory()
+        try:
+            job = session.query(Job).get(job_id)
+            session.expunge(job)
+            return job
+        finally:
+            session.close()
+
+    def _worker(self, **kwargs):
+        from .services.jobs import Worker
+
+        kwargs.setdefault('backoff', 0)
+        return Worker(self.session_factory, **kwargs)
+
+    def _run(self, **kwargs):
+        import threading
+
+        self._worker(**kwargs).run(threading.Event(), once=True)
+
+    def test_run(self):
+        import json
+        from .models import Cadastre, Numero, NumeroEtat, NumeroType
+
+        self.session.add_all([Cadastre(id=1, nom='Neuchâtel'),
+                              NumeroType(id=1, nom='Bien-fonds'),
+                              NumeroEtat(id=1, nom='Vigueur')])
+        self.session.add(Numero(cadastre_id=1, type_id=1, numero=12,
+                                etat_id=1))
+        job_id = self._enqueue('rebuild', {'only': ['numero_compteur']})
+        self.assertEqual(self._job(job_id).state, 'pending')
+
+        self._run()
+        job = self._job(job_id)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.progress, 1.0)
+        self.assertEqual(job.message, 'numero_compteur')
+        self.assertEqual(json.loads(job.result), {'numero_compteur': {
+            'inserted': 1, 'updated': 0, 'deleted': 0}})
+        self.assertIsNotNone(job.finished)
+
+    def test_retry(self):
+        import json
+
+        job_id = self._enqueue('test_flaky', {'succeed_at': 3})
+        self._run()
+        job = self._job(job_id)
+        self.assertEqual(self.calls, [1, 2, 3])
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(json.loads(job.result), {'attempt': 3})
+
+    def test_retry_backoff(self):
+        import datetime
+
+        job_id = self._enqueue('test_flaky', {'succeed_at': 2})
+        self._run(backoff=60)
+        job = self._job(job_id)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(job.state, 'pending')
+        self.assertEqual(job.error, 'TransientError: conflict')
+        self.assertGreater(job.run_after, datetime.datetime.utcnow() +
+                           datetime.timedelta(seconds=50))
+
+    def test_attempts_exhausted(self):
+        job_id = self._enqueue('test_flaky', max_attempts=2)
+        self._run()
+        job = self._job(job_id)
+        self.assertEqual(self.calls, [1, 2])
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.attempts, 2)
+
+    def test_max_attempts(self):
+        self.assertEqual(self._job(self._enqueue(
+            'test_limited', max_attempts=2)).max_attempts, 2)
+        self.assertEqual(self._job(self._enqueue(
+            'test_limited', default_max_attempts=5)).max_attempts, 4)
+        self.assertEqual(self._job(self._enqueue(
+            'test_flaky', default_max_attempts=5)).max_attempts, 5)
+        self.assertEqual(self._job(self._enqueue(
+            'test_flaky')).max_attempts, 3)
+
+    def test_not_retryable(self):
+        job_id = self._enqueue('test_broken')
+        self._run()
+        job = self._job(job_id)
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.error, 'ValueError: broken')
+        # what was committed before the error stays
+        self.assertEqual(job.progress, 0.5)
+        self.assertEqual(job.message, 'half way')
+
+    def test_limit(self):
+        first = self._enqueue('test_limited')
+        self._enqueue('test_limited')
+        other = self._enqueue('test_flaky', {'succeed_at': 1})
+
+        claimed = self._worker(name='a').claim()
+        self.assertEqual(claimed.id, first)
+        self.assertEqual(self._job(first).worker, 'a')
+        self.assertEqual(self._worker(name='b').claim().id, other)
+        self.assertIsNone(self._worker(name='b').claim())
+        self.assertIsNotNone(
+            self._worker(name='b', limits={'test_limited': 2}).claim())
+
+    def test_lost_worker(self):
+        import datetime
+        from .models import Job
+
+        job_id = self._enqueue('test_flaky', {'succeed_at': 1})
+        lost = self._worker(name='lost')
+        job = lost.claim()
+        self.assertIsNone(self._worker(name='b').claim())
+
+        self.session.query(Job).update({
+            'heartbeat': datetime.datetime.utcnow() -
+            datetime.timedelta(hours=1)})
+        transaction.commit()
+        self._run(name='b', timeout=60)
+        self.assertEqual(self._job(job_id).state, 'done')
+        self.assertEqual(self._job(job_id).attempts, 2)
+
+        # the lost worker cannot write over the job
+        self.assertIsNone(lost.execute(job))
+        self.assertEqual(self._job(job_id).worker, 'b')
+
+    def test_views(self):
+        import threading
+        from webtest import TestApp
+        from . import main
+        from .models.meta import Base
+        from .services.jobs import Worker
+        from .views import jobs as jobs_views
+
+        wsgi_app = main({}, **{'sqlalchemy.url': 'sqlite://',
+                               'retry.attempts': '5'})
+        session_factory = wsgi_app.registry['dbsession_factory']
+        Base.metadata.create_all(session_factory.kw['bind'])
+        app = TestApp(wsgi_app)
+
+        response = app.post_json('/api/jobs', {'kind': 'rebuild'},
+                                 status=202)
+        job = response.json
+        self.assertEqual(job['state'], 'pending')
+        self.assertEqual(job['max_attempts'], 5)
+        self.assertTrue(response.location.endswith('/api/jobs/%d' % job['id']))
+        app.post_json('/api/jobs', {'kind': 'unknown'}, status=400)
+        app.post_json('/api/jobs', {'kind': 'rebuild', 'params': []},
+                      status=400)
+        app.get('/api/jobs?state=lost', status=400)
+        app.get('/api/jobs?limit=x', status=400)
+        app.get('/api/jobs/0', status=404)
+
+        Worker(session_factory, kinds=['rebuild']).run(
+            threading.Event(), once=True)
+        job = app.get('/api/jobs/%d' % job['id']).json
+        self.assertEqual(job['state'], 'done')
+        self.assertEqual(sorted(job['result']), [
+            'modification_affaire_hierarchie', 'numero_compteur',
+            'statistiques', 'statut_courant'])
+        self.assertEqual(
+            [j['id'] for j in app.get('/api/jobs?state=done').json['jobs']],
+            [job['id']])
+
+        app.post_json('/api/jobs', {'kind': 'rebuild'}, status=202)
+        max_limit = jobs_views.MAX_LIMIT
+        jobs_views.MAX_LIMIT = 1
+        try:
+            jobs = app.get('/api/jobs?limit=1000').json['jobs']
+        finally:
+            jobs_views.MAX_LIMIT = max_limit
+        self.assertEqual(len(jobs), 1)
+
+
+class TestDocuments(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from webtest import TestApp
+        from . import main
+        from .models.meta import Base
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.wsgi_app = main({}, **{
+            'sqlalchemy.url': 'sqlite://',
+            'documents.root': self.directory.name,
+            'documents.max_size': str(2 * 2 ** 30),
+        })
+        self.store = self.wsgi_app.registry['document_store']
+        session_factory = self.wsgi_app.registry['dbsession_factory']
+        Base.metadata.create_all(session_factory.kw['bind'])
+        self.app = TestApp(self.wsgi_app)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def _upload(self, body, nom='plan.pdf', **kwargs):
+        return self.app.post(
+            '/api/documents?nom=%s' % nom, body,
+            content_type='application/pdf', **kwargs)
+
+    def test_upload(self):
+        import hashlib
+
+        body = b'%PDF-1.4 ' + bytes(range(256)) * 1000
+        first = self._upload(body, status=201).json
+        self.assertEqual(first['sha256'], hashlib.sha256(body).hexdigest())
+        self.assertEqual(first['taille'], len(body))
+        self.assertFalse(first['deja_stocke'])
+        second = self._upload(body, nom='copie.pdf', status=201).json
+        self.assertNotEqual(second['id'], first['id'])
+        self.assertTrue(second['deja_stocke'])
+        # stored once, nothing left behind
+        self.assertEqual(os.listdir(self.store.tmp), [])
+        with self.store.open(first['sha256']) as f:
+            self.assertEqual(f.read(), body)
+
+        info = self.app.get('/api/documents/%d/info' % first['id']).json
+        self.assertEqual(info['nom'], 'plan.pdf')
+        self.assertEqual(info['type_contenu'], 'application/pdf')
+        self.app.post('/api/documents', body, status=400)
+        self.app.get('/api/documents/0', status=404)
+
+    def test_download(self):
+        body = bytes(range(256)) * 1000
+        document = self._upload(body, nom='Plan%20Neuch%C3%A2tel.pdf').json
+        url = '/api/documents/%d' % document['id']
+
+        response = self.app.get(url)
+        self.assertEqual(response.body, body)
+        self.assertEqual(response.content_type, 'application/pdf')
+        self.assertEqual(response.etag, document['sha256'])
+        self.assertEqual(response.headers['Accept-Ranges'], 'bytes')
+        self.assertIn("filename*=UTF-8''Plan%20Neuch%C3%A2tel.pdf",
+                      response.headers['Content-Disposition'])
+
+        etag = response.headers['ETag']
+        self.app.get(url, headers={'If-None-Match': etag}, status=304)
+
+        response = self.app.get(url, headers={'Range': 'bytes=1000-1999'},
+                                status=206)
+        self.assertEqual(response.body, body[1000:2000])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 1000-1999/256000')
+        response = self.app.get(url, headers={'Range': 'bytes=-10'},
+                                status=206)
+        self.assertEqual(response.body, body[-10:])
+        # the range of another version of the document is not sent
+        response = self.app.get(url, headers={
+            'Range': 'bytes=0-9', 'If-Range': '"other"'}, status=200)
+        self.assertEqual(len(response.body), len(body))
+        response = self.app.get(url, headers={'Range': 'bytes=300000-'},
+                                status=416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */256000')
+
+    def test_too_large(self):
+        self.wsgi_app.registry['document_max_size'] = 1000
+        self._upload(b'x' * 1001, status=413)
+        self.assertEqual(os.listdir(self.store.tmp), [])
+
+    def test_large_file_flat_memory(self):
+        from wsgiref.util import FileWrapper
+        from webob import Request
+
+        def resident():
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+        class Zeros(object):
+            """A request body of ``size`` bytes, made as it is read."""
+
+            def __init__(self, size):
+                self.remaining = size
+
+            def read(self, size=-1):
+                size = self.remaining if size < 0 else min(
+                    size, self.remaining)
+                self.remaining -= size
+                return bytes(size)
+
+        size = 2 ** 30
+        start = resident()
+        request = Request.blank('/api/documents?nom=scan.pdf', POST=None)
+        request.method = 'POST'
+        request.content_type = 'application/pdf'
+        request.body_file_raw = Zeros(size)
+        request.content_length = size
+        response = request.get_response(self.wsgi_app)
+        self.assertEqual(response.status_int, 201)
+        self.assertLess(resident() - start, 64 * 2 ** 20)
+
+        for headers, expected in (({}, size),
+                                  ({'Range': 'bytes=%d-' % (size // 2)},
+                                   size // 2)):
+            request = Request.blank(
+                response.location, headers=headers,
+                environ={'wsgi.file_wrapper': FileWrapper})
+            status, headers, app_iter = request.call_application(
+                self.wsgi_app)
+            length = growth = 0
+            try:
+                for chunk in app_iter:
+                    length += len(chunk)
+                    growth = max(growth, resident() - start)
+            finally:
+                app_iter.close()
+            self.assertEqual(length, expected)
+            self.assertLess(growth, 64 * 2 ** 20)
+
+
+class SMTPStandIn(object):
+    """
+    Local SMTP server keeping the messages it receives, for the tests.
+
+    ``refused`` addresses are refused (550), the next DATA commands are
+    answered with the codes of ``data_replies`` (e.g. 451) and a
+    connection is dropped after ``drop_after`` messages when set.
+
+    """
+
+    def __init__(self):
+        import socketserver
+        import threading
+
+        stand_in = self
+        self.messages = []
+        self.connections = 0
+        self.refused = set()
+        self.data_replies = []
+        self.drop_after = None
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write(line.encode('ascii') + b'\r\n')
+
+            def handle(self):
+                stand_in.connections += 1
+                received = 0
+                recipients = []
+                self.reply('220 stand-in ready')
+                for line in self.rfile:
+                    command = line.decode('ascii').strip()
+                    verb = command[:4].upper()
+                    if verb == 'EHLO':
+                        self.reply('250-stand-in')
+                        self.reply('250 8BITMIME')
+                    elif verb in ('HELO', 'RSET', 'NOOP'):
+                        recipients = []
+                        self.reply('250 OK')
+                    elif verb == 'MAIL':
+                        recipients = []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        address = command.split(':', 1)[1].strip('<> ')
+                        if address in stand_in.refused:
+                            self.reply('550 no such user')
+                        else:
+                            recipients.append(address)
+                            self.reply('250 OK')
+                    elif verb == 'DATA':
+                        if stand_in.data_replies:
+                            self.reply('%d try again later' %
+                                       stand_in.data_replies.pop(0))
+                            continue
+                        self.reply('354 go ahead')
+                        data = []
+                        for data_line in self.rfile:
+                            if data_line == b'.\r\n':
+                                break
+                            data.append(data_line)
+                        stand_in.messages.append(
+                            (recipients, b''.join(data)))
+                        received += 1
+                        self.reply('250 queued')
+                        if received == stand_in.drop_after:
+                            return
+                    elif verb == 'QUIT':
+                        self.reply('221 bye')
+                        return
+                    else:
+                        self.reply('502 not implemented')
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+class TestEnvoi(BaseTest):
+
+    def setUp(self):
+        super(TestEnvoi, self).setUp()
+        self.init_database()
+
+        import io
+        import tempfile
+        from .models import (
+            Affaire,
+            AffaireType,
+            Cadastre,
+            Client,
+            Document,
+            Operateur,
+            RelationAffaireClient,
+            RelationClientAffaireType,
+        )
+        from .services.documents import DocumentStore
+
+        self.stand_in = SMTPStandIn()
+        self.addCleanup(self.stand_in.close)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.store = DocumentStore(self.directory.name)
+        self.session.add_all([
+            Cadastre(id=1, nom='Neuchâtel'),
+            AffaireType(id=1, nom='Mutation'),
+            Operateur(id=1, nom='Dupont', prenom='Jean'),
+            RelationClientAffaireType(id=1, nom='Mandataire'),
+        ])
+        self.session.flush()
+        for i in range(1, 4):
+            self.session.add(Affaire(
+                id=i, type_id=1, cadastre_id=1, responsable_id=1,
+                technicien_id=1, localisation_E=2561000,
+                localisation_N=1205000))
+            digest, size, _ = self.store.write(io.BytesIO(b'plan %d' % i))
+            self.session.add(Document(
+                id=i, chemin=self.store.relative_path(digest),
+                nom='plan_%d.pdf' % i, type_contenu='application/pdf',
+                taille=size, sha256=digest))
+        # client 1 is a client of affaires 1 and 2, client 4 has no mail
+        for client_id, mail in ((1, 'a@example.ch'), (2, 'b@example.ch'),
+                                (3, 'c@example.ch'), (4, None)):
+            self.session.add(Client(id=client_id, mail=mail))
+        self.session.flush()
+        for client_id, affaire_id in ((1, 1), (1, 2), (2, 2), (3, 3),
+                                      (4, 3)):
+            self.session.add(RelationAffaireClient(
+                client_id=client_id, affaire_id=affaire_id,
+                relation_type_id=1))
+        transaction.commit()
+        self.sleeps = []
+
+    def _dispatcher(self, **kwargs):
+        import functools
+        from .services.envoi import Dispatcher, smtp_connect
+
+        kwargs.setdefault('store', self.store)
+        kwargs.setdefault('backoff', 0.01)
+        return Dispatcher(
+            self.session_factory,
+            functools.partial(smtp_connect, '127.0.0.1', self.stand_in.port),
+            'infolica@example.ch', sleep=self.sleeps.append,
+            report=lambda line: None, **kwargs)
+
+    def _pairs(self):
+        from .services.envoi import destinataires
+
+        return list(destinataires(self.session, [(1, 1), (2, 2), (3, 3)]))
+
+    def _envois(self):
+        from .models import EnvoiDocument
+
+        return sorted(self.session.query(
+            EnvoiDocument.destinataire_id, EnvoiDocument.document_id))
+
+    def test_dispatch(self):
+        import email
+
+        counts = self._dispatcher().run(self._pairs())
+        self.assertEqual(
+            (counts['envoyes'], counts['sans_adresse'], counts['rejetes'],
+             counts['envois']), (3, 1, 0, 4))
+        self.assertGreater(counts['messages_par_seconde'], 0)
+        # one message per recipient, over one connection
+        self.assertEqual(self.stand_in.connections, 1)
+        self.assertEqual(sorted(r for r, _ in self.stand_in.messages),
+                         [['a@example.ch'], ['b@example.ch'],
+                          ['c@example.ch']])
+        message = email.message_from_bytes(dict(
+            (r[0], m) for r, m in self.stand_in.messages)['a@example.ch'])
+        self.assertEqual(
+            [(p.get_filename(), p.get_payload(decode=True))
+             for p in message.walk() if p.get_filename()],
+            [('plan_1.pdf', b'plan 1'), ('plan_2.pdf', b'plan 2')])
+        self.assertEqual(self._envois(), [(1, 1), (1, 2), (2, 2), (3, 3)])
+
+        # what was sent is not sent again
+        counts = self._dispatcher().run(self._pairs())
+        self.assertEqual((counts['envoyes'], counts['deja_envoyes']), (0, 3))
+        self.assertEqual(len(self.stand_in.messages), 3)
+
+    def test_links(self):
+        import email
+        import email.policy
+
+        self._dispatcher(max_attachments_size=6,
+                         documents_url='https://infolica/api/documents/'
+                         ).run([(1, 1), (1, 2)])
+        message = email.message_from_bytes(self.stand_in.messages[0][1],
+                                           policy=email.policy.default)
+        parts = [p for p in message.walk() if not p.is_multipart()]
+        self.assertEqual([p.get_filename() for p in parts],
+                         [None, 'plan_1.pdf'])
+        self.assertIn('plan_2.pdf : https://infolica/api/documents/2',
+                      parts[0].get_content())
+
+    def test_retry(self):
+        self.stand_in.data_replies = [451, 451]
+        self.stand_in.refused.add('b@example.ch')
+        counts = self._dispatcher().run(self._pairs())
+        self.assertEqual((counts['envoyes'], counts['rejetes']), (2, 1))
+        self.assertEqual(self.sleeps, [0.01, 0.02])
+        self.assertEqual(self._envois(), [(1, 1), (1, 2), (3, 3)])
+
+        # out of attempts
+        self.stand_in.data_replies = [451] * 3
+        counts = self._dispatcher(resend=True).run([(2, 2)])
+        self.assertEqual((counts['envoyes'], counts['rejetes']), (0, 1))
+
+    def test_connections(self):
+        pairs = self._pairs()
+        self._dispatcher(max_per_connection=2).run(pairs)
+        self.assertEqual(self.stand_in.connections, 2)
+
+        self.stand_in.drop_after = 1
+        counts = self._dispatcher(resend=True).run(pairs)
+        self.assertEqual(counts['envoyes'], 3)
+        self.assertEqual(self.stand_in.connections, 5)
+
+    def test_throttle(self):
+        self._dispatcher(rate=10).run(self._pairs())
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertTrue(all(0 < s <= 0.2 for s in self.sleeps))
+
+    def test_job(self):
+        import json
+        import threading
+        from .models import Job
+        from .services.jobs import Worker, enqueue, worker_options
+
+        job_id = enqueue(self.session, 'envoi_documents', {
+            'envois': [[1, 1], [2, 2], [3, 3]], 'sujet': 'Plans'}).id
+        transaction.commit()
+        options = worker_options({
+            'mail.host': '127.0.0.1', 'mail.port': str(self.stand_in.port),
+            'documents.root': self.directory.name})
+        Worker(self.session_factory, **options).run(
+            threading.Event(), once=True)
+        job = self.session.query(Job).get(job_id)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(json.loads(job.result)['envoyes'], 3)
+        self.assertIn('messages/s', job.message)
+        self.assertEqual(len(self.stand_in.messages), 3)
+
+
+class TestPreavis(BaseTest):
+
+    def setUp(self):
+        super(TestPreavis, self).setUp()
+        self.init_database()
+        self.config.include('.services.preavis')
+
+        import datetime
+        from .models import Preavis, PreavisDecision, PreavisType, Services
+        from .scripts.benchmark import create_reference_data
+
+        create_reference_data(self.session)
+        self.session.add_all([
+            Services(id=1, service='Cadastre', mail='cadastre@example.ch'),
+            Services(id=2, service='Routes', mail='routes@example.ch'),
+            Services(id=3, service='Eaux'),
+            PreavisType(id=1, nom='Mutation'),
+            PreavisDecision(id=1, nom='En attente'),
+        ])
+        self.session.flush()
+        self.session.add(self._affaire())
+        self.day = datetime.date(2026, 3, 1)
+        # service 1 answered in 10 and 20 days, 4 and 5 are due on 3.31
+        # and 4.30 (service 2 has 60 days), 6 on 3.31 has no address
+        for id_, service_id, demande, reponse in (
+                (1, 1, 0, 10), (2, 1, 0, 20), (3, 2, 0, 5),
+                (4, 1, 0, None), (5, 2, 0, None), (6, 3, 0, None)):
+            self.session.add(Preavis(
+                id=id_, affaire_id=1, service_id=service_id, preavis_id=1,
+                decision=1, date_demande=self._day(demande),
+                date_reponse=None if reponse is None else self._day(reponse)))
+        transaction.commit()
+        self.config.registry['dbsession_factory'] = self.session_factory
+        self.scheduler = self.config.registry['preavis_scheduler']
+        self.scheduler.delais = {2: 60}
+        self.scheduler.watch(self.session_factory)
+
+    def _affaire(self):
+        from .models import Affaire
+
+        return Affaire(id=1, responsable_id=1, technicien_id=1, type_id=1,
+                       cadastre_id=1, localisation_E=2561000,
+                       localisation_N=1205000)
+
+    def _day(self, days):
+        import datetime
+
+        return self.day + datetime.timedelta(days=days)
+
+    def _overdue(self, days):
+        return [id_ for id_, _ in self.scheduler.overdue(self._day(days))]
+
+    def test_overdue(self):
+        self.scheduler.ensure_loaded(self.session)
+        self.assertEqual(self._overdue(30), [])
+        self.assertEqual(self._overdue(31), [4, 6])
+        self.assertEqual(self._overdue(61), [4, 6, 5])
+        # back in time
+        self.assertEqual(self._overdue(40), [4, 6])
+
+        stats = self.scheduler.stats(self._day(40))
+        self.assertEqual(stats[1], {'ouverts': 1, 'en_retard': 1,
+                                    'repondus': 2, 'delai_moyen': 15.0})
+        self.assertEqual(stats[2], {'ouverts': 1, 'en_retard': 0,
+                                    'repondus': 1, 'delai_moyen': 5.0})
+        self.assertIsNone(stats[3]['delai_moyen'])
+
+    def test_follows_committed_changes(self):
+        from .models import Preavis
+
+        self.scheduler.ensure_loaded(self.session)
+        self.assertEqual(self._overdue(40), [4, 6])
+
+        # answered
+        self.session.query(Preavis).get(4).date_reponse = self._day(42)
+        transaction.commit()
+        self.assertEqual(self._overdue(45), [6])
+        self.assertEqual(self.scheduler.stats(self._day(45))[1]['repondus'], 3)
+
+        # asked again, already late
+        self.session.add(Preavis(
+            id=7, affaire_id=1, service_id=1, preavis_id=1, decision=1,
+            date_demande=self._day(5)))
+        transaction.commit()
+        self.assertEqual(self._overdue(45), [6, 7])
+        self.assertEqual(self.scheduler.stats(self._day(45))[1]['en_retard'],
+                         1)
+
+        # rolled back, then deleted
+        self.session.delete(self.session.query(Preavis).get(6))
+        self.session.flush()
+        transaction.abort()
+        self.assertEqual(self._overdue(45), [6, 7])
+        self.session.delete(self.session.query(Preavis).get(6))
+        transaction.commit()
+        self.assertEqual(self._overdue(45), [7])
+        self.assertNotIn(3, self.scheduler.stats(self._day(45)))
+
+        # the open preavis are those the database has
+        reloaded = type(self.scheduler)(delais={2: 60})
+        reloaded.load(self.session)
+        self.assertEqual(reloaded.overdue(self._day(61)),
+                         self.scheduler.overdue(self._day(61)))
+        self.assertEqual(reloaded.stats(self._day(61)),
+                         self.scheduler.stats(self._day(61)))
+
+    def test_heap_compaction(self):
+        from .services.preavis import Etat, PreavisScheduler
+
+        scheduler = PreavisScheduler()
+        for i in range(1000):
+            scheduler._add(i, Etat(1, 1, self._day(i % 50), None))
+        for i in range(990):
+            scheduler._remove(i, Etat(1, 1, self._day(i % 50), None))
+        self.assertLessEqual(len(scheduler._heap), 2 * 10 + 64)
+        self.assertEqual([i for i, _ in scheduler.overdue(self._day(100))],
+                         list(range(990, 1000)))
+
+    def test_views(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .views.preavis import (
+            preavis_retard_view,
+            preavis_statistiques_view,
+        )
+
+        request = dummy_request(self.session)
+        request.params = {'date': self._day(61).isoformat()}
+        info = preavis_retard_view(request)
+        self.assertEqual(info['total'], 3)
+        self.assertEqual(info['preavis'][0], {
+            'id': 4, 'affaire_id': 1, 'service_id': 1,
+            'date_demande': '2026-03-01', 'echeance': '2026-03-31',
+            'jours_retard': 31})
+
+        request.params = {'date': self._day(61).isoformat(),
+                          'service_id': '2'}
+        self.assertEqual([p['id'] for p in
+                          preavis_retard_view(request)['preavis']], [5])
+
+        request.params = {'date': self._day(61).isoformat()}
+        services = preavis_statistiques_view(request)['services']
+        self.assertEqual([(s['service'], s['en_retard']) for s in services],
+                         [('Cadastre', 1), ('Routes', 1), ('Eaux', 1)])
+
+        request.params = {'date': '1.3.2026'}
+        self.assertRaises(HTTPBadRequest, preavis_retard_view, request)
+
+    def test_rappels(self):
+        import email
+        import email.policy
+        import functools
+        from .models import Preavis
+        from .services.envoi import smtp_connect
+        from .services.preavis import envoyer_rappels
+
+        stand_in = SMTPStandIn()
+        self.addCleanup(stand_in.close)
+        connect = functools.partial(smtp_connect, '127.0.0.1', stand_in.port)
+
+        counts = envoyer_rappels(self.session_factory, self.scheduler,
+                                 connect, 'infolica@example.ch',
+                                 today=self._day(61))
+        self.assertEqual(dict(counts), {'services': 2, 'sans_adresse': 1,
+                                        'rejetes': 0, 'preavis': 2})
+        self.assertEqual(stand_in.connections, 1)
+        self.assertEqual(sorted(r for r, _ in stand_in.messages),
+                         [['cadastre@example.ch'], ['routes@example.ch']])
+        message = email.message_from_bytes(stand_in.messages[0][1],
+                                           policy=email.policy.default)
+        self.assertIn('affaire 1, demandé le 01.03.2026',
+                      message.get_content())
+        self.assertEqual(
+            sorted(self.session.query(Preavis.id, Preavis.date_rappel).filter(
+                Preavis.date_rappel.isnot(None))),
+            [(4, self._day(61)), (5, self._day(61))])
+
+        # not again before the interval
+        counts = envoyer_rappels(self.session_factory, self.scheduler,
+                                 connect, 'infolica@example.ch',
+                                 today=self._day(65))
+        self.assertEqual(counts['services'], 0)
+        counts = envoyer_rappels(self.session_factory, self.scheduler,
+                                 connect, 'infolica@example.ch',
+                                 today=self._day(68))
+        self.assertEqual(counts['preavis'], 2)
+
+    def test_job(self):
+        import json
+        import threading
+        from .models import Job
+        from .services.jobs import Worker, enqueue, worker_options
+
+        stand_in = SMTPStandIn()
+        self.addCleanup(stand_in.close)
+        job_id = enqueue(self.session, 'rappels_preavis').id
+        transaction.commit()
+        options = worker_options({
+            'mail.host': '127.0.0.1', 'mail.port': str(stand_in.port),
+            'preavis.delai.2': '60'})
+        Worker(self.session_factory, **options).run(
+            threading.Event(), once=True)
+        job = self.session.query(Job).get(job_id)
+        self.assertEqual(job.state, 'done')
+        # every preavis of 2026-03-01 is overdue today
+        self.assertEqual(json.loads(job.result)['preavis'], 2)
+        self.assertEqual(len(stand_in.messages), 2)
+
+
+class TestStatistiques(BaseTest):
+
+    def setUp(self):
+        super(TestStatistiques, self).setUp()
+        self.init_database()
+
+        from .scripts.benchmark import create_reference_data
+
+        create_reference_data(self.session)
+        self.session.flush()
+
+    def _affaire(self, id_, responsable_id, technicien_id, ouverture,
+                 cloture=None, type_id=1):
+        import datetime
+        from .models import Affaire
+
+        return Affaire(
+            id=id_, type_id=type_id, cadastre_id=1,
+            responsable_id=responsable_id, technicien_id=technicien_id,
+            date_ouverture=datetime.date(*ouverture),
+            date_cloture=datetime.date(*cloture) if cloture else None,
+            localisation_E=2561000, localisation_N=1205000)
+
+    def _rows(self):
+        from .models import StatistiqueMois, StatistiqueOperateur
+
+        ouvertes = {
+            row.operateur_id: (row.ouvertes_responsable,
+                               row.ouvertes_technicien)
+            for row in self.session.query(StatistiqueOperateur)
+            if row.ouvertes_responsable or row.ouvertes_technicien}
+        mois = {(row.operateur_id, row.mois.strftime('%Y-%m'), row.type_id):
+                (row.cloturees, row.jours)
+                for row in self.session.query(StatistiqueMois)
+                if row.cloturees}
+        return ouvertes, mois
+
+    def _assert_rebuild_agrees(self):
+        from .models.statistiques import rebuild_statistiques
+
+        rows = self._rows()
+        inserted, updated, _ = rebuild_statistiques(self.session)
+        self.assertEqual((inserted, updated), (0, 0))
+        self.assertEqual(self._rows(), rows)
+        self.assertEqual(rebuild_statistiques(self.session), (0, 0, 0))
+
+    def test_rollups_follow_changes(self):
+        from .models import Affaire
+
+        self.session.add_all([
+            self._affaire(1, 1, 2, (2026, 1, 5)),
+            self._affaire(2, 1, 1, (2026, 1, 5)),
+            self._affaire(3, 2, 1, (2026, 1, 1), (2026, 1, 21)),
+            self._affaire(4, 2, 1, (2026, 1, 1), (2026, 1, 31), type_id=2),
+        ])
+        self.session.flush()
+        self.assertEqual(self._rows(), (
+            {1: (2, 1), 2: (0, 1)},
+            {(2, '2026-01', 1): (1, 20), (2, '2026-01', 2): (1, 30)}))
+
+        # closed, then moved to another responsable and month
+        affaire = self.session.query(Affaire).get(1)
+        affaire.date_cloture = affaire.date_ouverture.replace(day=15)
+        self.session.flush()
+        affaire.responsable_id = 2
+        affaire.date_cloture = affaire.date_ouverture.replace(month=2)
+        self.session.flush()
+        self.assertEqual(self._rows(), (
+            {1: (1, 1)},
+            {(2, '2026-01', 1): (1, 20), (2, '2026-01', 2): (1, 30),
+             (2, '2026-02', 1): (1, 31)}))
+
+        # reopened, a value changed without being loaded, deleted
+        affaire.date_cloture = None
+        self.session.flush()
+        affaire = self.session.query(Affaire).get(2)
+        self.session.expire(affaire, ['technicien_id'])
+        affaire.technicien_id = 2
+        self.session.flush()
+        self.session.delete(self.session.query(Affaire).get(3))
+        self.session.flush()
+        self.assertEqual(self._rows(), (
+            {1: (1, 0), 2: (1, 2)}, {(2, '2026-01', 2): (1, 30)}))
+        self._assert_rebuild_agrees()
+
+    def test_rebuild_repairs_drift(self):
+        from .models import Affaire
+        from .models.statistiques import rebuild_statistiques
+
+        self.session.add_all([
+            self._affaire(1, 1, 2, (2026, 1, 5)),
+            self._affaire(2, 2, 2, (2026, 1, 1), (2026, 3, 1)),
+        ])
+        self.session.flush()
+        # bulk updates bypass the mapper events
+        self.session.query(Affaire).filter(Affaire.id == 1).update(
+            {'date_cloture': Affaire.date_ouverture},
+            synchronize_session=False)
+        self.assertEqual(rebuild_statistiques(self.session), (1, 0, 2))
+        self.assertEqual(self._rows(), ({}, {
+            (1, '2026-01', 1): (1, 0), (2, '2026-03', 1): (1, 59)}))
+        self.assertEqual(rebuild_statistiques(self.session), (0, 0, 0))
+
+    def test_views(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from .views.statistiques import (
+            statistiques_operateurs_view,
+            statistiques_types_view,
+        )
+
+        self.session.add_all([
+            self._affaire(1, 1, 2, (2026, 1, 5)),
+            self._affaire(2, 1, 1, (2026, 1, 1), (2026, 1, 11)),
+            self._affaire(3, 1, 2, (2026, 1, 1), (2026, 2, 1)),
+            self._affaire(4, 2, 1, (2026, 1, 1), (2026, 2, 21), type_id=2),
+        ])
+        self.session.flush()
+        request = dummy_request(self.session)
+        # read from the rollups whatever the number of affaires
+        with self.assertQueryCount(3):
+            operateurs = statistiques_operateurs_view(request)['operateurs']
+        self.assertEqual(operateurs[0], {
+            'operateur_id': 1, 'nom': 'Nom 1', 'prenom': 'Prenom 1',
+            'ouvertes_responsable': 1, 'ouvertes_technicien': 0,
+            'cloturees': 2, 'duree_moyenne': 20.5, 'mois': [
+                {'mois': '2026-01', 'cloturees': 1, 'duree_moyenne': 10.0},
+                {'mois': '2026-02', 'cloturees': 1, 'duree_moyenne': 31.0},
+            ]})
+        self.assertEqual(
+            [(o['operateur_id'], o['ouvertes_technicien'], o['cloturees'])
+             for o in operateurs], [(1, 0, 2), (2, 1, 1)])
+
+        request.params = {'debut': '2026-02', 'operateur_id': '1'}
+        operateurs = statistiques_operateurs_view(request)['operateurs']
+        self.assertEqual([(o['operateur_id'], o['cloturees'])
+                          for o in operateurs], [(1, 1)])
+
+        request.params = {'fin': '2026-02'}
+        types = statistiques_types_view(request)['types']
+        self.assertEqual([(t['type_id'], t['cloturees'], t['duree_moyenne'])
+                          for t in types], [(1, 2, 20.5), (2, 1, 51.0)])
+
+        request.params = {'debut': '2026-1-1'}
+        self.assertRaises(HTTPBadRequest, statistiques_types_view, request)
@@ -0,0 +1,366 @@
+import math
+
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPNotFound,
+    HTTPNotModified,
+)
+from pyramid.response import Response
+from pyramid.view import view_config
+from sqlalchemy import func
+
+from .. import models
+from ..models.hierarchie import path_to_root, subtree
+from ..services.detail import read_affaire_full
+from ..services.listing import (
+    FilterSet,
+    KeysetPaginator,
+    in_filter,
+    iter_json_page,
+    null_filter,
+    parse_date,
+)
+
+AFFAIRE_COLUMNS = [
+    models.Affaire.id,
+    models.Affaire.type_id,
+    models.Affaire.cadastre_id,
+    models.Affaire.responsable_id,
+    models.Affaire.technicien_id,
+    models.Affaire.information,
+    models.Affaire.date_ouverture,
+    models.Affaire.date_cloture,
+    models.Affaire.localisation_E,
+    models.Affaire.localisation_N,
+    models.AffaireStatutCourant.statut_id,
+]
+
+affaire_filters = FilterSet(
+    type_id=in_filter(models.Affaire.type_id),
+    cadastre_id=in_filter(models.Affaire.cadastre_id),
+    responsable_id=in_filter(models.Affaire.responsable_id),
+    technicien_id=in_filter(models.Affaire.technicien_id),
+    cloture=null_filter(models.Affaire.date_cloture),
+    statut_id=in_filter(models.AffaireStatutCourant.statut_id),
+)
+
+# tables read by the affaire detail views, for the response cache
+AFFAIRE_DETAIL_DEPENDS = (
+    models.Affaire,
+    models.AffaireNumero,
+    models.AffaireStatutCourant,
+    models.AffaireType,
+    models.Cadastre,
+    models.ClientEntreprise,
+    models.ClientPersonne,
+    models.EtapeAffaire,
+    models.Numero,
+    models.NumeroEtat,
+    models.NumeroType,
+    models.Operateur,
+    models.Preavis,
+    models.PreavisDecision,
+    models.PreavisType,
+    models.RelationAffaireClient,
+    models.RelationClientAffaireType,
+    models.Services,
+    models.StatutAffaire,
+)
+
+affaire_paginator = KeysetPaginator(
+    [models.Affaire.date_ouverture, models.Affaire.id], [parse_date, int])
+
+DEFAULT_LIMIT = 1000
+MAX_LIMIT = 10000
+
+
+def _float_param(request, name):
+    try:
+        value = float(request.params[name])
+    except KeyError:
+        raise HTTPBadRequest('Missing parameter: %s' % name)
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: %s' % name)
+    # inf and nan have no grid cell
+    if not math.isfinite(value):
+        raise HTTPBadRequest('Invalid parameter: %s' % name)
+    return value
+
+
+def _limit_param(request):
+    try:
+        limit = int(request.params.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: limit')
+    return max(0, min(limit, MAX_LIMIT))
+
+
+def _spatial_index(request):
+    index = request.registry['affaire_spatial_index']
+    models.ensure_loaded(request.registry, index)
+    return index
+
+
+def _operateur(operateur):
+    return {'id': operateur.id, 'nom': operateur.nom,
+            'prenom': operateur.prenom}
+
+
+def _client(client):
+    return {
+        'id': client.id,
+        'type': client.type,
+        'nom': getattr(client, 'nom', None),
+        'prenom': getattr(client, 'prenom', None),
+        'adresse': client.adresse,
+        'npa': client.npa,
+        'localite': client.localite,
+    }
+
+
+def affaires_query(dbsession):
+    """Affaire columns with their current status, for listings."""
+    return dbsession.query(*AFFAIRE_COLUMNS).select_from(
+        models.Affaire).outerjoin(
+            models.AffaireStatutCourant,
+            models.AffaireStatutCourant.affaire_id == models.Affaire.id)
+
+
+@view_config(route_name='affaires', request_method='GET',
+             cache_depends=(models.Affaire, models.AffaireStatutCourant,
+                            models.AffaireType, models.Cadastre,
+                            models.StatutAffaire))
+def affaires_view(request):
+    """
+    Page of affaires ordered by ``(date_ouverture, id)``.
+
+    Filters: ``type_id``, ``cadastre_id``, ``responsable_id`` and
+    ``technicien_id``, ``statut_id`` (comma separated ids) and
+    ``cloture`` (boolean).
+    Paging: ``limit``, ``order`` (``asc`` or ``desc``) and the ``cursor``
+    returned as ``next`` by the previous page.
+
+    """
+    if request.params.get('order', 'asc') not in ('asc', 'desc'):
+        raise HTTPBadRequest('Invalid parameter: order')
+    query = affaires_query(request.dbsession)
+    query = affaire_filters.apply(query, request.params)
+    rows, next_cursor = affaire_paginator.page(query, request.params)
+
+    # labels come from the lookup cache instead of joins
+    types = request.lookups.noms(models.AffaireType)
+    cadastres = request.lookups.noms(models.Cadastre)
+    statuts = request.lookups.noms(models.StatutAffaire)
+
+    def serialize(row):
+        affaire = row._asdict()
+        affaire['type'] = types.get(row.type_id)
+        affaire['cadastre'] = cadastres.get(row.cadastre_id)
+        affaire['statut'] = statuts.get(row.statut_id)
+        return affaire
+
+    return Response(
+        app_iter=iter_json_page('affaires', rows, next_cursor, serialize),
+        content_type='application/json',
+        charset='utf-8',
+    )
+
+
+@view_config(route_name='affaires_statuts', renderer='json',
+             cache_depends=(models.Affaire, models.AffaireStatutCourant,
+                            models.StatutAffaire))
+def affaires_statuts_view(request):
+    """
+    Number of affaires per current status, with the listing filters.
+
+    """
+    S = models.AffaireStatutCourant
+    query = request.dbsession.query(S.statut_id, func.count()).join(
+        models.Affaire, models.Affaire.id == S.affaire_id)
+    query = affaire_filters.apply(query, request.params)
+    counts = query.group_by(S.statut_id).order_by(S.statut_id)
+    statuts = request.lookups.noms(models.StatutAffaire)
+    return {'statuts': [
+        {'statut_id': statut_id, 'statut': statuts.get(statut_id),
+         'count': count}
+        for statut_id, count in counts]}
+
+
+@view_config(route_name='affaires_bbox', renderer='json',
+             cache_depends=(models.Affaire,))
+def affaires_bbox_view(request):
+    """
+    Affaires located inside ``bbox=minE,minN,maxE,maxN``.
+
+    """
+    try:
+        min_e, min_n, max_e, max_n = [
+            float(v) for v in request.params['bbox'].split(',')]
+    except KeyError:
+        raise HTTPBadRequest('Missing parameter: bbox')
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: bbox')
+    if not all(map(math.isfinite, (min_e, min_n, max_e, max_n))) or \
+            min_e > max_e or min_n > max_n:
+        raise HTTPBadRequest('Invalid parameter: bbox')
+    limit = _limit_param(request)
+
+    index = _spatial_index(request)
+    ids = index.bbox(min_e, min_n, max_e, max_n)
+    affaires = []
+    for id_ in ids[:limit]:
+        point = index.point(id_)
+        if point is None:
+            # removed since the search
+            continue
+        affaires.append({'id': id_, 'localisation_E': point[0],
+                         'localisation_N': point[1]})
+    return {'count': len(ids), 'affaires': affaires}
+
+
+@view_config(route_name='affaires_radius', renderer='json',
+             cache_depends=(models.Affaire,))
+def affaires_radius_view(request):
+    """
+    Affaires within ``r`` metres of ``e``, ``n``, nearest first.
+
+    """
+    e = _float_param(request, 'e')
+    n = _float_param(request, 'n')
+    r = _float_param(request, 'r')
+    if r < 0:
+        raise HTTPBadRequest('Invalid parameter: r')
+    limit = _limit_param(request)
+
+    index = _spatial_index(request)
+    found = index.radius(e, n, r)
+    affaires = []
+    for id_, distance in found[:limit]:
+        point = index.point(id_)
+        if point is None:
+            # removed since the search
+            continue
+        affaires.append({
+            'id': id_,
+            'localisation_E': point[0],
+            'localisation_N': point[1],
+            'distance': distance,
+        })
+    return {'count': len(found), 'affaires': affaires}
+
+
+@view_config(route_name='affaire_famille', renderer='json',
+             cache_depends=(models.ModificationAffaireHierarchie,))
+def affaire_famille_view(request):
+    """
+    Mother affaires up to the root and all daughter affaires of an affaire.
+
+    ``depth`` limits the descendants returned.
+
+    """
+    try:
+        affaire_id = int(request.matchdict['id'])
+    except ValueError:
+        raise HTTPBadRequest('Invalid affaire id')
+    depth = request.params.get('depth')
+    if depth is not None:
+        try:
+            depth = int(depth)
+        except ValueError:
+            raise HTTPBadRequest('Invalid parameter: depth')
+    descendants = subtree(request.dbsession, affaire_id, depth)
+    return {
+        'affaire_id': affaire_id,
+        'ancetres': [{'id': a, 'profondeur': d}
+                     for a, d in path_to_root(request.dbsession, affaire_id)],
+        'descendants': [{'id': a, 'profondeur': d} for a, d in descendants],
+    }
+
+
+def affaire_detail(affaire):
+    """JSON data of an affaire loaded with the ``affaire_detail`` profile."""
+    statut = affaire.statut_courant
+    return {
+        'id': affaire.id,
+        'type': affaire.type.nom,
+        'cadastre': affaire.cadastre.nom,
+        'responsable': _operateur(affaire.responsable),
+        'technicien': _operateur(affaire.technicien),
+        'information': affaire.information,
+        'date_ouverture': affaire.date_ouverture.isoformat(),
+        'date_cloture': (affaire.date_cloture.isoformat()
+                         if affaire.date_cloture else None),
+        'localisation_E': affaire.localisation_E,
+        'localisation_N': affaire.localisation_N,
+        'statut': statut.statut.nom if statut is not None else None,
+        'etapes': [{'statut': e.statut.nom, 'date': e.date.isoformat()}
+                   for e in affaire.etapes],
+        'clients': [dict(_client(r.client), relation=r.relation_type.nom)
+                    for r in affaire.clients],
+        'numeros': [{
+            'id': n.numero.id,
+            'numero': n.numero.numero,
+            'suffixe': n.numero.suffixe,
+            'type': n.numero.type.nom,
+            'etat': n.numero.etat.nom,
+            'modifie': n.modifie,
+        } for n in affaire.numeros],
+        'preavis': [{
+            'service': p.service.service,
+            'type': p.preavis_type.nom,
+            'decision': p.preavis_decision.nom,
+            'date_demande': p.date_demande.isoformat(),
+            'date_reponse': (p.date_reponse.isoformat()
+                             if p.date_reponse else None),
+        } for p in affaire.preavis],
+    }
+
+
+@view_config(route_name='affaire', renderer='json',
+             cache_depends=AFFAIRE_DETAIL_DEPENDS)
+def affaire_view(request):
+    """
+    An affaire with its operators, status history, clients, numeros and
+    preavis, read with a fixed number of queries.
+
+    """
+    try:
+        affaire_id = int(request.matchdict['id'])
+    except ValueError:
+        raise HTTPBadRequest('Invalid affaire id')
+    affaire = models.with_profile(
+        request.dbsession.query(models.Affaire), 'affaire_detail').filter(
+            models.Affaire.id == affaire_id).one_or_none()
+    if affaire is None:
+        raise HTTPNotFound()
+    return affaire_detail(affaire)
+
+
+@view_config(route_name='affaire_full', renderer='json')
+def affaire_full_view(request):
+    """
+    Everything shown on the detail page of an affaire.
+
+    The independent parts are read concurrently when the registry has a
+    reader pool.  The ETag is the affaire's last-change stamp, so a
+    matching ``If-None-Match`` is answered 304 without any query.
+
+    """
+    try:
+        affaire_id = int(request.matchdict['id'])
+    except ValueError:
+        raise HTTPBadRequest('Invalid affaire id')
+    registry = request.registry
+    # taken before reading, a commit during the reads changes it again
+    etag = registry['affaire_stamps'].stamp(affaire_id)
+    if etag in request.if_none_match:
+        return HTTPNotModified(etag=etag)
+    data = read_affaire_full(
+        request.dbsession, affaire_id,
+        executor=registry['affaire_detail_executor'],
+        session_factory=registry['dbsession_factory_ro'])
+    if data is None:
+        raise HTTPNotFound()
+    request.response.etag = etag
+    request.response.cache_control.no_cache = True
+    return data
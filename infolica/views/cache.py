@@ -0,0 +1,17 @@
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.view import view_config
+
+
+@view_config(route_name='response_cache_stats', renderer='json')
+def response_cache_stats_view(request):
+    """Hit, miss and size counters of the response cache."""
+    cache = request.registry.get('response_cache')
+    if cache is None:
+        raise HTTPNotFound()
+    stats = dict(cache.stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_ratio'] = stats['hits'] / lookups if lookups else None
+    stats['entries'] = len(cache)
+    stats['memory_size'] = cache.memory_size
+    stats['spilled_size'] = cache.spilled_size
+    return stats
@@ -0,0 +1,58 @@
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.view import view_config
+
+from .. import models
+from ..services.search import client_search_query
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+@view_config(route_name='clients_recherche', renderer='json',
+             cache_depends=(models.ClientEntreprise, models.ClientPersonne))
+def clients_recherche_view(request):
+    """
+    Clients matching ``q``, best first (at most ``limit``).
+
+    Matching ignores case and accents, completes the words being typed
+    and tolerates typos.
+
+    """
+    q = request.params.get('q', '').strip()
+    if not q:
+        raise HTTPBadRequest('Missing parameter: q')
+    try:
+        limit = int(request.params.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: limit')
+    limit = max(0, min(limit, MAX_LIMIT))
+
+    index = request.registry['client_search_index']
+    models.ensure_loaded(request.registry, index)
+    found = index.search(q, limit)
+    if not found:
+        return {'clients': []}
+
+    client = models.Client.__table__
+    rows = {
+        row.id: row for row in request.dbsession.execute(
+            client_search_query().column(client.c.type).where(
+                client.c.id.in_([id_ for id_, score in found])))
+    }
+    clients = []
+    for id_, score in found:
+        row = rows.get(id_)
+        # committed elsewhere after the index was loaded
+        if row is None:
+            continue
+        clients.append({
+            'id': id_,
+            'type': row.type,
+            'nom': row.nom,
+            'prenom': row.prenom,
+            'adresse': row.adresse,
+            'npa': row.npa,
+            'localite': row.localite,
+            'score': score,
+        })
+    return {'clients': clients}
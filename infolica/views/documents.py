@@ -0,0 +1,128 @@
+from urllib.parse import quote
+
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPNotFound,
+    HTTPNotModified,
+    HTTPRequestEntityTooLarge,
+    HTTPRequestRangeNotSatisfiable,
+)
+from pyramid.response import Response
+from pyramid.view import view_config
+from webob.byterange import ContentRange
+
+from .. import models
+from ..services.documents import DocumentTooLarge, FileRange, file_app_iter
+
+# browsers may keep a document this many seconds, its content never
+# changes
+MAX_AGE = 24 * 3600
+
+
+def _store(request):
+    store = request.registry.get('document_store')
+    if store is None:
+        raise HTTPNotFound()
+    return store
+
+
+def _document_json(document):
+    return {'id': document.id, 'nom': document.nom,
+            'type_contenu': document.type_contenu,
+            'taille': document.taille, 'sha256': document.sha256}
+
+
+@view_config(route_name='documents', request_method='POST', renderer='json')
+def document_upload_view(request):
+    """
+    Store the request body as a new document.
+
+    The body is the file itself, its ``Content-Type`` is kept; parameter
+    ``nom``: the file name.  Content already in the store is not written
+    again.
+
+    """
+    store = _store(request)
+    nom = request.GET.get('nom')
+    if not nom:
+        raise HTTPBadRequest('Missing parameter: nom')
+    max_size = request.registry.get('document_max_size')
+    if max_size is not None and (request.content_length or 0) > max_size:
+        raise HTTPRequestEntityTooLarge()
+    try:
+        digest, size, stored = store.write(request.body_file, max_size)
+    except DocumentTooLarge:
+        raise HTTPRequestEntityTooLarge()
+    document = models.Document(
+        chemin=store.relative_path(digest), nom=nom,
+        type_contenu=request.content_type or 'application/octet-stream',
+        taille=size, sha256=digest)
+    request.dbsession.add(document)
+    request.dbsession.flush()
+    request.response.status = 201
+    request.response.location = request.route_url('document', id=document.id)
+    return dict(_document_json(document), deja_stocke=not stored)
+
+
+@view_config(route_name='document_info', request_method='GET',
+             renderer='json')
+def document_info_view(request):
+    """Name, content type, size and digest of a stored document."""
+    return _document_json(_stored_document(request))
+
+
+def _stored_document(request):
+    try:
+        document_id = int(request.matchdict['id'])
+    except ValueError:
+        raise HTTPBadRequest('Invalid document id')
+    # read right after the POST answering its Location, a lagging replica
+    # would not know the document yet
+    document = request.primary_dbsession.query(models.Document).get(
+        document_id)
+    if document is None or document.sha256 is None:
+        raise HTTPNotFound()
+    return document
+
+
+@view_config(route_name='document', request_method='GET')
+def document_download_view(request):
+    """
+    The content of a stored document.
+
+    Its digest is its ETag: ``If-None-Match`` answers 304.  A single
+    byte ``Range`` answers 206 (unless ``If-Range`` does not match).  The
+    file is sent through the server's file wrapper, never read whole.
+
+    """
+    store = _store(request)
+    document = _stored_document(request)
+    response = Response(content_type=document.type_contenu, charset=None)
+    response.etag = document.sha256
+    response.accept_ranges = 'bytes'
+    response.cache_control = 'private, max-age=%d' % MAX_AGE
+    # an ASCII name for old clients, the UTF-8 one (RFC 6266) for others
+    response.content_disposition = (
+        'attachment; filename="%s"; filename*=UTF-8\'\'%s' % (
+            document.nom.encode('ascii', 'replace').decode().replace(
+                '"', ''), quote(document.nom)))
+    if document.sha256 in request.if_none_match:
+        return HTTPNotModified(headers={'ETag': response.headers['ETag']})
+
+    size = document.taille
+    start, stop = 0, size
+    byte_range = request.range
+    if byte_range is not None and response in request.if_range:
+        bounds = byte_range.range_for_length(size)
+        if bounds is None:
+            raise HTTPRequestRangeNotSatisfiable(
+                headers={'Content-Range': 'bytes */%d' % size})
+        start, stop = bounds
+        response.status = 206
+        response.content_range = ContentRange(start, stop, size)
+
+    f = store.open(document.sha256)
+    body = f if (start, stop) == (0, size) else FileRange(f, start, stop)
+    response.app_iter = file_app_iter(request.environ, body)
+    response.content_length = stop - start
+    return response
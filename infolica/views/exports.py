@@ -0,0 +1,104 @@
+import datetime
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.response import Response
+from pyramid.view import view_config
+from sqlalchemy import select
+
+from .. import models
+from ..services.export import FORMATS, iter_rows
+from .affaires import AFFAIRE_COLUMNS, affaire_filters, affaires_query
+
+
+def _int_param(request, name):
+    try:
+        return int(request.params[name])
+    except KeyError:
+        raise HTTPBadRequest('Missing parameter: %s' % name)
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: %s' % name)
+
+
+def _export(request, filename, header, rows):
+    """Stream ``rows`` in the ``format`` asked (``csv`` or ``xlsx``)."""
+    format_ = request.params.get('format', 'csv')
+    if format_ not in FORMATS:
+        raise HTTPBadRequest('Invalid parameter: format')
+    writer, content_type = FORMATS[format_]
+    response = Response(
+        app_iter=writer(header, rows),
+        content_type=content_type,
+        charset='utf-8' if format_ == 'csv' else None,
+    )
+    response.content_disposition = 'attachment; filename="%s.%s"' % (
+        filename, format_)
+    return response
+
+
+def _session_factory(request):
+    return request.registry['dbsession_factory_ro']
+
+
+@view_config(route_name='export_affaires', request_method='GET')
+def export_affaires_view(request):
+    """
+    All the affaires, ordered by ``(date_ouverture, id)``, with the
+    filters of the affaire listing.
+
+    """
+    query = affaire_filters.apply(
+        affaires_query(request.dbsession), request.params).order_by(
+            models.Affaire.date_ouverture, models.Affaire.id)
+    types = request.lookups.noms(models.AffaireType)
+    cadastres = request.lookups.noms(models.Cadastre)
+    statuts = request.lookups.noms(models.StatutAffaire)
+
+    def rows():
+        for row in iter_rows(_session_factory(request), query.statement):
+            yield tuple(row) + (types.get(row.type_id),
+                                cadastres.get(row.cadastre_id),
+                                statuts.get(row.statut_id))
+
+    header = [c.key for c in AFFAIRE_COLUMNS] + ['type', 'cadastre',
+                                                 'statut']
+    return _export(request, 'affaires', header, rows())
+
+
+@view_config(route_name='export_factures', request_method='GET')
+def export_factures_view(request):
+    """All the invoices dated in year ``annee``."""
+    annee = _int_param(request, 'annee')
+    if not datetime.MINYEAR <= annee <= datetime.MAXYEAR:
+        raise HTTPBadRequest('Invalid parameter: annee')
+    facture = models.Facture.__table__
+    partielle = models.FacturePartielle.__table__
+    columns = [facture.c.sap, facture.c.type, facture.c.affaire_id,
+               facture.c.client_id, facture.c.date, facture.c.montant_mo,
+               facture.c.montant_rf, facture.c.montant_mat_diff,
+               facture.c.montant_tva, facture.c.total, partielle.c.immeuble]
+    statement = select(columns).select_from(
+        facture.outerjoin(partielle, partielle.c.sap == facture.c.sap)
+    ).where(facture.c.date.between(
+        datetime.date(annee, 1, 1), datetime.date(annee, 12, 31))
+    ).order_by(facture.c.date, facture.c.sap)
+    return _export(request, 'factures_%d' % annee, [c.key for c in columns],
+                   iter_rows(_session_factory(request), statement))
+
+
+@view_config(route_name='export_numeros', request_method='GET')
+def export_numeros_view(request):
+    """All the numeros of cadastre ``cadastre_id``, with their state."""
+    cadastre_id = _int_param(request, 'cadastre_id')
+    numero = models.Numero.__table__
+    type_ = models.NumeroType.__table__
+    etat = models.NumeroEtat.__table__
+    columns = [numero.c.id, numero.c.numero, numero.c.suffixe,
+               type_.c.nom.label('type'), etat.c.nom.label('etat')]
+    statement = select(columns).select_from(
+        numero.join(type_, type_.c.id == numero.c.type_id)
+        .join(etat, etat.c.id == numero.c.etat_id)
+    ).where(numero.c.cadastre_id == cadastre_id).order_by(
+        numero.c.type_id, numero.c.numero, numero.c.suffixe)
+    return _export(request, 'numeros_%d' % cadastre_id,
+                   [c.key for c in columns],
+                   iter_rows(_session_factory(request), statement))
@@ -0,0 +1,73 @@
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.view import view_config
+
+from .. import models
+from ..models.job import STATES
+from ..services.jobs import KINDS, enqueue, job_status
+
+MAX_LIMIT = 500
+
+
+@view_config(route_name='jobs', request_method='POST', renderer='json')
+def job_create_view(request):
+    """
+    Queue a job.
+
+    JSON body: ``kind`` and optionally ``params``, an object given to the
+    job.  Answers 202 with the job, whose status is then at
+    ``/api/jobs/{id}``.
+
+    """
+    try:
+        body = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('Invalid JSON body')
+    if not isinstance(body, dict):
+        raise HTTPBadRequest('Invalid JSON body')
+    kind = body.get('kind')
+    if kind is None:
+        raise HTTPBadRequest('Missing field: kind')
+    if kind not in KINDS:
+        raise HTTPBadRequest('Invalid field: kind')
+    params = body.get('params', {})
+    if not isinstance(params, dict):
+        raise HTTPBadRequest('Invalid field: params')
+    job = enqueue(
+        request.dbsession, kind, params,
+        default_max_attempts=request.registry.get('job_max_attempts'))
+    request.response.status = 202
+    request.response.location = request.route_url('job', id=job.id)
+    return job_status(job)
+
+
+@view_config(route_name='jobs', request_method='GET', renderer='json')
+def jobs_view(request):
+    """The last ``limit`` queued jobs, optionally in ``state`` only."""
+    query = request.dbsession.query(models.Job)
+    state = request.params.get('state')
+    if state is not None:
+        if state not in STATES:
+            raise HTTPBadRequest('Invalid parameter: state')
+        query = query.filter(models.Job.state == state)
+    try:
+        limit = int(request.params.get('limit', 50))
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: limit')
+    limit = max(0, min(limit, MAX_LIMIT))
+    jobs = query.order_by(models.Job.id.desc()).limit(limit).all()
+    return {'jobs': [job_status(j) for j in jobs]}
+
+
+@view_config(route_name='job', request_method='GET', renderer='json')
+def job_view(request):
+    """State, progress and result of a job."""
+    try:
+        job_id = int(request.matchdict['id'])
+    except ValueError:
+        raise HTTPBadRequest('Invalid job id')
+    # polled right after the POST answering its Location, a lagging
+    # replica would not know the job yet
+    job = request.primary_dbsession.query(models.Job).get(job_id)
+    if job is None:
+        raise HTTPNotFound()
+    return job_status(job)
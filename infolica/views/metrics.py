@@ -0,0 +1,76 @@
+from pyramid.response import Response
+from pyramid.view import view_config
+
+from ..models import pool_status
+
+PREFIX = 'infolica_'
+
+HELP = {
+    'duration': ('request_duration_seconds', 'Time to answer requests'),
+    'sql_count': ('request_sql_statements', 'SQL statements per request'),
+    'sql_time': ('request_sql_seconds', 'Time in SQL statements per request'),
+    'view_time': ('request_view_seconds', 'Time in the view callable'),
+    'render_time': ('request_render_seconds', 'Time rendering the response'),
+    'commit_time': ('request_commit_seconds', 'Time committing'),
+}
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _bound(value):
+    return '+Inf' if value == float('inf') else repr(value)
+
+
+def request_metric_lines(snapshot, window):
+    """Prometheus text lines of ``RequestMetrics.snapshot()``."""
+    lines = []
+    for series, (name, text) in HELP.items():
+        name = PREFIX + name
+        # counts of the last window only, so not a Prometheus counter
+        lines.append('# HELP %s %s, over the last %gs' % (name, text, window))
+        lines.append('# TYPE %s histogram' % name)
+        for route_name in sorted(snapshot, key=str):
+            histogram = snapshot[route_name][series]
+            route = _label(route_name or '')
+            for bound, count in histogram['buckets']:
+                lines.append('%s_bucket{route="%s",le="%s"} %d' % (
+                    name, route, _bound(bound), count))
+            lines.append('%s_sum{route="%s"} %r' % (
+                name, route, histogram['sum']))
+            lines.append('%s_count{route="%s"} %d' % (
+                name, route, histogram['count']))
+    return lines
+
+
+def _gauges(lines, name, values, labels):
+    for key, value in sorted(values.items()):
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append('%s%s_%s{%s} %r' % (PREFIX, name, key, labels, value))
+
+
+@view_config(route_name='metrics')
+def metrics_view(request):
+    """Request histograms, pool and response cache counters for Prometheus."""
+    registry = request.registry
+    metrics = registry['request_metrics']
+    lines = request_metric_lines(metrics.snapshot(), metrics.window)
+
+    primary = registry['dbsession_factory']
+    replica = registry['dbsession_factory_ro']
+    _gauges(lines, 'pool', pool_status(primary.kw['bind']),
+            'database="primary"')
+    if replica is not primary:
+        _gauges(lines, 'pool', pool_status(replica.kw['bind']),
+                'database="replica"')
+
+    cache = registry.get('response_cache')
+    if cache is not None:
+        stats = dict(cache.stats, entries=len(cache),
+                     memory_size=cache.memory_size,
+                     spilled_size=cache.spilled_size)
+        _gauges(lines, 'response_cache', stats, '')
+
+    return Response('\n'.join(lines) + '\n',
+                    content_type='text/plain', charset='utf-8')
@@ -0,0 +1,86 @@
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.view import view_config
+
+from .. import models
+from ..services.lineage import DIRECTIONS, lineage
+from ..services.numeros import reserve_numeros
+
+
+def _int_field(body, name, default=None):
+    value = body.get(name, default)
+    if value is None:
+        raise HTTPBadRequest('Missing field: %s' % name)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise HTTPBadRequest('Invalid field: %s' % name)
+
+
+@view_config(route_name='numeros_reservations', request_method='POST',
+             renderer='json')
+def numeros_reservation_view(request):
+    """
+    Reserve consecutive numbers.
+
+    JSON body: ``cadastre_id``, ``type_id``, ``nombre`` and optionally
+    ``etat_id`` (defaults to the ``numeros.etat_reserve_id`` setting).
+
+    """
+    try:
+        body = request.json_body
+    except ValueError:
+        raise HTTPBadRequest('Invalid JSON body')
+    if not isinstance(body, dict):
+        raise HTTPBadRequest('Invalid JSON body')
+    settings = request.registry.settings
+    cadastre_id = _int_field(body, 'cadastre_id')
+    type_id = _int_field(body, 'type_id')
+    nombre = _int_field(body, 'nombre')
+    etat_id = _int_field(
+        body, 'etat_id', settings.get('numeros.etat_reserve_id'))
+    try:
+        numeros = reserve_numeros(
+            request.dbsession, cadastre_id, type_id, nombre, etat_id)
+    except ValueError as e:
+        raise HTTPBadRequest(str(e))
+    request.response.status = 201
+    return {'numeros': [
+        {'id': n.id, 'cadastre_id': n.cadastre_id, 'type_id': n.type_id,
+         'numero': n.numero, 'etat_id': n.etat_id}
+        for n in numeros]}
+
+
+@view_config(route_name='numero_lineage', request_method='GET',
+             renderer='json',
+             cache_depends=(models.Numero, models.NumeroRelation))
+def numero_lineage_view(request):
+    """
+    Lineage of a numero through its relations.
+
+    Parameters: ``direction`` (``descendants``, ``ancestors`` or ``both``)
+    and ``depth`` to limit the neighbourhood.
+
+    """
+    try:
+        numero_id = int(request.matchdict['id'])
+    except ValueError:
+        raise HTTPBadRequest('Invalid numero id')
+    direction = request.params.get('direction', 'descendants')
+    if direction not in DIRECTIONS:
+        raise HTTPBadRequest('Invalid parameter: direction')
+    try:
+        depth = int(request.params.get('depth', 0)) or None
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: depth')
+    if depth is not None and depth < 0:
+        raise HTTPBadRequest('Invalid parameter: depth')
+
+    cache = request.registry.get('numero_lineage_cache')
+    if cache is not None:
+        # synced from the commits of the primary, a lagging replica would
+        # leave it stale until the next change
+        result = cache.lineage(
+            request.primary_dbsession, numero_id, direction, depth)
+    else:
+        result = lineage(request.dbsession, numero_id, direction, depth)
+    return result.as_dict()
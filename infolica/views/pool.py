@@ -0,0 +1,16 @@
+from pyramid.view import view_config
+
+from ..models import pool_status
+
+
+@view_config(route_name='pool_stats', renderer='json')
+def pool_stats_view(request):
+    """Use and wait counters of the connection pools."""
+    registry = request.registry
+    primary = registry['dbsession_factory']
+    replica = registry['dbsession_factory_ro']
+    return {
+        'primary': pool_status(primary.kw['bind']),
+        'replica': (pool_status(replica.kw['bind'])
+                    if replica is not primary else None),
+    }
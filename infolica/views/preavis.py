@@ -0,0 +1,77 @@
+import datetime
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.view import view_config
+
+from .. import models
+from ..services.listing import parse_date
+
+
+def _scheduler(request):
+    scheduler = request.registry['preavis_scheduler']
+    models.ensure_loaded(request.registry, scheduler)
+    return scheduler
+
+
+def _today(request):
+    date = request.params.get('date')
+    if date is None:
+        return datetime.date.today()
+    try:
+        return parse_date(date)
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: date')
+
+
+@view_config(route_name='preavis_retard', request_method='GET',
+             renderer='json')
+def preavis_retard_view(request):
+    """
+    The unanswered preavis past their due date (on ``date``, today by
+    default), the most late first, of ``service_id`` only when given.
+
+    """
+    today = _today(request)
+    try:
+        service_id = request.params.get('service_id')
+        service_id = int(service_id) if service_id is not None else None
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: service_id')
+    try:
+        limit = int(request.params.get('limit', 500))
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: limit')
+    overdue = _scheduler(request).overdue(today)
+    if service_id is not None:
+        overdue = [(i, o) for i, o in overdue if o.service_id == service_id]
+    return {
+        'total': len(overdue),
+        'preavis': [{
+            'id': id_,
+            'affaire_id': ouvert.affaire_id,
+            'service_id': ouvert.service_id,
+            'date_demande': ouvert.date_demande.isoformat(),
+            'echeance': ouvert.echeance.isoformat(),
+            'jours_retard': (today - ouvert.echeance).days,
+        } for id_, ouvert in overdue[:max(limit, 0)]],
+    }
+
+
+@view_config(route_name='preavis_statistiques', request_method='GET',
+             renderer='json')
+def preavis_statistiques_view(request):
+    """
+    By service: unanswered and overdue preavis, answered ones and their
+    mean days to answer.
+
+    """
+    today = _today(request)
+    stats = _scheduler(request).stats(today)
+    names = dict(request.dbsession.query(
+        models.Services.id, models.Services.service).filter(
+            models.Services.id.in_(list(stats))).all()) if stats else {}
+    return {'services': [
+        dict(stats[service_id], service_id=service_id,
+             service=names.get(service_id))
+        for service_id in sorted(stats)
+    ]}
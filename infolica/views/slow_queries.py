@@ -0,0 +1,19 @@
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
+from pyramid.view import view_config
+
+
+@view_config(route_name='slow_queries', renderer='json')
+def slow_queries_view(request):
+    """The last slow statements with their plan, most recent first."""
+    slow_queries = request.registry.get('slow_queries')
+    if slow_queries is None:
+        raise HTTPNotFound()
+    try:
+        limit = int(request.params.get('limit', 50))
+    except ValueError:
+        raise HTTPBadRequest('Invalid parameter: limit')
+    return {
+        'threshold': slow_queries.threshold,
+        'count': slow_queries.count,
+        'records': slow_queries.recent(max(limit, 0)),
+    }
@@ -0,0 +1,117 @@
+import datetime
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.view import view_config
+from sqlalchemy import func
+
+from .. import models
+from ..services.listing import FilterSet, in_filter
+
+
+def parse_month(value):
+    return datetime.datetime.strptime(value, '%Y-%m').date()
+
+
+def _month_filter(column, compare):
+    def criterion(value):
+        return compare(column, parse_month(value))
+    return criterion
+
+
+mois_filters = FilterSet(
+    operateur_id=in_filter(models.StatistiqueMois.operateur_id),
+    type_id=in_filter(models.StatistiqueMois.type_id),
+    debut=_month_filter(models.StatistiqueMois.mois,
+                        lambda column, month: column >= month),
+    fin=_month_filter(models.StatistiqueMois.mois,
+                      lambda column, month: column <= month),
+)
+
+
+def _moyenne(jours, cloturees):
+    return round(jours / cloturees, 1) if cloturees else None
+
+
+@view_config(route_name='statistiques_operateurs', renderer='json',
+             cache_depends=(models.StatistiqueOperateur,
+                            models.StatistiqueMois, models.Operateur))
+def statistiques_operateurs_view(request):
+    """
+    Workload of each operator: open affaires as responsable and as
+    technicien, affaires closed as responsable by month and their mean
+    days from opening to closing.
+
+    Filters: ``operateur_id``, ``type_id`` (comma separated ids) and the
+    months ``debut`` and ``fin`` (``YYYY-MM``) of the closed affaires.
+    Read from the rollups, the cost depends on the number of operators
+    and months, not of affaires.
+
+    """
+    S = models.StatistiqueMois
+    query = request.dbsession.query(
+        S.operateur_id, S.mois, func.sum(S.cloturees), func.sum(S.jours))
+    query = mois_filters.apply(query, request.params)
+    mois = {}
+    for operateur_id, month, cloturees, jours in query.group_by(
+            S.operateur_id, S.mois).order_by(S.operateur_id, S.mois):
+        mois.setdefault(operateur_id, []).append((month, cloturees, jours))
+
+    Op = models.StatistiqueOperateur
+    query = request.dbsession.query(
+        Op.operateur_id, Op.ouvertes_responsable, Op.ouvertes_technicien)
+    operateur_ids = request.params.get('operateur_id')
+    if operateur_ids:
+        try:
+            query = query.filter(in_filter(Op.operateur_id)(operateur_ids))
+        except ValueError:
+            raise HTTPBadRequest('Invalid parameter: operateur_id')
+    ouvertes = {row.operateur_id: row for row in query}
+
+    ids = sorted(set(mois) | {k for k, row in ouvertes.items()
+                              if row.ouvertes_responsable or
+                              row.ouvertes_technicien})
+    noms = {row.id: row for row in request.dbsession.query(
+        models.Operateur.id, models.Operateur.nom,
+        models.Operateur.prenom).filter(
+            models.Operateur.id.in_(ids))} if ids else {}
+
+    def serialize(operateur_id):
+        operateur = noms.get(operateur_id)
+        row = ouvertes.get(operateur_id)
+        months = mois.get(operateur_id, [])
+        cloturees = sum(m[1] for m in months)
+        return {
+            'operateur_id': operateur_id,
+            'nom': operateur.nom if operateur else None,
+            'prenom': operateur.prenom if operateur else None,
+            'ouvertes_responsable': row.ouvertes_responsable if row else 0,
+            'ouvertes_technicien': row.ouvertes_technicien if row else 0,
+            'cloturees': cloturees,
+            'duree_moyenne': _moyenne(sum(m[2] for m in months), cloturees),
+            'mois': [{'mois': month.strftime('%Y-%m'), 'cloturees': n,
+                      'duree_moyenne': _moyenne(jours, n)}
+                     for month, n, jours in months if n],
+        }
+
+    return {'operateurs': [serialize(i) for i in ids]}
+
+
+@view_config(route_name='statistiques_types', renderer='json',
+             cache_depends=(models.StatistiqueMois, models.AffaireType))
+def statistiques_types_view(request):
+    """
+    Affaires closed by type and their mean days from opening to closing,
+    with the filters of the operators' statistics.
+
+    """
+    S = models.StatistiqueMois
+    query = request.dbsession.query(
+        S.type_id, func.sum(S.cloturees), func.sum(S.jours))
+    query = mois_filters.apply(query, request.params)
+    types = request.lookups.noms(models.AffaireType)
+    return {'types': [
+        {'type_id': type_id, 'type': types.get(type_id),
+         'cloturees': cloturees, 'duree_moyenne': _moyenne(jours, cloturees)}
+        for type_id, cloturees, jours in query.group_by(S.type_id).order_by(
+            S.type_id)
+        if cloturees]}
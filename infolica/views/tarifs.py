@@ -0,0 +1,38 @@
+import datetime
+
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.view import view_config
+
+from .. import models
+
+
+def _row(row):
+    if row is None:
+        return None
+    return {k: v.isoformat() if isinstance(v, datetime.date) else v
+            for k, v in row._asdict().items()}
+
+
+@view_config(route_name='tarifs', renderer='json',
+             cache_depends=(models.EmolumentsMOParametres,
+                            models.EmolumentsRFParametres))
+def tarifs_view(request):
+    """
+    Fee parameters valid at ``date`` (``YYYY-MM-DD``, defaults to today).
+
+    """
+    date = datetime.date.today()
+    if request.params.get('date'):
+        try:
+            date = datetime.datetime.strptime(
+                request.params['date'], '%Y-%m-%d').date()
+        except ValueError:
+            raise HTTPBadRequest('Invalid parameter: date')
+    tarifs = request.registry['tarifs']
+    # the cache is synced from the commits of the primary
+    dbsession = request.primary_dbsession
+    return {
+        'date': date.isoformat(),
+        'mo': _row(tarifs.mo.valid_at(dbsession, date)),
+        'rf': _row(tarifs.rf.valid_at(dbsession, date)),
+    }
@@ -26,6 +26,7 @@ tests_require = [
     'WebTest >= 1.3.1',  # py3 compat
     'pytest >= 3.7.4',
     'pytest-cov',
+    'pytest-benchmark',
 ]
 
 setup(
@@ -56,6 +57,12 @@ setup(
         ],
         'console_scripts': [
             'initialize_infolica_db=infolica.scripts.initialize_db:main',
+            'run_infolica_jobs=infolica.scripts.worker:main',
+            'generate_infolica_data=infolica.scripts.generate_data:main',
+            'import_infolica_cadastre=infolica.scripts.import_cadastre:main',
+            'benchmark_infolica=infolica.scripts.benchmark:main',
+            'rebuild_infolica=infolica.scripts.rebuild:main',
+            'index_audit_infolica=infolica.scripts.index_audit:main',
         ],
     },
 )